@@ -0,0 +1,66 @@
+"""
+資料庫連線預算檢查
+
+在 migrate / check 時執行（entrypoint 啟動前會先 migrate），
+確認所有 worker（含評分 worker）的連線池上限加總不會超過 PostgreSQL max_connections。
+"""
+
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+from django.db import connections
+
+
+def get_connections_per_process() -> int:
+    """每個 worker process 最多會使用的連線數（Django、checkpoint 與 thread 鎖連線池）"""
+    from .langgraph.checkpointer import get_sync_pool_max_size
+
+    total = (
+        settings.DJANGO_DB_POOL_MAX_SIZE
+        + get_sync_pool_max_size()
+        + settings.THREAD_LOCK_POOL_MAX_SIZE
+    )
+    if settings.ASYNC_VIEWS_ENABLED:
+        total += settings.CHECKPOINT_POOL_MAX_SIZE
+    return total
+
+
+@register()
+def check_connection_budget(app_configs, **kwargs):
+    """檢查設定的連線池大小是否符合連線預算"""
+    required = (
+        settings.DB_PROCESSES * get_connections_per_process() + settings.DB_RESERVED_CONNECTIONS
+    )
+    if required > settings.DB_MAX_CONNECTIONS:
+        return [
+            Error(
+                f'Database connection budget exceeded: {settings.DB_PROCESSES} processes × '
+                f'{get_connections_per_process()} connections + '
+                f'{settings.DB_RESERVED_CONNECTIONS} reserved = {required} '
+                f'> DB_MAX_CONNECTIONS={settings.DB_MAX_CONNECTIONS}',
+                hint='Reduce WEB_WORKERS / WEB_THREADS or raise DB_MAX_CONNECTIONS.',
+                id='chatbot.E001',
+            )
+        ]
+    return []
+
+
+@register(Tags.database)
+def check_server_max_connections(app_configs, databases=None, **kwargs):
+    """檢查 PostgreSQL 實際的 max_connections 是否不小於 DB_MAX_CONNECTIONS"""
+    if not databases or 'default' not in databases:
+        return []
+
+    with connections['default'].cursor() as cursor:
+        cursor.execute('SHOW max_connections')
+        server_max_connections = int(cursor.fetchone()[0])
+
+    if server_max_connections < settings.DB_MAX_CONNECTIONS:
+        return [
+            Error(
+                f'PostgreSQL max_connections={server_max_connections} is lower than '
+                f'DB_MAX_CONNECTIONS={settings.DB_MAX_CONNECTIONS}',
+                hint='Set DB_MAX_CONNECTIONS to the server max_connections value.',
+                id='chatbot.E002',
+            )
+        ]
+    return []
@@ -0,0 +1,332 @@
+"""
+POST 請求去重（Idempotency）
+
+連點兩次或前端重試時，相同的 chat / feedback 請求會在同一個 LangGraph thread 上
+重複執行完整的 LLM 流程（重複扣評分次數、對話歷史出現重複的回合）。
+idempotent decorator 為請求計算 key：
+- 優先使用 Idempotency-Key header
+- 沒有 header 時由 request 欄位推導（例如 map_id、message、user_action_id）
+第一個請求在 IdempotentRequest 表佔用 key 後執行，相同 key 的請求（可能在其他 worker）
+等待其完成並回傳相同的回應；成功的回應保留 IDEMPOTENCY_TTL_SECONDS，期間的重試直接回傳。
+執行失敗（非 2xx）時刪除紀錄，之後的重試會重新執行。
+串流回應（SSE）無法重播，串流結束後才完成：保存 view 以 set_stream_result 記錄的最終結果，
+重試時回傳該結果；串流中斷或最終結果失敗時刪除紀錄。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from datetime import timedelta
+from functools import wraps
+from inspect import iscoroutinefunction
+from typing import Optional, Sequence, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotentRequest
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+# 重播儲存的回應時加上的 response header
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+# 串流回應的最終結果（set_stream_result 設定）
+_STREAM_RESULT_ATTR = 'idempotent_result'
+
+# 等待相同請求完成時查詢資料庫的間隔（秒）
+_POLL_INTERVAL_SECONDS = 0.5
+
+# 每寫入幾筆清理一次過期資料
+_PURGE_INTERVAL = 500
+
+# _claim 的結果
+_OWNER = 'owner'
+_WAIT = 'wait'
+_REPLAY = 'replay'
+
+
+def make_request_key(
+    scope: str,
+    user_id,
+    header_key: Optional[str],
+    data,
+    fields: Sequence[str],
+    required: Optional[str] = None,
+) -> Optional[str]:
+    """
+    計算請求的 idempotency key
+
+    Args:
+        scope: 請求種類（例如 mindmap_chat），不同 endpoint 的 key 互不影響
+        user_id: 使用者 id
+        header_key: Idempotency-Key header 的值
+        data: request body
+        fields: 沒有 header 時用來推導 key 的欄位
+        required: 推導 key 時必須有值的欄位（例如每次送出都不同的 user_action_id），
+                  缺少時不推導，避免把刻意重複的請求當成重試
+
+    Returns:
+        str | None: 無法取得 key 時回傳 None（不去重）
+    """
+    if header_key:
+        source = f'header\n{header_key}'
+    else:
+        if required is not None and data.get(required) in (None, ''):
+            return None
+        values = {field: data.get(field) for field in fields}
+        source = 'body\n' + json.dumps(values, ensure_ascii=False, sort_keys=True, default=str)
+
+    raw_key = f'{scope}\n{user_id}\n{source}'
+    return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+
+class IdempotencyStore:
+    """IdempotentRequest 表的存取（跨 worker 共用）"""
+
+    def __init__(self):
+        self._writes = 0
+
+    def claim(self, key: str, scope: str) -> Tuple[str, Optional[IdempotentRequest]]:
+        """
+        嘗試佔用 key
+
+        Returns:
+            tuple: ('owner', None) 由呼叫端執行；('wait', record) 相同請求執行中；
+                   ('replay', record) 已有完成的回應
+        """
+        now = timezone.now()
+        pending_until = now + timedelta(seconds=settings.IDEMPOTENCY_LOCK_SECONDS)
+
+        try:
+            with transaction.atomic():
+                IdempotentRequest.objects.create(key=key, scope=scope, expires_at=pending_until)
+            return _OWNER, None
+        except IntegrityError:
+            pass
+
+        # 過期的紀錄（回應已超過保留期限，或執行中的 worker 已中斷）由條件更新接手，只有一個請求會成功
+        taken_over = IdempotentRequest.objects.filter(key=key, expires_at__lte=now).update(
+            status=IdempotentRequest.STATUS_PENDING,
+            status_code=None,
+            response=None,
+            expires_at=pending_until,
+        )
+        if taken_over:
+            return _OWNER, None
+
+        record = IdempotentRequest.objects.filter(key=key).first()
+        if record is None:
+            # 剛被刪除（前一個請求失敗），下次查詢時重新佔用
+            return _WAIT, None
+        if record.status == IdempotentRequest.STATUS_COMPLETED:
+            return _REPLAY, record
+        return _WAIT, record
+
+    def complete(self, key: str, response: Response):
+        """儲存成功的回應；失敗的回應刪除紀錄，讓重試重新執行"""
+        if not status.is_success(response.status_code):
+            IdempotentRequest.objects.filter(key=key).delete()
+            return
+
+        IdempotentRequest.objects.filter(key=key).update(
+            status=IdempotentRequest.STATUS_COMPLETED,
+            status_code=response.status_code,
+            response=response.data,
+            expires_at=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_TTL_SECONDS),
+        )
+        self._purge_expired()
+
+    def release(self, key: str):
+        """view 拋出例外時刪除紀錄"""
+        IdempotentRequest.objects.filter(key=key).delete()
+
+    def _purge_expired(self):
+        """定期刪除過期資料，避免資料表無限成長"""
+        self._writes += 1
+        if self._writes % _PURGE_INTERVAL:
+            return
+        deleted, _ = IdempotentRequest.objects.filter(expires_at__lte=timezone.now()).delete()
+        logger.info(f'Idempotency store purged: {deleted} expired requests')
+
+
+idempotency_store = IdempotencyStore()
+
+
+def _replay(record: IdempotentRequest) -> Response:
+    logger.info(f'Idempotent request replayed: {record}')
+    response = Response(record.response, status=record.status_code)
+    response[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def set_stream_result(response, result: dict):
+    """串流 view 送出最終結果時呼叫，串流結束後由 idempotent 保存（成功時重試直接回傳該結果）"""
+    setattr(response, _STREAM_RESULT_ATTR, result)
+
+
+def _finish(key: str, response, completed: bool = True):
+    """view 完成後保存回應（串流回應保存最終結果），未完成時刪除紀錄"""
+    try:
+        if not getattr(response, 'streaming', False):
+            idempotency_store.complete(key, response)
+            return
+        result = getattr(response, _STREAM_RESULT_ATTR, None)
+        if completed and result is not None and result.get('success'):
+            idempotency_store.complete(key, Response(result))
+        else:
+            idempotency_store.release(key)
+    except Exception as e:
+        logger.warning(f'Idempotency store write failed: {str(e)[:100]}')
+
+
+def _track_stream(key: str, response):
+    """串流結束（或中斷）時才完成 key，期間相同請求等待或回傳 409"""
+    content = response.streaming_content
+
+    if response.is_async:
+
+        async def async_content():
+            completed = False
+            try:
+                async for chunk in content:
+                    yield chunk
+                completed = True
+            finally:
+                await sync_to_async(_finish)(key, response, completed)
+
+        response.streaming_content = async_content()
+        return response
+
+    def sync_content():
+        completed = False
+        try:
+            yield from content
+            completed = True
+        finally:
+            _finish(key, response, completed)
+
+    response.streaming_content = sync_content()
+    return response
+
+
+def _in_progress() -> Response:
+    return Response(
+        {'success': False, 'error': 'The same request is still being processed'},
+        status=status.HTTP_409_CONFLICT,
+    )
+
+
+def idempotent(scope: str, fields: Sequence[str], required: Optional[str] = None):
+    """
+    去重 decorator：相同 key 的請求只執行一次
+
+    使用方式（放在 require_map_owner 之後，確認權限後才佔用 key）：
+        @api_view(['POST'])
+        @require_map_owner
+        @idempotent('chat', fields=('map_id', 'message', 'user_action_id'), required='user_action_id')
+        def chat(request, chat_type):
+            ...
+
+    Args:
+        scope: 請求種類，URL 參數 chat_type 存在時併入（例如 mindmap_chat）
+        fields / required: 沒有 Idempotency-Key header 時推導 key 的方式，見 make_request_key
+    """
+
+    def get_key(request, kwargs) -> Tuple[Optional[str], str]:
+        full_scope = f'{kwargs["chat_type"]}_{scope}' if 'chat_type' in kwargs else scope
+        if not settings.IDEMPOTENCY_ENABLED:
+            return None, full_scope
+        key = make_request_key(
+            full_scope,
+            request.user.id,
+            request.headers.get(IDEMPOTENCY_HEADER),
+            request.data,
+            fields,
+            required,
+        )
+        return key, full_scope
+
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+
+            @wraps(view_func)
+            async def async_wrapper(request, *args, **kwargs):
+                key, full_scope = get_key(request, kwargs)
+                if key is None:
+                    return await view_func(request, *args, **kwargs)
+
+                deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+                while True:
+                    try:
+                        outcome, record = await sync_to_async(idempotency_store.claim)(
+                            key, full_scope
+                        )
+                    except Exception as e:
+                        # 資料庫異常時不去重，照常處理請求
+                        logger.warning(f'Idempotency claim failed: {str(e)[:100]}')
+                        return await view_func(request, *args, **kwargs)
+
+                    if outcome == _REPLAY:
+                        return _replay(record)
+                    if outcome == _OWNER:
+                        break
+                    if time.monotonic() > deadline:
+                        return _in_progress()
+                    await asyncio.sleep(_POLL_INTERVAL_SECONDS)
+
+                try:
+                    response = await view_func(request, *args, **kwargs)
+                except BaseException:
+                    await sync_to_async(idempotency_store.release)(key)
+                    raise
+                if getattr(response, 'streaming', False):
+                    return _track_stream(key, response)
+                await sync_to_async(_finish)(key, response)
+                return response
+
+            return async_wrapper
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            key, full_scope = get_key(request, kwargs)
+            if key is None:
+                return view_func(request, *args, **kwargs)
+
+            deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+            while True:
+                try:
+                    outcome, record = idempotency_store.claim(key, full_scope)
+                except Exception as e:
+                    logger.warning(f'Idempotency claim failed: {str(e)[:100]}')
+                    return view_func(request, *args, **kwargs)
+
+                if outcome == _REPLAY:
+                    return _replay(record)
+                if outcome == _OWNER:
+                    break
+                if time.monotonic() > deadline:
+                    return _in_progress()
+                time.sleep(_POLL_INTERVAL_SECONDS)
+
+            try:
+                response = view_func(request, *args, **kwargs)
+            except BaseException:
+                idempotency_store.release(key)
+                raise
+            if getattr(response, 'streaming', False):
+                return _track_stream(key, response)
+            _finish(key, response)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,157 @@
+"""
+LangGraph checkpoint 的保留與清理
+
+PostgresSaver 會保留每個 thread 的所有中間 checkpoint（每輪對話數個），但讀取歷史與繼續對話
+只需要最新的 checkpoint。此模組以小批次刪除：
+- 每個 thread 只保留最新的 checkpoint 與最近 keep 個歷史 checkpoint
+- 已不屬於任何 checkpoint 的 checkpoint_writes
+- 未被任何 checkpoint 的 channel_versions 參照的 checkpoint_blobs；
+  版本新於 thread 目前參照的最新版本者可能是寫入中的 checkpoint，不刪除；
+  差異 blob 的錨點（見 delta_saver）在參照它的差異刪除後，於下一次執行時才刪除
+- 封存：刪除 thread 的所有 checkpoint，只保留對話歷史投影（ChatHistoryThread / ChatHistoryMessage）
+每次只處理一批 thread，每個語句各自提交，不會長時間持有鎖。
+"""
+
+import logging
+from typing import Dict, List
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+_DELETE_OLD_CHECKPOINTS_SQL = """
+DELETE FROM checkpoints c
+USING (
+    SELECT thread_id, checkpoint_ns, checkpoint_id
+    FROM (
+        SELECT
+            thread_id,
+            checkpoint_ns,
+            checkpoint_id,
+            row_number() OVER (
+                PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC
+            ) AS position
+        FROM checkpoints
+        WHERE thread_id = ANY(%s)
+    ) ranked
+    WHERE position > %s
+) old
+WHERE c.thread_id = old.thread_id
+    AND c.checkpoint_ns = old.checkpoint_ns
+    AND c.checkpoint_id = old.checkpoint_id
+"""
+
+_DELETE_ORPHANED_WRITES_SQL = """
+DELETE FROM checkpoint_writes w
+WHERE w.thread_id = ANY(%s)
+    AND NOT EXISTS (
+        SELECT 1 FROM checkpoints c
+        WHERE c.thread_id = w.thread_id
+            AND c.checkpoint_ns = w.checkpoint_ns
+            AND c.checkpoint_id = w.checkpoint_id
+    )
+"""
+
+# 版本字串為固定長度的數字（見 PostgresSaver.get_next_version），以 "C" collation 比較
+_DELETE_ORPHANED_BLOBS_SQL = """
+DELETE FROM checkpoint_blobs b
+WHERE b.thread_id = ANY(%s)
+    AND NOT EXISTS (
+        SELECT 1 FROM checkpoints c
+        WHERE c.thread_id = b.thread_id
+            AND c.checkpoint_ns = b.checkpoint_ns
+            AND c.checkpoint -> 'channel_versions' ->> b.channel = b.version
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM checkpoint_blobs d
+        WHERE d.thread_id = b.thread_id
+            AND d.checkpoint_ns = b.checkpoint_ns
+            AND d.channel = b.channel
+            AND d.type LIKE 'delta:%%'
+            AND split_part(d.type, ':', 2) = b.version
+    )
+    AND b.version COLLATE "C" < (
+        SELECT max((c.checkpoint -> 'channel_versions' ->> b.channel) COLLATE "C")
+        FROM checkpoints c
+        WHERE c.thread_id = b.thread_id AND c.checkpoint_ns = b.checkpoint_ns
+    )
+"""
+
+
+def iter_thread_batches(batch_size: int):
+    """依 thread_id 順序分批列出有 checkpoint 的 thread（keyset 分頁，每批只掃描該批的索引範圍）"""
+    last = ''
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT DISTINCT thread_id FROM checkpoints '
+                'WHERE thread_id > %s ORDER BY thread_id LIMIT %s',
+                [last, batch_size],
+            )
+            thread_ids = [row[0] for row in cursor.fetchall()]
+        if not thread_ids:
+            return
+        yield thread_ids
+        last = thread_ids[-1]
+
+
+def get_threads_with_checkpoints(thread_ids: List[str]) -> List[str]:
+    """篩選出仍有 checkpoint 的 thread"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT DISTINCT thread_id FROM checkpoints WHERE thread_id = ANY(%s)',
+            [thread_ids],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def prune_threads(thread_ids: List[str], keep: int) -> Dict[str, int]:
+    """
+    刪除 thread 較舊的 checkpoint 與不再被參照的 writes / blobs
+
+    Args:
+        thread_ids: 一批 thread
+        keep: 最新的 checkpoint 之外，再保留幾個歷史 checkpoint
+
+    Returns:
+        dict: 各資料表刪除的筆數
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(_DELETE_OLD_CHECKPOINTS_SQL, [thread_ids, keep + 1])
+        checkpoints = cursor.rowcount
+        cursor.execute(_DELETE_ORPHANED_WRITES_SQL, [thread_ids])
+        writes = cursor.rowcount
+        cursor.execute(_DELETE_ORPHANED_BLOBS_SQL, [thread_ids])
+        blobs = cursor.rowcount
+    return {'checkpoints': checkpoints, 'writes': writes, 'blobs': blobs}
+
+
+def prune_thread_after_turn(thread_id: str):
+    """
+    一輪對話完成後清理該 thread 較舊的 checkpoint（CHECKPOINT_PRUNE_ON_TURN）
+
+    呼叫端持有 thread 鎖；失敗時只記錄 log，由 manage.py prune_checkpoints 補清理
+    """
+    if not settings.CHECKPOINT_PRUNE_ON_TURN:
+        return
+    try:
+        deleted = prune_threads([thread_id], settings.CHECKPOINT_RETENTION_KEEP)
+        logger.debug(f'Checkpoints pruned: thread_id={thread_id}, deleted={deleted}')
+    except Exception:
+        logger.exception(f'Failed to prune checkpoints: thread_id={thread_id}')
+
+
+def archive_thread(thread_id: str) -> Dict[str, int]:
+    """
+    刪除 thread 的所有 checkpoint（呼叫端須先確認歷史投影已是最新）
+
+    封存後讀取歷史只使用投影；thread 無法再繼續對話（對話記憶已刪除）
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        deleted = {}
+        for table in ('checkpoints', 'checkpoint_writes', 'checkpoint_blobs'):
+            cursor.execute(f'DELETE FROM {table} WHERE thread_id = %s', [thread_id])
+            deleted[table.removeprefix('checkpoint_')] = cursor.rowcount
+    logger.info(f'Thread archived: thread_id={thread_id}, deleted={deleted}')
+    return deleted
@@ -0,0 +1,180 @@
+"""
+LangGraph checkpointer 共用連線池
+
+mindmap 與 essay graph 共用同一個 process 層級的連線池，
+連線池大小由 settings 中的連線預算（CHECKPOINT_POOL_MAX_SIZE）決定，
+避免每個 graph 各自建立連線池造成連線數超過 PostgreSQL max_connections。
+"""
+
+import asyncio
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+from langgraph.checkpoint.postgres import PostgresSaver
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+from .delta_saver import AsyncDeltaPostgresSaver, DeltaPostgresSaver
+from .state_cache import AsyncStateCacheMixin, StateCacheMixin
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointSaver(StateCacheMixin, DeltaPostgresSaver):
+    """messages 以差異儲存（見 delta_saver），最近的 thread state 快取於 process 內（見 state_cache）"""
+
+
+class AsyncCheckpointSaver(AsyncStateCacheMixin, AsyncDeltaPostgresSaver):
+    """CheckpointSaver 的 async 版本（ASGI 模式使用）"""
+
+
+_CONNECTION_KWARGS = {
+    'autocommit': True,
+    'prepare_threshold': 0,
+    'row_factory': dict_row,
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_async_pool = None
+_async_pool_lock = asyncio.Lock()
+
+
+def get_sync_pool_max_size() -> int:
+    """
+    同步連線池大小
+
+    ASGI 模式下請求走 async 連線池，同步連線池只用於 checkpointer.setup()，只保留 1 條連線
+    """
+    if settings.ASYNC_VIEWS_ENABLED:
+        return 1
+    return settings.CHECKPOINT_POOL_MAX_SIZE
+
+
+def get_checkpoint_pool(db_url: str) -> ConnectionPool:
+    """取得 process 共用的同步連線池（第一次呼叫時建立）"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                max_size = get_sync_pool_max_size()
+                _pool = ConnectionPool(
+                    conninfo=db_url,
+                    name='langgraph-checkpoint',
+                    min_size=1,
+                    max_size=max_size,
+                    timeout=settings.DB_POOL_TIMEOUT,
+                    kwargs=_CONNECTION_KWARGS,
+                )
+                logger.info(f'Checkpoint connection pool created: max_size={max_size}')
+    return _pool
+
+
+async def aget_checkpoint_pool(db_url: str) -> AsyncConnectionPool:
+    """
+    取得 process 共用的 async 連線池（ASGI 模式使用）
+
+    連線池會綁定目前的 event loop，因此必須在 event loop 中呼叫
+    """
+    global _async_pool
+    if _async_pool is None:
+        async with _async_pool_lock:
+            if _async_pool is None:
+                pool = AsyncConnectionPool(
+                    conninfo=db_url,
+                    name='langgraph-checkpoint-async',
+                    min_size=1,
+                    max_size=settings.CHECKPOINT_POOL_MAX_SIZE,
+                    timeout=settings.DB_POOL_TIMEOUT,
+                    kwargs=_CONNECTION_KWARGS,
+                    open=False,
+                )
+                await pool.open()
+                _async_pool = pool
+                logger.info(
+                    f'Async checkpoint connection pool created: '
+                    f'max_size={settings.CHECKPOINT_POOL_MAX_SIZE}'
+                )
+    return _async_pool
+
+
+def setup_checkpoint_tables(db_url: str):
+    """
+    建立 / 更新 checkpoint 資料表（LangGraph 的 migration）
+
+    使用單獨的連線，部署時由 manage.py setup_checkpointer 執行一次
+    """
+    with PostgresSaver.from_conn_string(db_url) as checkpointer:
+        checkpointer.setup()
+    logger.info('Checkpoint tables set up')
+
+
+def create_checkpointer(db_url: str) -> PostgresSaver:
+    """
+    建立 PostgreSQL checkpointer（使用共用連線池）
+
+    CHECKPOINT_SETUP_ON_START 關閉時（部署時已執行 migration）不執行 setup
+    """
+    checkpointer = CheckpointSaver(get_checkpoint_pool(db_url))
+    if settings.CHECKPOINT_SETUP_ON_START:
+        checkpointer.setup()
+
+    return checkpointer
+
+
+async def acreate_checkpointer(db_url: str) -> AsyncPostgresSaver:
+    """建立 async PostgreSQL checkpointer（ASGI 模式使用，使用共用 async 連線池）"""
+    checkpointer = AsyncCheckpointSaver(await aget_checkpoint_pool(db_url))
+    if settings.CHECKPOINT_SETUP_ON_START:
+        await checkpointer.setup()
+
+    return checkpointer
+
+
+def _pool_metrics(pool) -> dict:
+    """
+    將 psycopg_pool 的統計資料整理為等待時間與飽和度指標
+
+    統計值為連線池建立以來的累計值（每個 worker process 各自獨立）
+    """
+    stats = pool.get_stats()
+    size = stats.get('pool_size', 0)
+    in_use = size - stats.get('pool_available', 0)
+    requests = stats.get('requests_num', 0)
+    wait_ms = stats.get('requests_wait_ms', 0)
+
+    return {
+        'max_size': pool.max_size,
+        'size': size,
+        'in_use': in_use,
+        'waiting': stats.get('requests_waiting', 0),
+        'saturation': round(in_use / pool.max_size, 3) if pool.max_size else 0.0,
+        'requests': requests,
+        'requests_queued': stats.get('requests_queued', 0),
+        'avg_wait_ms': round(wait_ms / requests, 2) if requests else 0.0,
+        'total_wait_ms': wait_ms,
+        'errors': stats.get('requests_errors', 0),
+    }
+
+
+def get_pool_metrics() -> dict:
+    """
+    取得目前 process 內各連線池的指標
+
+    Returns:
+        dict: {pool 名稱: 指標}，尚未建立或尚未開啟的連線池不會出現在結果中
+    """
+    pools = {
+        'django': connections['default'].pool,
+        'checkpoint': _pool,
+        'checkpoint_async': _async_pool,
+    }
+    return {
+        name: _pool_metrics(pool)
+        for name, pool in pools.items()
+        if pool is not None and not pool.closed
+    }
@@ -0,0 +1,178 @@
+"""
+對話 context 去重儲存
+
+每一輪 HumanMessage 都會帶著完整的 mind_map_data / essay_content，
+PostgresSaver 會把每一份都永久保存。此模組將這些欄位依內容雜湊存入 ContextBlob，
+訊息中只保留 {'$blob': digest} 參考，agent 需要時再還原（rehydrate）。
+"""
+
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+from langchain_core.messages import BaseMessage, HumanMessage
+
+from apps.chatbot.models import ContextBlob
+
+logger = logging.getLogger(__name__)
+
+BLOB_REF_KEY = '$blob'
+
+# 需要去重的 context 欄位
+DEDUPLICATED_FIELDS = ('mind_map_data', 'essay_content')
+
+_CACHE_MAX_SIZE = 256
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def compute_digest(value: Any) -> tuple[str, str]:
+    """
+    計算內容的 SHA-256（JSON 正規化後）
+
+    Returns:
+        tuple: (digest, 正規化後的 JSON 字串)
+    """
+    serialized = json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest(), serialized
+
+
+def is_blob_ref(value: Any) -> bool:
+    """判斷是否為 blob 參考"""
+    return isinstance(value, dict) and len(value) == 1 and BLOB_REF_KEY in value
+
+
+def _cache_get(digest: str):
+    with _cache_lock:
+        if digest not in _cache:
+            return None
+        _cache.move_to_end(digest)
+        return _cache[digest]
+
+
+def _cache_put(digest: str, value: Any):
+    with _cache_lock:
+        _cache[digest] = value
+        _cache.move_to_end(digest)
+        while len(_cache) > _CACHE_MAX_SIZE:
+            _cache.popitem(last=False)
+
+
+def dehydrate_context(context: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    將 context 中需要去重的欄位存入 ContextBlob，回傳只含參考的 context
+
+    空值（例如尚未撰寫的 essay）直接保留，不建立 blob
+    """
+    dehydrated = dict(context)
+    new_blobs = []
+
+    for field in DEDUPLICATED_FIELDS:
+        value = context.get(field)
+        if not value or is_blob_ref(value):
+            continue
+
+        digest, serialized = compute_digest(value)
+        dehydrated[field] = {BLOB_REF_KEY: digest}
+
+        if _cache_get(digest) is None:
+            new_blobs.append(ContextBlob(digest=digest, content=value, size=len(serialized)))
+        _cache_put(digest, value)
+
+    if new_blobs:
+        # 相同 digest 的內容一定相同，已存在時直接略過
+        ContextBlob.objects.bulk_create(new_blobs, ignore_conflicts=True)
+        logger.debug(f'Context blobs stored: {[blob.digest[:12] for blob in new_blobs]}')
+
+    return dehydrated
+
+
+def _load_blobs(digests: set) -> Dict[str, Any]:
+    """依 digest 取得內容，先查 process 內快取，缺少的一次從資料庫讀取"""
+    loaded = {}
+    missing = set()
+    for digest in digests:
+        value = _cache_get(digest)
+        if value is None:
+            missing.add(digest)
+        else:
+            loaded[digest] = value
+
+    if missing:
+        for blob in ContextBlob.objects.filter(digest__in=missing):
+            loaded[blob.digest] = blob.content
+            _cache_put(blob.digest, blob.content)
+
+        not_found = missing - loaded.keys()
+        if not_found:
+            logger.warning(f'Context blobs not found: {sorted(d[:12] for d in not_found)}')
+
+    return loaded
+
+
+def resolve_context_value(value: Any, default: Any = None) -> Any:
+    """還原單一 context 欄位，非參考的值（舊資料或批次評分）直接回傳"""
+    if not is_blob_ref(value):
+        return value
+
+    digest = value[BLOB_REF_KEY]
+    return _load_blobs({digest}).get(digest, default)
+
+
+def _parse_message(message: BaseMessage):
+    """解析 HumanMessage 的 JSON 內容，非 JSON 訊息回傳 None"""
+    if not isinstance(message, HumanMessage) or not isinstance(message.content, str):
+        return None
+    try:
+        data = json.loads(message.content)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get('context'), dict):
+        return None
+    return data
+
+
+def rehydrate_messages(messages: List[BaseMessage]) -> List[BaseMessage]:
+    """
+    還原訊息列表中所有 blob 參考（需要完整歷史 context 的 agent 使用）
+
+    同一份內容在多輪中只會讀取一次
+    """
+    parsed = [_parse_message(message) for message in messages]
+
+    digests = set()
+    for data in parsed:
+        if data is None:
+            continue
+        for value in data['context'].values():
+            if is_blob_ref(value):
+                digests.add(value[BLOB_REF_KEY])
+
+    if not digests:
+        return messages
+
+    blobs = _load_blobs(digests)
+
+    rehydrated = []
+    for message, data in zip(messages, parsed):
+        if data is None:
+            rehydrated.append(message)
+            continue
+
+        data['context'] = {
+            key: blobs.get(value[BLOB_REF_KEY]) if is_blob_ref(value) else value
+            for key, value in data['context'].items()
+        }
+        rehydrated.append(
+            HumanMessage(
+                content=json.dumps(data, ensure_ascii=False),
+                additional_kwargs=message.additional_kwargs,
+                id=message.id,
+            )
+        )
+
+    return rehydrated
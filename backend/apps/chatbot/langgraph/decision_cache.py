@@ -0,0 +1,155 @@
+"""
+意圖分類結果快取
+
+相近的問題（例如 "what is evidence?"）不需要每次都呼叫 LLM classifier。
+key = 正規化後的 query + 最近 K 輪（過濾 context 後）對話的雜湊 + prompt 版本，
+先查 process 內 LRU，再查跨 worker 共用的 ClassifierDecision 表。
+"""
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import List, Optional
+
+from django.conf import settings
+from django.utils import timezone
+from langchain_core.messages import BaseMessage
+
+from apps.chatbot.models import ClassifierDecision
+from apps.common.utils.message_filter import filter_messages
+
+from .fast_router import DECISION_SOURCE_CACHE, get_latest_query
+
+logger = logging.getLogger(__name__)
+
+_LRU_MAX_SIZE = 1024
+
+# 每寫入幾筆清理一次過期資料
+_PURGE_INTERVAL = 500
+
+_TRAILING_PUNCTUATION = '?？!！.。,，~～ '
+
+
+def normalize_query(query: str) -> str:
+    """正規化 query：小寫、合併空白、移除結尾標點"""
+    normalized = re.sub(r'\s+', ' ', query.strip().lower())
+    return normalized.rstrip(_TRAILING_PUNCTUATION)
+
+
+class ClassifierDecisionCache:
+    """意圖分類結果快取（in-process LRU + PostgreSQL）"""
+
+    def __init__(self, classifier: str, prompt: str, model: str):
+        """
+        Args:
+            classifier: 分類器名稱（mindmap / essay），不同分類器的結果互不共用
+            prompt: 分類器的 system prompt，內容變更時版本隨之改變
+            model: 分類器使用的模型
+        """
+        self.classifier = classifier
+        self.prompt_version = hashlib.sha256(f'{model}\n{prompt}'.encode('utf-8')).hexdigest()[:16]
+        self.enabled = settings.CLASSIFIER_CACHE_ENABLED
+        self.ttl = settings.CLASSIFIER_CACHE_TTL_SECONDS
+        self.history_turns = settings.CLASSIFIER_CACHE_HISTORY_TURNS
+
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def make_key(self, messages: List[BaseMessage]) -> Optional[str]:
+        """
+        計算快取 key
+
+        Returns:
+            str | None: 沒有 query 時回傳 None（不使用快取）
+        """
+        query = normalize_query(get_latest_query(messages))
+        if not query:
+            return None
+
+        # 最近 K 輪對話（不含本次訊息），context 已移除，只保留 query 與回應
+        window = filter_messages(messages[:-1], context_fields_to_keep=[])
+        window = window[-self.history_turns * 2 :] if self.history_turns > 0 else []
+        history = json.dumps(
+            [[message.type, message.content] for message in window], ensure_ascii=False
+        )
+
+        raw_key = f'{self.classifier}\n{self.prompt_version}\n{query}\n{history}'
+        return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        """查詢快取，未命中或已過期回傳 None"""
+        if not self.enabled or key is None:
+            return None
+
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                result, expires_at = entry
+                if expires_at > time.time():
+                    self._lru.move_to_end(key)
+                    return self._as_hit(result)
+                del self._lru[key]
+
+        try:
+            decision = ClassifierDecision.objects.filter(
+                cache_key=key, expires_at__gt=timezone.now()
+            ).first()
+        except Exception as e:
+            logger.warning(f'Classifier cache lookup failed: {str(e)[:100]}')
+            return None
+
+        if decision is None:
+            return None
+
+        result = {'reasoning': decision.reasoning, 'next_action': decision.next_action}
+        self._put_local(key, result, decision.expires_at.timestamp())
+        return self._as_hit(result)
+
+    def set(self, key: Optional[str], result: dict):
+        """寫入快取（只應寫入 LLM 成功判斷的結果）"""
+        if not self.enabled or key is None:
+            return
+
+        expires_at = timezone.now() + timedelta(seconds=self.ttl)
+        cached = {'reasoning': result.get('reasoning', ''), 'next_action': result['next_action']}
+        self._put_local(key, cached, expires_at.timestamp())
+
+        try:
+            ClassifierDecision.objects.update_or_create(
+                cache_key=key,
+                defaults={
+                    'classifier': self.classifier,
+                    'prompt_version': self.prompt_version,
+                    'next_action': cached['next_action'],
+                    'reasoning': cached['reasoning'],
+                    'expires_at': expires_at,
+                },
+            )
+            self._purge_expired()
+        except Exception as e:
+            logger.warning(f'Classifier cache write failed: {str(e)[:100]}')
+
+    def _put_local(self, key: str, result: dict, expires_at: float):
+        with self._lock:
+            self._lru[key] = (result, expires_at)
+            self._lru.move_to_end(key)
+            while len(self._lru) > _LRU_MAX_SIZE:
+                self._lru.popitem(last=False)
+
+    def _purge_expired(self):
+        """定期刪除過期資料，避免資料表無限成長"""
+        self._writes += 1
+        if self._writes % _PURGE_INTERVAL:
+            return
+        deleted, _ = ClassifierDecision.objects.filter(expires_at__lte=timezone.now()).delete()
+        logger.info(f'Classifier cache purged: {deleted} expired decisions')
+
+    def _as_hit(self, result: dict) -> dict:
+        logger.info(f'Classifier cache hit: {self.classifier} -> {result["next_action"]}')
+        return {**result, 'decision_source': DECISION_SOURCE_CACHE}
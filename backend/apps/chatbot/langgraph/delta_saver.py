@@ -0,0 +1,235 @@
+"""
+append-only channel 的差異儲存（PostgresSaver）
+
+AgentState.messages 以 operator.add 累加，PostgresSaver 每個 step 都會把完整的訊息列表
+重新序列化存入 checkpoint_blobs，儲存量與寫入時間隨對話輪數平方成長。
+此模組的 saver 對 CHECKPOINT_DELTA_CHANNELS 改為儲存「錨點 + 累積差異」：
+- 錨點：一般的完整 blob（與 PostgresSaver 格式相同）
+- 差異：只包含錨點之後新增的訊息，type 欄位記錄為 'delta:{錨點版本}:{序列化格式}'
+- 差異累積超過 CHECKPOINT_DELTA_CONSOLIDATE_MESSAGES 則訊息時，改寫入新的完整錨點（合併）
+讀取時在同一個查詢中一併取出錨點，錨點 + 差異即為完整列表，graph.get_state / invoke 不需修改。
+寫入差異前會確認新列表確實以錨點的訊息開頭（同一個物件），無法確認時（例如 process 內沒有
+錨點資訊、或列表不是延續錨點）寫入完整 blob，因此任何時候都可以關閉或重新開啟此功能。
+寫入的新錨點在 put 成功後才生效；put 失敗時清除該 thread 的錨點，下次寫入完整 blob，
+不會寫出指向未儲存錨點的差異。
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from langgraph.checkpoint.postgres import PostgresSaver
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+from langgraph.checkpoint.postgres.base import SELECT_SQL as BASE_SELECT_SQL
+
+logger = logging.getLogger(__name__)
+
+DELTA_TYPE_PREFIX = 'delta:'
+
+# 差異 blob 的錨點（與 channel_values 同一次查詢取出）
+_DELTA_ANCHORS_SQL = """
+    (
+        select array_agg(array[anchor.channel::bytea, anchor.version::bytea, anchor.type::bytea, anchor.blob])
+        from jsonb_each_text(checkpoint -> 'channel_versions')
+        inner join checkpoint_blobs bl
+            on bl.thread_id = checkpoints.thread_id
+            and bl.checkpoint_ns = checkpoints.checkpoint_ns
+            and bl.channel = jsonb_each_text.key
+            and bl.version = jsonb_each_text.value
+            and bl.type like 'delta:%%'
+        inner join checkpoint_blobs anchor
+            on anchor.thread_id = bl.thread_id
+            and anchor.checkpoint_ns = bl.checkpoint_ns
+            and anchor.channel = bl.channel
+            and anchor.version = split_part(bl.type, ':', 2)
+    ) as delta_anchors"""
+
+_select_columns, _ = BASE_SELECT_SQL.rsplit('from checkpoints', 1)
+SELECT_SQL = f'{_select_columns.rstrip()},{_DELTA_ANCHORS_SQL}\nfrom checkpoints '
+
+_ANCHOR_CACHE_MAX_SIZE = 1024
+
+
+class _Anchor:
+    """thread 目前的錨點：版本、訊息數與最後一則訊息（用來確認新列表延續此錨點）"""
+
+    __slots__ = ('version', 'length', 'last')
+
+    def __init__(self, version: str, values: List[Any]):
+        self.version = version
+        self.length = len(values)
+        self.last = values[-1] if values else None
+
+    def is_prefix_of(self, values: List[Any]) -> bool:
+        return 0 < self.length <= len(values) and values[self.length - 1] is self.last
+
+
+# (thread_id, checkpoint_ns, channel) -> _Anchor，sync / async saver 共用
+_anchors: 'OrderedDict[tuple, _Anchor]' = OrderedDict()
+# put 進行中寫入的錨點：(thread_id, checkpoint_ns) -> {(thread_id, checkpoint_ns, channel): _Anchor}
+_staged_anchors: Dict[tuple, Dict[tuple, _Anchor]] = {}
+_anchors_lock = threading.Lock()
+
+
+def _get_anchor(key: tuple) -> Optional[_Anchor]:
+    with _anchors_lock:
+        anchor = _anchors.get(key)
+        if anchor is not None:
+            _anchors.move_to_end(key)
+        return anchor
+
+
+def _set_anchor(key: tuple, anchor: _Anchor):
+    with _anchors_lock:
+        _anchors[key] = anchor
+        _anchors.move_to_end(key)
+        while len(_anchors) > _ANCHOR_CACHE_MAX_SIZE:
+            _anchors.popitem(last=False)
+
+
+def _stage_anchor(key: tuple, anchor: _Anchor):
+    """記錄 put 寫入的新錨點，put 成功後才由 _commit_anchors 生效"""
+    with _anchors_lock:
+        _staged_anchors.setdefault(key[:2], {})[key] = anchor
+
+
+def _commit_anchors(prefix: tuple):
+    with _anchors_lock:
+        staged = _staged_anchors.pop(prefix, {})
+    for key, anchor in staged.items():
+        _set_anchor(key, anchor)
+
+
+def _discard_anchors(prefix: tuple):
+    """put 失敗：捨棄寫入中的錨點並清除 thread 的錨點（無法確定資料庫中的錨點）"""
+    with _anchors_lock:
+        _staged_anchors.pop(prefix, None)
+        for key in [key for key in _anchors if key[:2] == prefix]:
+            del _anchors[key]
+
+
+def clear_anchors():
+    with _anchors_lock:
+        _anchors.clear()
+        _staged_anchors.clear()
+
+
+class DeltaBlobMixin:
+    """PostgresSaver / AsyncPostgresSaver 共用的差異寫入與還原"""
+
+    SELECT_SQL = SELECT_SQL
+
+    @contextmanager
+    def _anchor_transaction(self, config):
+        """put 成功後才讓寫入的錨點生效，失敗時清除該 thread 的錨點"""
+        prefix = (config['configurable']['thread_id'], config['configurable']['checkpoint_ns'])
+        try:
+            yield
+        except BaseException:
+            _discard_anchors(prefix)
+            raise
+        _commit_anchors(prefix)
+
+    def _dump_blobs(self, thread_id, checkpoint_ns, values, versions):
+        rows = super()._dump_blobs(thread_id, checkpoint_ns, values, versions)
+        if not settings.CHECKPOINT_DELTA_ENABLED:
+            return rows
+
+        for index, row in enumerate(rows):
+            channel, version = row[2], row[3]
+            value = values.get(channel)
+            if channel not in settings.CHECKPOINT_DELTA_CHANNELS or not isinstance(value, list):
+                continue
+
+            key = (thread_id, checkpoint_ns, channel)
+            anchor = _get_anchor(key)
+            if (
+                anchor is not None
+                and anchor.is_prefix_of(value)
+                and len(value) - anchor.length <= settings.CHECKPOINT_DELTA_CONSOLIDATE_MESSAGES
+            ):
+                # super() 已序列化完整列表，改為只序列化錨點之後的訊息
+                value_type, blob = self.serde.dumps_typed(value[anchor.length :])
+                rows[index] = (
+                    *row[:4],
+                    f'{DELTA_TYPE_PREFIX}{anchor.version}:{value_type}',
+                    blob,
+                )
+            else:
+                _stage_anchor(key, _Anchor(version, value))
+        return rows
+
+    def _resolve_deltas(self, value) -> Dict[str, List[Any]]:
+        """
+        將查詢結果中的差異 blob 與錨點還原為完整列表
+
+        已還原的 channel 會從 value['channel_values'] 移除，還原後的列表另外回傳
+        """
+        key_prefix = (value['thread_id'], value['checkpoint_ns'])
+        versions = value['checkpoint'].get('channel_versions', {})
+        anchors = {
+            channel.decode(): (version.decode(), value_type.decode(), blob)
+            for channel, version, value_type, blob in value.pop('delta_anchors', None) or []
+        }
+
+        resolved = {}
+        for row in value['channel_values'] or []:
+            channel, value_type, blob = row[0].decode(), row[1].decode(), row[2]
+            if channel not in settings.CHECKPOINT_DELTA_CHANNELS or channel not in versions:
+                continue
+
+            if not value_type.startswith(DELTA_TYPE_PREFIX):
+                loaded = self.serde.loads_typed((value_type, blob))
+                resolved[channel] = loaded
+                _set_anchor((*key_prefix, channel), _Anchor(versions[channel], loaded))
+                continue
+
+            anchor_version, delta_type = value_type[len(DELTA_TYPE_PREFIX) :].split(':', 1)
+            if channel not in anchors or anchors[channel][0] != anchor_version:
+                message = (
+                    f'Checkpoint anchor missing: thread_id={key_prefix[0]}, '
+                    f'channel={channel}, version={anchor_version}'
+                )
+                logger.error(message)
+                raise ValueError(message)
+            _, anchor_type, anchor_blob = anchors[channel]
+            anchor_values = self.serde.loads_typed((anchor_type, anchor_blob))
+            resolved[channel] = anchor_values + self.serde.loads_typed((delta_type, blob))
+            _set_anchor((*key_prefix, channel), _Anchor(anchor_version, anchor_values))
+
+        # 已還原的 channel 不再由 _load_blobs 反序列化
+        value['channel_values'] = [
+            row for row in value['channel_values'] or [] if row[0].decode() not in resolved
+        ]
+        return resolved
+
+
+class DeltaPostgresSaver(DeltaBlobMixin, PostgresSaver):
+    """以差異儲存 append-only channel 的 PostgresSaver"""
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        with self._anchor_transaction(config):
+            return super().put(config, checkpoint, metadata, new_versions)
+
+    def _load_checkpoint_tuple(self, value):
+        resolved = self._resolve_deltas(value)
+        checkpoint_tuple = super()._load_checkpoint_tuple(value)
+        checkpoint_tuple.checkpoint['channel_values'].update(resolved)
+        return checkpoint_tuple
+
+
+class AsyncDeltaPostgresSaver(DeltaBlobMixin, AsyncPostgresSaver):
+    """DeltaPostgresSaver 的 async 版本（ASGI 模式使用）"""
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        with self._anchor_transaction(config):
+            return await super().aput(config, checkpoint, metadata, new_versions)
+
+    async def _load_checkpoint_tuple(self, value):
+        resolved = self._resolve_deltas(value)
+        checkpoint_tuple = await super()._load_checkpoint_tuple(value)
+        checkpoint_tuple.checkpoint['channel_values'].update(resolved)
+        return checkpoint_tuple
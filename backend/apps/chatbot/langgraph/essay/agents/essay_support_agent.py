@@ -6,9 +6,15 @@ from typing import List
 
 from langchain_core.messages import BaseMessage, SystemMessage
 
-from apps.common.utils.json_parser import parse_llm_json_response
 from apps.common.utils.message_filter import filter_messages
-
+from apps.common.utils.stream_parser import JsonFieldStreamParser
+from apps.common.utils.structured_output import (
+    StructuredOutput,
+    SupportResponse,
+    get_structured_output,
+)
+
+from ...context_store import rehydrate_messages, resolve_context_value
 from ..prompts import ESSAY_SUPPORT_PROMPT
 from .base import BaseAgent
 
@@ -18,8 +24,11 @@ logger = logging.getLogger(__name__)
 class EssaySupportAgent(BaseAgent):
     """Essay 寫作引導 Agent"""
 
+    # final_response 已串流給使用者，解析失敗時不重試
+    output_schema = StructuredOutput('essay_support', SupportResponse, retry=False)
+
     def __init__(self):
-        super().__init__(temperature=0.5)
+        super().__init__(route='essay_support')
         self.prompt_template = ESSAY_SUPPORT_PROMPT
 
     def prepare_messages(
@@ -42,7 +51,9 @@ class EssaySupportAgent(BaseAgent):
 
         try:
             content = json.loads(last_message.content)
-            mind_map_data = content.get('context', {}).get('mind_map_data', {})
+            mind_map_data = resolve_context_value(
+                content.get('context', {}).get('mind_map_data', {}), default={}
+            )
         except (json.JSONDecodeError, AttributeError):
             pass
 
@@ -53,13 +64,19 @@ class EssaySupportAgent(BaseAgent):
         )
 
         # 過濾歷史訊息，只保留 essay_content，移除重複的 mind_map_data
-        filtered_messages = filter_messages(messages, context_fields_to_keep=['essay_content'])
+        filtered_messages = rehydrate_messages(
+            filter_messages(messages, context_fields_to_keep=['essay_content'])
+        )
 
         return [SystemMessage(content=system_message_content)] + filtered_messages
 
+    def create_stream_parser(self) -> JsonFieldStreamParser:
+        """串流輸出時只推送 JSON 回應中的 final_response 欄位"""
+        return JsonFieldStreamParser('final_response')
+
     def process_response(self, response) -> str:
         """
-        處理回應：解析 JSON 並提取 final_response
+        處理回應：取出已解析 JSON 的 final_response
 
         Args:
             response: LLM 的回應
@@ -67,33 +84,27 @@ class EssaySupportAgent(BaseAgent):
         Returns:
             str: final_response 的內容，或完整回應（如果解析失敗）
         """
-        try:
-            result = parse_llm_json_response(response.content)
-            if 'final_response' not in result:
-                logger.warning('Response missing final_response field, using raw content')
-                return response.content
-            return result['final_response']
-        except Exception as e:
-            logger.warning(f'Failed to parse response: {str(e)[:100]}, using raw content')
+        result = get_structured_output(response)
+        if result is None:
+            logger.warning('Invalid structured response, using raw content')
             return response.content
+        return result['final_response']
 
     def extract_metadata(self, response) -> dict:
         """
-        提取 metadata：從 JSON 回應中提取 reasoning, response_strategy
+        提取 metadata：從已解析的 JSON 回應中提取 reasoning, response_strategy, strategy_detail
 
         Args:
             response: LLM 的回應
 
         Returns:
-            dict: metadata
+            dict: metadata 包含 reasoning, response_strategy, strategy_detail
         """
-        try:
-            result = parse_llm_json_response(response.content)
-            return {
-                'reasoning': result.get('reasoning', ''),
-                'response_strategy': result.get('response_strategy', ''),
-                'strategy_detail': result.get('strategy_detail', ''),
-            }
-        except Exception as e:
-            logger.warning(f'Failed to extract metadata: {str(e)[:100]}')
+        result = get_structured_output(response)
+        if result is None:
             return {}
+        return {
+            'reasoning': result['reasoning'],
+            'response_strategy': result['response_strategy'],
+            'strategy_detail': result['strategy_detail'],
+        }
@@ -2,29 +2,53 @@
 
 import json
 import logging
-from typing import List
+from typing import List, Optional
 
-from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from langchain_core.messages import BaseMessage, HumanMessage
+from pydantic import BaseModel
 
-from apps.common.utils.json_parser import parse_llm_json_response
+from apps.common.utils.prompt_cache import prompt_assembly_cache
+from apps.common.utils.structured_output import StructuredOutput, get_structured_output
 
+from ...context_store import resolve_context_value
 from ..prompts.scoring_prompt import SCORING_PROMPT
 from .base import BaseAgent
 
 logger = logging.getLogger(__name__)
 
 
+class EssayScoreItem(BaseModel):
+    """單一評分面向（0-4 分）"""
+
+    score: int
+    feedback: str
+
+
+class EssayScoringResult(BaseModel):
+    """Essay 評分結果（欄位順序與 prompt 的 OUTPUT FORMAT 相同）"""
+
+    Explanation_of_Issues: EssayScoreItem
+    Evidence_Integration: EssayScoreItem
+    Influence_of_Context: EssayScoreItem
+    Students_Position: EssayScoreItem
+    Conclusions: EssayScoreItem
+
+
 class EssayScoringAgent(BaseAgent):
     """Essay 評分 Agent"""
 
+    scoring_type = 'essay_scoring'
+    output_schema = StructuredOutput('essay_scoring', EssayScoringResult)
+
     def __init__(self):
-        super().__init__(temperature=0.5, model='gemini-3-pro-preview')
+        super().__init__(route='essay_scoring')
         self.prompt_template = SCORING_PROMPT
 
     def prepare_messages(
         self,
         messages: List[BaseMessage],
         article_content: str = '',
+        template_key: Optional[str] = None,
         **kwargs,
     ) -> List[BaseMessage]:
         """
@@ -33,6 +57,7 @@ class EssayScoringAgent(BaseAgent):
         Args:
             messages: 原始對話歷史
             article_content: 文章內容
+            template_key: template 的快取識別（None 時不使用 system prompt 快取）
             **kwargs: 未使用的額外參數
 
         Returns:
@@ -43,24 +68,26 @@ class EssayScoringAgent(BaseAgent):
 
         try:
             content = json.loads(last_message.content)
-            essay_content = content.get('context', {}).get('essay_content', '')
+            essay_content = resolve_context_value(
+                content.get('context', {}).get('essay_content', ''), default=''
+            )
         except (json.JSONDecodeError, AttributeError):
             pass
 
-        system_message_content = self.prompt_template.format(
-            article_content=article_content,
+        system_message = prompt_assembly_cache.render(
+            'essay_scoring', self.prompt_template, article_content, template_key
         )
 
         human_message_content = essay_content if essay_content else '（尚未撰寫）'
 
         return [
-            SystemMessage(content=system_message_content),
+            system_message,
             HumanMessage(content=human_message_content),
         ]
 
     def process_response(self, response) -> str:
         """
-        處理回應：解析並驗證 JSON 評分結果
+        處理回應：輸出已解析並驗證的 JSON 評分結果
 
         Args:
             response: LLM 的回應
@@ -68,30 +95,16 @@ class EssayScoringAgent(BaseAgent):
         Returns:
             str: 格式化的 JSON 字串（如果解析成功）或原始內容（如果解析失敗）
         """
-
-        try:
-            result = parse_llm_json_response(response.content)
-            required_keys = [
-                'Explanation_of_Issues',
-                'Evidence_Integration',
-                'Influence_of_Context',
-                'Students_Position',
-                'Conclusions',
-            ]
-            for key in required_keys:
-                if key not in result:
-                    logger.warning(f'Scoring result missing {key} field, using raw content')
-                    return response.content
-
-            return json.dumps(result, ensure_ascii=False, indent=2)
-
-        except Exception as e:
-            logger.warning(f'Failed to parse scoring result: {str(e)[:100]}, using raw content')
+        result = get_structured_output(response)
+        if result is None:
+            logger.warning('Invalid scoring result, using raw content')
             return response.content
 
+        return json.dumps(result, ensure_ascii=False, indent=2)
+
     def extract_metadata(self, response) -> dict:
         """
-        提取 metadata：從 JSON 回應中提取完整的評分資訊
+        提取 metadata：從已解析的評分結果中提取完整的評分資訊
 
         Args:
             response: LLM 的回應
@@ -99,35 +112,19 @@ class EssayScoringAgent(BaseAgent):
         Returns:
             dict: metadata 包含各面向評分資訊
         """
-        try:
-            result = parse_llm_json_response(response.content)
-            required_keys = [
-                'Explanation_of_Issues',
-                'Evidence_Integration',
-                'Influence_of_Context',
-                'Students_Position',
-                'Conclusions',
-            ]
-
-            for key in required_keys:
-                if key not in result:
-                    return {}
-
-            return {
-                'explanation_of_issues_score': result['Explanation_of_Issues'].get('score', ''),
-                'explanation_of_issues_feedback': result['Explanation_of_Issues'].get(
-                    'feedback', ''
-                ),
-                'evidence_integration_score': result['Evidence_Integration'].get('score', ''),
-                'evidence_integration_feedback': result['Evidence_Integration'].get('feedback', ''),
-                'influence_of_context_score': result['Influence_of_Context'].get('score', ''),
-                'influence_of_context_feedback': result['Influence_of_Context'].get('feedback', ''),
-                'students_position_score': result['Students_Position'].get('score', ''),
-                'students_position_feedback': result['Students_Position'].get('feedback', ''),
-                'conclusions_score': result['Conclusions'].get('score', ''),
-                'conclusions_feedback': result['Conclusions'].get('feedback', ''),
-            }
-
-        except Exception as e:
-            logger.warning(f'Failed to extract metadata: {str(e)[:100]}')
+        result = get_structured_output(response)
+        if result is None:
             return {}
+
+        return {
+            'explanation_of_issues_score': result['Explanation_of_Issues']['score'],
+            'explanation_of_issues_feedback': result['Explanation_of_Issues']['feedback'],
+            'evidence_integration_score': result['Evidence_Integration']['score'],
+            'evidence_integration_feedback': result['Evidence_Integration']['feedback'],
+            'influence_of_context_score': result['Influence_of_Context']['score'],
+            'influence_of_context_feedback': result['Influence_of_Context']['feedback'],
+            'students_position_score': result['Students_Position']['score'],
+            'students_position_feedback': result['Students_Position']['feedback'],
+            'conclusions_score': result['Conclusions']['score'],
+            'conclusions_feedback': result['Conclusions']['feedback'],
+        }
@@ -6,27 +6,44 @@ Essay Intent Classifier
 import logging
 from typing import Any, List
 
+from asgiref.sync import sync_to_async
 from langchain_core.messages import BaseMessage, SystemMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
 
 from apps.common.utils.json_parser import parse_llm_json_response
+from apps.common.utils.llm_routing import RoutedChatModel, get_routing_metadata
 from apps.common.utils.message_filter import filter_messages
 
+from ..decision_cache import ClassifierDecisionCache
+from ..fast_router import DECISION_SOURCE_LLM, DECISION_SOURCE_LLM_FALLBACK
 from .prompts import CLASSIFIER_PROMPT
 
 logger = logging.getLogger(__name__)
 
+# 快速路由規則（在 LLM classifier 之前判斷，命中時不呼叫 LLM）
+FAST_PATH_SENTINELS = {
+    '[scoring]': 'essay_scoring',
+}
+
+FAST_PATH_RULES = [
+    (
+        r'^(請|麻煩)?(幫我|幫忙)?(評分|打分數?|給我?分數|評估我的(文章|作文))(吧|一下)?[。!！]*$',
+        'essay_scoring',
+    ),
+    (r'^(please )?(score|grade) my (essay|writing)( please)?[.!]*$', 'essay_scoring'),
+]
+
 
 class EssayIntentClassifier:
     """Essay 意圖分類器"""
 
     def __init__(self):
-        self.llm = ChatGoogleGenerativeAI(
-            model='gemini-2.5-pro',
-            temperature=0.3,
-        )
+        # 路由類的輕量工作使用 flash 等級模型（設定見 settings.LLM_ROUTES）
+        self.llm = RoutedChatModel('essay_classifier')
         self.system_prompt = CLASSIFIER_PROMPT
 
+        # 分類結果快取（key 含 prompt 版本，prompt 或模型變更後自動失效）
+        self.decision_cache = ClassifierDecisionCache('essay', self.system_prompt, self.llm.model)
+
     def classify(self, messages: List[BaseMessage], callbacks: List[Any] = None) -> dict:
         """
         分類使用者意圖
@@ -39,32 +56,85 @@ class EssayIntentClassifier:
             dict: 包含 reasoning 和 next_action 的字典
                   next_action 為 "essay_support" 或 "essay_scoring"
         """
-        filtered_messages = filter_messages(messages, context_fields_to_keep=[])
+        cache_key = self.decision_cache.make_key(messages)
+        cached = self.decision_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-        final_messages = [SystemMessage(content=self.system_prompt)] + filtered_messages
+        final_messages = self._prepare_messages(messages)
 
+        response = None
         try:
             logger.info('Invoking essay classifier LLM')
             response = self.llm.invoke(
                 final_messages, config={'callbacks': callbacks, 'run_name': 'EssayIntentClassifier'}
             )
-            result = parse_llm_json_response(response.content)
+            result = self._parse_result(response)
+            self.decision_cache.set(cache_key, result)
+            return result
+
+        except Exception as e:
+            return self._fallback_result(e, response)
+
+    async def aclassify(self, messages: List[BaseMessage], callbacks: List[Any] = None) -> dict:
+        """
+        分類使用者意圖（async 版本，供 ASGI 模式使用）
+
+        Args:
+            同 classify
 
-            if 'next_action' not in result:
-                raise ValueError('分類結果缺少 next_action 欄位')
+        Returns:
+            dict: 包含 reasoning 和 next_action 的字典
+        """
+        cache_key = self.decision_cache.make_key(messages)
+        cached = await sync_to_async(self.decision_cache.get)(cache_key)
+        if cached is not None:
+            return cached
 
-            valid_actions = ['essay_support', 'essay_scoring']
-            if result['next_action'] not in valid_actions:
-                raise ValueError(f'無效的分類結果: {result["next_action"]}')
+        final_messages = self._prepare_messages(messages)
 
-            logger.info(f'Essay classification result: {result.get("next_action")}')
+        response = None
+        try:
+            logger.info('Invoking essay classifier LLM (async)')
+            response = await self.llm.ainvoke(
+                final_messages, config={'callbacks': callbacks, 'run_name': 'EssayIntentClassifier'}
+            )
+            result = self._parse_result(response)
+            await sync_to_async(self.decision_cache.set)(cache_key, result)
             return result
 
         except Exception as e:
-            logger.exception('Essay classifier failed')
-            if 'response' in locals():
-                logger.debug(f'Raw response: {response.content[:200]}')
-            return {
-                'reasoning': f'發生錯誤: {str(e)}',
-                'next_action': 'essay_support',
-            }
+            return self._fallback_result(e, response)
+
+    def _prepare_messages(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        """過濾 context 後組成分類器的輸入訊息"""
+        filtered_messages = filter_messages(messages, context_fields_to_keep=[])
+
+        return [SystemMessage(content=self.system_prompt)] + filtered_messages
+
+    def _parse_result(self, response) -> dict:
+        """解析並驗證分類結果"""
+        result = parse_llm_json_response(response.content)
+
+        if 'next_action' not in result:
+            raise ValueError('分類結果缺少 next_action 欄位')
+
+        valid_actions = ['essay_support', 'essay_scoring']
+        if result['next_action'] not in valid_actions:
+            raise ValueError(f'無效的分類結果: {result["next_action"]}')
+
+        logger.info(f'Essay classification result: {result.get("next_action")}')
+        result['decision_source'] = DECISION_SOURCE_LLM
+        result.update(get_routing_metadata(response, prefix='classifier'))
+        return result
+
+    def _fallback_result(self, error: Exception, response=None) -> dict:
+        """分類失敗時的預設結果"""
+        logger.exception('Essay classifier failed')
+        if response is not None:
+            logger.debug(f'Raw response: {response.content[:200]}')
+        return {
+            'reasoning': f'發生錯誤: {str(error)}',
+            'next_action': 'essay_support',
+            'decision_source': DECISION_SOURCE_LLM_FALLBACK,
+        }
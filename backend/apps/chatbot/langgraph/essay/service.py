@@ -6,17 +6,28 @@ Essay LangGraph Service
 - essay_content 塞進 HumanMessage context
 """
 
-import json
 import logging
-from typing import Dict
+import threading
+from typing import AsyncIterator, Dict, Iterator, Optional
 
-from langfuse import Langfuse, propagate_attributes
-from langfuse.langchain import CallbackHandler
+from asgiref.sync import sync_to_async
+from langchain_core.messages import HumanMessage
 
 from apps.common.utils.map_data_utils import simplify_map_data
+from apps.common.utils.prompt_cache import make_template_key
+from apps.common.utils.tracing import tracer
 from apps.map.models import Map
 from config.settings import DATABASE_URL
 
+from ..history_store import (
+    get_history_version,
+    get_projected_checkpoint_id,
+    load_history,
+    record_history,
+    record_turn,
+)
+from ..scoring_cache import SCORING_CACHE_HIT_KEY
+from ..thread_lock import ThreadBusyError, thread_busy_result, thread_lock_manager
 from .graph import EssayConversationGraph
 
 logger = logging.getLogger(__name__)
@@ -25,53 +36,126 @@ logger = logging.getLogger(__name__)
 class EssayLangGraphService:
     def __init__(self):
         self.conversation_graph = EssayConversationGraph(DATABASE_URL)
-        self.langfuse = Langfuse()
+
+    def _get_trace_route(self, user_input: str) -> str:
+        """tracing 取樣用的 route：規則可判斷為評分的請求一律記錄，其餘視為一般對話"""
+        decision = self.conversation_graph.fast_router.route([HumanMessage(content=user_input)])
+        if decision and decision['next_action'] == 'essay_scoring':
+            return 'essay_scoring'
+        return 'essay_chat'
+
+    def _load_map_context(
+        self, map_id: int, map_instance: Optional[Map] = None
+    ) -> tuple[dict, str, Optional[str]]:
+        """
+        從 Map 取得 graph 需要的 context
+
+        Args:
+            map_id: 心智圖 ID
+            map_instance: view 已載入的 map（含 template），提供時不再查詢
+
+        Returns:
+            tuple: (簡化後的心智圖資料, 文章內容, template 快取識別)
+        """
+        # 1. 獲取 Map
+        try:
+            if map_instance is None:
+                map_instance = Map.objects.select_related('template').get(id=map_id)
+            logger.debug(
+                f'Map loaded: nodes={len(map_instance.nodes)}, edges={len(map_instance.edges)}, template_id={map_instance.template_id}'
+            )
+        except Map.DoesNotExist:
+            logger.error(f'Map not found in process_user_message: map_id={map_id}')
+            raise ValueError(f'Map with id {map_id} does not exist')
+
+        # 2. 簡化 Mind Map
+        mind_map_data = {'nodes': map_instance.nodes, 'edges': map_instance.edges}
+        simplified_map_data = simplify_map_data(mind_map_data)
+
+        # 3. 獲取文章模板
+        article_content = ''
+        if map_instance.template:
+            article_content = map_instance.template.article_content
+            logger.debug(f'Article content: {article_content[:100]}...')
+
+        return simplified_map_data, article_content, make_template_key(map_instance.template)
+
+    def _summarize_result(self, result: dict) -> tuple[str, str | None, dict]:
+        """
+        從 graph 最終狀態取得回應內容、message_type 和 trace metadata
+
+        Returns:
+            tuple: (回應內容, message_type, trace metadata)
+        """
+        if result.get('messages'):
+            last_message = result['messages'][-1]
+            response_content = last_message.content
+            # 從 additional_kwargs 取得 message_type
+            message_type = getattr(last_message, 'additional_kwargs', {}).get('message_type', None)
+        else:
+            response_content = '系統無法產生回應'
+            message_type = None
+
+        trace_metadata = {
+            'classifier_next_action': result.get('classification', {}).get(
+                'next_action', 'unknown'
+            ),
+            'classifier_reasoning': result.get('classification', {}).get('reasoning', 'unknown'),
+            'classifier_decision_source': result.get('classification', {}).get(
+                'decision_source', 'unknown'
+            ),
+            'speculation': result.get('classification', {}).get('speculation', 'off'),
+        }
+        # classifier 實際使用的模型與降級原因（classifier_model、classifier_fallback_reason）
+        trace_metadata.update(
+            {
+                key: value
+                for key, value in result.get('classification', {}).items()
+                if key in ('classifier_route', 'classifier_model', 'classifier_fallback_reason')
+            }
+        )
+
+        agent_metadata = result.get('agent_metadata', {})
+        if agent_metadata:
+            trace_metadata.update(agent_metadata)
+
+        return response_content, message_type, trace_metadata
 
     def process_user_message(
-        self, user_input: str, map_id: int, user_id: str, essay_plain_text: str = ''
+        self,
+        user_input: str,
+        map_id: int,
+        user_id: str,
+        essay_plain_text: str = '',
+        map_instance: Optional[Map] = None,
     ) -> Dict:
         logger.info(f'Processing essay message: map_id={map_id}, user_id={user_id}')
         logger.debug(f'User input: {user_input[:100]}...')
 
         try:
-            # 1. 獲取 Map 和 Essay
-            try:
-                map_instance = Map.objects.select_related('template').get(id=map_id)
-                logger.debug(
-                    f'Map loaded: nodes={len(map_instance.nodes)}, edges={len(map_instance.edges)}, template_id={map_instance.template_id}'
-                )
-            except Map.DoesNotExist:
-                logger.error(f'Map not found in process_user_message: map_id={map_id}')
-                raise ValueError(f'Map with id {map_id} does not exist')
-
-            # 2. 簡化 Mind Map
-            mind_map_data = {'nodes': map_instance.nodes, 'edges': map_instance.edges}
-            simplified_map_data = simplify_map_data(mind_map_data)
+            # 1~3. 獲取簡化 Mind Map 與文章內容
+            simplified_map_data, article_content, template_key = self._load_map_context(
+                map_id, map_instance
+            )
 
-            # 3. 獲取 Essay 純文字內容（來自前端）
+            # 4. 獲取 Essay 純文字內容（來自前端）
             essay_content = essay_plain_text
             logger.debug(f'Essay content: {essay_content[:100]}...')
 
-            # 4. 獲取文章模板
-            article_content = ''
-            if map_instance.template:
-                article_content = map_instance.template.article_content
-                logger.debug(f'Article content: {article_content[:100]}...')
-
             # 5. 設定 thread_id
             thread_id = f'essay-{map_id}'
             session_id = thread_id
 
-            # 6. Langfuse tracing
-            with self.langfuse.start_as_current_observation(
-                name='essay_interaction',
-                as_type='span',
-            ) as trace_span:
-                with propagate_attributes(session_id=session_id, user_id=user_id):
-                    trace_span.update_trace(input=user_input)
-
-                    langfuse_handler = CallbackHandler()
-
+            # 6. Langfuse tracing（依 route 取樣）
+            # 同一個 thread 的請求依序執行，避免兩個請求讀到相同的 checkpoint 後各自寫入
+            with thread_lock_manager.lock(thread_id):
+                with tracer.trace(
+                    'essay_interaction',
+                    self._get_trace_route(user_input),
+                    session_id=session_id,
+                    user_id=user_id,
+                    input=user_input,
+                ) as trace_span:
                     # 7. 調用 graph
                     result = self.conversation_graph.process_message(
                         user_input=user_input,
@@ -79,35 +163,16 @@ class EssayLangGraphService:
                         essay_content=essay_content,
                         article_content=article_content,
                         thread_id=thread_id,
-                        callbacks=[langfuse_handler],
+                        callbacks=trace_span.callbacks,
+                        template_key=template_key,
                     )
 
                     # 8. 取得回應
-                    if result.get('messages'):
-                        last_message = result['messages'][-1]
-                        response_content = last_message.content
-                        # 從 additional_kwargs 取得 message_type
-                        message_type = getattr(last_message, 'additional_kwargs', {}).get(
-                            'message_type', None
-                        )
-                    else:
-                        response_content = '系統無法產生回應'
-                        message_type = None
+                    record_turn(thread_id, result.get('messages', []))
 
-                    # 9. 更新 trace
-                    trace_metadata = {
-                        'classifier_next_action': result.get('classification', {}).get(
-                            'next_action', 'unknown'
-                        ),
-                        'classifier_reasoning': result.get('classification', {}).get(
-                            'reasoning', 'unknown'
-                        ),
-                    }
-
-                    agent_metadata = result.get('agent_metadata', {})
-                    if agent_metadata:
-                        trace_metadata.update(agent_metadata)
+                    response_content, message_type, trace_metadata = self._summarize_result(result)
 
+                    # 9. 更新 trace
                     trace_span.update_trace(
                         output=response_content,
                         metadata=trace_metadata,
@@ -121,10 +186,13 @@ class EssayLangGraphService:
                 'success': True,
                 'message': response_content,
                 'message_type': message_type,
+                'scoring_cached': trace_metadata.get(SCORING_CACHE_HIT_KEY, False),
                 'classification': result.get('classification', {}),
                 'trace_id': trace_id,
             }
 
+        except ThreadBusyError as e:
+            return thread_busy_result(e)
         except Exception as e:
             logger.exception(f'Essay processing failed: map_id={map_id}')
             return {
@@ -132,52 +200,278 @@ class EssayLangGraphService:
                 'message': 'Sorry, an error occurred while processing your request.',
             }
 
-    def get_conversation_history(self, map_id: int) -> Dict:
-        """獲取對話歷史"""
-        logger.info(f'Getting essay conversation history: map_id={map_id}')
+    def stream_user_message(
+        self,
+        user_input: str,
+        map_id: int,
+        user_id: str,
+        essay_plain_text: str = '',
+        map_instance: Optional[Map] = None,
+    ) -> Iterator[dict]:
+        """
+        以串流方式處理使用者訊息（供 SSE endpoint 使用）
+
+        Yields:
+            dict: {'event': 'token', 'data': {'delta': ...}} 逐步產生的回應文字
+                  {'event': 'done', 'data': {...}} 最終結果（格式同 process_user_message 的回傳值）
+        """
+        logger.info(f'Streaming essay message: map_id={map_id}, user_id={user_id}')
 
         try:
+            simplified_map_data, article_content, template_key = self._load_map_context(
+                map_id, map_instance
+            )
+
             thread_id = f'essay-{map_id}'
-            config = {'configurable': {'thread_id': thread_id}}
+            session_id = thread_id
+
+            # 同一個 thread 的請求依序執行，避免兩個請求讀到相同的 checkpoint 後各自寫入
+            with thread_lock_manager.lock(thread_id):
+                with tracer.trace(
+                    'essay_interaction',
+                    self._get_trace_route(user_input),
+                    session_id=session_id,
+                    user_id=user_id,
+                    input=user_input,
+                    metadata={'streaming': True},
+                ) as trace_span:
+                    result = {}
+                    for kind, payload in self.conversation_graph.stream_message(
+                        user_input=user_input,
+                        mind_map_data=simplified_map_data,
+                        essay_content=essay_plain_text,
+                        article_content=article_content,
+                        thread_id=thread_id,
+                        callbacks=trace_span.callbacks,
+                        template_key=template_key,
+                    ):
+                        if kind == 'token':
+                            yield {'event': 'token', 'data': {'delta': payload}}
+                        else:
+                            result = payload
+
+                    record_turn(thread_id, result.get('messages', []))
+
+                    response_content, message_type, trace_metadata = self._summarize_result(result)
+                    trace_metadata['streaming'] = True
+                    trace_span.update_trace(output=response_content, metadata=trace_metadata)
+                    trace_id = trace_span.trace_id
+
+            logger.info(f'Essay message streamed successfully: map_id={map_id}')
+            yield {
+                'event': 'done',
+                'data': {
+                    'success': True,
+                    'message': response_content,
+                    'message_type': message_type,
+                    'scoring_cached': trace_metadata.get(SCORING_CACHE_HIT_KEY, False),
+                    'classification': result.get('classification', {}),
+                    'trace_id': trace_id,
+                },
+            }
 
-            state_snapshot = self.conversation_graph.graph.get_state(config)
+        except ThreadBusyError as e:
+            yield {'event': 'done', 'data': thread_busy_result(e)}
+        except Exception:
+            logger.exception(f'Essay streaming failed: map_id={map_id}')
+            yield {
+                'event': 'done',
+                'data': {
+                    'success': False,
+                    'message': 'Sorry, an error occurred while processing your request.',
+                },
+            }
 
-            if not state_snapshot or not state_snapshot.values:
-                return {'success': True, 'messages': []}
+    async def aprocess_user_message(
+        self,
+        user_input: str,
+        map_id: int,
+        user_id: str,
+        essay_plain_text: str = '',
+        map_instance: Optional[Map] = None,
+    ) -> Dict:
+        """process_user_message 的 async 版本（ASGI 模式使用）"""
+        logger.info(f'Processing essay message (async): map_id={map_id}, user_id={user_id}')
 
-            state_messages = state_snapshot.values.get('messages', [])
+        try:
+            (
+                simplified_map_data,
+                article_content,
+                template_key,
+            ) = await sync_to_async(self._load_map_context)(map_id, map_instance)
 
-            messages = []
-            for idx, msg in enumerate(state_messages):
-                if hasattr(msg, 'type'):
-                    role = 'user' if msg.type == 'human' else 'assistant'
+            thread_id = f'essay-{map_id}'
+            session_id = thread_id
 
-                    message_data = {'id': idx, 'role': role, 'content': msg.content}
+            # 同一個 thread 的請求依序執行，避免兩個請求讀到相同的 checkpoint 後各自寫入
+            async with thread_lock_manager.alock(thread_id):
+                with tracer.trace(
+                    'essay_interaction',
+                    self._get_trace_route(user_input),
+                    session_id=session_id,
+                    user_id=user_id,
+                    input=user_input,
+                ) as trace_span:
+                    result = await self.conversation_graph.aprocess_message(
+                        user_input=user_input,
+                        mind_map_data=simplified_map_data,
+                        essay_content=essay_plain_text,
+                        article_content=article_content,
+                        thread_id=thread_id,
+                        callbacks=trace_span.callbacks,
+                        template_key=template_key,
+                    )
 
-                    # 解析 user 訊息
-                    if isinstance(msg.content, str) and role == 'user':
-                        try:
-                            parsed_content = json.loads(msg.content)
-                            if isinstance(parsed_content, dict) and 'query' in parsed_content:
-                                message_data['content'] = parsed_content['query']
-                        except (json.JSONDecodeError, ValueError) as e:
-                            logger.warning(
-                                f'Message content is not JSON, using raw content: {str(e)[:100]}'
-                            )
+                    await sync_to_async(record_turn)(thread_id, result.get('messages', []))
 
-                    # 取得 message_type
-                    if role == 'assistant' and hasattr(msg, 'additional_kwargs'):
-                        message_data['message_type'] = msg.additional_kwargs.get(
-                            'message_type', None
-                        )
+                    response_content, message_type, trace_metadata = self._summarize_result(result)
+                    trace_span.update_trace(output=response_content, metadata=trace_metadata)
+                    trace_id = trace_span.trace_id
 
-                    messages.append(message_data)
+            logger.info(f'Essay message processed successfully (async): map_id={map_id}')
+            return {
+                'success': True,
+                'message': response_content,
+                'message_type': message_type,
+                'scoring_cached': trace_metadata.get(SCORING_CACHE_HIT_KEY, False),
+                'classification': result.get('classification', {}),
+                'trace_id': trace_id,
+            }
+
+        except ThreadBusyError as e:
+            return thread_busy_result(e)
+        except Exception:
+            logger.exception(f'Essay processing failed (async): map_id={map_id}')
+            return {
+                'success': False,
+                'message': 'Sorry, an error occurred while processing your request.',
+            }
+
+    async def astream_user_message(
+        self,
+        user_input: str,
+        map_id: int,
+        user_id: str,
+        essay_plain_text: str = '',
+        map_instance: Optional[Map] = None,
+    ) -> AsyncIterator[dict]:
+        """stream_user_message 的 async 版本（ASGI 模式使用）"""
+        logger.info(f'Streaming essay message (async): map_id={map_id}, user_id={user_id}')
+
+        try:
+            (
+                simplified_map_data,
+                article_content,
+                template_key,
+            ) = await sync_to_async(self._load_map_context)(map_id, map_instance)
+
+            thread_id = f'essay-{map_id}'
+            session_id = thread_id
+
+            # 同一個 thread 的請求依序執行，避免兩個請求讀到相同的 checkpoint 後各自寫入
+            async with thread_lock_manager.alock(thread_id):
+                with tracer.trace(
+                    'essay_interaction',
+                    self._get_trace_route(user_input),
+                    session_id=session_id,
+                    user_id=user_id,
+                    input=user_input,
+                    metadata={'streaming': True},
+                ) as trace_span:
+                    result = {}
+                    async for kind, payload in self.conversation_graph.astream_message(
+                        user_input=user_input,
+                        mind_map_data=simplified_map_data,
+                        essay_content=essay_plain_text,
+                        article_content=article_content,
+                        thread_id=thread_id,
+                        callbacks=trace_span.callbacks,
+                        template_key=template_key,
+                    ):
+                        if kind == 'token':
+                            yield {'event': 'token', 'data': {'delta': payload}}
+                        else:
+                            result = payload
+
+                    await sync_to_async(record_turn)(thread_id, result.get('messages', []))
+
+                    response_content, message_type, trace_metadata = self._summarize_result(result)
+                    trace_metadata['streaming'] = True
+                    trace_span.update_trace(output=response_content, metadata=trace_metadata)
+                    trace_id = trace_span.trace_id
+
+            logger.info(f'Essay message streamed successfully (async): map_id={map_id}')
+            yield {
+                'event': 'done',
+                'data': {
+                    'success': True,
+                    'message': response_content,
+                    'message_type': message_type,
+                    'scoring_cached': trace_metadata.get(SCORING_CACHE_HIT_KEY, False),
+                    'classification': result.get('classification', {}),
+                    'trace_id': trace_id,
+                },
+            }
+
+        except ThreadBusyError as e:
+            yield {'event': 'done', 'data': thread_busy_result(e)}
+        except Exception:
+            logger.exception(f'Essay streaming failed (async): map_id={map_id}')
+            yield {
+                'event': 'done',
+                'data': {
+                    'success': False,
+                    'message': 'Sorry, an error occurred while processing your request.',
+                },
+            }
+
+    def get_conversation_history(
+        self,
+        map_id: int,
+        limit: Optional[int] = None,
+        before: Optional[int] = None,
+        etag: Optional[str] = None,
+    ) -> Dict:
+        """
+        讀取對話歷史（從歷史投影讀取，投影不存在或過期時才從 checkpointer 重建）
+
+        Args:
+            map_id: 地圖 ID（作為 thread_id）
+            limit: 回傳最新的幾個回合，None 表示全部
+            before: 分頁 cursor（上一頁回傳的 next_cursor）
+            etag: 前端快取的版本（If-None-Match），與最新 checkpoint 相同時不回傳訊息
+
+        Returns:
+            dict: 包含成功狀態、訊息陣列、etag 與 next_cursor 的字典
+        """
+        logger.info(f'Getting essay conversation history: map_id={map_id}')
+
+        try:
+            thread_id = f'essay-{map_id}'
+            checkpoint_id = get_history_version(thread_id)
+
+            if checkpoint_id is None:
+                return {'success': True, 'messages': [], 'etag': None, 'next_cursor': None}
+            if etag == checkpoint_id:
+                return {'success': True, 'not_modified': True, 'etag': checkpoint_id}
+
+            if get_projected_checkpoint_id(thread_id) != checkpoint_id:
+                # 投影不存在（舊對話）或落後，從 checkpoint 重建
+                config = {'configurable': {'thread_id': thread_id}}
+                state_snapshot = self.conversation_graph.graph.get_state(config)
+                record_history(thread_id, state_snapshot.values.get('messages', []), checkpoint_id)
+
+            messages, next_cursor = load_history(thread_id, limit=limit, before=before)
 
-            logger.debug(f'Retrieved {len(messages)} messages')
             logger.info(
                 f'Essay conversation history retrieved: map_id={map_id}, count={len(messages)}'
             )
-            return {'success': True, 'messages': messages}
+            return {
+                'success': True,
+                'messages': messages,
+                'etag': checkpoint_id,
+                'next_cursor': next_cursor,
+            }
 
         except Exception as e:
             logger.exception(f'Failed to get essay conversation history: map_id={map_id}')
@@ -186,13 +480,61 @@ class EssayLangGraphService:
                 'messages': [],
             }
 
+    async def aget_conversation_history(
+        self,
+        map_id: int,
+        limit: Optional[int] = None,
+        before: Optional[int] = None,
+        etag: Optional[str] = None,
+    ) -> Dict:
+        """get_conversation_history 的 async 版本（ASGI 模式使用）"""
+        logger.info(f'Getting essay conversation history (async): map_id={map_id}')
+
+        try:
+            thread_id = f'essay-{map_id}'
+            checkpoint_id = await sync_to_async(get_history_version)(thread_id)
+
+            if checkpoint_id is None:
+                return {'success': True, 'messages': [], 'etag': None, 'next_cursor': None}
+            if etag == checkpoint_id:
+                return {'success': True, 'not_modified': True, 'etag': checkpoint_id}
+
+            if await sync_to_async(get_projected_checkpoint_id)(thread_id) != checkpoint_id:
+                config = {'configurable': {'thread_id': thread_id}}
+                graph = await self.conversation_graph.get_async_graph()
+                state_snapshot = await graph.aget_state(config)
+                await sync_to_async(record_history)(
+                    thread_id, state_snapshot.values.get('messages', []), checkpoint_id
+                )
+
+            messages, next_cursor = await sync_to_async(load_history)(
+                thread_id, limit=limit, before=before
+            )
+            return {
+                'success': True,
+                'messages': messages,
+                'etag': checkpoint_id,
+                'next_cursor': next_cursor,
+            }
+
+        except Exception:
+            logger.exception(f'Failed to get essay conversation history (async): map_id={map_id}')
+            return {
+                'success': False,
+                'messages': [],
+            }
+
 
 _essay_langgraph_service = None
+_essay_langgraph_service_lock = threading.Lock()
 
 
 def get_essay_langgraph_service() -> EssayLangGraphService:
     """取得 Essay LangGraph 服務實例（單例模式）"""
     global _essay_langgraph_service
     if _essay_langgraph_service is None:
-        _essay_langgraph_service = EssayLangGraphService()
+        # 同時到達的請求（或 warm-up）只建立一次
+        with _essay_langgraph_service_lock:
+            if _essay_langgraph_service is None:
+                _essay_langgraph_service = EssayLangGraphService()
     return _essay_langgraph_service
@@ -0,0 +1,94 @@
+"""
+規則式快速路由（Fast-path Router）
+
+在 LLM classifier 之前以規則判斷意圖，命中時直接決定 next_action，省去一次 LLM 呼叫：
+- sentinel：前端按鈕送出的固定訊息（例如評分按鈕的 [scoring]）
+- rule：高信心的關鍵字 / 正規表示式
+判斷不明確的輸入回傳 None，交給 LLM classifier 處理。
+"""
+
+import json
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.messages import BaseMessage, HumanMessage
+
+logger = logging.getLogger(__name__)
+
+# classification['decision_source'] 的可能值
+DECISION_SOURCE_SENTINEL = 'sentinel'
+DECISION_SOURCE_RULE = 'rule'
+DECISION_SOURCE_LLM = 'llm'
+DECISION_SOURCE_LLM_FALLBACK = 'llm_fallback'
+DECISION_SOURCE_CACHE = 'cache'
+
+# 規則只套用在短句，長句通常包含多個意圖或是對前文的回應，交給 LLM 判斷
+_MAX_RULE_QUERY_LENGTH = 40
+
+
+def get_latest_query(messages: List[BaseMessage]) -> str:
+    """取得最後一則使用者訊息的 query"""
+    for message in reversed(messages):
+        if not isinstance(message, HumanMessage):
+            continue
+        try:
+            data = json.loads(message.content)
+        except (json.JSONDecodeError, TypeError):
+            return message.content if isinstance(message.content, str) else ''
+        if isinstance(data, dict):
+            return str(data.get('query', ''))
+        return ''
+    return ''
+
+
+class FastPathRouter:
+    """規則式快速路由"""
+
+    def __init__(
+        self,
+        sentinels: Dict[str, str],
+        rules: List[Tuple[str, str]],
+    ):
+        """
+        Args:
+            sentinels: {固定訊息: next_action}，完全相符才命中
+            rules: [(正規表示式, next_action)]，依序比對，第一個命中者生效
+        """
+        self.sentinels = {key.strip().lower(): action for key, action in sentinels.items()}
+        self.rules = [(re.compile(pattern, re.IGNORECASE), action) for pattern, action in rules]
+
+    def route(self, messages: List[BaseMessage]) -> Optional[dict]:
+        """
+        以規則判斷意圖
+
+        Returns:
+            dict | None: 命中時回傳與 LLM classifier 相同格式的結果（另含 decision_source），
+                         未命中回傳 None
+        """
+        query = get_latest_query(messages).strip()
+        if not query:
+            return None
+
+        action = self.sentinels.get(query.lower())
+        if action:
+            logger.info(f'Fast-path routed by sentinel: {query} -> {action}')
+            return {
+                'reasoning': f'固定訊息 {query}，直接導向 {action}',
+                'next_action': action,
+                'decision_source': DECISION_SOURCE_SENTINEL,
+            }
+
+        if len(query) > _MAX_RULE_QUERY_LENGTH:
+            return None
+
+        for pattern, action in self.rules:
+            if pattern.search(query):
+                logger.info(f'Fast-path routed by rule: {pattern.pattern} -> {action}')
+                return {
+                    'reasoning': f'符合規則 {pattern.pattern}，直接導向 {action}',
+                    'next_action': action,
+                    'decision_source': DECISION_SOURCE_RULE,
+                }
+
+        return None
@@ -0,0 +1,208 @@
+"""
+對話歷史投影
+
+每輪對話完成後，將新增的訊息整理為前端需要的欄位（id、role、content、message_type）
+存入 ChatHistoryMessage。讀取歷史時只查詢投影，不需要反序列化整個 checkpoint。
+投影以 LangGraph 最新的 checkpoint id 作為版本（同時作為 ETag），版本不一致時從 checkpoint 重建。
+已封存的 thread（checkpoint 已刪除，見 checkpoint_retention）只保留投影。
+"""
+
+import json
+import logging
+from typing import Callable, List, Optional
+
+from django.db import connection, transaction
+from langchain_core.messages import BaseMessage
+
+from apps.chatbot.models import ChatHistoryMessage, ChatHistoryThread
+
+from .checkpoint_retention import archive_thread, prune_thread_after_turn
+from .thread_lock import ThreadBusyError, thread_lock_manager
+
+logger = logging.getLogger(__name__)
+
+
+def get_latest_checkpoint_id(thread_id: str) -> Optional[str]:
+    """
+    查詢 thread 最新的 checkpoint id（只讀取 checkpoints 表的主鍵，不載入內容）
+
+    checkpoint id 為 uuid6，依字串排序即為時間順序
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT checkpoint_id FROM checkpoints '
+            "WHERE thread_id = %s AND checkpoint_ns = '' "
+            'ORDER BY checkpoint_id DESC LIMIT 1',
+            [thread_id],
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get_projected_checkpoint_id(thread_id: str) -> Optional[str]:
+    """取得投影目前對應的 checkpoint id，尚未建立投影時回傳 None"""
+    return (
+        ChatHistoryThread.objects.filter(thread_id=thread_id)
+        .values_list('checkpoint_id', flat=True)
+        .first()
+    )
+
+
+def get_history_version(thread_id: str) -> Optional[str]:
+    """
+    對話歷史的版本（ETag）：最新的 checkpoint id
+
+    已封存的 thread 沒有 checkpoint，使用投影的版本；兩者都不存在時回傳 None
+    """
+    return get_latest_checkpoint_id(thread_id) or get_projected_checkpoint_id(thread_id)
+
+
+def archive_projected_thread(thread_id: str, refresh_history: Callable[[], bool]) -> bool:
+    """
+    確認對話歷史投影為最新後封存 thread（刪除所有 checkpoint）
+
+    確認與刪除都在 thread 鎖內進行，期間完成的對話不會在封存時遺失
+
+    Args:
+        refresh_history: 更新投影（讀取歷史時會從 checkpoint 重建過期的投影），成功時回傳 True
+
+    Returns:
+        bool: 是否已封存；thread 忙碌或投影未更新時略過
+    """
+    try:
+        with thread_lock_manager.lock(thread_id):
+            if not refresh_history():
+                return False
+            if get_projected_checkpoint_id(thread_id) != get_latest_checkpoint_id(thread_id):
+                return False
+            archive_thread(thread_id)
+            return True
+    except ThreadBusyError:
+        return False
+
+
+def _project_message(sequence: int, turn: int, msg: BaseMessage) -> ChatHistoryMessage:
+    """將 BaseMessage 轉換為投影格式"""
+    role = 'user' if msg.type == 'human' else 'assistant'
+    content = msg.content
+    message_type = None
+
+    # 對於 user 訊息，解析並提取 query
+    if isinstance(content, str) and role == 'user':
+        try:
+            parsed_content = json.loads(content)
+            if isinstance(parsed_content, dict) and 'query' in parsed_content:
+                content = parsed_content['query']
+        except (json.JSONDecodeError, ValueError) as e:
+            logger.warning(f'Message content is not JSON, using raw content: {str(e)[:100]}')
+
+    # 對於 assistant 訊息，從 additional_kwargs 取得 message_type
+    if role == 'assistant':
+        message_type = getattr(msg, 'additional_kwargs', {}).get('message_type', None)
+
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False)
+
+    return ChatHistoryMessage(
+        sequence=sequence,
+        turn=turn,
+        role=role,
+        content=content,
+        message_type=message_type,
+    )
+
+
+def record_history(thread_id: str, messages: List[BaseMessage], checkpoint_id: str):
+    """
+    將 state 中尚未投影的訊息寫入投影並更新版本
+
+    messages 為 thread 的完整訊息列表（messages channel 只會 append），
+    已存在的 sequence 會略過，因此重複呼叫或並行寫入都是安全的
+    """
+    with transaction.atomic():
+        thread, _ = ChatHistoryThread.objects.select_for_update().get_or_create(
+            thread_id=thread_id, defaults={'checkpoint_id': checkpoint_id}
+        )
+
+        start = thread.message_count
+        turn = thread.turn_count
+        new_entries = []
+        for sequence in range(start, len(messages)):
+            msg = messages[sequence]
+            if msg.type == 'human':
+                turn += 1
+            entry = _project_message(sequence, max(turn, 1), msg)
+            entry.thread_id = thread_id
+            new_entries.append(entry)
+
+        ChatHistoryMessage.objects.bulk_create(new_entries, ignore_conflicts=True)
+
+        thread.checkpoint_id = checkpoint_id
+        thread.message_count = max(start, len(messages))
+        thread.turn_count = turn
+        thread.save(update_fields=['checkpoint_id', 'message_count', 'turn_count', 'updated_at'])
+
+    logger.debug(f'History projected: thread_id={thread_id}, new_messages={len(new_entries)}')
+
+
+def record_turn(thread_id: str, messages: List[BaseMessage]):
+    """
+    一輪對話完成後更新投影（失敗時只記錄 log，讀取時會從 checkpoint 重建），
+    並依 CHECKPOINT_PRUNE_ON_TURN 清理較舊的 checkpoint
+    """
+    try:
+        checkpoint_id = get_latest_checkpoint_id(thread_id)
+        if checkpoint_id:
+            record_history(thread_id, messages, checkpoint_id)
+    except Exception:
+        logger.exception(f'Failed to update history projection: thread_id={thread_id}')
+        return
+    prune_thread_after_turn(thread_id)
+
+
+def paginate_turns(turns: List[int], limit: int) -> tuple[List[int], Optional[int]]:
+    """
+    從依新到舊排序的回合中取出一頁
+
+    Returns:
+        tuple: (本頁的回合, 下一頁的 cursor；沒有更早的回合時為 None)
+    """
+    if len(turns) > limit:
+        return turns[:limit], turns[limit - 1]
+    return turns, None
+
+
+def load_history(
+    thread_id: str, limit: Optional[int] = None, before: Optional[int] = None
+) -> tuple[list, Optional[int]]:
+    """
+    讀取投影中的訊息
+
+    Args:
+        thread_id: 對話 thread
+        limit: 回傳最新的幾個回合，None 表示全部
+        before: cursor，只回傳此回合之前的訊息
+
+    Returns:
+        tuple: (依時間排序的訊息列表, 下一頁的 cursor；沒有更早的訊息時為 None)
+    """
+    queryset = ChatHistoryMessage.objects.filter(thread_id=thread_id)
+    if before is not None:
+        queryset = queryset.filter(turn__lt=before)
+
+    next_cursor = None
+    if limit is not None:
+        turns, next_cursor = paginate_turns(
+            list(queryset.order_by('-turn').values_list('turn', flat=True).distinct()[: limit + 1]),
+            limit,
+        )
+        queryset = queryset.filter(turn__in=turns)
+
+    messages = []
+    for entry in queryset.order_by('sequence'):
+        message_data = {'id': entry.sequence, 'role': entry.role, 'content': entry.content}
+        if entry.role == 'assistant':
+            message_data['message_type'] = entry.message_type
+        messages.append(message_data)
+
+    return messages, next_cursor
@@ -0,0 +1,172 @@
+"""
+心智圖差異編碼（Map Diff）
+
+每輪 HumanMessage 都帶著完整的簡化心智圖，學生通常只修改了一兩個節點，
+需要完整歷史的 agent（CERCognitiveSupportAgent）卻會在 prompt 中重複送出每一輪的完整心智圖。
+送給 LLM 前以 encode_map_history 改寫歷史訊息：
+- 第一則訊息、無法取得前一輪心智圖、或差異過大時保留完整的 mind_map_data
+- 其餘歷史訊息改為 mind_map_delta（相對於前一輪的新增 / 刪除 / 修改，以節點 id 為 key）
+- 最新一則訊息一定保留完整的 mind_map_data（agent 回答的依據）
+checkpoint 中的訊息不受影響，任一輪的完整心智圖都可以由 apply_map_delta 還原。
+"""
+
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from langchain_core.messages import BaseMessage, HumanMessage
+
+logger = logging.getLogger(__name__)
+
+MAP_FIELD = 'mind_map_data'
+DELTA_FIELD = 'mind_map_delta'
+
+
+def _edge_key(edge: Dict[str, Any]) -> tuple:
+    # simplify_map_data 的 edge 沒有 id，以兩端節點作為識別
+    return edge.get('node1'), edge.get('node2')
+
+
+def compute_map_delta(previous: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    計算兩份簡化心智圖的差異
+
+    Returns:
+        dict: {'nodes': {'added', 'removed', 'edited'}, 'edges': {'added', 'removed'}}，
+              只包含有變更的項目；完全相同時回傳空 dict
+    """
+    previous_nodes = {node['id']: node for node in previous.get('nodes', [])}
+    current_nodes = {node['id']: node for node in current.get('nodes', [])}
+    previous_edges = {_edge_key(edge) for edge in previous.get('edges', [])}
+    current_edges = {_edge_key(edge) for edge in current.get('edges', [])}
+
+    nodes = {
+        'added': [node for node_id, node in current_nodes.items() if node_id not in previous_nodes],
+        'removed': [node_id for node_id in previous_nodes if node_id not in current_nodes],
+        'edited': [
+            node
+            for node_id, node in current_nodes.items()
+            if node_id in previous_nodes and previous_nodes[node_id] != node
+        ],
+    }
+    edges = {
+        'added': [
+            edge for edge in current.get('edges', []) if _edge_key(edge) not in previous_edges
+        ],
+        'removed': [
+            edge for edge in previous.get('edges', []) if _edge_key(edge) not in current_edges
+        ],
+    }
+
+    delta = {}
+    for name, changes in (('nodes', nodes), ('edges', edges)):
+        changes = {kind: items for kind, items in changes.items() if items}
+        if changes:
+            delta[name] = changes
+    return delta
+
+
+def apply_map_delta(previous: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """由前一輪的心智圖與差異還原目前的心智圖（保留原本的節點與連線順序）"""
+    node_changes = delta.get('nodes', {})
+    edge_changes = delta.get('edges', {})
+
+    removed = set(node_changes.get('removed', []))
+    edited = {node['id']: node for node in node_changes.get('edited', [])}
+    nodes = [
+        edited.get(node['id'], node)
+        for node in previous.get('nodes', [])
+        if node['id'] not in removed
+    ]
+    nodes.extend(node_changes.get('added', []))
+
+    removed_edges = {_edge_key(edge) for edge in edge_changes.get('removed', [])}
+    edges = [edge for edge in previous.get('edges', []) if _edge_key(edge) not in removed_edges]
+    edges.extend(edge_changes.get('added', []))
+
+    return {'nodes': nodes, 'edges': edges}
+
+
+def _same_map(left: Dict[str, Any], right: Dict[str, Any]) -> bool:
+    """比較兩份心智圖的內容（節點與連線的順序不影響意義）"""
+    left_nodes, right_nodes = left.get('nodes', []), right.get('nodes', [])
+    left_edges, right_edges = left.get('edges', []), right.get('edges', [])
+    return (
+        len(left_nodes) == len(right_nodes)
+        and {node['id']: node for node in left_nodes} == {node['id']: node for node in right_nodes}
+        and sorted(map(_edge_key, left_edges), key=str)
+        == sorted(map(_edge_key, right_edges), key=str)
+    )
+
+
+def _is_compact(delta: Dict[str, Any], current: Dict[str, Any]) -> bool:
+    """差異是否明顯小於完整心智圖（超過 MAP_DELTA_MAX_RATIO 時送出完整心智圖較容易理解）"""
+    delta_size = len(json.dumps(delta, ensure_ascii=False))
+    full_size = len(json.dumps(current, ensure_ascii=False))
+    return delta_size <= full_size * settings.MAP_DELTA_MAX_RATIO
+
+
+def _encode_map(previous: Optional[Dict[str, Any]], current: Any) -> Optional[Dict[str, Any]]:
+    """回傳 mind_map_delta，不適合差異編碼時回傳 None"""
+    if previous is None or not isinstance(current, dict):
+        return None
+    try:
+        delta = compute_map_delta(previous, current)
+        # 節點 id 重複等情況無法正確還原，改送完整心智圖
+        if not _same_map(apply_map_delta(previous, delta), current):
+            return None
+    except (KeyError, TypeError):
+        logger.warning('Mind map delta encoding failed, sending full map')
+        return None
+    return delta if _is_compact(delta, current) else None
+
+
+def encode_map_history(messages: List[BaseMessage]) -> List[BaseMessage]:
+    """
+    將歷史訊息中的完整心智圖改寫為相對前一輪的差異（messages 需已還原 blob 參考）
+
+    Returns:
+        List[BaseMessage]: 改寫後的訊息；未啟用或沒有可編碼的訊息時回傳原本的列表
+    """
+    if not settings.MAP_DELTA_ENABLED:
+        return messages
+
+    last_human = max(
+        (index for index, message in enumerate(messages) if isinstance(message, HumanMessage)),
+        default=None,
+    )
+
+    encoded = []
+    previous = None
+    for index, message in enumerate(messages):
+        data = None
+        if isinstance(message, HumanMessage) and isinstance(message.content, str):
+            try:
+                data = json.loads(message.content)
+            except json.JSONDecodeError:
+                pass
+        if not isinstance(data, dict) or not isinstance(data.get('context'), dict):
+            encoded.append(message)
+            continue
+
+        current = data['context'].get(MAP_FIELD)
+        delta = None if index == last_human else _encode_map(previous, current)
+        if isinstance(current, dict):
+            previous = current
+
+        if delta is None:
+            encoded.append(message)
+            continue
+
+        context = {key: value for key, value in data['context'].items() if key != MAP_FIELD}
+        context[DELTA_FIELD] = delta
+        encoded.append(
+            HumanMessage(
+                content=json.dumps({**data, 'context': context}, ensure_ascii=False),
+                additional_kwargs=message.additional_kwargs,
+                id=message.id,
+            )
+        )
+
+    return encoded
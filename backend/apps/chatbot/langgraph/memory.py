@@ -0,0 +1,177 @@
+"""
+對話摘要記憶（Rolling Summary Memory）
+
+長對話中 agent 每輪都會收到完整歷史（含每輪的心智圖 / essay），token 與延遲隨輪數增加。
+mindmap 與 essay graph 在 classifier 之前執行 memory node：
+- 保留最近 CONVERSATION_MEMORY_WINDOW_TURNS 輪完整訊息
+- 更早的訊息累積到 CONVERSATION_MEMORY_BATCH_TURNS 輪後，與既有摘要合併成新的摘要（增量更新）
+- 摘要與已摘要的訊息數量存在 graph state（summary / summarized_count），隨 checkpoint 保存
+agent 透過 get_memory_messages 取得「摘要 + 未摘要的訊息」，checkpoint 中的完整歷史不受影響。
+"""
+
+import logging
+from typing import Any, List, Optional, Tuple
+
+from django.conf import settings
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.prompts import PromptTemplate
+
+from apps.common.utils.llm_routing import RoutedChatModel
+
+from .fast_router import get_latest_query
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = PromptTemplate.from_template(
+    """
+# ROLE
+You maintain the running memory of a tutoring conversation between a student and a CER (Claim, Evidence, Reasoning) learning assistant.
+
+# TASK
+Merge the EXISTING SUMMARY with the NEW TURNS into one updated summary that the assistant can rely on instead of the full transcript.
+- Keep: the student's questions and misconceptions, guidance and hints already given, scores or feedback already reported, and commitments the assistant made.
+- Drop: greetings, repeated content, and details of the mind map or essay (the assistant always receives the latest version separately).
+- Write in the same language the student uses, as concise bullet points, no more than 300 words.
+- Output the summary only.
+
+# EXISTING SUMMARY
+{summary}
+
+# NEW TURNS
+{transcript}
+"""
+)
+
+# 摘要在送給 agent 的訊息中的標題
+SUMMARY_HEADER = '[EARLIER CONVERSATION SUMMARY]'
+
+
+def _count_turns(messages: List[BaseMessage]) -> int:
+    return sum(1 for message in messages if isinstance(message, HumanMessage))
+
+
+def select_messages_to_fold(
+    messages: List[BaseMessage], summarized_count: int
+) -> Optional[Tuple[List[BaseMessage], int]]:
+    """
+    選出要併入摘要的訊息
+
+    Args:
+        messages: 完整對話歷史（含本輪訊息）
+        summarized_count: 開頭已併入摘要的訊息數量
+
+    Returns:
+        tuple | None: (要併入摘要的訊息, 新的 summarized_count)；不需要更新摘要時回傳 None
+    """
+    window = settings.CONVERSATION_MEMORY_WINDOW_TURNS
+
+    # 由後往前找出最近 window 輪的起點（以 HumanMessage 為一輪的開始）
+    boundary = len(messages)
+    turns = 0
+    while boundary > summarized_count and turns < window:
+        boundary -= 1
+        if isinstance(messages[boundary], HumanMessage):
+            turns += 1
+    if turns < window:
+        return None
+
+    pending = messages[summarized_count:boundary]
+    if _count_turns(pending) < settings.CONVERSATION_MEMORY_BATCH_TURNS:
+        return None
+    return pending, boundary
+
+
+def format_transcript(messages: List[BaseMessage]) -> str:
+    """將訊息轉為摘要用的逐字稿（只保留 query，不含心智圖等 context）"""
+    lines = []
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            query = get_latest_query([message])
+            if query:
+                lines.append(f'Student: {query}')
+        elif isinstance(message, AIMessage) and isinstance(message.content, str):
+            message_type = message.additional_kwargs.get('message_type', 'assistant')
+            lines.append(f'Assistant ({message_type}): {message.content}')
+    return '\n'.join(lines)
+
+
+def get_memory_messages(state: dict) -> List[BaseMessage]:
+    """
+    取得 agent 使用的對話歷史
+
+    Returns:
+        List[BaseMessage]: 有摘要時為「摘要訊息 + 未摘要的訊息」，否則為完整歷史
+    """
+    messages = state['messages']
+    summary = state.get('summary')
+    if not summary:
+        return messages
+
+    summary_message = HumanMessage(content=f'{SUMMARY_HEADER}\n{summary}')
+    return [summary_message] + messages[state.get('summarized_count', 0) :]
+
+
+class ConversationSummarizer:
+    """以 LLM 增量更新對話摘要"""
+
+    def __init__(self):
+        self.llm = RoutedChatModel('conversation_summary')
+
+    def _prepare_messages(self, summary: str, messages: List[BaseMessage]) -> List[BaseMessage]:
+        content = SUMMARY_PROMPT.format(
+            summary=summary or '(none)', transcript=format_transcript(messages)
+        )
+        return [SystemMessage(content=content), HumanMessage(content='Update the summary.')]
+
+    def _get_pending(self, state: dict) -> Optional[Tuple[List[BaseMessage], int]]:
+        if not settings.CONVERSATION_MEMORY_ENABLED:
+            return None
+        return select_messages_to_fold(state['messages'], state.get('summarized_count', 0))
+
+    @staticmethod
+    def _build_update(response, boundary: int) -> dict:
+        summary = response.content.strip() if isinstance(response.content, str) else ''
+        if not summary:
+            raise ValueError('Empty summary')
+        logger.info(f'Conversation summary updated: summarized_count={boundary}')
+        return {'summary': summary, 'summarized_count': boundary}
+
+    def update(self, state: dict, callbacks: List[Any] = None) -> dict:
+        """
+        需要時更新摘要
+
+        Returns:
+            dict: state 更新（summary / summarized_count），不需要更新或失敗時回傳空 dict
+                  （失敗時 agent 仍使用既有摘要與完整的未摘要訊息，下一輪再重試）
+        """
+        pending = self._get_pending(state)
+        if pending is None:
+            return {}
+
+        messages, boundary = pending
+        try:
+            response = self.llm.invoke(
+                self._prepare_messages(state.get('summary', ''), messages),
+                config={'callbacks': callbacks, 'run_name': 'ConversationSummarizer'},
+            )
+            return self._build_update(response, boundary)
+        except Exception:
+            logger.exception('Conversation summary update failed')
+            return {}
+
+    async def aupdate(self, state: dict, callbacks: List[Any] = None) -> dict:
+        """需要時更新摘要（async 版本）"""
+        pending = self._get_pending(state)
+        if pending is None:
+            return {}
+
+        messages, boundary = pending
+        try:
+            response = await self.llm.ainvoke(
+                self._prepare_messages(state.get('summary', ''), messages),
+                config={'callbacks': callbacks, 'run_name': 'ConversationSummarizer'},
+            )
+            return self._build_update(response, boundary)
+        except Exception:
+            logger.exception('Conversation summary update failed (async)')
+            return {}
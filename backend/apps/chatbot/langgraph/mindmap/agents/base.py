@@ -6,10 +6,20 @@ BaseAgent 抽象基類
 
 import logging
 from abc import ABC, abstractmethod
-from typing import Any, List
+from typing import Any, List, Optional
 
+from asgiref.sync import sync_to_async
 from langchain_core.messages import BaseMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
+
+from apps.common.utils.llm_routing import RoutedChatModel, get_routing_metadata
+from apps.common.utils.structured_output import StructuredOutput
+
+from ...scoring_cache import (
+    SCORING_CACHE_HIT_KEY,
+    compute_scoring_key,
+    get_cached_score,
+    store_score,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -17,17 +27,21 @@ logger = logging.getLogger(__name__)
 class BaseAgent(ABC):
     """所有 Agent 的抽象基類"""
 
-    def __init__(self, temperature: float = 0.7, model: str = 'gemini-2.5-pro'):
+    # 評分類 agent 設定為 cer_scoring / essay_scoring，相同輸入的評分結果會被快取
+    scoring_type: Optional[str] = None
+
+    # 回傳 JSON 的 agent 設定輸出 schema，呼叫時開啟 provider JSON 模式並解析一次
+    # （結果由 get_structured_output 取得）
+    output_schema: Optional[StructuredOutput] = None
+
+    def __init__(self, route: str):
         """
         初始化 BaseAgent
 
         Args:
-            temperature: LLM 的溫度參數，控制輸出的隨機性
+            route: settings.LLM_ROUTES 中的 route 名稱（決定模型、溫度、延遲預算與 fallback 模型）
         """
-        self.llm = ChatGoogleGenerativeAI(
-            model=model,
-            temperature=temperature,
-        )
+        self.llm = RoutedChatModel(route)
 
     @abstractmethod
     def prepare_messages(self, messages: List[BaseMessage], **kwargs) -> List[BaseMessage]:
@@ -69,6 +83,33 @@ class BaseAgent(ABC):
         """
         pass
 
+    def create_stream_parser(self):
+        """
+        建立串流輸出用的解析器（子類可覆寫）
+
+        Returns:
+            解析器實例（需提供 feed(chunk) -> str），None 表示此 agent 不串流輸出
+        """
+        return None
+
+    def get_scoring_cache_key(self, final_messages: List[BaseMessage]) -> Optional[str]:
+        """評分結果快取的 key，非評分類 agent（或快取停用）回傳 None"""
+        if self.scoring_type is None:
+            return None
+        return compute_scoring_key(
+            self.scoring_type, self.llm.model, self.prompt_template, final_messages
+        )
+
+    def _invoke_llm(self, final_messages: List[BaseMessage], config: dict):
+        if self.output_schema is None:
+            return self.llm.invoke(final_messages, config=config)
+        return self.output_schema.invoke(self.llm, final_messages, config=config)
+
+    async def _ainvoke_llm(self, final_messages: List[BaseMessage], config: dict):
+        if self.output_schema is None:
+            return await self.llm.ainvoke(final_messages, config=config)
+        return await self.output_schema.ainvoke(self.llm, final_messages, config=config)
+
     def process(
         self, messages: List[BaseMessage], callbacks: List[Any] = None, **kwargs
     ) -> tuple[str, dict]:
@@ -91,20 +132,87 @@ class BaseAgent(ABC):
             final_messages = self.prepare_messages(messages, **kwargs)
             logger.info(f'{agent_name}: Messages prepared')
 
+            # 相同內容已評分過時直接回傳，不呼叫 LLM
+            cache_key = self.get_scoring_cache_key(final_messages)
+            if cache_key:
+                cached = get_cached_score(cache_key)
+                if cached is not None:
+                    return cached
+
             # 呼叫 LLM
-            response = self.llm.invoke(
+            response = self._invoke_llm(
                 final_messages, config={'callbacks': callbacks, 'run_name': agent_name}
             )
             logger.info(f'{agent_name}: LLM invoked')
 
-            # 處理回應並提取 metadata
-            response_text = self.process_response(response)
-            logger.info(f'{agent_name}: Response processed')
-
-            metadata = self.extract_metadata(response)
-
-            return response_text, metadata
+            return self._finalize_response(response, cache_key)
 
         except Exception as e:
             logger.exception(f'{agent_name}: Processing failed')
             raise
+
+    async def aprocess(
+        self, messages: List[BaseMessage], callbacks: List[Any] = None, **kwargs
+    ) -> tuple[str, dict]:
+        """
+        統一的處理流程（async 版本，供 ASGI 模式使用）
+
+        Args:
+            同 process
+
+        Returns:
+            tuple: (處理後的回應文字, metadata 字典)
+        """
+        agent_name = self.__class__.__name__
+        logger.info(f'{agent_name}: Processing {len(messages)} messages (async)')
+
+        try:
+            # prepare_messages 可能需要從資料庫還原 context，在 thread 中執行
+            final_messages = await sync_to_async(self.prepare_messages)(messages, **kwargs)
+
+            cache_key = self.get_scoring_cache_key(final_messages)
+            if cache_key:
+                cached = await sync_to_async(get_cached_score)(cache_key)
+                if cached is not None:
+                    return cached
+
+            response = await self._ainvoke_llm(
+                final_messages, config={'callbacks': callbacks, 'run_name': agent_name}
+            )
+            logger.info(f'{agent_name}: LLM invoked (async)')
+
+            if cache_key:
+                return await sync_to_async(self._finalize_response)(response, cache_key)
+            return self._finalize_response(response)
+
+        except Exception:
+            logger.exception(f'{agent_name}: Async processing failed')
+            raise
+
+    def _finalize_response(self, response, cache_key: Optional[str] = None) -> tuple[str, dict]:
+        """處理回應並提取 metadata（有 cache_key 時儲存評分結果）"""
+        agent_name = self.__class__.__name__
+
+        response_text = self.process_response(response)
+        logger.info(f'{agent_name}: Response processed')
+
+        metadata = self.extract_metadata(response)
+        routing_metadata = get_routing_metadata(response)
+
+        if cache_key:
+            # 只快取解析成功、且由主要模型產生的評分結果
+            if metadata and not routing_metadata.get('llm_fallback_reason'):
+                store_score(
+                    cache_key,
+                    self.scoring_type,
+                    self.llm.model,
+                    self.prompt_template,
+                    response_text,
+                    metadata,
+                )
+            metadata[SCORING_CACHE_HIT_KEY] = False
+
+        # 實際使用的模型與降級原因
+        metadata.update(routing_metadata)
+
+        return response_text, metadata
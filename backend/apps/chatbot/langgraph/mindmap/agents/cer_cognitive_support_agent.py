@@ -5,12 +5,20 @@ CERCognitiveSupportAgent - CER 認知學習支援 Agent
 """
 
 import logging
-from typing import List
+from typing import List, Optional
 
-from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.messages import BaseMessage
 
-from apps.common.utils.json_parser import parse_llm_json_response
+from apps.common.utils.prompt_cache import prompt_assembly_cache
+from apps.common.utils.stream_parser import JsonFieldStreamParser
+from apps.common.utils.structured_output import (
+    StructuredOutput,
+    SupportResponse,
+    get_structured_output,
+)
 
+from ...context_store import rehydrate_messages
+from ...map_diff import encode_map_history
 from ..prompts import CER_COGNITIVE_SUPPORT_PROMPT
 from .base import BaseAgent
 
@@ -20,13 +28,20 @@ logger = logging.getLogger(__name__)
 class CERCognitiveSupportAgent(BaseAgent):
     """CER 認知學習支援 Agent"""
 
+    # final_response 已串流給使用者，解析失敗時不重試
+    output_schema = StructuredOutput('cer_cognitive_support', SupportResponse, retry=False)
+
     def __init__(self):
         """初始化 CERCognitiveSupportAgent"""
-        super().__init__(temperature=0.5)
+        super().__init__(route='cer_cognitive_support')
         self.prompt_template = CER_COGNITIVE_SUPPORT_PROMPT
 
     def prepare_messages(
-        self, messages: List[BaseMessage], article_content: str = '', **kwargs
+        self,
+        messages: List[BaseMessage],
+        article_content: str = '',
+        template_key: Optional[str] = None,
+        **kwargs,
     ) -> List[BaseMessage]:
         """
         準備訊息：格式化 prompt（注入 article_content），保留完整 context
@@ -34,18 +49,26 @@ class CERCognitiveSupportAgent(BaseAgent):
         Args:
             messages: 原始對話歷史
             article_content: 文章內容（從 template 取得）
+            template_key: template 的快取識別（None 時不使用 system prompt 快取）
             **kwargs: 未使用的額外參數
 
         Returns:
             List[BaseMessage]: SystemMessage（已格式化）+ 原始訊息
         """
-        system_message_content = self.prompt_template.format(article_content=article_content)
+        system_message = prompt_assembly_cache.render(
+            'cer_cognitive_support', self.prompt_template, article_content, template_key
+        )
+
+        # 歷史訊息只送出心智圖的變更，最新一則保留完整心智圖
+        return [system_message] + encode_map_history(rehydrate_messages(messages))
 
-        return [SystemMessage(content=system_message_content)] + messages
+    def create_stream_parser(self) -> JsonFieldStreamParser:
+        """串流輸出時只推送 JSON 回應中的 final_response 欄位"""
+        return JsonFieldStreamParser('final_response')
 
     def process_response(self, response) -> str:
         """
-        處理回應：解析 JSON 並提取 final_response
+        處理回應：取出已解析 JSON 的 final_response
 
         Args:
             response: LLM 的回應
@@ -53,19 +76,15 @@ class CERCognitiveSupportAgent(BaseAgent):
         Returns:
             str: final_response 的內容，或完整回應（如果解析失敗）
         """
-        try:
-            result = parse_llm_json_response(response.content)
-            if 'final_response' not in result:
-                logger.warning('Response missing final_response field, using raw content')
-                return response.content
-            return result['final_response']
-        except Exception as e:
-            logger.warning(f'Failed to parse response: {str(e)[:100]}, using raw content')
+        result = get_structured_output(response)
+        if result is None:
+            logger.warning('Invalid structured response, using raw content')
             return response.content
+        return result['final_response']
 
     def extract_metadata(self, response) -> dict:
         """
-        提取 metadata：從 JSON 回應中提取 reasoning, response_strategy, strategy_detail
+        提取 metadata：從已解析的 JSON 回應中提取 reasoning, response_strategy, strategy_detail
 
         Args:
             response: LLM 的回應
@@ -73,13 +92,11 @@ class CERCognitiveSupportAgent(BaseAgent):
         Returns:
             dict: metadata 包含 reasoning, response_strategy, strategy_detail
         """
-        try:
-            result = parse_llm_json_response(response.content)
-            return {
-                'reasoning': result.get('reasoning', ''),
-                'response_strategy': result.get('response_strategy', ''),
-                'strategy_detail': result.get('strategy_detail', ''),
-            }
-        except Exception as e:
-            logger.warning(f'Failed to extract metadata: {str(e)[:100]}')
+        result = get_structured_output(response)
+        if result is None:
             return {}
+        return {
+            'reasoning': result['reasoning'],
+            'response_strategy': result['response_strategy'],
+            'strategy_detail': result['strategy_detail'],
+        }
@@ -9,6 +9,7 @@ from typing import List
 from langchain_core.messages import BaseMessage, SystemMessage
 
 from apps.common.utils.message_filter import filter_messages
+from apps.common.utils.stream_parser import RawTextStreamParser
 
 from ..prompts import OPERATOR_SUPPORT_PROMPT
 from .base import BaseAgent
@@ -19,7 +20,7 @@ class OperatorSupportAgent(BaseAgent):
 
     def __init__(self):
         """初始化 OperatorSupportAgent"""
-        super().__init__(temperature=0.3)
+        super().__init__(route='operator_support')
         self.system_prompt = OPERATOR_SUPPORT_PROMPT
 
     def prepare_messages(self, messages: List[BaseMessage], **kwargs) -> List[BaseMessage]:
@@ -36,6 +37,10 @@ class OperatorSupportAgent(BaseAgent):
         filtered_messages = filter_messages(messages, context_fields_to_keep=[])
         return [SystemMessage(content=self.system_prompt)] + filtered_messages
 
+    def create_stream_parser(self) -> RawTextStreamParser:
+        """串流輸出時直接推送 LLM 的原始文字"""
+        return RawTextStreamParser()
+
     def process_response(self, response) -> str:
         """
         處理回應：直接回傳 LLM 的內容
@@ -6,36 +6,62 @@ ScoringAgent - CER 評分 Agent
 
 import json
 import logging
-from typing import List
+from typing import List, Optional, Union
 
-from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from langchain_core.messages import BaseMessage, HumanMessage
+from pydantic import BaseModel
 
-from apps.common.utils.json_parser import parse_llm_json_response
+from apps.common.utils.prompt_cache import prompt_assembly_cache
+from apps.common.utils.structured_output import StructuredOutput, get_structured_output
 
+from ...context_store import resolve_context_value
 from ..prompts.scoring_prompt import SCORING_PROMPT
 from .base import BaseAgent
 
 logger = logging.getLogger(__name__)
 
 
+class ScoreItem(BaseModel):
+    """單一評分面向"""
+
+    # prompt 未限定格式（數字或「Y分」），保留模型原本的輸出
+    score: Union[int, float, str]
+    feedback: str
+
+
+class CERScoringResult(BaseModel):
+    """CER 評分結果（欄位順序與 prompt 的 OUTPUT FORMAT 相同）"""
+
+    Claim_Coverage: ScoreItem
+    Claim_Precision: ScoreItem
+    Evidence_Coverage_and_Accuracy: ScoreItem
+    Evidence_Connection_Accuracy: ScoreItem
+    Reasoning_Accuracy: ScoreItem
+
+
 class ScoringAgent(BaseAgent):
     """CER 評分 Agent - 單一請求模式"""
 
+    scoring_type = 'cer_scoring'
+    output_schema = StructuredOutput('cer_scoring', CERScoringResult)
+
     def __init__(self):
         """初始化 ScoringAgent"""
-        super().__init__(temperature=0.5, model='gemini-3-pro-preview')
+        super().__init__(route='cer_scoring')
         self.prompt_template = SCORING_PROMPT
 
     def prepare_messages(
         self,
         messages: List[BaseMessage],
         article_content: str = '',
+        template_key: Optional[str] = None,
         **kwargs,
     ) -> List[BaseMessage]:
         """
         Args:
             messages: 原始對話歷史
             article_content: 文章內容
+            template_key: template 的快取識別（None 時不使用 system prompt 快取）
             **kwargs: 未使用的額外參數
 
         Returns:
@@ -46,22 +72,26 @@ class ScoringAgent(BaseAgent):
 
         try:
             content = json.loads(last_message.content)
-            mind_map_data = content.get('context', {}).get('mind_map_data', {})
+            mind_map_data = resolve_context_value(
+                content.get('context', {}).get('mind_map_data', {}), default={}
+            )
         except (json.JSONDecodeError, AttributeError) as e:
             logger.warning(f'Failed to parse mind_map_data: {str(e)[:100]}')
 
-        system_message_content = self.prompt_template.format(article_content=article_content)
+        system_message = prompt_assembly_cache.render(
+            'cer_scoring', self.prompt_template, article_content, template_key
+        )
 
         human_message_content = json.dumps(mind_map_data, ensure_ascii=False)
 
         return [
-            SystemMessage(content=system_message_content),
+            system_message,
             HumanMessage(content=human_message_content),
         ]
 
     def process_response(self, response) -> str:
         """
-        處理回應：解析並驗證 JSON 評分結果
+        處理回應：輸出已解析並驗證的 JSON 評分結果
 
         期望 LLM 回傳 JSON 格式：
         {
@@ -78,30 +108,16 @@ class ScoringAgent(BaseAgent):
         Returns:
             str: 格式化的 JSON 字串（如果解析成功）或原始內容（如果解析失敗）
         """
-
-        try:
-            result = parse_llm_json_response(response.content)
-            required_keys = [
-                'Claim_Coverage',
-                'Claim_Precision',
-                'Evidence_Coverage_and_Accuracy',
-                'Evidence_Connection_Accuracy',
-                'Reasoning_Accuracy',
-            ]
-            for key in required_keys:
-                if key not in result:
-                    logger.warning(f'Scoring result missing {key} field, using raw content')
-                    return response.content
-
-            return json.dumps(result, ensure_ascii=False, indent=2)
-
-        except Exception as e:
-            logger.warning(f'Failed to parse scoring result: {str(e)[:100]}, using raw content')
+        result = get_structured_output(response)
+        if result is None:
+            logger.warning('Invalid scoring result, using raw content')
             return response.content
 
+        return json.dumps(result, ensure_ascii=False, indent=2)
+
     def extract_metadata(self, response) -> dict:
         """
-        提取 metadata：從 JSON 回應中提取完整的評分資訊
+        提取 metadata：從已解析的評分結果中提取完整的評分資訊
 
         Args:
             response: LLM 的回應
@@ -109,41 +125,19 @@ class ScoringAgent(BaseAgent):
         Returns:
             dict: metadata 包含 Claim, Evidence, Reasoning 的評分資訊
         """
-        try:
-            result = parse_llm_json_response(response.content)
-            required_keys = [
-                'Claim_Coverage',
-                'Claim_Precision',
-                'Evidence_Coverage_and_Accuracy',
-                'Evidence_Connection_Accuracy',
-                'Reasoning_Accuracy',
-            ]
-
-            for key in required_keys:
-                if key not in result:
-                    return {}
-
-            return {
-                'claim_coverage_score': result['Claim_Coverage'].get('score', ''),
-                'claim_coverage_feedback': result['Claim_Coverage'].get('feedback', ''),
-                'claim_precision_score': result['Claim_Precision'].get('score', ''),
-                'claim_precision_feedback': result['Claim_Precision'].get('feedback', ''),
-                'evidence_coverage_score': result['Evidence_Coverage_and_Accuracy'].get(
-                    'score', ''
-                ),
-                'evidence_coverage_feedback': result['Evidence_Coverage_and_Accuracy'].get(
-                    'feedback', ''
-                ),
-                'evidence_connection_score': result['Evidence_Connection_Accuracy'].get(
-                    'score', ''
-                ),
-                'evidence_connection_feedback': result['Evidence_Connection_Accuracy'].get(
-                    'feedback', ''
-                ),
-                'reasoning_score': result['Reasoning_Accuracy'].get('score', ''),
-                'reasoning_feedback': result['Reasoning_Accuracy'].get('feedback', ''),
-            }
-
-        except Exception as e:
-            logger.warning(f'Failed to extract metadata: {str(e)[:100]}')
+        result = get_structured_output(response)
+        if result is None:
             return {}
+
+        return {
+            'claim_coverage_score': result['Claim_Coverage']['score'],
+            'claim_coverage_feedback': result['Claim_Coverage']['feedback'],
+            'claim_precision_score': result['Claim_Precision']['score'],
+            'claim_precision_feedback': result['Claim_Precision']['feedback'],
+            'evidence_coverage_score': result['Evidence_Coverage_and_Accuracy']['score'],
+            'evidence_coverage_feedback': result['Evidence_Coverage_and_Accuracy']['feedback'],
+            'evidence_connection_score': result['Evidence_Connection_Accuracy']['score'],
+            'evidence_connection_feedback': result['Evidence_Connection_Accuracy']['feedback'],
+            'reasoning_score': result['Reasoning_Accuracy']['score'],
+            'reasoning_feedback': result['Reasoning_Accuracy']['feedback'],
+        }
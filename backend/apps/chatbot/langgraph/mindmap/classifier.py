@@ -7,16 +7,45 @@ import json
 import logging
 from typing import Any, List
 
+from asgiref.sync import sync_to_async
 from langchain_core.messages import BaseMessage, SystemMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
 
 from apps.common.utils.json_parser import parse_llm_json_response
+from apps.common.utils.llm_routing import RoutedChatModel, get_routing_metadata
 from apps.common.utils.message_filter import filter_messages
 
+from ..decision_cache import ClassifierDecisionCache
+from ..fast_router import DECISION_SOURCE_LLM, DECISION_SOURCE_LLM_FALLBACK
 from .prompts import CLASSIFIER_PROMPT
 
 logger = logging.getLogger(__name__)
 
+# 快速路由規則（在 LLM classifier 之前判斷，命中時不呼叫 LLM）
+FAST_PATH_SENTINELS = {
+    '[scoring]': 'cer_scoring',
+}
+
+FAST_PATH_RULES = [
+    (
+        r'^(請|麻煩)?(幫我|幫忙)?(評分|打分數?|給我?分數|評估我的(心智圖|CER))(吧|一下)?[。!！]*$',
+        'cer_scoring',
+    ),
+    (r'^(please )?(score|grade) my (mind ?map|map|cer)( please)?[.!]*$', 'cer_scoring'),
+    # 操作問題只比對整句（僅允許結尾標點），句中提到操作的內容問題交給 LLM classifier
+    (
+        r'^(請問)?(要)?(怎麼|如何|要怎樣)(新增|增加|刪除|移除|連接|移動|編輯)(一個)?(節點|連線|線)(呢)?[?？。!！]*$',
+        'operator_support',
+    ),
+    (
+        r'^(請問)?(要)?(怎麼|如何|要怎樣)(畫線|拉線|連線|存檔|儲存|復原)(呢)?[?？。!！]*$',
+        'operator_support',
+    ),
+    (
+        r'^how (do i|to|can i) (add|delete|remove|connect|move|edit) (a |the )?(node|edge|line)s?[?.!]*$',
+        'operator_support',
+    ),
+]
+
 
 class IntentClassifier:
     """意圖分類器 - Context-Aware Router"""
@@ -25,16 +54,15 @@ class IntentClassifier:
         """
         初始化分類器
         """
-        # 使用 LangChain 的 ChatGoogleGenerativeAI
-        # API key 會自動從環境變數 GOOGLE_API_KEY 讀取
-        self.llm = ChatGoogleGenerativeAI(
-            model='gemini-2.5-pro',
-            temperature=0.3,
-        )
+        # 路由類的輕量工作使用 flash 等級模型（設定見 settings.LLM_ROUTES）
+        self.llm = RoutedChatModel('mindmap_classifier')
 
         # 使用預定義的 prompt
         self.system_prompt = CLASSIFIER_PROMPT
 
+        # 分類結果快取（key 含 prompt 版本，prompt 或模型變更後自動失效）
+        self.decision_cache = ClassifierDecisionCache('mindmap', self.system_prompt, self.llm.model)
+
     def classify(self, messages: List[BaseMessage], callbacks: List[Any] = None) -> dict:
         """
         分類使用者意圖
@@ -48,10 +76,12 @@ class IntentClassifier:
             dict: 包含 reasoning 和 next_action 的字典
                   next_action 為 "operator_support" 或 "cer_cognitive_support"
         """
-        filtered_messages = filter_messages(messages, context_fields_to_keep=[])
+        cache_key = self.decision_cache.make_key(messages)
+        cached = self.decision_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-        # 使用 List Injection，LLM 會自動讀取 JSON 中的 query
-        final_messages = [SystemMessage(content=self.system_prompt)] + filtered_messages
+        final_messages = self._prepare_messages(messages)
 
         try:
             # 呼叫 LLM（直接傳遞 List[BaseMessage]）
@@ -59,32 +89,83 @@ class IntentClassifier:
             response = self.llm.invoke(
                 final_messages, config={'callbacks': callbacks, 'run_name': 'IntentClassifier'}
             )
-            # 提取並解析 JSON
-            result = parse_llm_json_response(response.content)
+            result = self._parse_result(response)
+            self.decision_cache.set(cache_key, result)
+            return result
+
+        except Exception as e:
+            return self._fallback_result(e)
 
-            # 驗證回應格式
-            if 'next_action' not in result:
-                raise ValueError('分類結果缺少 next_action 欄位')
+    async def aclassify(self, messages: List[BaseMessage], callbacks: List[Any] = None) -> dict:
+        """
+        分類使用者意圖（async 版本，供 ASGI 模式使用）
+
+        Args:
+            同 classify
+
+        Returns:
+            dict: 包含 reasoning 和 next_action 的字典
+        """
+        cache_key = self.decision_cache.make_key(messages)
+        cached = await sync_to_async(self.decision_cache.get)(cache_key)
+        if cached is not None:
+            return cached
 
-            # 驗證分類結果是否合法
-            valid_actions = ['operator_support', 'cer_cognitive_support', 'cer_scoring']
-            if result['next_action'] not in valid_actions:
-                raise ValueError(f'無效的分類結果: {result["next_action"]}')
+        final_messages = self._prepare_messages(messages)
 
-            logger.info(f'Classification result: {result.get("next_action")}')
+        try:
+            logger.info('Invoking classifier LLM (async)')
+            response = await self.llm.ainvoke(
+                final_messages, config={'callbacks': callbacks, 'run_name': 'IntentClassifier'}
+            )
+            result = self._parse_result(response)
+            await sync_to_async(self.decision_cache.set)(cache_key, result)
             return result
 
-        except json.JSONDecodeError as e:
-            logger.warning(f'JSON parsing error: {str(e)[:100]}')
-            # 預設回傳 cer_cognitive_support
-            return {
-                'reasoning': 'JSON 解析失敗，預設為 cer_cognitive_support',
-                'next_action': 'cer_cognitive_support',
-            }
         except Exception as e:
-            logger.exception('Classifier failed')
+            return self._fallback_result(e)
+
+    def _prepare_messages(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        """過濾 context 後組成分類器的輸入訊息"""
+        filtered_messages = filter_messages(messages, context_fields_to_keep=[])
+
+        # 使用 List Injection，LLM 會自動讀取 JSON 中的 query
+        return [SystemMessage(content=self.system_prompt)] + filtered_messages
+
+    def _parse_result(self, response) -> dict:
+        """解析並驗證分類結果"""
+        # 提取並解析 JSON
+        result = parse_llm_json_response(response.content)
+
+        # 驗證回應格式
+        if 'next_action' not in result:
+            raise ValueError('分類結果缺少 next_action 欄位')
+
+        # 驗證分類結果是否合法
+        valid_actions = ['operator_support', 'cer_cognitive_support', 'cer_scoring']
+        if result['next_action'] not in valid_actions:
+            raise ValueError(f'無效的分類結果: {result["next_action"]}')
+
+        logger.info(f'Classification result: {result.get("next_action")}')
+        result['decision_source'] = DECISION_SOURCE_LLM
+        result.update(get_routing_metadata(response, prefix='classifier'))
+        return result
+
+    def _fallback_result(self, error: Exception) -> dict:
+        """分類失敗時的預設結果"""
+        if isinstance(error, json.JSONDecodeError):
+            logger.warning(f'JSON parsing error: {str(error)[:100]}')
             # 預設回傳 cer_cognitive_support
             return {
-                'reasoning': f'發生錯誤: {str(e)}',
+                'reasoning': 'JSON 解析失敗，預設為 cer_cognitive_support',
                 'next_action': 'cer_cognitive_support',
+                'decision_source': DECISION_SOURCE_LLM_FALLBACK,
             }
+
+        logger.exception('Classifier failed')
+        # 預設回傳 cer_cognitive_support
+        return {
+            'reasoning': f'發生錯誤: {str(error)}',
+            'next_action': 'cer_cognitive_support',
+            'decision_source': DECISION_SOURCE_LLM_FALLBACK,
+        }
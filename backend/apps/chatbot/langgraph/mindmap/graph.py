@@ -3,19 +3,36 @@ LangGraph 對話流程
 採用全路由架構 + PostgreSQL 持久化：Classifier → Expert Agents
 """
 
+import asyncio
 import json
 import operator
-from typing import Annotated, Any, Dict, List, Literal, TypedDict
-
+from typing import (
+    Annotated,
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    TypedDict,
+)
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
-from langchain_core.runnables import RunnableConfig
-from langgraph.checkpoint.postgres import PostgresSaver
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from langgraph.graph import END, START, StateGraph
-from psycopg.rows import dict_row
-from psycopg_pool import ConnectionPool
 
+from ..checkpointer import acreate_checkpointer, create_checkpointer
+from ..context_store import dehydrate_context
+from ..fast_router import FastPathRouter
+from ..memory import ConversationSummarizer, get_memory_messages
+from ..speculation import SPECULATION_HIT, arun_speculative, predict_agent, run_speculative
+from ..streaming import astream_graph, stream_graph
 from .agents import AgentManager
-from .classifier import IntentClassifier
+from .classifier import FAST_PATH_RULES, FAST_PATH_SENTINELS, IntentClassifier
 
 
 # 定義狀態結構
@@ -23,24 +40,11 @@ class AgentState(TypedDict):
     messages: Annotated[List[BaseMessage], operator.add]
     classification: Dict[str, Any]
     article_content: str
+    template_key: Optional[str]
     agent_metadata: Dict[str, Any]
-
-
-def create_checkpointer(db_url: str) -> PostgresSaver:
-    """建立 PostgreSQL checkpointer"""
-    conn_pool = ConnectionPool(
-        conninfo=db_url,
-        max_size=20,
-        kwargs={
-            'autocommit': True,
-            'prepare_threshold': 0,
-            'row_factory': dict_row,
-        },
-    )
-    checkpointer = PostgresSaver(conn_pool)
-    checkpointer.setup()
-
-    return checkpointer
+    # 對話摘要記憶：較早訊息的摘要，以及 messages 開頭已併入摘要的數量
+    summary: str
+    summarized_count: int
 
 
 class ConversationGraph:
@@ -55,22 +59,113 @@ class ConversationGraph:
         """
         self.db_url = db_url
         self.checkpointer = create_checkpointer(db_url)
+        self.fast_router = FastPathRouter(FAST_PATH_SENTINELS, FAST_PATH_RULES)
         self.classifier = IntentClassifier()
         self.agent_manager = AgentManager()
-        self.graph = self._build_graph()
+        self.summarizer = ConversationSummarizer()
+
+        # 推測執行：classifier 執行的同時先執行預測的對話型 agent
+        self.speculative = settings.SPECULATIVE_EXECUTION_ENABLED
+        self._speculative_nodes = {
+            'operator_support': (self._operator_support_node, self._aoperator_support_node),
+            'cer_cognitive_support': (
+                self._cer_cognitive_support_node,
+                self._acer_cognitive_support_node,
+            ),
+        }
+
+        self.graph = self._build_graph(self.checkpointer)
+
+        # ASGI 模式使用的 graph（AsyncPostgresSaver），第一次使用時才建立
+        self._async_graph = None
+        self._async_graph_lock = asyncio.Lock()
+
+    async def get_async_graph(self):
+        """取得使用 AsyncPostgresSaver 的 graph（第一次呼叫時在目前的 event loop 建立連線池）"""
+        if self._async_graph is None:
+            async with self._async_graph_lock:
+                if self._async_graph is None:
+                    checkpointer = await acreate_checkpointer(self.db_url)
+                    self._async_graph = self._build_graph(checkpointer)
+        return self._async_graph
+
+    def _memory_node(self, state: AgentState, config: RunnableConfig) -> dict:
+        """Node: 將超出視窗的較早訊息併入對話摘要"""
+        return self.summarizer.update(state, config.get('callbacks', []))
+
+    async def _amemory_node(self, state: AgentState, config: RunnableConfig) -> dict:
+        """Node: 將超出視窗的較早訊息併入對話摘要（async）"""
+        return await self.summarizer.aupdate(state, config.get('callbacks', []))
 
     def _classifier_node(self, state: AgentState, config: RunnableConfig) -> dict:
         """Node: 意圖分類"""
+        # 規則可判斷的輸入（例如 [scoring]）不呼叫 LLM classifier
+        classification = self.fast_router.route(state['messages'])
+        if classification is not None:
+            return {'classification': classification}
+
         callbacks = config.get('callbacks', [])
-        classification = self.classifier.classify(state['messages'], callbacks)
+        predicted = self._predict_agent(state, config)
+        if predicted is None:
+            return {'classification': self.classifier.classify(state['messages'], callbacks)}
+
+        sync_node, _ = self._speculative_nodes[predicted]
+        return run_speculative(
+            'mindmap',
+            predicted,
+            lambda: self.classifier.classify(state['messages'], callbacks),
+            lambda: sync_node(state, config),
+        )
 
-        return {'classification': classification}
+    async def _aclassifier_node(self, state: AgentState, config: RunnableConfig) -> dict:
+        """Node: 意圖分類（async）"""
+        classification = self.fast_router.route(state['messages'])
+        if classification is not None:
+            return {'classification': classification}
+
+        callbacks = config.get('callbacks', [])
+        predicted = self._predict_agent(state, config)
+        if predicted is None:
+            return {'classification': await self.classifier.aclassify(state['messages'], callbacks)}
+
+        _, async_node = self._speculative_nodes[predicted]
+        return await arun_speculative(
+            'mindmap',
+            predicted,
+            lambda: self.classifier.aclassify(state['messages'], callbacks),
+            lambda: async_node(state, config),
+        )
+
+    def _predict_agent(self, state: AgentState, config: RunnableConfig):
+        """
+        決定本輪要推測執行的 agent
+
+        只有呼叫端在 configurable 中開啟 speculative 時才推測（串流模式需等分類完成才能輸出 token，不推測）
+        """
+        if not config.get('configurable', {}).get('speculative'):
+            return None
+        return predict_agent(
+            state['messages'], list(self._speculative_nodes), 'cer_cognitive_support'
+        )
 
     def _operator_support_node(self, state: AgentState, config: RunnableConfig) -> dict:
         """Node: 介面支援 Agent"""
         agent = self.agent_manager.get_agent('operator_support')
         callbacks = config.get('callbacks', [])
-        response, metadata = agent.process(state['messages'], callbacks)
+        response, metadata = agent.process(get_memory_messages(state), callbacks)
+
+        return {
+            'messages': [
+                AIMessage(content=response, additional_kwargs={'message_type': 'operator_support'})
+            ],
+            'agent_metadata': metadata,
+        }
+
+    async def _aoperator_support_node(self, state: AgentState, config: RunnableConfig) -> dict:
+        """Node: 介面支援 Agent（async）"""
+        agent = self.agent_manager.get_agent('operator_support')
+        callbacks = config.get('callbacks', [])
+        response, metadata = await agent.aprocess(get_memory_messages(state), callbacks)
 
         return {
             'messages': [
@@ -87,7 +182,33 @@ class ConversationGraph:
         article_content = state.get('article_content', '')
 
         response, metadata = agent.process(
-            state['messages'], callbacks, article_content=article_content
+            get_memory_messages(state),
+            callbacks,
+            article_content=article_content,
+            template_key=state.get('template_key'),
+        )
+
+        return {
+            'messages': [
+                AIMessage(
+                    content=response, additional_kwargs={'message_type': 'cer_cognitive_support'}
+                )
+            ],
+            'agent_metadata': metadata,
+        }
+
+    async def _acer_cognitive_support_node(self, state: AgentState, config: RunnableConfig) -> dict:
+        """Node: 認知支援 Agent（async）"""
+        agent = self.agent_manager.get_agent('cer_cognitive_support')
+        callbacks = config.get('callbacks', [])
+
+        article_content = state.get('article_content', '')
+
+        response, metadata = await agent.aprocess(
+            get_memory_messages(state),
+            callbacks,
+            article_content=article_content,
+            template_key=state.get('template_key'),
         )
 
         return {
@@ -107,7 +228,31 @@ class ConversationGraph:
         article_content = state.get('article_content', '')
 
         response, metadata = agent.process(
-            state['messages'], callbacks, article_content=article_content
+            get_memory_messages(state),
+            callbacks,
+            article_content=article_content,
+            template_key=state.get('template_key'),
+        )
+
+        return {
+            'messages': [
+                AIMessage(content=response, additional_kwargs={'message_type': 'cer_scoring'})
+            ],
+            'agent_metadata': metadata,
+        }
+
+    async def _ascoring_node(self, state: AgentState, config: RunnableConfig) -> dict:
+        """Node: CER 評分 Agent（async）"""
+        agent = self.agent_manager.get_agent('cer_scoring')
+        callbacks = config.get('callbacks', [])
+
+        article_content = state.get('article_content', '')
+
+        response, metadata = await agent.aprocess(
+            get_memory_messages(state),
+            callbacks,
+            article_content=article_content,
+            template_key=state.get('template_key'),
         )
 
         return {
@@ -119,9 +264,12 @@ class ConversationGraph:
 
     def _route_decision(
         self, state: AgentState
-    ) -> Literal['operator_support', 'cer_cognitive_support', 'cer_scoring']:
+    ) -> Literal['operator_support', 'cer_cognitive_support', 'cer_scoring', '__end__']:
         """條件邊：根據分類結果決定路由"""
         classification = state.get('classification', {})
+        # 推測執行命中時 classifier node 已產生回應
+        if classification.get('speculation') == SPECULATION_HIT:
+            return END
         intent = classification.get('next_action', 'operator_support')
 
         # 直接回傳分類結果,預設為 operator_support
@@ -130,17 +278,31 @@ class ConversationGraph:
         else:
             return 'operator_support'
 
-    def _build_graph(self):
+    def _build_graph(self, checkpointer):
         workflow = StateGraph(AgentState)
 
-        # 加入節點
-        workflow.add_node('classifier', self._classifier_node)
-        workflow.add_node('operator_support', self._operator_support_node)
-        workflow.add_node('cer_cognitive_support', self._cer_cognitive_support_node)
-        workflow.add_node('cer_scoring', self._scoring_node)
+        # 加入節點（同時提供 sync / async 實作，invoke 與 ainvoke 共用同一個 graph 結構）
+        workflow.add_node('memory', RunnableLambda(self._memory_node, afunc=self._amemory_node))
+        workflow.add_node(
+            'classifier', RunnableLambda(self._classifier_node, afunc=self._aclassifier_node)
+        )
+        workflow.add_node(
+            'operator_support',
+            RunnableLambda(self._operator_support_node, afunc=self._aoperator_support_node),
+        )
+        workflow.add_node(
+            'cer_cognitive_support',
+            RunnableLambda(
+                self._cer_cognitive_support_node, afunc=self._acer_cognitive_support_node
+            ),
+        )
+        workflow.add_node(
+            'cer_scoring', RunnableLambda(self._scoring_node, afunc=self._ascoring_node)
+        )
 
         # 設定流程
-        workflow.add_edge(START, 'classifier')
+        workflow.add_edge(START, 'memory')
+        workflow.add_edge('memory', 'classifier')
         workflow.add_conditional_edges(
             'classifier',
             self._route_decision,
@@ -148,13 +310,14 @@ class ConversationGraph:
                 'operator_support': 'operator_support',
                 'cer_cognitive_support': 'cer_cognitive_support',
                 'cer_scoring': 'cer_scoring',
+                END: END,
             },
         )
         workflow.add_edge('operator_support', END)
         workflow.add_edge('cer_cognitive_support', END)
         workflow.add_edge('cer_scoring', END)
 
-        return workflow.compile(checkpointer=self.checkpointer)
+        return workflow.compile(checkpointer=checkpointer)
 
     def process_message(
         self,
@@ -163,6 +326,7 @@ class ConversationGraph:
         article_content: str,
         thread_id: str,
         callbacks: List[Any] = None,
+        template_key: Optional[str] = None,
     ) -> dict:
         """
         處理使用者訊息
@@ -173,24 +337,121 @@ class ConversationGraph:
             article_content: 文章內容（從 template 取得）
             thread_id: 對話執行緒 ID (對應 map_id)
             callbacks: LangChain callbacks
+            template_key: template 的快取識別（system prompt 組裝快取使用）
+
+        Returns:
+            dict: 包含處理結果的狀態
+        """
+        config = {
+            'configurable': {'thread_id': thread_id, 'speculative': self.speculative},
+            'callbacks': callbacks,
+        }
+        inputs = self._build_inputs(user_input, mind_map_data, article_content, template_key)
+
+        return self.graph.invoke(inputs, config=config)
+
+    async def aprocess_message(
+        self,
+        user_input: str,
+        mind_map_data: Dict[str, Any],
+        article_content: str,
+        thread_id: str,
+        callbacks: List[Any] = None,
+        template_key: Optional[str] = None,
+    ) -> dict:
+        """
+        處理使用者訊息（async 版本，使用 AsyncPostgresSaver）
+
+        Args:
+            同 process_message
 
         Returns:
             dict: 包含處理結果的狀態
         """
+        config = {
+            'configurable': {'thread_id': thread_id, 'speculative': self.speculative},
+            'callbacks': callbacks,
+        }
+        inputs = await sync_to_async(self._build_inputs)(
+            user_input, mind_map_data, article_content, template_key
+        )
+
+        graph = await self.get_async_graph()
+        return await graph.ainvoke(inputs, config=config)
+
+    def stream_message(
+        self,
+        user_input: str,
+        mind_map_data: Dict[str, Any],
+        article_content: str,
+        thread_id: str,
+        callbacks: List[Any] = None,
+        template_key: Optional[str] = None,
+    ) -> Iterator[Tuple[str, Any]]:
+        """
+        以串流方式處理使用者訊息
+
+        Args:
+            同 process_message
+
+        Yields:
+            ('token', str): 回應 agent 新產生的文字（已經過 agent 的串流解析器）
+            ('result', dict): 流程結束後的最終狀態（與 process_message 的回傳值相同）
+        """
+        config = {'configurable': {'thread_id': thread_id}, 'callbacks': callbacks}
+        inputs = self._build_inputs(user_input, mind_map_data, article_content, template_key)
+
+        yield from stream_graph(self.graph, self.agent_manager, inputs, config)
+
+    async def astream_message(
+        self,
+        user_input: str,
+        mind_map_data: Dict[str, Any],
+        article_content: str,
+        thread_id: str,
+        callbacks: List[Any] = None,
+        template_key: Optional[str] = None,
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        以串流方式處理使用者訊息（async 版本）
+
+        Args:
+            同 process_message
+
+        Yields:
+            同 stream_message
+        """
         config = {'configurable': {'thread_id': thread_id}, 'callbacks': callbacks}
+        inputs = await sync_to_async(self._build_inputs)(
+            user_input, mind_map_data, article_content, template_key
+        )
 
-        inputs = {
+        graph = await self.get_async_graph()
+        async for event in astream_graph(graph, self.agent_manager, inputs, config):
+            yield event
+
+    def _build_inputs(
+        self,
+        user_input: str,
+        mind_map_data: Dict[str, Any],
+        article_content: str,
+        template_key: Optional[str] = None,
+    ) -> dict:
+        """組成 graph 的輸入狀態（context 內容存入 ContextBlob，訊息只保留參考）"""
+        return {
             'messages': [
                 HumanMessage(
                     content=json.dumps(
-                        {'query': user_input, 'context': {'mind_map_data': mind_map_data}},
+                        {
+                            'query': user_input,
+                            'context': dehydrate_context({'mind_map_data': mind_map_data}),
+                        },
                         ensure_ascii=False,
                     )
                 )
             ],
             'classification': {},
             'article_content': article_content,
+            'template_key': template_key,
             'agent_metadata': {},
         }
-
-        return self.graph.invoke(inputs, config=config)
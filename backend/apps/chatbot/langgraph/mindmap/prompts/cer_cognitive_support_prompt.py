@@ -132,6 +132,7 @@ PROMPT_TEMPLATE = """
 - `query`：使用者的問題
 - `context`:
     - `mind_map_data`: 使用者當前的心智圖資料。
+    - `mind_map_delta`: 較早的訊息可能以此取代 `mind_map_data`，表示該次提問時心智圖相對於前一則訊息的變更：nodes 的 added / edited 為新增或修改後的節點，removed 為刪除的節點 id；edges 的 added / removed 為新增或刪除的連線。最新一則訊息一定包含完整的 `mind_map_data`。
 註: 
 - mind_map_data 中的 nodes 為節點清單，清單中每筆資料皆有 id 以及 content，id 的開頭可辨別節點 (Node) 類型，c 表示主張 (Claim)、e 表示證據 (Evidence)、r 表示推理 (Reasoning)，content 則為該節點 (Node) 的內容。
 - mind_map_data 中的 edges 為連線清單，清單中每筆資料皆有 node1 以及 node2，代表其之間有連線、互相有關連性，但是不具備方向性。
@@ -0,0 +1,102 @@
+"""
+評分結果快取
+
+評分 agent 的輸入只有 prompt（含文章內容）與簡化心智圖 / essay 內容，
+內容完全相同時評分結果可以直接重用（學生常在未修改的情況下連按兩次評分）。
+key = hash(評分類型, 模型, prompt 版本, 送給 LLM 的訊息內容)，結果存入 ScoringResult。
+"""
+
+import hashlib
+import logging
+from typing import List, Optional
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from langchain_core.messages import BaseMessage
+from langchain_core.prompts import PromptTemplate
+
+from apps.chatbot.models import ScoringResult
+from apps.common.utils.prompt_cache import get_prompt_version
+
+logger = logging.getLogger(__name__)
+
+# agent metadata 中標記是否命中快取的欄位
+SCORING_CACHE_HIT_KEY = 'scoring_cache_hit'
+
+
+def compute_scoring_key(
+    scoring_type: str,
+    model: str,
+    prompt_template: PromptTemplate,
+    final_messages: List[BaseMessage],
+) -> Optional[str]:
+    """
+    計算評分快取的 key
+
+    Args:
+        scoring_type: cer_scoring / essay_scoring
+        model: 評分使用的模型
+        prompt_template: 評分 prompt 模板
+        final_messages: 送給 LLM 的訊息（SystemMessage 含文章內容，HumanMessage 為評分內容）
+
+    Returns:
+        str | None: 快取停用時回傳 None
+    """
+    if not settings.SCORING_CACHE_ENABLED:
+        return None
+
+    digest = hashlib.sha256()
+    for part in (scoring_type, model, get_prompt_version(prompt_template)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    for message in final_messages:
+        digest.update(f'{message.type}\0{message.content}\0'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_cached_score(cache_key: str) -> Optional[tuple[str, dict]]:
+    """
+    查詢評分快取
+
+    Returns:
+        tuple | None: (回應內容, metadata)，未命中時回傳 None
+    """
+    try:
+        cached = ScoringResult.objects.filter(cache_key=cache_key).first()
+        if cached is None:
+            return None
+
+        ScoringResult.objects.filter(cache_key=cache_key).update(
+            hit_count=F('hit_count') + 1, last_hit_at=timezone.now()
+        )
+    except Exception as e:
+        logger.warning(f'Scoring cache lookup failed: {str(e)[:100]}')
+        return None
+
+    logger.info(f'Scoring cache hit: {cached.scoring_type} {cache_key[:12]}')
+    return cached.response, {**cached.metadata, SCORING_CACHE_HIT_KEY: True}
+
+
+def store_score(
+    cache_key: str,
+    scoring_type: str,
+    model: str,
+    prompt_template: PromptTemplate,
+    response: str,
+    metadata: dict,
+):
+    """儲存評分結果（只應儲存解析成功的結果）"""
+    try:
+        ScoringResult.objects.update_or_create(
+            cache_key=cache_key,
+            defaults={
+                'scoring_type': scoring_type,
+                'prompt_version': get_prompt_version(prompt_template),
+                'model': model,
+                'response': response,
+                'metadata': metadata,
+            },
+        )
+    except Exception as e:
+        logger.warning(f'Scoring cache write failed: {str(e)[:100]}')
@@ -0,0 +1,213 @@
+"""
+推測執行（Speculative Execution）
+
+一般流程中 classifier 完成後才會開始執行 expert agent，延遲為兩次 LLM 呼叫的總和。
+推測模式在呼叫 classifier 的同時，先執行此 thread 過去最常使用的 agent：
+- 分類結果與預測相符：直接採用 agent 的結果（hit）
+- 不相符：取消（async）或丟棄（sync，執行中的 thread 無法中斷）推測結果，依分類結果重新路由（miss）
+
+只推測對話型 agent（評分會消耗較多資源，且通常由 fast-path router 直接判斷）。
+"""
+
+import asyncio
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from django.conf import settings
+from django.db import connections
+from langchain_core.messages import AIMessage, BaseMessage
+
+logger = logging.getLogger(__name__)
+
+# classification['speculation'] 的可能值
+SPECULATION_HIT = 'hit'
+SPECULATION_MISS = 'miss'
+SPECULATION_ERROR = 'error'
+
+# 預測時參考最近幾則 agent 回應
+_PREDICTION_WINDOW = 10
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def predict_agent(
+    messages: List[BaseMessage], candidates: List[str], default: Optional[str]
+) -> Optional[str]:
+    """
+    依 thread 過去的回應類型預測本輪最可能的 agent
+
+    Args:
+        messages: 目前的對話歷史（含本輪訊息）
+        candidates: 可推測執行的 agent
+        default: 沒有歷史紀錄時使用的 agent
+
+    Returns:
+        str | None: 最常出現的 agent（次數相同時取最近使用的），無法預測時回傳 None
+    """
+    recent = [
+        message.additional_kwargs.get('message_type')
+        for message in messages
+        if isinstance(message, AIMessage)
+    ][-_PREDICTION_WINDOW:]
+    recent = [message_type for message_type in recent if message_type in candidates]
+
+    if not recent:
+        return default if default in candidates else None
+
+    counts = Counter(recent)
+    # 由新到舊比較，次數相同時 max 保留第一個（最近使用的）
+    return max(reversed(recent), key=counts.__getitem__)
+
+
+class SpeculationStats:
+    """推測執行命中率統計（per process）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, Counter] = {}
+
+    def record(self, graph_name: str, outcome: str):
+        with self._lock:
+            self._counts.setdefault(graph_name, Counter())[outcome] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            counts = {name: dict(counter) for name, counter in self._counts.items()}
+
+        metrics = {}
+        for name, counter in counts.items():
+            attempts = sum(counter.values())
+            hits = counter.get(SPECULATION_HIT, 0)
+            metrics[name] = {
+                'attempts': attempts,
+                'hits': hits,
+                'misses': counter.get(SPECULATION_MISS, 0),
+                'errors': counter.get(SPECULATION_ERROR, 0),
+                'hit_rate': round(hits / attempts, 4) if attempts else None,
+            }
+        return metrics
+
+
+speculation_stats = SpeculationStats()
+
+
+def get_speculation_metrics() -> Dict[str, Dict[str, Any]]:
+    """取得目前 process 的推測執行命中率"""
+    return speculation_stats.snapshot()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """sync 模式下執行推測 agent 的 thread pool（第一次使用時建立）"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.WEB_THREADS, thread_name_prefix='speculation'
+                )
+    return _executor
+
+
+def _run_in_worker(func: Callable[[], dict]) -> dict:
+    """在 worker thread 執行推測 agent，結束後歸還此 thread 的 Django 資料庫連線"""
+    try:
+        return func()
+    finally:
+        connections.close_all()
+
+
+def _attach(classification: dict, outcome: str, predicted: str) -> dict:
+    return {**classification, 'speculation': outcome, 'speculative_agent': predicted}
+
+
+def run_speculative(
+    graph_name: str,
+    predicted: str,
+    classify: Callable[[], dict],
+    run_agent: Callable[[], dict],
+) -> dict:
+    """
+    同時執行 classifier 與預測的 agent（sync）
+
+    Args:
+        graph_name: 統計用的 graph 名稱
+        predicted: 預測的 agent（next_action）
+        classify: 執行 classifier，回傳分類結果
+        run_agent: 執行預測的 agent node，回傳 node 的 state 更新
+
+    Returns:
+        dict: node 的 state 更新；命中時同時包含 agent 的 messages / agent_metadata
+    """
+    context = copy_context()
+    future = _get_executor().submit(context.run, _run_in_worker, run_agent)
+
+    classification = classify()
+    if classification.get('next_action') != predicted:
+        future.cancel()
+        speculation_stats.record(graph_name, SPECULATION_MISS)
+        logger.info(
+            f'Speculation missed: predicted={predicted}, actual={classification["next_action"]}'
+        )
+        return {'classification': _attach(classification, SPECULATION_MISS, predicted)}
+
+    try:
+        update = future.result()
+    except Exception:
+        logger.exception(f'Speculative agent failed, falling back to routing: {predicted}')
+        speculation_stats.record(graph_name, SPECULATION_ERROR)
+        return {'classification': _attach(classification, SPECULATION_ERROR, predicted)}
+
+    speculation_stats.record(graph_name, SPECULATION_HIT)
+    logger.info(f'Speculation hit: {predicted}')
+    return {**update, 'classification': _attach(classification, SPECULATION_HIT, predicted)}
+
+
+async def arun_speculative(
+    graph_name: str,
+    predicted: str,
+    classify: Callable[[], Awaitable[dict]],
+    run_agent: Callable[[], Awaitable[dict]],
+) -> dict:
+    """
+    同時執行 classifier 與預測的 agent（async，未命中時取消推測的 task）
+
+    Args / Returns:
+        同 run_speculative
+    """
+    task = asyncio.create_task(run_agent())
+
+    try:
+        classification = await classify()
+    except BaseException:
+        task.cancel()
+        raise
+
+    if classification.get('next_action') != predicted:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.debug('Cancelled speculative agent raised before cancellation')
+        speculation_stats.record(graph_name, SPECULATION_MISS)
+        logger.info(
+            f'Speculation missed: predicted={predicted}, actual={classification["next_action"]}'
+        )
+        return {'classification': _attach(classification, SPECULATION_MISS, predicted)}
+
+    try:
+        update = await task
+    except Exception:
+        logger.exception(f'Speculative agent failed, falling back to routing: {predicted}')
+        speculation_stats.record(graph_name, SPECULATION_ERROR)
+        return {'classification': _attach(classification, SPECULATION_ERROR, predicted)}
+
+    speculation_stats.record(graph_name, SPECULATION_HIT)
+    logger.info(f'Speculation hit: {predicted}')
+    return {**update, 'classification': _attach(classification, SPECULATION_HIT, predicted)}
@@ -0,0 +1,252 @@
+"""
+最近使用的 thread state 快取（per process，write-through）
+
+每輪對話開始時 graph 會從 PostgreSQL 載入完整的 thread state（所有 blob 並反序列化），
+同一位學生連續對話時，幾秒內重複讀取的都是同一份 state。此模組在 checkpointer 前加上快取：
+- put 寫入 checkpoint 時同時更新快取（write-through），下一輪對話不需重新載入
+- 讀取前只查詢 thread 最新的 checkpoint id 與 pending writes 數量（不讀取 blob），
+  與快取相同時直接使用快取；其他 worker 寫入新的 checkpoint 後版本不同，重新載入，
+  因此不會以過期的 state 繼續對話造成分岔
+- 以 thread 數（THREAD_STATE_CACHE_MAX_THREADS）與訊息總數（THREAD_STATE_CACHE_MAX_MESSAGES）
+  限制記憶體用量，超過時淘汰最久未使用的 thread
+回傳給 graph 的是 checkpoint 的複本（channel 的值本身共用，graph 以 reducer 產生新值，不會原地修改）。
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+from langgraph.checkpoint.base import (
+    CheckpointTuple,
+    copy_checkpoint,
+    get_checkpoint_id,
+    get_serializable_checkpoint_metadata,
+)
+
+_VERSION_SQL = """
+SELECT
+    c.checkpoint_id,
+    (
+        SELECT count(*) FROM checkpoint_writes w
+        WHERE w.thread_id = c.thread_id
+            AND w.checkpoint_ns = c.checkpoint_ns
+            AND w.checkpoint_id = c.checkpoint_id
+    ) AS writes
+FROM checkpoints c
+WHERE c.thread_id = %s AND c.checkpoint_ns = %s"""
+
+
+def _get_key(config) -> tuple:
+    configurable = config['configurable']
+    return configurable['thread_id'], configurable.get('checkpoint_ns', '')
+
+
+def _get_weight(checkpoint_tuple: CheckpointTuple) -> int:
+    """快取項目的大小（以訊息等列表的元素數估計）"""
+    values = checkpoint_tuple.checkpoint.get('channel_values', {})
+    return 1 + sum(len(value) for value in values.values() if isinstance(value, list))
+
+
+def _copy_tuple(checkpoint_tuple: CheckpointTuple) -> CheckpointTuple:
+    """graph 會原地更新 checkpoint 的 channel_versions，快取只交出複本"""
+    return checkpoint_tuple._replace(
+        checkpoint=copy_checkpoint(checkpoint_tuple.checkpoint),
+        pending_writes=list(checkpoint_tuple.pending_writes or []),
+    )
+
+
+class _Entry:
+    __slots__ = ('checkpoint_id', 'writes', 'checkpoint_tuple', 'weight')
+
+    def __init__(self, checkpoint_tuple: CheckpointTuple):
+        self.checkpoint_id = checkpoint_tuple.config['configurable']['checkpoint_id']
+        self.writes = len(checkpoint_tuple.pending_writes or [])
+        self.checkpoint_tuple = checkpoint_tuple
+        self.weight = _get_weight(checkpoint_tuple)
+
+
+class ThreadStateCache:
+    """每個 thread 最新的 CheckpointTuple（LRU）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[tuple, _Entry]' = OrderedDict()
+        self._weight = 0
+        self._stats = {'hits': 0, 'misses': 0, 'stale': 0, 'stores': 0, 'evictions': 0}
+
+    def lookup(self, config) -> Optional[str]:
+        """
+        快取中的 checkpoint id（讀取前用來決定是否需要查詢版本）
+
+        config 指定的 checkpoint 與快取不同時回傳 None
+        """
+        with self._lock:
+            entry = self._entries.get(_get_key(config))
+            checkpoint_id = get_checkpoint_id(config)
+            if entry is None or (checkpoint_id and checkpoint_id != entry.checkpoint_id):
+                self._stats['misses'] += 1
+                return None
+            return entry.checkpoint_id
+
+    def get(self, config, version: Optional[tuple]) -> Optional[CheckpointTuple]:
+        """
+        資料庫中的版本 (checkpoint_id, pending writes 數) 與快取相同時回傳快取的 state
+
+        版本不同時移除快取（其他 worker 已寫入新的 checkpoint）
+        """
+        key = _get_key(config)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and version == (entry.checkpoint_id, entry.writes):
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return _copy_tuple(entry.checkpoint_tuple)
+            self._stats['stale'] += 1
+            if entry is not None:
+                self._remove(key)
+        return None
+
+    def store(self, checkpoint_tuple: Optional[CheckpointTuple]):
+        if checkpoint_tuple is None:
+            return
+        key = _get_key(checkpoint_tuple.config)
+        entry = _Entry(_copy_tuple(checkpoint_tuple))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._weight += entry.weight
+            self._stats['stores'] += 1
+            while self._entries and (
+                len(self._entries) > settings.THREAD_STATE_CACHE_MAX_THREADS
+                or self._weight > settings.THREAD_STATE_CACHE_MAX_MESSAGES
+            ):
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def store_put(self, config, next_config, checkpoint, metadata):
+        """put 後寫入快取（與 PostgresSaver 載入時的內容相同）"""
+        parent_id = config['configurable'].get('checkpoint_id')
+        self.store(
+            CheckpointTuple(
+                next_config,
+                checkpoint,
+                get_serializable_checkpoint_metadata(config, metadata),
+                {'configurable': {**next_config['configurable'], 'checkpoint_id': parent_id}}
+                if parent_id
+                else None,
+                [],
+            )
+        )
+
+    def invalidate(self, config):
+        """config 的 checkpoint 新增 pending writes 時移除快取"""
+        key = _get_key(config)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.checkpoint_id == get_checkpoint_id(config):
+                self._remove(key)
+
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key)
+        self._weight -= entry.weight
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+            for name in self._stats:
+                self._stats[name] = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses'] + self._stats['stale']
+            return {
+                'threads': len(self._entries),
+                'messages': self._weight,
+                **self._stats,
+                'hit_rate': round(self._stats['hits'] / lookups, 3) if lookups else 0.0,
+            }
+
+
+thread_state_cache = ThreadStateCache()
+
+
+def get_state_cache_metrics() -> Dict[str, Any]:
+    """取得目前 process 的 thread state 快取統計（命中、未命中、過期與淘汰次數）"""
+    return thread_state_cache.snapshot()
+
+
+def _version_query(config) -> tuple[str, list]:
+    thread_id, checkpoint_ns = _get_key(config)
+    args = [thread_id, checkpoint_ns]
+    query = _VERSION_SQL
+    if checkpoint_id := get_checkpoint_id(config):
+        query += ' AND c.checkpoint_id = %s'
+        args.append(checkpoint_id)
+    return query + ' ORDER BY c.checkpoint_id DESC LIMIT 1', args
+
+
+class StateCacheMixin:
+    """PostgresSaver 的 thread state 快取"""
+
+    def get_tuple(self, config):
+        if not settings.THREAD_STATE_CACHE_ENABLED:
+            return super().get_tuple(config)
+
+        if thread_state_cache.lookup(config) is not None:
+            query, args = _version_query(config)
+            with self._cursor() as cur:
+                cur.execute(query, args)
+                row = cur.fetchone()
+            version = (row['checkpoint_id'], row['writes']) if row else None
+            if (cached := thread_state_cache.get(config, version)) is not None:
+                return cached
+
+        checkpoint_tuple = super().get_tuple(config)
+        if not get_checkpoint_id(config):
+            thread_state_cache.store(checkpoint_tuple)
+        return checkpoint_tuple
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        next_config = super().put(config, checkpoint, metadata, new_versions)
+        if settings.THREAD_STATE_CACHE_ENABLED:
+            thread_state_cache.store_put(config, next_config, checkpoint, metadata)
+        return next_config
+
+    def put_writes(self, config, writes, task_id, task_path=''):
+        super().put_writes(config, writes, task_id, task_path)
+        thread_state_cache.invalidate(config)
+
+
+class AsyncStateCacheMixin:
+    """AsyncPostgresSaver 的 thread state 快取（sync 方法會轉呼叫這些 async 方法）"""
+
+    async def aget_tuple(self, config):
+        if not settings.THREAD_STATE_CACHE_ENABLED:
+            return await super().aget_tuple(config)
+
+        if thread_state_cache.lookup(config) is not None:
+            query, args = _version_query(config)
+            async with self._cursor() as cur:
+                await cur.execute(query, args)
+                row = await cur.fetchone()
+            version = (row['checkpoint_id'], row['writes']) if row else None
+            if (cached := thread_state_cache.get(config, version)) is not None:
+                return cached
+
+        checkpoint_tuple = await super().aget_tuple(config)
+        if not get_checkpoint_id(config):
+            thread_state_cache.store(checkpoint_tuple)
+        return checkpoint_tuple
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        next_config = await super().aput(config, checkpoint, metadata, new_versions)
+        if settings.THREAD_STATE_CACHE_ENABLED:
+            thread_state_cache.store_put(config, next_config, checkpoint, metadata)
+        return next_config
+
+    async def aput_writes(self, config, writes, task_id, task_path=''):
+        await super().aput_writes(config, writes, task_id, task_path)
+        thread_state_cache.invalidate(config)
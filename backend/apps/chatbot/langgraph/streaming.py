@@ -0,0 +1,103 @@
+"""
+LangGraph 串流共用邏輯
+mindmap 與 essay graph 共用：從 graph.stream 取出回應 agent 的 token，交給 agent 的串流解析器處理
+"""
+
+import logging
+from typing import Any, AsyncIterator, Dict, Iterator, Tuple
+
+from langchain_core.messages import AIMessageChunk
+
+from apps.common.utils.stream_parser import get_chunk_text
+
+logger = logging.getLogger(__name__)
+
+
+def _get_stream_parser(agent_manager, node_name: str):
+    """取得 node 對應 agent 的串流解析器，非 agent node（例如 classifier）回傳 None"""
+    try:
+        agent = agent_manager.get_agent(node_name)
+    except ValueError:
+        return None
+
+    if agent is None:
+        return None
+
+    return agent.create_stream_parser()
+
+
+def stream_graph(
+    graph, agent_manager, inputs: Dict[str, Any], config: Dict[str, Any]
+) -> Iterator[Tuple[str, Any]]:
+    """
+    以串流模式執行 graph
+
+    Args:
+        graph: 已編譯的 LangGraph
+        agent_manager: AgentManager / EssayAgentManager，用於取得各 node 的串流解析器
+        inputs: graph 輸入狀態
+        config: graph 設定（thread_id、callbacks）
+
+    Yields:
+        ('token', str): 回應 agent 新產生、可直接顯示給使用者的文字
+        ('result', dict): 流程結束後的最終狀態
+    """
+    parsers = {}
+    final_state = {}
+
+    for mode, payload in graph.stream(inputs, config=config, stream_mode=['messages', 'values']):
+        if mode == 'values':
+            final_state = payload
+            continue
+
+        text = _parse_message_chunk(agent_manager, parsers, payload)
+        if text:
+            yield 'token', text
+
+    logger.debug(f'Graph stream finished: nodes={list(parsers)}')
+    yield 'result', final_state
+
+
+async def astream_graph(
+    graph, agent_manager, inputs: Dict[str, Any], config: Dict[str, Any]
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    以串流模式執行 graph（async 版本，graph 需使用 async checkpointer）
+
+    Args / Yields:
+        同 stream_graph
+    """
+    parsers = {}
+    final_state = {}
+
+    async for mode, payload in graph.astream(
+        inputs, config=config, stream_mode=['messages', 'values']
+    ):
+        if mode == 'values':
+            final_state = payload
+            continue
+
+        text = _parse_message_chunk(agent_manager, parsers, payload)
+        if text:
+            yield 'token', text
+
+    logger.debug(f'Async graph stream finished: nodes={list(parsers)}')
+    yield 'result', final_state
+
+
+def _parse_message_chunk(agent_manager, parsers: Dict[str, Any], payload) -> str:
+    """將 messages 串流的 (chunk, metadata) 交給對應 node 的解析器，回傳可顯示的文字"""
+    chunk, metadata = payload
+    # node 回傳的完整 AIMessage 也會出現在 messages 串流中，只處理 LLM 產生的 chunk
+    if not isinstance(chunk, AIMessageChunk):
+        return ''
+
+    node_name = metadata.get('langgraph_node')
+    if node_name not in parsers:
+        parsers[node_name] = _get_stream_parser(agent_manager, node_name)
+
+    parser = parsers[node_name]
+    if parser is None:
+        return ''
+
+    return parser.feed(get_chunk_text(chunk))
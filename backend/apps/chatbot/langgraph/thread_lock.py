@@ -0,0 +1,393 @@
+"""
+LangGraph thread 的互斥鎖（PostgreSQL advisory lock）
+
+同一個 thread（例如 mindmap-{map_id}）的兩個請求同時執行時（兩個分頁、連續送出），
+會讀到相同的 checkpoint 並各自寫入，造成對話歷史分岔。process 內的鎖無法涵蓋多個 worker / 節點，
+因此以 PostgreSQL session 層級的 advisory lock 作為 thread 的互斥鎖：
+- 每個持有中的鎖各自使用鎖專用連線池（THREAD_LOCK_POOL_MAX_SIZE）的一條連線，直到釋放才歸還；
+  一條連線異常只會影響該連線上的鎖，不會讓其他進行中的對話同時失去鎖
+- 鎖專用連線都在使用中時回報鎖後端飽和（ThreadLockSaturatedError，view 回傳 503），
+  不會把無關的 thread 誤報為忙碌；WSGI 模式的連線池不小於 WEB_THREADS，只有 ASGI 模式可能飽和
+- THREAD_LOCK_POLICY=queue 時等待（最多 THREAD_LOCK_TIMEOUT_SECONDS），reject 時立即回報忙碌
+- 連線中斷時 PostgreSQL 會自動釋放該 session 的所有鎖，不會留下無法釋放的鎖
+無法連線資料庫時不加鎖，照常處理請求。
+"""
+
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Dict, Optional, Set
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+POLICY_QUEUE = 'queue'
+POLICY_REJECT = 'reject'
+
+# service 回傳結果中表示 thread 忙碌的錯誤代碼（view 對應為 409）
+THREAD_BUSY_ERROR = 'thread_busy'
+# 鎖專用連線都在使用中的錯誤代碼（view 對應為 503）
+THREAD_LOCK_SATURATED_ERROR = 'thread_lock_saturated'
+
+# 等待鎖時重新嘗試的間隔（秒）
+_POLL_INTERVAL_SECONDS = 0.2
+
+# 取得鎖專用連線的等待上限（秒），逾時回報鎖後端飽和
+_CONNECTION_TIMEOUT_SECONDS = 1.0
+
+
+class ThreadBusyError(Exception):
+    """同一個 thread 有其他請求正在處理"""
+
+    reason = 'Thread is busy'
+
+    def __init__(self, thread_id: str):
+        super().__init__(f'{self.reason}: {thread_id}')
+        self.thread_id = thread_id
+
+
+class ThreadLockSaturatedError(ThreadBusyError):
+    """鎖專用連線都在使用中，無法取得任何 thread 的鎖（與 thread 本身是否忙碌無關）"""
+
+    reason = 'Thread lock backend saturated'
+
+
+def thread_busy_result(error: Optional[ThreadBusyError] = None) -> dict:
+    """thread 忙碌（或鎖後端飽和）時 service 的回傳值（格式同處理失敗的結果）"""
+    if isinstance(error, ThreadLockSaturatedError):
+        return {
+            'success': False,
+            'message': 'The server is busy. Please try again shortly.',
+            'error': {'code': THREAD_LOCK_SATURATED_ERROR},
+        }
+    return {
+        'success': False,
+        'message': 'Your previous message is still being processed. Please try again shortly.',
+        'error': {'code': THREAD_BUSY_ERROR},
+    }
+
+
+def get_lock_key(thread_id: str) -> int:
+    """thread_id 對應的 advisory lock key（signed bigint）"""
+    digest = hashlib.sha256(f'langgraph-thread:{thread_id}'.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+class ThreadLockBackend(ABC):
+    """跨 process 的鎖後端（非阻塞）"""
+
+    @abstractmethod
+    def try_lock(self, key: int) -> bool:
+        """
+        嘗試取得鎖，已被其他持有者取得時回傳 False
+
+        Raises:
+            ThreadLockSaturatedError: 後端沒有可用的資源（例如連線）可取得鎖
+        """
+
+    @abstractmethod
+    def unlock(self, key: int):
+        """釋放 try_lock 取得的鎖"""
+
+
+class PostgresAdvisoryLockBackend(ThreadLockBackend):
+    """PostgreSQL session 層級 advisory lock（每個持有中的鎖使用各自的連線）"""
+
+    def __init__(self):
+        self._pool = None
+        self._lock = threading.Lock()
+        self._connections: Dict[int, Any] = {}
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    from psycopg_pool import ConnectionPool
+
+                    self._pool = ConnectionPool(
+                        conninfo=settings.DATABASE_URL,
+                        name='thread-lock',
+                        min_size=1,
+                        max_size=settings.THREAD_LOCK_POOL_MAX_SIZE,
+                        kwargs={'autocommit': True},
+                        check=ConnectionPool.check_connection,
+                    )
+                    logger.info(
+                        f'Thread lock connection pool created: '
+                        f'max_size={settings.THREAD_LOCK_POOL_MAX_SIZE}'
+                    )
+        return self._pool
+
+    def try_lock(self, key: int) -> bool:
+        from psycopg_pool import PoolTimeout
+
+        try:
+            conn = self.pool.getconn(timeout=_CONNECTION_TIMEOUT_SECONDS)
+        except PoolTimeout:
+            logger.warning(f'No thread lock connection available: key={key}')
+            raise ThreadLockSaturatedError(f'key={key}') from None
+
+        try:
+            acquired = conn.execute('SELECT pg_try_advisory_lock(%s)', (key,)).fetchone()[0]
+        except Exception:
+            # 歸還時連線池會丟棄中斷的連線，其他鎖不受影響
+            self.pool.putconn(conn)
+            raise
+        if not acquired:
+            self.pool.putconn(conn)
+            return False
+
+        with self._lock:
+            self._connections[key] = conn
+        return True
+
+    def unlock(self, key: int):
+        with self._lock:
+            conn = self._connections.pop(key, None)
+        if conn is None:
+            logger.warning(f'Thread lock connection not found on release: key={key}')
+            return
+        try:
+            if not conn.execute('SELECT pg_advisory_unlock(%s)', (key,)).fetchone()[0]:
+                logger.error(f'Thread lock was lost before release: key={key}')
+        finally:
+            self.pool.putconn(conn)
+
+
+class InMemoryThreadLockBackend(ThreadLockBackend):
+    """單一 process 的替代後端（測試與本機開發用）"""
+
+    def __init__(self):
+        self._held: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def try_lock(self, key: int) -> bool:
+        with self._lock:
+            if key in self._held:
+                return False
+            self._held.add(key)
+            return True
+
+    def unlock(self, key: int):
+        with self._lock:
+            self._held.discard(key)
+
+
+class ThreadLockManager:
+    """thread 互斥鎖與排隊統計（per process）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._backend: Optional[ThreadLockBackend] = None
+        self._held: Set[int] = set()
+        self._waiting: Dict[str, int] = {}
+        self._stats = {
+            'acquired': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'saturated': 0,
+            'max_waiting': 0,
+            'total_wait_ms': 0.0,
+        }
+
+    @property
+    def backend(self) -> ThreadLockBackend:
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = import_string(settings.THREAD_LOCK_BACKEND)()
+        return self._backend
+
+    def reset(self, backend: Optional[ThreadLockBackend] = None):
+        """清除持有紀錄與統計並更換後端（None 表示下次使用時依設定重新建立）"""
+        with self._lock:
+            self._backend = backend
+            self._held.clear()
+            self._waiting.clear()
+            for name in self._stats:
+                self._stats[name] = 0
+
+    def _try_acquire(self, key: int) -> bool:
+        with self._lock:
+            if key in self._held:
+                return False
+            self._held.add(key)
+        try:
+            acquired = self.backend.try_lock(key)
+        except Exception:
+            with self._lock:
+                self._held.discard(key)
+            raise
+        if not acquired:
+            with self._lock:
+                self._held.discard(key)
+        return acquired
+
+    def _release(self, key: int):
+        try:
+            self.backend.unlock(key)
+        except Exception as e:
+            # 連線異常時鎖已隨 session 釋放
+            logger.warning(f'Thread lock release failed: {str(e)[:100]}')
+        finally:
+            with self._lock:
+                self._held.discard(key)
+
+    def _saturated(self, thread_id: str):
+        with self._lock:
+            self._stats['saturated'] += 1
+        raise ThreadLockSaturatedError(thread_id)
+
+    def _start_waiting(self, thread_id: str):
+        with self._lock:
+            self._waiting[thread_id] = self._waiting.get(thread_id, 0) + 1
+            depth = sum(self._waiting.values())
+            self._stats['max_waiting'] = max(self._stats['max_waiting'], depth)
+
+    def _stop_waiting(self, thread_id: str, outcome: Optional[str], waited: float):
+        with self._lock:
+            self._waiting[thread_id] -= 1
+            if not self._waiting[thread_id]:
+                del self._waiting[thread_id]
+            if outcome:
+                self._stats[outcome] += 1
+            self._stats['total_wait_ms'] += waited * 1000
+
+    def _begin(self, thread_id: str) -> tuple[Optional[int], Optional[bool]]:
+        """
+        第一次嘗試取得鎖
+
+        Returns:
+            tuple: (key, acquired)；未啟用或後端異常時 key 為 None（不加鎖）
+
+        Raises:
+            ThreadLockSaturatedError: 鎖後端飽和（不等待，也不在沒有鎖的情況下執行）
+        """
+        if not settings.THREAD_LOCK_ENABLED:
+            return None, None
+        key = get_lock_key(thread_id)
+        try:
+            acquired = self._try_acquire(key)
+        except ThreadLockSaturatedError:
+            self._saturated(thread_id)
+        except Exception as e:
+            logger.warning(f'Thread lock unavailable, continuing without lock: {str(e)[:100]}')
+            return None, None
+
+        if acquired:
+            with self._lock:
+                self._stats['acquired'] += 1
+        elif settings.THREAD_LOCK_POLICY == POLICY_REJECT:
+            with self._lock:
+                self._stats['rejected'] += 1
+            logger.info(f'Thread busy, request rejected: {thread_id}')
+            raise ThreadBusyError(thread_id)
+        return key, acquired
+
+    @contextmanager
+    def lock(self, thread_id: str):
+        """
+        取得 thread 的互斥鎖
+
+        Raises:
+            ThreadBusyError: reject 模式下 thread 忙碌，或 queue 模式下等待逾時
+            ThreadLockSaturatedError: 鎖後端飽和
+        """
+        key, acquired = self._begin(thread_id)
+        if key is not None and not acquired and not self._wait(thread_id, key):
+            key = None
+        try:
+            yield
+        finally:
+            if key is not None:
+                self._release(key)
+
+    @asynccontextmanager
+    async def alock(self, thread_id: str):
+        """lock 的 async 版本（等待時不佔用 event loop）"""
+        key, acquired = await asyncio.to_thread(self._begin, thread_id)
+        if key is not None and not acquired and not await self._await(thread_id, key):
+            key = None
+        try:
+            yield
+        finally:
+            if key is not None:
+                await asyncio.to_thread(self._release, key)
+
+    def _wait(self, thread_id: str, key: int) -> bool:
+        """等待鎖釋放，回傳 False 表示後端異常（不加鎖繼續），逾時拋出 ThreadBusyError"""
+        start = time.monotonic()
+        deadline = start + settings.THREAD_LOCK_TIMEOUT_SECONDS
+        self._start_waiting(thread_id)
+        outcome = 'timeouts'
+        try:
+            while time.monotonic() < deadline:
+                time.sleep(_POLL_INTERVAL_SECONDS)
+                try:
+                    if self._try_acquire(key):
+                        outcome = 'acquired'
+                        return True
+                except ThreadLockSaturatedError:
+                    outcome = None
+                    self._saturated(thread_id)
+                except Exception as e:
+                    logger.warning(f'Thread lock unavailable while waiting: {str(e)[:100]}')
+                    outcome = None
+                    return False
+        finally:
+            self._stop_waiting(thread_id, outcome, time.monotonic() - start)
+            if outcome == 'timeouts':
+                logger.warning(f'Thread lock wait timed out: {thread_id}')
+        raise ThreadBusyError(thread_id)
+
+    async def _await(self, thread_id: str, key: int) -> bool:
+        """_wait 的 async 版本"""
+        start = time.monotonic()
+        deadline = start + settings.THREAD_LOCK_TIMEOUT_SECONDS
+        self._start_waiting(thread_id)
+        outcome = 'timeouts'
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(_POLL_INTERVAL_SECONDS)
+                try:
+                    if await asyncio.to_thread(self._try_acquire, key):
+                        outcome = 'acquired'
+                        return True
+                except ThreadLockSaturatedError:
+                    outcome = None
+                    self._saturated(thread_id)
+                except Exception as e:
+                    logger.warning(f'Thread lock unavailable while waiting: {str(e)[:100]}')
+                    outcome = None
+                    return False
+        finally:
+            self._stop_waiting(thread_id, outcome, time.monotonic() - start)
+            if outcome == 'timeouts':
+                logger.warning(f'Thread lock wait timed out (async): {thread_id}')
+        raise ThreadBusyError(thread_id)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'policy': settings.THREAD_LOCK_POLICY,
+                'held': len(self._held),
+                'waiting': sum(self._waiting.values()),
+                'waiting_threads': len(self._waiting),
+                **self._stats,
+                'total_wait_ms': round(self._stats['total_wait_ms'], 1),
+            }
+
+
+thread_lock_manager = ThreadLockManager()
+
+
+def get_thread_lock_metrics() -> Dict[str, Any]:
+    """取得目前 process 的 thread 鎖統計（持有數、排隊深度、拒絕與逾時次數）"""
+    return thread_lock_manager.snapshot()
@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('chatbot', '0004_delete_chatmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContextBlob',
+            fields=[
+                (
+                    'digest',
+                    models.CharField(
+                        help_text='內容的 SHA-256',
+                        max_length=64,
+                        primary_key=True,
+                        serialize=False,
+                    ),
+                ),
+                ('content', models.JSONField()),
+                ('size', models.IntegerField(default=0, help_text='序列化後的字元數')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'chatbot_context_blob',
+            },
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2 on 2026-10-18 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('chatbot', '0005_contextblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatHistoryThread',
+            fields=[
+                ('thread_id', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                (
+                    'checkpoint_id',
+                    models.CharField(help_text='投影對應的 checkpoint id', max_length=64),
+                ),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('turn_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'chatbot_history_thread',
+            },
+        ),
+        migrations.CreateModel(
+            name='ChatHistoryMessage',
+            fields=[
+                (
+                    'id',
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name='ID'
+                    ),
+                ),
+                ('thread_id', models.CharField(max_length=100)),
+                (
+                    'sequence',
+                    models.PositiveIntegerField(
+                        help_text='訊息在 thread 中的位置（即前端的 message id）'
+                    ),
+                ),
+                (
+                    'turn',
+                    models.PositiveIntegerField(help_text='所屬回合，每則使用者訊息開始新的回合'),
+                ),
+                ('role', models.CharField(max_length=20)),
+                (
+                    'content',
+                    models.TextField(help_text='使用者訊息為 query，assistant 訊息為回應內容'),
+                ),
+                ('message_type', models.CharField(blank=True, max_length=50, null=True)),
+            ],
+            options={
+                'db_table': 'chatbot_history_message',
+                'ordering': ['sequence'],
+                'indexes': [
+                    models.Index(
+                        fields=['thread_id', 'turn'], name='chatbot_his_thread__6eb0b6_idx'
+                    )
+                ],
+                'constraints': [
+                    models.UniqueConstraint(
+                        fields=('thread_id', 'sequence'), name='unique_history_message_sequence'
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-18 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('chatbot', '0006_chat_history_projection'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClassifierDecision',
+            fields=[
+                ('cache_key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('classifier', models.CharField(help_text='mindmap / essay', max_length=20)),
+                ('prompt_version', models.CharField(max_length=16)),
+                ('next_action', models.CharField(max_length=50)),
+                ('reasoning', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'db_table': 'chatbot_classifier_decision',
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('chatbot', '0007_classifierdecision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScoringResult',
+            fields=[
+                ('cache_key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                (
+                    'scoring_type',
+                    models.CharField(help_text='cer_scoring / essay_scoring', max_length=20),
+                ),
+                ('prompt_version', models.CharField(max_length=16)),
+                ('model', models.CharField(max_length=50)),
+                ('response', models.TextField()),
+                ('metadata', models.JSONField(default=dict)),
+                ('hit_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_hit_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'chatbot_scoring_result',
+            },
+        ),
+    ]
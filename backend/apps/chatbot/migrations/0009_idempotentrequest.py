@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-18 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('chatbot', '0008_scoringresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotentRequest',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                (
+                    'scope',
+                    models.CharField(
+                        help_text='mindmap_chat / essay_chat / feedback', max_length=30
+                    ),
+                ),
+                ('status', models.CharField(default='pending', max_length=10)),
+                ('status_code', models.IntegerField(blank=True, null=True)),
+                ('response', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                (
+                    'expires_at',
+                    models.DateTimeField(
+                        db_index=True, help_text='pending：視為中斷的時間；completed：回應保留期限'
+                    ),
+                ),
+            ],
+            options={
+                'db_table': 'chatbot_idempotent_request',
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('chatbot', '0009_idempotentrequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMRateBucket',
+            fields=[
+                ('model', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('requests', models.FloatField(help_text='剩餘的請求額度')),
+                (
+                    'tokens',
+                    models.FloatField(help_text='剩餘的 token 額度（可為負數：實際用量超過預估）'),
+                ),
+                ('updated_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'chatbot_llm_rate_bucket',
+            },
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 5.2 on 2026-10-18 15:00
+
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('chatbot', '0010_llmratebucket'),
+        ('map', '0005_mapsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScoringJob',
+            fields=[
+                (
+                    'id',
+                    models.UUIDField(
+                        default=uuid.uuid4, editable=False, primary_key=True, serialize=False
+                    ),
+                ),
+                ('kind', models.CharField(help_text='mindmap / essay', max_length=20)),
+                ('content_hash', models.CharField(help_text='評分內容的 SHA-256', max_length=64)),
+                (
+                    'essay_plain_text',
+                    models.TextField(blank=True, default='', help_text='essay 評分的文章內容'),
+                ),
+                ('user_action_id', models.IntegerField(blank=True, null=True)),
+                ('status', models.CharField(default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                (
+                    'available_at',
+                    models.DateTimeField(help_text='可被 worker 領取的時間（重試時延後）'),
+                ),
+                (
+                    'lease_expires_at',
+                    models.DateTimeField(
+                        blank=True,
+                        help_text='執行中的工作超過此時間視為 worker 中斷，可重新領取',
+                        null=True,
+                    ),
+                ),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                (
+                    'map',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='scoring_jobs',
+                        to='map.map',
+                    ),
+                ),
+            ],
+            options={
+                'db_table': 'chatbot_scoring_job',
+                'indexes': [
+                    models.Index(
+                        fields=['status', 'available_at'], name='chatbot_sco_status_59c211_idx'
+                    )
+                ],
+                'constraints': [
+                    models.UniqueConstraint(
+                        condition=models.Q(('status__in', ['pending', 'running'])),
+                        fields=('map', 'kind', 'content_hash'),
+                        name='unique_active_scoring_job',
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,200 @@
+import uuid
+
+from django.db import models
+
+
+class ContextBlob(models.Model):
+    """
+    對話 context 內容（mind_map_data、essay_content）的去重儲存
+
+    checkpoint 中的 HumanMessage 只保留 {'$blob': digest} 參考，內容依 SHA-256 只存一份
+    """
+
+    digest = models.CharField(max_length=64, primary_key=True, help_text='內容的 SHA-256')
+    content = models.JSONField()
+    size = models.IntegerField(default=0, help_text='序列化後的字元數')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'chatbot_context_blob'
+
+    def __str__(self):
+        return self.digest
+
+
+class ChatHistoryThread(models.Model):
+    """對話歷史投影的版本資訊，checkpoint_id 與 LangGraph 最新 checkpoint 相同時代表投影為最新"""
+
+    thread_id = models.CharField(max_length=100, primary_key=True)
+    checkpoint_id = models.CharField(max_length=64, help_text='投影對應的 checkpoint id')
+    message_count = models.PositiveIntegerField(default=0)
+    turn_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'chatbot_history_thread'
+
+    def __str__(self):
+        return f'{self.thread_id} @ {self.checkpoint_id}'
+
+
+class ChatHistoryMessage(models.Model):
+    """對話歷史投影：每則訊息只保留前端顯示需要的欄位，避免讀取歷史時反序列化整個 checkpoint"""
+
+    thread_id = models.CharField(max_length=100)
+    sequence = models.PositiveIntegerField(
+        help_text='訊息在 thread 中的位置（即前端的 message id）'
+    )
+    turn = models.PositiveIntegerField(help_text='所屬回合，每則使用者訊息開始新的回合')
+    role = models.CharField(max_length=20)
+    content = models.TextField(help_text='使用者訊息為 query，assistant 訊息為回應內容')
+    message_type = models.CharField(max_length=50, null=True, blank=True)
+
+    class Meta:
+        db_table = 'chatbot_history_message'
+        ordering = ['sequence']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['thread_id', 'sequence'], name='unique_history_message_sequence'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['thread_id', 'turn']),
+        ]
+
+    def __str__(self):
+        return f'{self.thread_id} #{self.sequence}'
+
+
+class ClassifierDecision(models.Model):
+    """意圖分類結果快取（跨 worker 共用），key 包含 prompt 版本，prompt 變更後舊結果自然失效"""
+
+    cache_key = models.CharField(max_length=64, primary_key=True)
+    classifier = models.CharField(max_length=20, help_text='mindmap / essay')
+    prompt_version = models.CharField(max_length=16)
+    next_action = models.CharField(max_length=50)
+    reasoning = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        db_table = 'chatbot_classifier_decision'
+
+    def __str__(self):
+        return f'{self.classifier}: {self.next_action}'
+
+
+class ScoringResult(models.Model):
+    """評分結果快取：以評分輸入（prompt 版本、文章、心智圖 / essay 內容）的雜湊為 key"""
+
+    cache_key = models.CharField(max_length=64, primary_key=True)
+    scoring_type = models.CharField(max_length=20, help_text='cer_scoring / essay_scoring')
+    prompt_version = models.CharField(max_length=16)
+    model = models.CharField(max_length=50)
+    response = models.TextField()
+    metadata = models.JSONField(default=dict)
+    hit_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_hit_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'chatbot_scoring_result'
+
+    def __str__(self):
+        return f'{self.scoring_type}: {self.cache_key[:12]}'
+
+
+class IdempotentRequest(models.Model):
+    """
+    POST 請求的去重紀錄（chat、feedback）
+
+    第一個請求以 pending 狀態佔用 key 並執行，相同 key 的請求等待其完成後直接回傳儲存的回應
+    """
+
+    STATUS_PENDING = 'pending'
+    STATUS_COMPLETED = 'completed'
+
+    key = models.CharField(max_length=64, primary_key=True)
+    scope = models.CharField(max_length=30, help_text='mindmap_chat / essay_chat / feedback')
+    status = models.CharField(max_length=10, default=STATUS_PENDING)
+    status_code = models.IntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(
+        db_index=True, help_text='pending：視為中斷的時間；completed：回應保留期限'
+    )
+
+    class Meta:
+        db_table = 'chatbot_idempotent_request'
+
+    def __str__(self):
+        return f'{self.scope}: {self.key[:12]} ({self.status})'
+
+
+class LLMRateBucket(models.Model):
+    """
+    LLM 呼叫的 token bucket（每個模型一筆，所有 worker 共用）
+
+    由 apps.common.utils.llm_governor 以條件 UPDATE 補充並扣除額度
+    """
+
+    model = models.CharField(max_length=100, primary_key=True)
+    requests = models.FloatField(help_text='剩餘的請求額度')
+    tokens = models.FloatField(help_text='剩餘的 token 額度（可為負數：實際用量超過預估）')
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'chatbot_llm_rate_bucket'
+
+    def __str__(self):
+        return f'{self.model}: {self.requests:.0f} requests / {self.tokens:.0f} tokens'
+
+
+class ScoringJob(models.Model):
+    """
+    非同步評分工作（SCORING_JOBS_ENABLED）
+
+    view 預扣評分次數並建立工作後立即回傳 job id，由 manage.py run_scoring_worker 領取執行：
+    評分結果寫入 LangGraph thread，成功時確認次數，最後一次嘗試仍失敗時退回
+    """
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    ACTIVE_STATUSES = (STATUS_PENDING, STATUS_RUNNING)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    map = models.ForeignKey('map.Map', on_delete=models.CASCADE, related_name='scoring_jobs')
+    kind = models.CharField(max_length=20, help_text='mindmap / essay')
+    content_hash = models.CharField(max_length=64, help_text='評分內容的 SHA-256')
+    essay_plain_text = models.TextField(blank=True, default='', help_text='essay 評分的文章內容')
+    user_action_id = models.IntegerField(null=True, blank=True)
+    status = models.CharField(max_length=10, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    available_at = models.DateTimeField(help_text='可被 worker 領取的時間（重試時延後）')
+    lease_expires_at = models.DateTimeField(
+        null=True, blank=True, help_text='執行中的工作超過此時間視為 worker 中斷，可重新領取'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'chatbot_scoring_job'
+        constraints = [
+            # 相同內容的評分在處理中時不重複建立（重複送出回傳同一個工作）
+            models.UniqueConstraint(
+                fields=['map', 'kind', 'content_hash'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='unique_active_scoring_job',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'available_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.kind} scoring {self.id} ({self.status})'
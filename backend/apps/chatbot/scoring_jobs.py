@@ -0,0 +1,245 @@
+"""
+非同步評分工作（SCORING_JOBS_ENABLED）
+
+評分使用較慢的模型，同步執行時單一請求常需數十秒，期間佔用 worker thread，
+也可能超過 cloudflared 等反向代理的逾時。啟用後 [scoring] 請求改為：
+- view 預扣一次評分次數並建立 ScoringJob（map、評分類型、評分內容雜湊），立即回傳 202 與 job id；
+  相同內容的工作處理中時回傳同一個工作，不重複預扣
+- 評分 worker（manage.py run_scoring_worker）以 SELECT ... FOR UPDATE SKIP LOCKED 領取工作，
+  透過 service 執行評分（結果寫入 LangGraph thread 與對話歷史），成功時確認次數，
+  失敗時延後重試，最後一次嘗試仍失敗時退回次數
+- 預扣隨工作保存在資料庫，worker 中斷時工作在 lease 逾時後由其他 worker 重新領取，次數不會遺失
+前端可輪詢工作狀態，或以 SSE 訂閱直到完成（僅 ASGI 模式）。
+"""
+
+import hashlib
+import json
+import logging
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from apps.map.models import Map
+from apps.user_action.models import UserAction
+
+from .langgraph.essay import get_essay_langgraph_service
+from .langgraph.mindmap import get_langgraph_service
+from .models import ScoringJob
+from .scoring_quota import ScoringQuota
+
+logger = logging.getLogger(__name__)
+
+SCORING_MESSAGE = '[scoring]'
+
+
+def compute_content_hash(kind: str, map_instance: Map, essay_plain_text: str = '') -> str:
+    """評分內容（template、心智圖、essay 文章）的 SHA-256，內容相同的評分視為同一個工作"""
+    content = {
+        'kind': kind,
+        'template_id': map_instance.template_id,
+        'nodes': map_instance.nodes,
+        'edges': map_instance.edges,
+        'essay': essay_plain_text if kind == 'essay' else '',
+    }
+    serialized = json.dumps(content, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def submit_scoring_job(
+    kind: str,
+    map_instance: Map,
+    essay_plain_text: str = '',
+    user_action_id: Optional[int] = None,
+) -> Optional[ScoringJob]:
+    """
+    預扣一次評分次數並建立評分工作
+
+    Returns:
+        ScoringJob | None: 相同內容的工作處理中時回傳該工作；評分次數不足時回傳 None
+    """
+    content_hash = compute_content_hash(kind, map_instance, essay_plain_text)
+    jobs = ScoringJob.objects.filter(map_id=map_instance.pk, kind=kind, content_hash=content_hash)
+    active = jobs.filter(status__in=ScoringJob.ACTIVE_STATUSES).first()
+    if active is not None:
+        return active
+
+    quota = ScoringQuota(kind, map_instance)
+    if not quota.reserve():
+        return None
+    try:
+        with transaction.atomic():
+            job = ScoringJob.objects.create(
+                map_id=map_instance.pk,
+                kind=kind,
+                content_hash=content_hash,
+                essay_plain_text=essay_plain_text if kind == 'essay' else '',
+                user_action_id=user_action_id,
+                available_at=timezone.now(),
+            )
+    except IntegrityError:
+        # 同時送出的相同評分已建立工作
+        quota.release()
+        return jobs.filter(status__in=ScoringJob.ACTIVE_STATUSES).first()
+    except Exception:
+        quota.release()
+        raise
+
+    logger.info(f'Scoring job submitted: job_id={job.id}, kind={kind}, map_id={map_instance.pk}')
+    return job
+
+
+def claim_scoring_job() -> Optional[ScoringJob]:
+    """領取一個可執行的工作（等待中，或 lease 已逾時的執行中工作），沒有工作時回傳 None"""
+    now = timezone.now()
+    with transaction.atomic():
+        job = (
+            ScoringJob.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(status=ScoringJob.STATUS_PENDING, available_at__lte=now)
+                | Q(status=ScoringJob.STATUS_RUNNING, lease_expires_at__lt=now)
+            )
+            .order_by('available_at')
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = ScoringJob.STATUS_RUNNING
+        job.attempts += 1
+        job.started_at = now
+        job.lease_expires_at = now + timedelta(seconds=settings.SCORING_JOB_LEASE_SECONDS)
+        job.save(update_fields=['status', 'attempts', 'started_at', 'lease_expires_at'])
+    return job
+
+
+def _score(job: ScoringJob) -> dict:
+    """以 service 執行評分（與同步的 chat 相同，結果寫入 LangGraph thread）"""
+    map_instance = Map.objects.select_related('template').get(pk=job.map_id)
+    kwargs = {
+        'user_input': SCORING_MESSAGE,
+        'map_id': job.map_id,
+        'user_id': str(map_instance.user_id),
+        'map_instance': map_instance,
+    }
+    if job.kind == 'essay':
+        return get_essay_langgraph_service().process_user_message(
+            essay_plain_text=job.essay_plain_text, **kwargs
+        )
+    return get_langgraph_service().process_user_message(**kwargs)
+
+
+def run_scoring_job(job: ScoringJob) -> Optional[str]:
+    """
+    執行領取的工作並記錄結果
+
+    Returns:
+        str | None: 工作的新狀態（延後重試時為 pending）；lease 逾時已由其他 worker 領取時為 None
+    """
+    try:
+        result = _score(job)
+    except Exception as e:
+        logger.exception(f'Scoring job raised: job_id={job.id}')
+        result = {'success': False, 'error': {'message': str(e)}}
+
+    with transaction.atomic():
+        # 只由目前持有工作的 worker 更新（attempts 相同），避免確認或退回兩次
+        current = (
+            ScoringJob.objects.select_for_update()
+            .select_related('map')
+            .filter(pk=job.pk, status=ScoringJob.STATUS_RUNNING, attempts=job.attempts)
+            .first()
+        )
+        if current is None:
+            logger.warning(f'Scoring job lease lost: job_id={job.id}, attempts={job.attempts}')
+            return None
+
+        quota = ScoringQuota(current.kind, current.map, reserved=True)
+        now = timezone.now()
+        if result['success']:
+            current.status = ScoringJob.STATUS_SUCCEEDED
+            current.result = {
+                'message': result['message'],
+                'message_type': result.get('message_type'),
+                'scoring_remaining': quota.commit(result.get('scoring_cached', False)),
+            }
+            current.error = ''
+        else:
+            current.error = str(result.get('error') or result.get('message', ''))
+            if current.attempts < settings.SCORING_JOB_MAX_ATTEMPTS:
+                current.status = ScoringJob.STATUS_PENDING
+                current.available_at = now + timedelta(
+                    seconds=settings.SCORING_JOB_RETRY_DELAY_SECONDS * current.attempts
+                )
+            else:
+                quota.release()
+                current.status = ScoringJob.STATUS_FAILED
+        if current.status != ScoringJob.STATUS_PENDING:
+            current.finished_at = now
+        current.lease_expires_at = None
+        current.save()
+
+    logger.info(f'Scoring job {current.status}: job_id={current.id}, attempts={current.attempts}')
+    if result['success'] and current.user_action_id and result.get('trace_id'):
+        _attach_trace(current, result['trace_id'])
+    return current.status
+
+
+def _attach_trace(job: ScoringJob, trace_id: str):
+    """評分成功後，將 Langfuse trace_id 寫入送出評分的 user action"""
+    try:
+        action = UserAction.objects.get(id=job.user_action_id, user_id=job.map.user_id)
+        action.metadata = action.metadata or {}
+        action.metadata['langfuse_trace_id'] = trace_id
+        action.save()
+    except UserAction.DoesNotExist:
+        logger.warning(f'UserAction {job.user_action_id} not found for scoring job {job.id}')
+    except Exception as e:
+        logger.warning(f'Failed to update user action with trace_id: {e}')
+
+
+def get_user_job(job_id, user) -> Optional[ScoringJob]:
+    """取得使用者自己的評分工作（不屬於該使用者時回傳 None）"""
+    return ScoringJob.objects.filter(pk=job_id, map__user=user).first()
+
+
+def is_finished(job: ScoringJob) -> bool:
+    return job.status not in ScoringJob.ACTIVE_STATUSES
+
+
+def get_job_payload(job: ScoringJob) -> dict:
+    """工作狀態的回應內容：完成時包含與同步 chat 相同的 message、message_type 與 scoring_remaining"""
+    payload = {
+        'success': job.status != ScoringJob.STATUS_FAILED,
+        'job_id': str(job.id),
+        'kind': job.kind,
+        'status': job.status,
+    }
+    if job.status == ScoringJob.STATUS_SUCCEEDED:
+        payload.update(job.result or {})
+    elif job.status == ScoringJob.STATUS_FAILED:
+        payload['message'] = 'Sorry, an error occurred while processing your request.'
+        payload['error'] = job.error
+    return payload
+
+
+def get_scoring_job_metrics() -> dict:
+    """評分工作佇列的狀態：等待中與執行中的工作數、最久的等待時間（秒）"""
+    now = timezone.now()
+    active = ScoringJob.objects.filter(status__in=ScoringJob.ACTIVE_STATUSES)
+    counts = {status: 0 for status in ScoringJob.ACTIVE_STATUSES}
+    for row in active.values('status').annotate(count=Count('pk')).order_by():
+        counts[row['status']] = row['count']
+    oldest = (
+        active.filter(status=ScoringJob.STATUS_PENDING)
+        .order_by('created_at')
+        .values_list('created_at', flat=True)
+        .first()
+    )
+    return {
+        'enabled': settings.SCORING_JOBS_ENABLED,
+        **counts,
+        'oldest_pending_seconds': round((now - oldest).total_seconds(), 1) if oldest else 0.0,
+    }
@@ -0,0 +1,76 @@
+"""
+評分次數（scoring_remaining）的預扣與確認
+
+評分前以條件更新（scoring_remaining > 0 時以 F() 扣減）預扣一次，同時送出的評分請求不會超扣；
+評分成功時確認，失敗、串流中斷或命中評分快取（且設定為不扣次數）時退回。
+心智圖評分使用 Map.scoring_remaining，essay 評分使用 Essay.scoring_remaining。
+非同步評分工作（scoring_jobs）的預扣隨工作保存，由評分 worker 以 reserved=True 建立後確認或退回。
+"""
+
+import logging
+from typing import Optional
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from apps.essay.models import Essay
+from apps.map.models import Map
+
+logger = logging.getLogger(__name__)
+
+
+def get_essay(map_instance: Map) -> Optional[Essay]:
+    """取得 map 的 essay（已 select_related 時不查詢），不存在時回傳 None"""
+    try:
+        return map_instance.essay
+    except Essay.DoesNotExist:
+        return None
+
+
+class ScoringQuota:
+    """一次評分請求的次數預扣"""
+
+    def __init__(self, chat_type: str, map_instance: Map, reserved: bool = False):
+        if chat_type == 'mindmap':
+            self.queryset = Map.objects.filter(pk=map_instance.pk)
+        else:
+            self.queryset = Essay.objects.filter(map_id=map_instance.pk)
+        self.chat_type = chat_type
+        self.map_id = map_instance.pk
+        self.reserved = reserved
+
+    def reserve(self) -> bool:
+        """預扣一次，剩餘次數不足時回傳 False"""
+        updated = self.queryset.filter(scoring_remaining__gt=0).update(
+            scoring_remaining=F('scoring_remaining') - 1,
+            scoring_updated_at=timezone.now(),
+        )
+        self.reserved = updated > 0
+        return self.reserved
+
+    def release(self):
+        """退回預扣的次數（未預扣或已確認時不做任何事）"""
+        if not self.reserved:
+            return
+        self.reserved = False
+        self.queryset.update(
+            scoring_remaining=F('scoring_remaining') + 1,
+            scoring_updated_at=timezone.now(),
+        )
+        logger.info(f'Scoring quota released: chat_type={self.chat_type}, map_id={self.map_id}')
+
+    def commit(self, cached: bool = False) -> int:
+        """
+        評分成功，確認預扣的次數
+
+        Args:
+            cached: 是否命中評分快取（依 SCORING_CACHE_HIT_CONSUMES_QUOTA 決定是否扣減）
+
+        Returns:
+            int: 剩餘次數
+        """
+        if cached and not settings.SCORING_CACHE_HIT_CONSUMES_QUOTA:
+            self.release()
+        self.reserved = False
+        return self.queryset.values_list('scoring_remaining', flat=True).first() or 0
@@ -0,0 +1,1588 @@
+import asyncio
+import json
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.core.signals import request_finished
+from django.db import close_old_connections
+from django.utils import timezone as django_timezone
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.prompts import PromptTemplate
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from apps.chatbot import checks, idempotency, scoring_jobs, views
+from apps.chatbot.idempotency import REPLAYED_HEADER, idempotent, make_request_key
+from apps.chatbot.langgraph import checkpoint_retention, context_store, history_store
+from apps.chatbot.langgraph.context_store import (
+    BLOB_REF_KEY,
+    compute_digest,
+    dehydrate_context,
+    is_blob_ref,
+    rehydrate_messages,
+)
+from apps.chatbot.langgraph.decision_cache import ClassifierDecisionCache, normalize_query
+from apps.chatbot.langgraph.delta_saver import DeltaPostgresSaver, clear_anchors
+from apps.chatbot.langgraph.essay.classifier import FAST_PATH_RULES as ESSAY_RULES
+from apps.chatbot.langgraph.essay.classifier import FAST_PATH_SENTINELS as ESSAY_SENTINELS
+from apps.chatbot.langgraph.fast_router import FastPathRouter
+from apps.chatbot.langgraph.history_store import archive_projected_thread, paginate_turns
+from apps.chatbot.langgraph.map_diff import apply_map_delta, compute_map_delta, encode_map_history
+from apps.chatbot.langgraph.memory import (
+    SUMMARY_HEADER,
+    format_transcript,
+    get_memory_messages,
+    select_messages_to_fold,
+)
+from apps.chatbot.langgraph.mindmap import service as mindmap_service
+from apps.chatbot.langgraph.mindmap.classifier import FAST_PATH_RULES, FAST_PATH_SENTINELS
+from apps.chatbot.langgraph.scoring_cache import compute_scoring_key
+from apps.chatbot.langgraph.speculation import predict_agent
+from apps.chatbot.langgraph.state_cache import ThreadStateCache
+from apps.chatbot.langgraph.thread_lock import (
+    InMemoryThreadLockBackend,
+    PostgresAdvisoryLockBackend,
+    ThreadBusyError,
+    ThreadLockBackend,
+    ThreadLockSaturatedError,
+    get_lock_key,
+    thread_busy_result,
+    thread_lock_manager,
+)
+from apps.chatbot.models import ScoringJob
+from apps.chatbot.scoring_jobs import (
+    claim_scoring_job,
+    compute_content_hash,
+    get_job_payload,
+    run_scoring_job,
+    submit_scoring_job,
+)
+from apps.chatbot.scoring_quota import ScoringQuota
+from apps.chatbot.views import (
+    _error_status,
+    _history_response,
+    _parse_history_params,
+    _submit_scoring_job,
+)
+from apps.essay.models import Essay
+from apps.feedback.views import FEEDBACK_KEY_FIELDS
+from apps.map import permissions
+from apps.map.models import Map
+from apps.mindMapTemplate.models import MindMapTemplate
+from config.connection_budget import split_connection_budget
+
+
+def build_messages(query):
+    return [
+        HumanMessage(content=json.dumps({'query': '什麼是 CER?', 'context': {}})),
+        AIMessage(content='...'),
+        HumanMessage(content=json.dumps({'query': query, 'context': {}}, ensure_ascii=False)),
+    ]
+
+
+class TestFastPathRouter:
+    @pytest.mark.parametrize(
+        'query, next_action, decision_source',
+        [
+            ('[scoring]', 'cer_scoring', 'sentinel'),
+            ('請幫我評分', 'cer_scoring', 'rule'),
+            ('score my mind map', 'cer_scoring', 'rule'),
+            ('怎麼刪除節點?', 'operator_support', 'rule'),
+            ('請問如何存檔？', 'operator_support', 'rule'),
+            ('How do I add a node?', 'operator_support', 'rule'),
+        ],
+    )
+    def test_mindmap_routes_unambiguous_input(self, query, next_action, decision_source):
+        """測試 sentinel 與高信心規則直接決定 next_action"""
+        router = FastPathRouter(FAST_PATH_SENTINELS, FAST_PATH_RULES)
+
+        result = router.route(build_messages(query))
+
+        assert result['next_action'] == next_action
+        assert result['decision_source'] == decision_source
+
+    @pytest.mark.parametrize(
+        'query',
+        [
+            '我的證據和論點要怎麼連接比較好?',
+            '評分標準是什麼?',
+            '好',
+            '怎麼刪除節點之後，我的 claim 還是不太清楚，可以再解釋一次 reasoning 要寫什麼嗎?',
+            '我不知道怎麼連接節點才能表達證據如何支持主張？',
+            'how do I connect the nodes so the evidence supports my claim?',
+        ],
+    )
+    def test_mindmap_leaves_ambiguous_input_to_llm(self, query):
+        """測試不明確或長句的輸入交給 LLM classifier"""
+        router = FastPathRouter(FAST_PATH_SENTINELS, FAST_PATH_RULES)
+
+        assert router.route(build_messages(query)) is None
+
+    def test_essay_routes_scoring(self):
+        """測試 essay 的評分 sentinel 與規則"""
+        router = FastPathRouter(ESSAY_SENTINELS, ESSAY_RULES)
+
+        assert router.route(build_messages('[scoring]'))['next_action'] == 'essay_scoring'
+        assert router.route(build_messages('幫我評分一下'))['next_action'] == 'essay_scoring'
+        assert router.route(build_messages('怎麼刪除節點?')) is None
+
+
+class TestClassifierDecisionCache:
+    def test_normalize_query(self):
+        """測試大小寫、空白與結尾標點不影響 key"""
+        assert normalize_query('  What is   Evidence?? ') == 'what is evidence'
+        assert normalize_query('什麼是證據？') == '什麼是證據'
+
+    def test_key_ignores_context_and_formatting(self):
+        """測試相同問題在不同心智圖內容下共用同一個 key"""
+        cache = ClassifierDecisionCache('mindmap', 'prompt', 'model')
+        first = build_messages('What is evidence?')
+        second = build_messages('what is  evidence')
+        second[-1] = HumanMessage(
+            content=json.dumps({'query': 'what is  evidence', 'context': {'mind_map_data': 1}})
+        )
+
+        assert cache.make_key(first) == cache.make_key(second)
+
+    def test_key_depends_on_history_and_prompt_version(self):
+        """測試對話脈絡或 prompt 變更時 key 不同"""
+        cache = ClassifierDecisionCache('mindmap', 'prompt', 'model')
+        messages = build_messages('why?')
+        other_history = [AIMessage(content='另一個回答')] + messages[2:]
+
+        assert cache.make_key(messages) != cache.make_key(other_history)
+        assert cache.make_key(messages) != ClassifierDecisionCache(
+            'mindmap', 'prompt v2', 'model'
+        ).make_key(messages)
+
+
+class TestPredictAgent:
+    CANDIDATES = ['operator_support', 'cer_cognitive_support']
+
+    def _reply(self, message_type):
+        return AIMessage(content='...', additional_kwargs={'message_type': message_type})
+
+    def test_uses_default_without_history(self):
+        """測試沒有歷史回應時使用預設 agent"""
+        messages = build_messages('hi')[2:]
+
+        assert predict_agent(messages, self.CANDIDATES, 'cer_cognitive_support') == (
+            'cer_cognitive_support'
+        )
+
+    def test_predicts_most_frequent_agent(self):
+        """測試預測 thread 中最常出現的對話型 agent，忽略評分等不推測的 agent"""
+        messages = [
+            self._reply('operator_support'),
+            self._reply('cer_scoring'),
+            self._reply('cer_scoring'),
+            self._reply('operator_support'),
+            self._reply('cer_cognitive_support'),
+        ]
+
+        assert predict_agent(messages, self.CANDIDATES, None) == 'operator_support'
+
+    def test_prefers_most_recent_on_tie(self):
+        """測試次數相同時取最近使用的 agent"""
+        messages = [self._reply('operator_support'), self._reply('cer_cognitive_support')]
+
+        assert predict_agent(messages, self.CANDIDATES, None) == 'cer_cognitive_support'
+
+
+class TestScoringCacheKey:
+    PROMPT = PromptTemplate(template='評分 {article_content}', input_variables=['article_content'])
+
+    def _key(self, article='文章', content='{"nodes": []}', prompt=PROMPT):
+        messages = [
+            SystemMessage(content=prompt.format(article_content=article)),
+            HumanMessage(content=content),
+        ]
+        return compute_scoring_key('cer_scoring', 'model', prompt, messages)
+
+    def test_identical_input_shares_key(self):
+        """測試相同的文章與心智圖內容得到相同的 key"""
+        assert self._key() == self._key()
+
+    def test_key_changes_with_content_article_or_prompt(self):
+        """測試評分內容、文章或 prompt 變更時 key 不同"""
+        new_prompt = PromptTemplate(
+            template='新版評分 {article_content}', input_variables=['article_content']
+        )
+
+        assert self._key() != self._key(content='{"nodes": [1]}')
+        assert self._key() != self._key(article='另一篇文章')
+        assert self._key() != self._key(prompt=new_prompt)
+
+
+def build_turns(count):
+    messages = []
+    for i in range(count):
+        context = {'mind_map_data': {'nodes': [i]}}
+        messages.append(HumanMessage(content=json.dumps({'query': f'問題{i}', 'context': context})))
+        messages.append(AIMessage(content=f'回答{i}'))
+    return messages
+
+
+class TestContextStore:
+    """測試對話 context 的去重儲存（ContextBlob 以記憶體替代）"""
+
+    @pytest.fixture(autouse=True)
+    def stored(self, monkeypatch):
+        stored = []
+        context_store._cache.clear()
+        monkeypatch.setattr(
+            context_store.ContextBlob.objects,
+            'bulk_create',
+            lambda blobs, ignore_conflicts=False: stored.extend(blobs),
+        )
+        yield stored
+        context_store._cache.clear()
+
+    def test_digest_is_stable(self):
+        """測試 digest 不受 key 順序影響，內容不同時不同"""
+        digest, serialized = compute_digest({'nodes': [1, 2], 'edges': []})
+
+        assert compute_digest({'edges': [], 'nodes': [1, 2]}) == (digest, serialized)
+        assert compute_digest({'nodes': [2, 1], 'edges': []})[0] != digest
+        assert len(digest) == 64
+
+    def test_is_blob_ref(self):
+        """測試只有單一 $blob 欄位的 dict 視為參考"""
+        assert is_blob_ref({BLOB_REF_KEY: 'abc'})
+        assert not is_blob_ref({BLOB_REF_KEY: 'abc', 'nodes': []})
+        assert not is_blob_ref({'nodes': []})
+        assert not is_blob_ref('abc')
+
+    def test_dehydrate_skips_empty_and_references(self, stored):
+        """測試空值與已是參考的欄位不建立 blob，相同內容只儲存一次"""
+        mind_map = {'nodes': [{'id': 'n1'}], 'edges': []}
+        context = {'mind_map_data': mind_map, 'essay_content': '', 'other': 'x'}
+
+        dehydrated = dehydrate_context(context)
+        assert dehydrated['mind_map_data'] == {BLOB_REF_KEY: compute_digest(mind_map)[0]}
+        assert dehydrated['essay_content'] == ''
+        assert dehydrated['other'] == 'x'
+        assert [blob.content for blob in stored] == [mind_map]
+
+        assert dehydrate_context(dehydrated) == dehydrated
+        dehydrate_context(dict(context))
+        assert len(stored) == 1
+
+    def test_rehydrate_round_trip(self):
+        """測試還原後與原始 context 相同（內容取自 process 內快取，不查詢資料庫）"""
+        context = {'mind_map_data': {'nodes': [], 'edges': []}, 'essay_content': '文章'}
+        message = HumanMessage(
+            content=json.dumps(
+                {'query': '評分', 'context': dehydrate_context(context)}, ensure_ascii=False
+            ),
+            id='m1',
+        )
+        plain = AIMessage(content='回應')
+
+        rehydrated = rehydrate_messages([message, plain])
+        assert json.loads(rehydrated[0].content) == {'query': '評分', 'context': context}
+        assert rehydrated[0].id == 'm1'
+        assert rehydrated[1] is plain
+
+
+class TestChatHistory:
+    """測試對話歷史的回合分頁與 ETag"""
+
+    def test_paginate_turns(self):
+        """測試第一頁、以 cursor 取得中間頁與最後一頁（cursor 之前的回合由查詢篩選）"""
+        turns = [5, 4, 3, 2, 1]
+
+        page, cursor = paginate_turns(turns[:3], 2)
+        assert (page, cursor) == ([5, 4], 4)
+
+        page, cursor = paginate_turns([turn for turn in turns if turn < cursor][:3], 2)
+        assert (page, cursor) == ([3, 2], 2)
+
+        page, cursor = paginate_turns([turn for turn in turns if turn < cursor][:3], 2)
+        assert (page, cursor) == ([1], None)
+
+    def test_parse_if_none_match(self):
+        """測試 If-None-Match 去除弱驗證前綴與引號，limit 不合法時回傳 400"""
+        request = APIRequestFactory().get('/', {'limit': '2'}, HTTP_IF_NONE_MATCH='W/"c1"')
+        params, error_response = _parse_history_params(Request(request))
+        assert error_response is None
+        assert params == {'etag': 'c1', 'limit': 2, 'before': None}
+
+        request = APIRequestFactory().get('/', {'limit': '0'})
+        _, error_response = _parse_history_params(Request(request))
+        assert error_response.status_code == 400
+
+    def test_matching_etag_returns_304(self, monkeypatch):
+        """測試 If-None-Match 與最新 checkpoint 相同時回傳 304，不讀取訊息"""
+        monkeypatch.setattr(mindmap_service, 'get_history_version', lambda thread_id: 'c1')
+        monkeypatch.setattr(
+            mindmap_service,
+            'load_history',
+            lambda *args, **kwargs: pytest.fail('history should not be loaded'),
+        )
+        service = object.__new__(mindmap_service.LangGraphService)
+
+        response = _history_response(service.get_conversation_history(1, etag='c1'))
+        assert response.status_code == 304
+        assert response['ETag'] == '"c1"'
+        assert response['Cache-Control'] == 'private, no-cache'
+
+        response = _history_response({'success': True, 'messages': [], 'etag': 'c2'})
+        assert response.status_code == 200
+        assert response['ETag'] == '"c2"'
+
+
+class TestConversationMemory:
+    @pytest.fixture(autouse=True)
+    def memory_settings(self, settings):
+        settings.CONVERSATION_MEMORY_WINDOW_TURNS = 2
+        settings.CONVERSATION_MEMORY_BATCH_TURNS = 2
+
+    def test_waits_until_batch_is_full(self):
+        """測試超出視窗的訊息未達批次輪數時不更新摘要"""
+        assert select_messages_to_fold(build_turns(3), 0) is None
+
+    def test_folds_turns_outside_window(self):
+        """測試只摘要視窗之前、尚未摘要的訊息"""
+        messages = build_turns(4)
+
+        pending, boundary = select_messages_to_fold(messages, 0)
+
+        assert boundary == 4
+        assert pending == messages[:4]
+        assert select_messages_to_fold(messages, boundary) is None
+
+    def test_transcript_excludes_context(self):
+        """測試摘要用的逐字稿不包含心智圖"""
+        transcript = format_transcript(build_turns(1))
+
+        assert transcript == 'Student: 問題0\nAssistant (assistant): 回答0'
+
+    def test_agent_receives_summary_and_recent_turns(self):
+        """測試 agent 收到摘要與未摘要的訊息"""
+        messages = build_turns(4)
+
+        memory = get_memory_messages(
+            {'messages': messages, 'summary': '- 學生問過 CER 定義', 'summarized_count': 4}
+        )
+
+        assert memory[0].content == f'{SUMMARY_HEADER}\n- 學生問過 CER 定義'
+        assert memory[1:] == messages[4:]
+        assert get_memory_messages({'messages': messages}) == messages
+
+
+def build_map(*node_ids, edges=()):
+    return {
+        'nodes': [{'id': node_id, 'content': f'內容 {node_id}'} for node_id in node_ids],
+        'edges': [{'node1': node1, 'node2': node2} for node1, node2 in edges],
+    }
+
+
+class TestMapDiff:
+    def test_delta_round_trip(self):
+        """測試差異只包含變更的節點與連線，且可還原目前的心智圖"""
+        previous = build_map('c1', 'e1', 'e2', 'r1', 'r2', edges=[('c1', 'e1')])
+        current = build_map('c1', 'e1', 'e2', 'r1', 'e3', edges=[('c1', 'e3')])
+        current['nodes'][0]['content'] = '修改後的主張'
+
+        delta = compute_map_delta(previous, current)
+
+        assert delta == {
+            'nodes': {
+                'added': [{'id': 'e3', 'content': '內容 e3'}],
+                'removed': ['r2'],
+                'edited': [{'id': 'c1', 'content': '修改後的主張'}],
+            },
+            'edges': {
+                'added': [{'node1': 'c1', 'node2': 'e3'}],
+                'removed': [{'node1': 'c1', 'node2': 'e1'}],
+            },
+        }
+        assert apply_map_delta(previous, delta) == current
+
+    def test_history_keeps_first_and_latest_full(self):
+        """測試歷史訊息改為差異，第一則與最新一則保留完整心智圖"""
+        maps = [
+            build_map('c1', 'e1', 'e2', 'r1'),
+            build_map('c1', 'e1', 'e2', 'r1', 'r2'),
+            build_map('c1', 'e1', 'e2', 'r1', 'r2', 'e3'),
+        ]
+        messages = []
+        for index, mind_map in enumerate(maps):
+            payload = {'query': f'問題{index}', 'context': {'mind_map_data': mind_map}}
+            messages += [HumanMessage(content=json.dumps(payload)), AIMessage(content='回答')]
+        messages.pop()
+
+        encoded = [json.loads(message.content) for message in encode_map_history(messages)[::2]]
+
+        assert encoded[0]['context'] == {'mind_map_data': maps[0]}
+        assert encoded[1]['context'] == {
+            'mind_map_delta': {'nodes': {'added': [{'id': 'r2', 'content': '內容 r2'}]}}
+        }
+        assert encoded[2]['context'] == {'mind_map_data': maps[2]}
+
+    def test_large_change_sends_full_map(self):
+        """測試差異過大時保留完整心智圖"""
+        messages = [
+            HumanMessage(content=json.dumps({'query': 'q', 'context': {'mind_map_data': m}}))
+            for m in (build_map('c1'), build_map('c2', 'e2'), build_map('c2', 'e2'))
+        ]
+
+        encoded = encode_map_history(messages)
+
+        assert encoded[1] is messages[1]
+
+
+class InMemoryIdempotencyStore:
+    """IdempotencyStore 的記憶體版本（測試用，不需要資料庫）"""
+
+    def __init__(self):
+        self.records = {}
+
+    def claim(self, key, scope):
+        record = self.records.get(key)
+        if record is None:
+            self.records[key] = SimpleNamespace(status='pending')
+            return 'owner', None
+        return ('replay' if record.status == 'completed' else 'wait'), record
+
+    def complete(self, key, response):
+        if response.status_code >= 300:
+            del self.records[key]
+            return
+        self.records[key] = SimpleNamespace(
+            status='completed', response=response.data, status_code=response.status_code
+        )
+
+    def release(self, key):
+        self.records.pop(key, None)
+
+
+class TestIdempotency:
+    FIELDS = ('map_id', 'message', 'user_action_id')
+
+    def _request(self, data, headers=None):
+        return SimpleNamespace(user=SimpleNamespace(id=1), data=data, headers=headers or {})
+
+    def test_key_derived_from_fields(self):
+        """測試相同欄位產生相同 key，不同使用者、scope 或 user_action_id 時不同"""
+        data = {'map_id': 1, 'message': 'hi', 'user_action_id': 7}
+        key = make_request_key('mindmap_chat', 1, None, data, self.FIELDS, 'user_action_id')
+
+        assert key == make_request_key(
+            'mindmap_chat', 1, None, dict(data), self.FIELDS, 'user_action_id'
+        )
+        assert key != make_request_key('mindmap_chat', 2, None, data, self.FIELDS)
+        assert key != make_request_key('essay_chat', 1, None, data, self.FIELDS)
+        assert key != make_request_key(
+            'mindmap_chat', 1, None, {**data, 'user_action_id': 8}, self.FIELDS
+        )
+
+    def test_no_key_without_required_field(self):
+        """測試缺少 user_action_id 且沒有 header 時不去重（刻意重複的訊息照常處理）"""
+        data = {'map_id': 1, 'message': 'hi', 'user_action_id': None}
+
+        assert (
+            make_request_key('mindmap_chat', 1, None, data, self.FIELDS, 'user_action_id') is None
+        )
+        assert make_request_key('mindmap_chat', 1, 'abc', data, self.FIELDS, 'user_action_id')
+
+    def test_retry_replays_stored_response(self, monkeypatch, settings):
+        """測試相同請求只執行一次，重試直接回傳儲存的回應"""
+        settings.IDEMPOTENCY_ENABLED = True
+        monkeypatch.setattr(idempotency, 'idempotency_store', InMemoryIdempotencyStore())
+        calls = []
+
+        @idempotent('chat', fields=self.FIELDS, required='user_action_id')
+        def view(request, chat_type):
+            calls.append(chat_type)
+            return Response({'success': True, 'message': f'reply {len(calls)}'})
+
+        request = self._request({'map_id': 1, 'message': 'hi', 'user_action_id': 7})
+        first = view(request, chat_type='mindmap')
+        retry = view(request, chat_type='mindmap')
+
+        assert calls == ['mindmap']
+        assert retry.data == first.data
+        assert retry[REPLAYED_HEADER] == 'true'
+
+    def test_feedback_only_coalesces_identified_retries(self, monkeypatch, settings):
+        """測試回饋只合併帶有 user_action_id 或 Idempotency-Key 的重試，刻意重複的操作會重新執行"""
+        settings.IDEMPOTENCY_ENABLED = True
+        monkeypatch.setattr(idempotency, 'idempotency_store', InMemoryIdempotencyStore())
+        calls = []
+
+        @idempotent('feedback', fields=FEEDBACK_KEY_FIELDS, required='user_action_id')
+        def view(request):
+            calls.append(1)
+            return Response({'success': True})
+
+        data = {'map_id': 1, 'metadata': [{'action': 'edit'}], 'alert_title': 't'}
+        view(self._request(data))
+        view(self._request(data))
+        assert len(calls) == 2
+
+        view(self._request({**data, 'user_action_id': 3}))
+        view(self._request({**data, 'user_action_id': 3}))
+        view(self._request(data, {'Idempotency-Key': 'k1'}))
+        view(self._request(data, {'Idempotency-Key': 'k1'}))
+        assert len(calls) == 4
+
+    def test_failed_request_is_not_stored(self, monkeypatch, settings):
+        """測試失敗的回應不保留，重試時重新執行"""
+        settings.IDEMPOTENCY_ENABLED = True
+        monkeypatch.setattr(idempotency, 'idempotency_store', InMemoryIdempotencyStore())
+        calls = []
+
+        @idempotent('feedback', fields=('map_id',))
+        def view(request):
+            calls.append(1)
+            return Response({'success': False}, status=500)
+
+        view(self._request({'map_id': 1}))
+        view(self._request({'map_id': 1}))
+
+        assert len(calls) == 2
+
+
+class FakeLockConnection:
+    """advisory lock 連線的替代品：記錄執行的語句，broken 時拋出例外"""
+
+    def __init__(self, held):
+        self.held = held
+        self.broken = False
+
+    def execute(self, sql, params):
+        if self.broken:
+            raise ConnectionError('connection lost')
+        key = params[0]
+        if 'pg_try_advisory_lock' in sql:
+            result = key not in self.held
+            self.held.add(key)
+        else:
+            result = key in self.held
+            self.held.discard(key)
+        return SimpleNamespace(fetchone=lambda: (result,))
+
+
+class FakeLockPool:
+    def __init__(self, size):
+        self.held = set()
+        self.idle = [FakeLockConnection(self.held) for _ in range(size)]
+        self.returned = []
+
+    def getconn(self, timeout=None):
+        from psycopg_pool import PoolTimeout
+
+        if not self.idle:
+            raise PoolTimeout('pool exhausted')
+        return self.idle.pop()
+
+    def putconn(self, conn):
+        self.returned.append(conn)
+        self.idle.append(conn)
+
+
+class TestThreadLock:
+    @pytest.fixture
+    def locks(self, settings):
+        settings.THREAD_LOCK_ENABLED = True
+        settings.THREAD_LOCK_TIMEOUT_SECONDS = 2
+        thread_lock_manager.reset(InMemoryThreadLockBackend())
+        yield thread_lock_manager
+        thread_lock_manager.reset()
+
+    def test_lock_key_is_stable_per_thread(self):
+        """測試 lock key 由 thread_id 決定且落在 bigint 範圍內"""
+        assert get_lock_key('mindmap-1') == get_lock_key('mindmap-1')
+        assert get_lock_key('mindmap-1') != get_lock_key('essay-1')
+        assert -(2**63) <= get_lock_key('mindmap-1') < 2**63
+
+    def test_postgres_backend_holds_each_lock_on_own_connection(self):
+        """測試每個鎖使用各自的連線：其他連線異常不影響已持有的鎖，連線用完時回報飽和"""
+        backend = PostgresAdvisoryLockBackend()
+        backend._pool = pool = FakeLockPool(size=2)
+
+        assert backend.try_lock(1)
+        held_connection = backend._connections[1]
+
+        pool.idle[0].broken = True
+        with pytest.raises(ConnectionError):
+            backend.try_lock(2)
+        assert backend._connections == {1: held_connection}
+        assert held_connection not in pool.returned
+
+        pool.idle.clear()
+        with pytest.raises(ThreadLockSaturatedError):
+            backend.try_lock(3)
+
+        backend.unlock(1)
+        assert pool.held == set()
+        assert pool.returned[-1] is held_connection
+
+    @pytest.mark.parametrize('policy', ['reject', 'queue'])
+    def test_saturated_backend_is_not_reported_as_busy(self, locks, settings, policy):
+        """測試鎖連線用完時立即回報飽和（503），不等待也不誤報為 thread 忙碌（409）"""
+        settings.THREAD_LOCK_POLICY = policy
+
+        class SaturatedBackend(ThreadLockBackend):
+            def try_lock(self, key):
+                raise ThreadLockSaturatedError(f'key={key}')
+
+            def unlock(self, key):
+                pass
+
+        locks.reset(SaturatedBackend())
+        with pytest.raises(ThreadLockSaturatedError) as exc_info:
+            with locks.lock('mindmap-1'):
+                pass
+
+        result = thread_busy_result(exc_info.value)
+        assert _error_status(result) == 503
+        assert _error_status(thread_busy_result(ThreadBusyError('mindmap-1'))) == 409
+        assert locks.snapshot()['saturated'] == 1
+        assert locks.snapshot()['held'] == 0
+        assert locks.snapshot()['max_waiting'] == 0
+
+    def test_lock_pool_covers_every_web_thread(self):
+        """測試 WSGI 模式的鎖連線池不小於 WEB_THREADS，差額由 checkpoint 與 Django 連線池分攤"""
+        sizes = split_connection_budget(15, 10, async_views=False, thread_lock_enabled=True)
+        assert sizes == {'thread_lock': 10, 'checkpoint': 2, 'django': 3}
+
+        sizes = split_connection_budget(45, 10, async_views=True, thread_lock_enabled=True)
+        assert sizes == {'thread_lock': 15, 'checkpoint': 10, 'django': 10}
+
+        sizes = split_connection_budget(15, 10, async_views=False, thread_lock_enabled=False)
+        assert sizes == {'thread_lock': 0, 'checkpoint': 7, 'django': 8}
+
+    def test_reject_policy(self, locks, settings):
+        """測試 reject 模式下同一個 thread 的第二個請求立即失敗，其他 thread 不受影響"""
+        settings.THREAD_LOCK_POLICY = 'reject'
+
+        with locks.lock('mindmap-1'):
+            with pytest.raises(ThreadBusyError):
+                with locks.lock('mindmap-1'):
+                    pass
+            with locks.lock('mindmap-2'):
+                pass
+
+        with locks.lock('mindmap-1'):
+            pass
+        assert locks.snapshot()['rejected'] == 1
+        assert locks.snapshot()['held'] == 0
+
+    def test_queue_policy_waits_for_release(self, locks, settings):
+        """測試 queue 模式下第二個請求等待第一個完成後才執行"""
+        settings.THREAD_LOCK_POLICY = 'queue'
+        order = []
+        started = threading.Event()
+
+        def first():
+            with locks.lock('mindmap-1'):
+                started.set()
+                threading.Event().wait(0.3)
+                order.append('first')
+
+        worker = threading.Thread(target=first)
+        worker.start()
+        started.wait()
+        with locks.lock('mindmap-1'):
+            order.append('second')
+        worker.join()
+
+        assert order == ['first', 'second']
+        assert locks.snapshot()['max_waiting'] == 1
+        assert locks.snapshot()['waiting'] == 0
+
+    def test_queue_policy_times_out(self, locks, settings):
+        """測試等待超過 THREAD_LOCK_TIMEOUT_SECONDS 時回報忙碌"""
+        settings.THREAD_LOCK_POLICY = 'queue'
+        settings.THREAD_LOCK_TIMEOUT_SECONDS = 0.3
+
+        with locks.lock('mindmap-1'):
+            with pytest.raises(ThreadBusyError):
+                with locks.lock('mindmap-1'):
+                    pass
+
+        assert locks.snapshot()['timeouts'] == 1
+
+
+class TestConnectionBudget:
+    """測試連線預算的分配與 check_connection_budget"""
+
+    def test_defaults_fit_max_connections(self):
+        """測試預設設定（含評分 worker）下每個 WSGI thread 都有鎖連線，且總數不超過 max_connections"""
+        for processes in (12, 13):
+            per_process = (200 - 20) // processes
+            sizes = split_connection_budget(per_process, 10, False, True)
+            assert sizes['thread_lock'] == 10
+            assert sizes['django'] >= 2
+            assert processes * sum(sizes.values()) + 20 <= 200
+
+    def test_check_connection_budget(self, settings):
+        """測試所有 process 的連線池上限加總超過 DB_MAX_CONNECTIONS 時回報錯誤"""
+        settings.ASYNC_VIEWS_ENABLED = False
+        settings.DB_MAX_CONNECTIONS = 200
+        settings.DB_RESERVED_CONNECTIONS = 20
+        settings.DB_PROCESSES = 12
+        settings.THREAD_LOCK_POOL_MAX_SIZE = 10
+        settings.CHECKPOINT_POOL_MAX_SIZE = 2
+        settings.DJANGO_DB_POOL_MAX_SIZE = 3
+
+        assert checks.get_connections_per_process() == 15
+        assert checks.check_connection_budget(None) == []
+
+        settings.DJANGO_DB_POOL_MAX_SIZE = 4
+        errors = checks.check_connection_budget(None)
+        assert [error.id for error in errors] == ['chatbot.E001']
+        assert '12 processes × 16 connections + 20 reserved = 212' in errors[0].msg
+
+        settings.ASYNC_VIEWS_ENABLED = True
+        settings.DJANGO_DB_POOL_MAX_SIZE = 3
+        # ASGI 模式另有 async checkpoint 連線池，同步連線池只保留 1 條
+        assert checks.get_connections_per_process() == 16
+
+
+class FakeThreadCursor:
+    """checkpoints 表的替代品：依 thread_id 排序後回傳 thread_id > last 的前 limit 個"""
+
+    def __init__(self, thread_ids, queries):
+        self.thread_ids = sorted(thread_ids)
+        self.queries = queries
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params):
+        last, limit = params
+        self.queries.append(last)
+        self.rows = [(thread_id,) for thread_id in self.thread_ids if thread_id > last][:limit]
+
+    def fetchall(self):
+        return self.rows
+
+
+class TestCheckpointRetention:
+    @pytest.fixture
+    def locks(self, settings):
+        settings.THREAD_LOCK_ENABLED = True
+        settings.THREAD_LOCK_POLICY = 'reject'
+        thread_lock_manager.reset(InMemoryThreadLockBackend())
+        yield thread_lock_manager
+        thread_lock_manager.reset()
+
+    def test_iter_thread_batches(self, monkeypatch):
+        """測試依 thread_id 順序分批，每批從上一批的最後一個 thread 之後繼續"""
+        queries = []
+        thread_ids = ['mindmap-3', 'essay-1', 'mindmap-1', 'essay-2', 'mindmap-2']
+        monkeypatch.setattr(
+            checkpoint_retention,
+            'connection',
+            SimpleNamespace(cursor=lambda: FakeThreadCursor(thread_ids, queries)),
+        )
+
+        batches = list(checkpoint_retention.iter_thread_batches(2))
+        assert batches == [
+            ['essay-1', 'essay-2'],
+            ['mindmap-1', 'mindmap-2'],
+            ['mindmap-3'],
+        ]
+        assert queries == ['', 'essay-2', 'mindmap-2', 'mindmap-3']
+
+    def test_prune_after_turn_disabled(self, monkeypatch, settings):
+        """測試 CHECKPOINT_PRUNE_ON_TURN 關閉時每輪對話後不清理"""
+        settings.CHECKPOINT_PRUNE_ON_TURN = False
+        monkeypatch.setattr(
+            checkpoint_retention,
+            'prune_threads',
+            lambda *args: pytest.fail('prune_threads should not be called'),
+        )
+
+        checkpoint_retention.prune_thread_after_turn('mindmap-1')
+
+    def test_archive_only_when_projection_is_current(self, locks, monkeypatch):
+        """測試投影為最新時在 thread 鎖內封存，投影落後、更新失敗或 thread 忙碌時略過"""
+        archived = []
+        versions = {'latest': 'c2', 'projected': 'c1'}
+        monkeypatch.setattr(history_store, 'get_latest_checkpoint_id', lambda _: versions['latest'])
+        monkeypatch.setattr(
+            history_store, 'get_projected_checkpoint_id', lambda _: versions['projected']
+        )
+        monkeypatch.setattr(
+            history_store,
+            'archive_thread',
+            lambda thread_id: archived.append((thread_id, locks.snapshot()['held'])),
+        )
+
+        assert not archive_projected_thread('mindmap-1', lambda: True)
+        versions['projected'] = 'c2'
+        assert not archive_projected_thread('mindmap-1', lambda: False)
+
+        with locks.lock('mindmap-1'):
+            assert not archive_projected_thread('mindmap-1', lambda: True)
+        assert archived == []
+
+        assert archive_projected_thread('mindmap-1', lambda: True)
+        assert archived == [('mindmap-1', 1)]
+        assert locks.snapshot()['held'] == 0
+
+
+class TestDeltaSaver:
+    """messages channel 的差異儲存（錨點 + 累積差異）"""
+
+    @pytest.fixture
+    def saver(self, settings, monkeypatch):
+        settings.CHECKPOINT_DELTA_ENABLED = True
+        settings.CHECKPOINT_DELTA_CONSOLIDATE_MESSAGES = 3
+        clear_anchors()
+        saver = DeltaPostgresSaver(None)
+        saver.blob_rows = []
+        saver.fail_put = False
+
+        @contextmanager
+        def cursor(pipeline=False):
+            # 寫入 checkpoints 表失敗時整個 put（含 checkpoint_blobs）回滾
+            def execute(sql, params):
+                if saver.fail_put:
+                    raise ConnectionError('connection lost')
+
+            yield SimpleNamespace(
+                executemany=lambda sql, rows: saver.blob_rows.extend(rows), execute=execute
+            )
+
+        monkeypatch.setattr(saver, '_cursor', cursor)
+        yield saver
+        clear_anchors()
+
+    def dump(self, saver, messages, version):
+        """以 put 寫入 checkpoint，回傳 messages blob 的 (type, blob)"""
+        config = {'configurable': {'thread_id': 'mindmap-1', 'checkpoint_ns': ''}}
+        checkpoint = {
+            'v': 1,
+            'id': f'checkpoint-{version}',
+            'ts': '2026-10-18T12:00:00+00:00',
+            'channel_values': {'messages': messages},
+            'channel_versions': {'messages': version},
+            'versions_seen': {},
+        }
+        saver.put(config, checkpoint, {}, {'messages': version})
+        row = saver.blob_rows[-1]
+        return row[4], row[5]
+
+    def load(self, saver, version, blob, anchor=None):
+        value = {
+            'thread_id': 'mindmap-1',
+            'checkpoint_ns': '',
+            'checkpoint_id': 'checkpoint',
+            'parent_checkpoint_id': None,
+            'checkpoint': {'channel_versions': {'messages': version}, 'channel_values': {}},
+            'metadata': {},
+            'channel_values': [[b'messages', blob[0].encode(), blob[1]]],
+            'delta_anchors': [[b'messages', anchor[0].encode(), anchor[1].encode(), anchor[2]]]
+            if anchor
+            else None,
+            'pending_writes': None,
+        }
+        return saver._load_checkpoint_tuple(value).checkpoint['channel_values']['messages']
+
+    def test_writes_only_appended_messages(self, saver):
+        """測試延續錨點的列表只寫入新增的訊息，讀取時還原為完整列表"""
+        first = [HumanMessage(content='q1'), AIMessage(content='a1')]
+        second = first + [HumanMessage(content='q2'), AIMessage(content='a2')]
+
+        anchor_type, anchor_blob = self.dump(saver, first, 'v1')
+        delta_type, delta_blob = self.dump(saver, second, 'v2')
+
+        assert not anchor_type.startswith('delta:')
+        assert delta_type.startswith('delta:v1:')
+        assert len(saver.serde.loads_typed((delta_type.split(':', 2)[2], delta_blob))) == 2
+
+        clear_anchors()
+        loaded = self.load(saver, 'v2', (delta_type, delta_blob), ('v1', anchor_type, anchor_blob))
+        assert [m.content for m in loaded] == ['q1', 'a1', 'q2', 'a2']
+
+    def test_continues_delta_after_load(self, saver):
+        """測試讀取後（例如另一個 worker 寫入的 checkpoint）延續同一個錨點寫入差異"""
+        first = [HumanMessage(content='q1'), AIMessage(content='a1')]
+        anchor = self.dump(saver, first, 'v1')
+        clear_anchors()
+
+        loaded = self.load(saver, 'v1', anchor)
+        delta_type, _ = self.dump(saver, loaded + [HumanMessage(content='q2')], 'v2')
+
+        assert delta_type.startswith('delta:v1:')
+
+    def test_consolidates_and_rejects_non_prefix(self, saver):
+        """測試差異超過上限或列表不是延續錨點時寫入完整列表"""
+        first = [HumanMessage(content='q1')]
+        self.dump(saver, first, 'v1')
+
+        long_type, _ = self.dump(saver, first + [AIMessage(content='a')] * 4, 'v2')
+        rebuilt_type, _ = self.dump(
+            saver, [HumanMessage(content='q1'), AIMessage(content='a')], 'v3'
+        )
+
+        assert not long_type.startswith('delta:')
+        assert not rebuilt_type.startswith('delta:')
+
+    def test_failed_put_does_not_become_anchor(self, saver):
+        """測試 put 失敗時寫入中的錨點不生效，之後的寫入為完整列表而不是指向未儲存錨點的差異"""
+        first = [HumanMessage(content='q1')]
+        self.dump(saver, first, 'v1')
+
+        rebuilt = [HumanMessage(content='q1'), AIMessage(content='a1')]
+        saver.fail_put = True
+        with pytest.raises(ConnectionError):
+            self.dump(saver, rebuilt, 'v2')
+
+        saver.fail_put = False
+        third = rebuilt + [HumanMessage(content='q2')]
+        value_type, _ = self.dump(saver, third, 'v3')
+        assert not value_type.startswith('delta:')
+        delta_type, _ = self.dump(saver, third + [AIMessage(content='a2')], 'v4')
+        assert delta_type.startswith('delta:v3:')
+
+    def test_missing_anchor_raises(self, saver):
+        """測試錨點不存在時回報錯誤，不回傳不完整的對話"""
+        first = [HumanMessage(content='q1')]
+        self.dump(saver, first, 'v1')
+        delta = self.dump(saver, first + [AIMessage(content='a1')], 'v2')
+
+        with pytest.raises(ValueError):
+            self.load(saver, 'v2', delta)
+
+
+class TestThreadStateCache:
+    """thread state 快取（write-through，以 checkpoint id 確認版本）"""
+
+    @pytest.fixture
+    def cache(self, settings):
+        settings.THREAD_STATE_CACHE_MAX_THREADS = 2
+        settings.THREAD_STATE_CACHE_MAX_MESSAGES = 100
+        return ThreadStateCache()
+
+    @staticmethod
+    def config(thread_id, checkpoint_id=None):
+        configurable = {'thread_id': thread_id, 'checkpoint_ns': ''}
+        if checkpoint_id:
+            configurable['checkpoint_id'] = checkpoint_id
+        return {'configurable': configurable}
+
+    def put(self, cache, thread_id, checkpoint_id, messages):
+        checkpoint = {
+            'v': 1,
+            'id': checkpoint_id,
+            'ts': '',
+            'channel_values': {'messages': messages},
+            'channel_versions': {'messages': '1'},
+            'versions_seen': {},
+        }
+        cache.store_put(
+            self.config(thread_id), self.config(thread_id, checkpoint_id), checkpoint, {}
+        )
+
+    def test_hit_when_version_matches(self, cache):
+        """測試資料庫中的版本與快取相同時直接回傳，且回傳的是複本"""
+        self.put(cache, 'mindmap-1', 'c1', [HumanMessage(content='q1')])
+
+        assert cache.lookup(self.config('mindmap-1')) == 'c1'
+        state = cache.get(self.config('mindmap-1'), ('c1', 0))
+        state.checkpoint['channel_versions']['messages'] = '2'
+
+        again = cache.get(self.config('mindmap-1'), ('c1', 0))
+        assert again.checkpoint['channel_versions']['messages'] == '1'
+        assert again.checkpoint['channel_values']['messages'][0].content == 'q1'
+        assert cache.snapshot()['hits'] == 2
+
+    def test_stale_when_other_worker_wrote(self, cache):
+        """測試其他 worker 寫入新的 checkpoint 或 pending writes 後不使用快取"""
+        self.put(cache, 'mindmap-1', 'c1', [])
+
+        assert cache.get(self.config('mindmap-1'), ('c1', 2)) is None
+        assert cache.lookup(self.config('mindmap-1')) is None
+        assert cache.snapshot()['stale'] == 1
+
+    def test_invalidate_on_pending_writes(self, cache):
+        """測試目前 checkpoint 新增 pending writes 時移除快取，其他 checkpoint 的不影響"""
+        self.put(cache, 'mindmap-1', 'c2', [])
+
+        cache.invalidate(self.config('mindmap-1', 'c1'))
+        assert cache.lookup(self.config('mindmap-1')) == 'c2'
+
+        cache.invalidate(self.config('mindmap-1', 'c2'))
+        assert cache.lookup(self.config('mindmap-1')) is None
+
+    def test_evicts_least_recently_used(self, cache):
+        """測試超過 thread 數或訊息總數上限時淘汰最久未使用的 thread"""
+        self.put(cache, 'mindmap-1', 'c1', [])
+        self.put(cache, 'mindmap-2', 'c1', [])
+        cache.get(self.config('mindmap-1'), ('c1', 0))
+        self.put(cache, 'mindmap-3', 'c1', [])
+
+        assert cache.lookup(self.config('mindmap-2')) is None
+        assert cache.lookup(self.config('mindmap-1')) == 'c1'
+
+        self.put(cache, 'mindmap-4', 'c1', [HumanMessage(content='q')] * 150)
+        assert cache.snapshot()['threads'] == 0
+
+
+NOW = datetime(2026, 10, 18, 12, 0, tzinfo=timezone.utc)
+
+
+class FakeJobQuerySet:
+    """ScoringJob.objects 的替代品：以欄位值篩選記憶體中的工作（Q 條件不篩選）"""
+
+    def __init__(self, jobs, create_error=None):
+        self.jobs = list(jobs)
+        self.create_error = create_error
+
+    def select_for_update(self, **kwargs):
+        return self
+
+    def select_related(self, *fields):
+        return self
+
+    def order_by(self, *fields):
+        return self
+
+    def filter(self, *conditions, **fields):
+        def matches(job, field, value):
+            if field.endswith('__in'):
+                return getattr(job, field[: -len('__in')]) in value
+            return getattr(job, field) == value
+
+        return FakeJobQuerySet(
+            [
+                job
+                for job in self.jobs
+                if all(matches(job, field, value) for field, value in fields.items())
+            ]
+        )
+
+    def first(self):
+        return self.jobs[0] if self.jobs else None
+
+    def create(self, **fields):
+        if self.create_error is not None:
+            raise self.create_error
+        job = ScoringJob(**fields)
+        self.jobs.append(job)
+        return job
+
+
+class TestScoringJobs:
+    """測試非同步評分工作的內容雜湊、狀態回應、領取、重試與 202 回應"""
+
+    @pytest.fixture
+    def quota_calls(self, monkeypatch):
+        """以記錄呼叫的 ScoringQuota 取代次數預扣"""
+        calls = []
+
+        class FakeScoringQuota:
+            def __init__(self, kind, map_instance, reserved=False):
+                self.reserved = reserved
+
+            def reserve(self):
+                calls.append('reserve')
+                return True
+
+            def release(self):
+                calls.append('release')
+
+            def commit(self, cached=False):
+                calls.append('commit')
+                return 2
+
+        monkeypatch.setattr(scoring_jobs, 'ScoringQuota', FakeScoringQuota)
+        return calls
+
+    @pytest.fixture
+    def job_store(self, monkeypatch, settings, quota_calls):
+        """以記憶體中的工作取代資料庫，回傳目前的工作列表"""
+        settings.SCORING_JOB_LEASE_SECONDS = 300
+        settings.SCORING_JOB_MAX_ATTEMPTS = 2
+        settings.SCORING_JOB_RETRY_DELAY_SECONDS = 5
+        store = FakeJobQuerySet([])
+        monkeypatch.setattr(ScoringJob, 'objects', store)
+        monkeypatch.setattr(ScoringJob, 'save', lambda job, **kwargs: None)
+        monkeypatch.setattr(scoring_jobs, 'transaction', SimpleNamespace(atomic=nullcontext))
+        monkeypatch.setattr(scoring_jobs, 'timezone', SimpleNamespace(now=lambda: NOW))
+        return store
+
+    def build_job(self, **fields):
+        fields.setdefault('status', ScoringJob.STATUS_PENDING)
+        return ScoringJob(map=Map(id=1, user_id=7), kind='mindmap', available_at=NOW, **fields)
+
+    def score_with(self, monkeypatch, result):
+        monkeypatch.setattr(scoring_jobs, '_score', lambda job: result)
+
+    def build_map(self, nodes):
+        return Map(id=1, template_id=3, nodes=nodes, edges=[])
+
+    def test_content_hash(self):
+        """測試內容相同時雜湊相同；心智圖或 essay 文章改變時不同，心智圖評分不受文章影響"""
+        nodes = [{'id': 'n1', 'data': {'content': 'claim'}}]
+        key = compute_content_hash('essay', self.build_map(nodes), '文章')
+
+        assert compute_content_hash('essay', self.build_map(list(nodes)), '文章') == key
+        assert compute_content_hash('essay', self.build_map(nodes), '修改後的文章') != key
+        assert compute_content_hash('essay', self.build_map([]), '文章') != key
+        assert compute_content_hash('mindmap', self.build_map(nodes), '文章') == (
+            compute_content_hash('mindmap', self.build_map(nodes), '')
+        )
+
+    def test_job_payload(self):
+        """測試完成時回傳評分結果，失敗時 success 為 False，處理中只回傳狀態"""
+        job = ScoringJob(kind='mindmap', status=ScoringJob.STATUS_RUNNING)
+        assert get_job_payload(job) == {
+            'success': True,
+            'job_id': str(job.id),
+            'kind': 'mindmap',
+            'status': 'running',
+        }
+
+        job.status = ScoringJob.STATUS_SUCCEEDED
+        job.result = {'message': '評分結果', 'message_type': 'cer_scoring', 'scoring_remaining': 2}
+        payload = get_job_payload(job)
+        assert payload['message'] == '評分結果'
+        assert payload['scoring_remaining'] == 2
+
+        job.status = ScoringJob.STATUS_FAILED
+        job.error = 'timeout'
+        payload = get_job_payload(job)
+        assert payload['success'] is False
+        assert payload['error'] == 'timeout'
+
+    def test_submit_returns_active_job_after_integrity_error(self, job_store, quota_calls):
+        """測試同時送出的相同評分建立失敗時退回次數，只回傳處理中的工作"""
+        map_instance = self.build_map([])
+        content_hash = compute_content_hash('mindmap', map_instance)
+        finished = self.build_job(content_hash=content_hash, status=ScoringJob.STATUS_FAILED)
+        job_store.jobs.append(finished)
+        job_store.create_error = scoring_jobs.IntegrityError()
+
+        assert submit_scoring_job('mindmap', map_instance) is None
+        assert quota_calls == ['reserve', 'release']
+
+    def test_claim_job(self, job_store):
+        """測試領取工作時標記為執行中、累加嘗試次數並設定 lease"""
+        job = self.build_job()
+        job_store.jobs.append(job)
+
+        assert claim_scoring_job() is job
+        assert job.status == ScoringJob.STATUS_RUNNING
+        assert job.attempts == 1
+        assert job.started_at == NOW
+        assert job.lease_expires_at == NOW + timedelta(seconds=300)
+
+    def test_run_job_succeeds(self, job_store, quota_calls, monkeypatch):
+        """測試評分成功時確認次數並保存結果"""
+        job = self.build_job(status=ScoringJob.STATUS_RUNNING, attempts=1)
+        job_store.jobs.append(job)
+        self.score_with(monkeypatch, {'success': True, 'message': '評分結果'})
+
+        assert run_scoring_job(job) == ScoringJob.STATUS_SUCCEEDED
+        assert quota_calls == ['commit']
+        assert job.result['scoring_remaining'] == 2
+        assert job.finished_at == NOW
+
+    def test_run_job_retries_then_releases(self, job_store, quota_calls, monkeypatch):
+        """測試評分失敗時延後重試（間隔隨嘗試次數增加），最後一次失敗時退回次數"""
+        job = self.build_job()
+        job_store.jobs.append(job)
+        self.score_with(monkeypatch, {'success': False, 'error': 'timeout'})
+
+        claim_scoring_job()
+        assert run_scoring_job(job) == ScoringJob.STATUS_PENDING
+        assert job.available_at == NOW + timedelta(seconds=5)
+        assert job.lease_expires_at is None
+        assert job.finished_at is None
+        assert quota_calls == []
+
+        claim_scoring_job()
+        assert run_scoring_job(job) == ScoringJob.STATUS_FAILED
+        assert job.attempts == 2
+        assert job.error == 'timeout'
+        assert job.finished_at == NOW
+        assert quota_calls == ['release']
+
+    def test_run_job_after_lease_lost(self, job_store, quota_calls, monkeypatch):
+        """測試 lease 逾時後已由其他 worker 重新領取時不更新工作，也不確認或退回次數"""
+        job_store.jobs.append(self.build_job(status=ScoringJob.STATUS_RUNNING, attempts=2))
+        stale = self.build_job(status=ScoringJob.STATUS_RUNNING, attempts=1)
+        stale.pk = job_store.jobs[0].pk
+        self.score_with(monkeypatch, {'success': True, 'message': '評分結果'})
+
+        assert run_scoring_job(stale) is None
+        assert quota_calls == []
+        assert job_store.jobs[0].status == ScoringJob.STATUS_RUNNING
+
+    def test_chat_submits_job(self, monkeypatch):
+        """測試非同步評分回傳 202 與工作狀態網址，次數不足時回傳評分次數已用完"""
+        job = ScoringJob(kind='mindmap', status=ScoringJob.STATUS_PENDING)
+        submitted = []
+        monkeypatch.setattr(views, '_check_chat_request', lambda *args, **kwargs: (None, None))
+        monkeypatch.setattr(
+            views,
+            'submit_scoring_job',
+            lambda *args, **kwargs: submitted.append((args, kwargs)) or job,
+        )
+        map_instance = self.build_map([])
+
+        response = _submit_scoring_job('mindmap', map_instance, {'user_action_id': 5})
+        assert response.status_code == 202
+        assert response.data['job_id'] == str(job.id)
+        assert response.data['status'] == 'pending'
+        assert response['Location'] == response.data['status_url']
+        # WSGI 模式不提供 SSE 訂閱（每個訂閱會佔用 worker thread），只能輪詢
+        assert 'events_url' not in response.data
+        assert submitted == [
+            (('mindmap', map_instance), {'essay_plain_text': '', 'user_action_id': 5})
+        ]
+
+        monkeypatch.setattr(views, 'submit_scoring_job', lambda *args, **kwargs: None)
+        response = _submit_scoring_job('mindmap', map_instance, {})
+        assert response.status_code == 200
+        assert response.data['scoring_remaining'] == 0
+
+
+CHAT_USER = SimpleNamespace(id=7, is_authenticated=True)
+
+
+class FakeMapQuerySet:
+    """require_map_owner 查詢的替代品：回傳指定的 map"""
+
+    def __init__(self, map_instance):
+        self.map_instance = map_instance
+
+    def select_related(self, *fields):
+        return self
+
+    def first(self):
+        return self.map_instance
+
+    async def afirst(self):
+        return self.map_instance
+
+
+def post_chat(monkeypatch, data, headers=None, map_instance=None):
+    """建立已登入使用者對自己的 map 送出的聊天請求（map 查詢以 FakeMapQuerySet 取代）"""
+    map_instance = map_instance or Map(id=data['map_id'], user_id=CHAT_USER.id)
+    monkeypatch.setattr(
+        permissions,
+        'Map',
+        SimpleNamespace(objects=SimpleNamespace(filter=lambda **_: FakeMapQuerySet(map_instance))),
+    )
+    request = APIRequestFactory().post('/', data, format='json', headers=headers)
+    force_authenticate(request, user=CHAT_USER)
+    return request
+
+
+class FakeChatService:
+    """LangGraph service 的替代品：回傳固定結果並記錄呼叫順序"""
+
+    def __init__(self, calls, result):
+        self.calls = calls
+        self.result = result
+
+    def process_user_message(self, **kwargs):
+        self.calls.append('service')
+        return dict(self.result)
+
+    def stream_user_message(self, **kwargs):
+        self.calls.append('service')
+        yield {'event': 'token', 'data': {'delta': self.result.get('message', '')}}
+        yield {'event': 'done', 'data': dict(self.result)}
+
+    async def aprocess_user_message(self, **kwargs):
+        return self.process_user_message(**kwargs)
+
+    async def astream_user_message(self, **kwargs):
+        for event in self.stream_user_message(**kwargs):
+            yield event
+
+    async def aget_conversation_history(self, map_id, **params):
+        self.calls.append(('history', params))
+        return {'success': True, 'not_modified': True, 'etag': params['etag']}
+
+
+class TestChatViews:
+    """以替代的 map 查詢與 service 測試 chat endpoint（不需要資料庫與 LLM）"""
+
+    @pytest.fixture
+    def calls(self, monkeypatch, settings):
+        settings.IDEMPOTENCY_ENABLED = False
+        settings.SCORING_JOBS_ENABLED = False
+        calls = []
+        monkeypatch.setattr(views, '_check_chat_request', lambda *args, **kwargs: (None, None))
+        monkeypatch.setattr(views, 'close_old_connections', lambda: calls.append('release'))
+        service = FakeChatService(calls, {'success': True, 'message': '回應'})
+        monkeypatch.setattr(views, 'get_langgraph_service', lambda: service)
+        return calls
+
+    def test_chat_releases_db_connection_before_llm_call(self, monkeypatch, calls):
+        """測試呼叫 service（LLM）前先將 Django 連線歸還連線池"""
+        request = post_chat(monkeypatch, {'map_id': 1, 'message': 'hi'})
+
+        response = views.chat(request, chat_type='mindmap')
+        assert response.status_code == 200
+        assert response.data['message'] == '回應'
+        assert calls == ['release', 'service']
+
+    def test_stream_releases_db_connection_before_llm_call(self, monkeypatch, calls):
+        """測試串流在產生事件（呼叫 LLM）前先將 Django 連線歸還連線池"""
+        request = post_chat(monkeypatch, {'map_id': 1, 'message': 'hi'})
+
+        response = views.chat_stream(request, chat_type='mindmap')
+        assert calls == ['release']
+        body = b''.join(response.streaming_content).decode()
+        assert 'event: done' in body
+        assert calls == ['release', 'service']
+
+    def test_stream_submits_scoring_job(self, monkeypatch, calls, settings):
+        """測試啟用非同步評分時串流 endpoint 也建立工作並回傳 202，不在請求中執行評分"""
+        settings.SCORING_JOBS_ENABLED = True
+        job = ScoringJob(kind='mindmap', status=ScoringJob.STATUS_PENDING)
+        monkeypatch.setattr(views, 'submit_scoring_job', lambda *args, **kwargs: job)
+        data = {'map_id': 1, 'message': '[scoring]'}
+
+        response = views.chat_stream(post_chat(monkeypatch, data), chat_type='mindmap')
+        assert response.status_code == 202
+        assert response.data['job_id'] == str(job.id)
+
+        request = post_chat(monkeypatch, data, headers={'Accept': 'text/event-stream'})
+        response = views.chat_stream(request, chat_type='mindmap')
+        assert response.status_code == 202
+        assert response.rendered_content.decode().startswith('event: accepted\n')
+        assert calls == []
+
+    def test_job_subscription_releases_connection_between_polls(self, monkeypatch):
+        """測試 SSE 訂閱每次查詢工作狀態後立即歸還 Django 連線"""
+        calls = []
+        monkeypatch.setattr(views, 'get_user_job', lambda job_id, user: calls.append('query'))
+        monkeypatch.setattr(views, 'close_old_connections', lambda: calls.append('release'))
+
+        views._poll_user_job('job', CHAT_USER)
+        assert calls == ['query', 'release']
+
+    def test_stream_is_idempotent(self, monkeypatch, calls, settings):
+        """測試串流重複送出時只執行一次：進行中回傳 409，完成後回傳最終結果，中斷時可重試"""
+        settings.IDEMPOTENCY_ENABLED = True
+        settings.IDEMPOTENCY_WAIT_SECONDS = 0
+        monkeypatch.setattr(idempotency, 'idempotency_store', InMemoryIdempotencyStore())
+        data = {'map_id': 1, 'message': 'hi', 'user_action_id': 5}
+
+        first = views.chat_stream(post_chat(monkeypatch, data), chat_type='mindmap')
+        duplicate = views.chat_stream(post_chat(monkeypatch, data), chat_type='mindmap')
+        assert duplicate.status_code == 409
+
+        b''.join(first.streaming_content)
+        request = post_chat(monkeypatch, data, headers={'Accept': 'text/event-stream'})
+        retry = views.chat_stream(request, chat_type='mindmap')
+        assert retry[REPLAYED_HEADER] == 'true'
+        assert retry.rendered_content.decode().startswith('event: done\n')
+        assert retry.data == {'success': True, 'message': '回應'}
+        assert calls.count('service') == 1
+
+        data['user_action_id'] = 6
+        interrupted = views.chat_stream(post_chat(monkeypatch, data), chat_type='mindmap')
+        next(iter(interrupted.streaming_content))
+        # close() 會送出 request_finished，測試中不由 close_old_connections 處理資料庫連線
+        request_finished.disconnect(close_old_connections)
+        try:
+            interrupted.close()
+        finally:
+            request_finished.connect(close_old_connections)
+        retry = views.chat_stream(post_chat(monkeypatch, data), chat_type='mindmap')
+        assert retry.streaming
+
+
+@pytest.fixture
+def owned_map(db):
+    """使用者自己的 map（期限內的 template，含 essay），評分次數皆為 1"""
+    user = get_user_model().objects.create_user(
+        username='student', email='student@example.com', password='password123'
+    )
+    now = django_timezone.now()
+    template = MindMapTemplate.objects.create(
+        name='template',
+        issue_topic='topic',
+        article_content='article',
+        created_by=user,
+        start_date=now - timedelta(days=1),
+        end_date=now + timedelta(days=1),
+    )
+    map_instance = Map.objects.create(name='map', user=user, template=template, scoring_remaining=1)
+    # 建立 map 時會一併建立 essay
+    Essay.objects.update_or_create(
+        map=map_instance, defaults={'user': user, 'scoring_remaining': 1}
+    )
+    return map_instance
+
+
+@pytest.mark.django_db
+class TestScoringQuota:
+    """評分次數的條件預扣、退回與確認"""
+
+    def remaining(self, map_instance):
+        map_instance.refresh_from_db()
+        return map_instance.scoring_remaining
+
+    def test_reserve_fails_when_exhausted(self, owned_map):
+        """測試剩餘次數為 0 時預扣失敗，次數不會變成負數"""
+        assert ScoringQuota('mindmap', owned_map).reserve()
+        assert not ScoringQuota('mindmap', owned_map).reserve()
+        assert self.remaining(owned_map) == 0
+
+    def test_release_is_idempotent(self, owned_map):
+        """測試重複退回只退回一次，未預扣時退回不做任何事"""
+        quota = ScoringQuota('mindmap', owned_map)
+        quota.reserve()
+        quota.release()
+        quota.release()
+        ScoringQuota('mindmap', owned_map).release()
+        assert self.remaining(owned_map) == 1
+
+    @pytest.mark.parametrize('consumes, remaining', [(False, 1), (True, 0)])
+    def test_commit_on_cache_hit(self, owned_map, settings, consumes, remaining):
+        """測試命中評分快取時依 SCORING_CACHE_HIT_CONSUMES_QUOTA 退回或扣減次數"""
+        settings.SCORING_CACHE_HIT_CONSUMES_QUOTA = consumes
+        quota = ScoringQuota('essay', owned_map)
+        quota.reserve()
+
+        assert quota.commit(cached=True) == remaining
+        quota.release()
+        assert Essay.objects.get(map=owned_map).scoring_remaining == remaining
+
+    def test_chat_loads_map_once(self, owned_map, monkeypatch, settings, django_assert_num_queries):
+        """測試 chat 只以一次查詢載入 map、template 與 essay，view 與 service 共用"""
+        settings.IDEMPOTENCY_ENABLED = False
+        loaded = []
+
+        class Service:
+            def process_user_message(self, **kwargs):
+                loaded.append(kwargs['map_instance'])
+                return {'success': True, 'message': '回應'}
+
+        monkeypatch.setattr(views, 'get_essay_langgraph_service', Service)
+        # 測試在 transaction 中執行，不歸還連線
+        monkeypatch.setattr(views, 'close_old_connections', lambda: None)
+        request = APIRequestFactory().post(
+            '/', {'map_id': owned_map.id, 'message': 'hi'}, format='json'
+        )
+        force_authenticate(request, user=owned_map.user)
+
+        with django_assert_num_queries(1):
+            response = views.chat(request, chat_type='essay')
+            assert loaded[0].template.end_date
+            assert loaded[0].essay.scoring_remaining == 1
+        assert response.status_code == 200
+
+
+class TestAsyncChatViews:
+    """ASGI 模式的 async views（service 以 FakeChatService 取代）"""
+
+    @pytest.fixture
+    def service(self, monkeypatch, settings):
+        settings.IDEMPOTENCY_ENABLED = False
+        settings.SCORING_JOBS_ENABLED = False
+        service = FakeChatService([], {'success': True, 'message': '回應'})
+        monkeypatch.setattr(views, 'get_langgraph_service', lambda: service)
+        monkeypatch.setattr(views, 'close_old_connections', lambda: None)
+        return service
+
+    def open_map(self):
+        """期限內的 map（含 template）"""
+        now = django_timezone.now()
+        template = MindMapTemplate(
+            id=3, start_date=now - timedelta(days=1), end_date=now + timedelta(days=1)
+        )
+        return Map(id=1, user_id=CHAT_USER.id, template=template)
+
+    def test_scoring_limit(self, monkeypatch, service):
+        """測試評分次數用完時回傳 Scoring limit reached，不呼叫 service"""
+
+        class ExhaustedQuota:
+            def __init__(self, chat_type, map_instance):
+                pass
+
+            def reserve(self):
+                return False
+
+        monkeypatch.setattr(views, 'ScoringQuota', ExhaustedQuota)
+        data = {'map_id': 1, 'message': '[scoring]'}
+        request = post_chat(monkeypatch, data, map_instance=self.open_map())
+
+        response = asyncio.run(views.chat_async(request, chat_type='mindmap'))
+        assert response.status_code == 200
+        assert response.data['message'] == 'Scoring limit reached.'
+        assert response.data['scoring_remaining'] == 0
+        assert service.calls == []
+
+    def test_thread_busy_returns_409(self, monkeypatch, service):
+        """測試同一個對話已有請求在處理時回傳 409"""
+        service.result = thread_busy_result()
+        request = post_chat(
+            monkeypatch, {'map_id': 1, 'message': 'hi'}, map_instance=self.open_map()
+        )
+
+        response = asyncio.run(views.chat_async(request, chat_type='mindmap'))
+        assert response.status_code == 409
+        assert response.data['error'] == {'code': 'thread_busy'}
+
+    def test_stream_done_event(self, monkeypatch, service):
+        """測試串流的 done 事件與 chat 相同格式，不含內部欄位"""
+        service.result = {
+            'success': True,
+            'message': '回應',
+            'message_type': 'cer_cognitive_support',
+            'classification': {'next_action': 'cer_cognitive_support'},
+            'scoring_cached': False,
+            'trace_id': 'trace-1',
+        }
+        request = post_chat(
+            monkeypatch, {'map_id': 1, 'message': 'hi'}, map_instance=self.open_map()
+        )
+
+        async def consume():
+            response = await views.chat_stream_async(request, chat_type='mindmap')
+            return [chunk async for chunk in response.streaming_content]
+
+        events = b''.join(asyncio.run(consume())).decode().strip().split('\n\n')
+        assert events[0] == 'event: token\ndata: {"delta": "回應"}'
+        event, data = events[-1].split('\n')
+        assert event == 'event: done'
+        assert json.loads(data.removeprefix('data: ')) == {
+            'success': True,
+            'message': '回應',
+            'message_type': 'cer_cognitive_support',
+        }
+
+    def test_history_not_modified(self, monkeypatch, service):
+        """測試 async 歷史 endpoint 傳遞 If-None-Match，版本相同時回傳 304"""
+
+        class OwnedMap:
+            async def aexists(self):
+                return True
+
+        monkeypatch.setattr(
+            permissions,
+            'Map',
+            SimpleNamespace(objects=SimpleNamespace(filter=lambda **_: OwnedMap())),
+        )
+        request = APIRequestFactory().get('/', HTTP_IF_NONE_MATCH='"c1"')
+        force_authenticate(request, user=CHAT_USER)
+
+        response = asyncio.run(views.get_chat_history_async(request, chat_type='mindmap', map_id=1))
+        assert response.status_code == 304
+        assert response['ETag'] == '"c1"'
+        assert service.calls == [('history', {'etag': 'c1', 'limit': None, 'before': None})]
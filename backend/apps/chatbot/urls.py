@@ -1,10 +1,27 @@
+from django.conf import settings
 from django.urls import path
 
-from .views import chat, get_chat_history
+from .views import (
+    chat,
+    chat_async,
+    chat_stream,
+    chat_stream_async,
+    get_chat_history,
+    get_chat_history_async,
+    get_scoring_job,
+    get_scoring_job_async,
+    scoring_job_events_async,
+)
+
+# ASGI 模式（uvicorn）使用 async views，WSGI 模式（gunicorn）維持同步 views
+if settings.ASYNC_VIEWS_ENABLED:
+    chat, chat_stream, get_chat_history = chat_async, chat_stream_async, get_chat_history_async
+    get_scoring_job = get_scoring_job_async
 
 urlpatterns = [
     # Mind Map chat
     path('mindmap/chat/', chat, {'chat_type': 'mindmap'}, name='mindmap_chat'),
+    path('mindmap/chat/stream/', chat_stream, {'chat_type': 'mindmap'}, name='mindmap_chat_stream'),
     path(
         'mindmap/history/<int:map_id>/',
         get_chat_history,
@@ -13,10 +30,23 @@ urlpatterns = [
     ),
     # Essay chat
     path('essay/chat/', chat, {'chat_type': 'essay'}, name='essay_chat'),
+    path('essay/chat/stream/', chat_stream, {'chat_type': 'essay'}, name='essay_chat_stream'),
     path(
         'essay/history/<int:map_id>/',
         get_chat_history,
         {'chat_type': 'essay'},
         name='essay_chat_history',
     ),
+    # 非同步評分工作（SCORING_JOBS_ENABLED）：輪詢狀態
+    path('scoring-jobs/<uuid:job_id>/', get_scoring_job, name='scoring_job'),
 ]
+
+# 以 SSE 訂閱評分工作只在 ASGI 模式提供：WSGI 模式每個訂閱會佔用一個 worker thread 直到工作完成
+if settings.ASYNC_VIEWS_ENABLED:
+    urlpatterns.append(
+        path(
+            'scoring-jobs/<uuid:job_id>/events/',
+            scoring_job_events_async,
+            name='scoring_job_events',
+        )
+    )
@@ -1,25 +1,268 @@
+import asyncio
+import json
 import logging
+import time
 
-from django.utils import timezone
+from adrf.decorators import api_view as async_api_view
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import StreamingHttpResponse
+from django.urls import reverse
 from rest_framework import status
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, renderer_classes
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from rest_framework.response import Response
 
 from apps.common.utils.deadline_checker import check_template_deadline
-from apps.essay.models import Essay
-from apps.map.models import Map
 from apps.map.permissions import require_map_owner
 from apps.user_action.models import UserAction
 
+from .idempotency import idempotent, set_stream_result
 from .langgraph.essay import get_essay_langgraph_service
 from .langgraph.mindmap import get_langgraph_service
+from .langgraph.thread_lock import THREAD_BUSY_ERROR, THREAD_LOCK_SATURATED_ERROR
+from .scoring_jobs import get_job_payload, get_user_job, is_finished, submit_scoring_job
+from .scoring_quota import ScoringQuota, get_essay
 from .serializers import ChatMessageSerializer
 
 logger = logging.getLogger(__name__)
 
 
+class EventStreamRenderer(BaseRenderer):
+    """Server-Sent Events renderer，讓 Accept: text/event-stream 的請求通過 content negotiation"""
+
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # 串流 endpoint 的非串流回應（Response dict）以單一事件輸出：錯誤為 error 事件，
+        # 建立評分工作（202）為 accepted 事件，其餘（例如重試時回傳的最終結果）為 done 事件
+        if isinstance(data, dict):
+            response = (renderer_context or {}).get('response')
+            if response is None or response.status_code >= status.HTTP_400_BAD_REQUEST:
+                return format_sse_event('error', data)
+            if response.status_code == status.HTTP_202_ACCEPTED:
+                return format_sse_event('accepted', data)
+            return format_sse_event('done', data)
+        return data
+
+
+def format_sse_event(event: str, data: dict) -> str:
+    """將事件格式化為 SSE 文字"""
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+def _scoring_limit_response(chat_type):
+    return Response(
+        {
+            'success': True,
+            'message': 'Scoring limit reached.',
+            'message_type': f'{"cer_scoring" if chat_type == "mindmap" else "essay_scoring"}',
+            'scoring_remaining': 0,
+        }
+    )
+
+
+def _check_chat_request(chat_type, map_instance, is_scoring, reserve=True):
+    """
+    聊天請求的共用檢查：map 期限與評分次數（評分請求預扣一次）
+
+    Args:
+        map_instance: require_map_owner 載入的 map（含 template 與 essay）
+        reserve: 是否預扣評分次數（非同步評分工作於建立工作時預扣）
+
+    Returns:
+        tuple: (quota, error_response)，檢查通過時 error_response 為 None；
+               quota 為評分的預扣（非評分請求為 None），view 需確認或退回
+    """
+    # 檢查期限
+    if not map_instance.template or not check_template_deadline(map_instance.template):
+        logger.warning(
+            f'Template expired, cannot use chat: map_id={map_instance.id}, user={map_instance.user_id}'
+        )
+        return None, Response(
+            {'success': False, 'error': 'This task has expired and chat is not available'},
+            status=status.HTTP_403_FORBIDDEN,
+        )
+
+    if not is_scoring:
+        return None, None
+    if chat_type not in ('mindmap', 'essay'):
+        return None, Response(
+            {'success': False, 'error': f'Unknown chat type: {chat_type}'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    if chat_type == 'essay' and get_essay(map_instance) is None:
+        logger.error(f'Essay not found for map: map_id={map_instance.id}')
+        return None, Response(
+            {'success': False, 'error': 'Essay not found'},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+    if not reserve:
+        return None, None
+
+    # 評分次數以條件更新預扣，同時送出的評分請求不會超扣
+    quota = ScoringQuota(chat_type, map_instance)
+    if not quota.reserve():
+        logger.info(
+            f'Scoring limit reached: chat_type={chat_type}, map_id={map_instance.id}, user={map_instance.user_id}'
+        )
+        return None, _scoring_limit_response(chat_type)
+
+    return quota, None
+
+
+def _release_db_connection():
+    """
+    呼叫 LLM 前將 Django 連線歸還連線池
+
+    連線原本到 request_finished 才歸還，對話期間（數秒到數十秒）佔用連線池，
+    同時進行的對話超過 DJANGO_DB_POOL_MAX_SIZE 時其他請求只能等待；之後的查詢會重新取得連線
+    """
+    close_old_connections()
+
+
+def _finish_scoring(quota, result):
+    """service 處理完成：成功時確認評分次數並回傳剩餘次數，失敗時退回"""
+    if quota is None:
+        return None
+    if not result['success']:
+        quota.release()
+        return None
+    return quota.commit(result.get('scoring_cached', False))
+
+
+def _submit_scoring_job(chat_type, map_instance, validated_data):
+    """
+    建立非同步評分工作（SCORING_JOBS_ENABLED），回傳 202 與查詢工作狀態的網址
+    （ASGI 模式另有以 SSE 訂閱狀態的 events_url）
+    """
+    _, error_response = _check_chat_request(chat_type, map_instance, True, reserve=False)
+    if error_response is not None:
+        return error_response
+
+    job = submit_scoring_job(
+        chat_type,
+        map_instance,
+        essay_plain_text=validated_data.get('essay_plain_text', ''),
+        user_action_id=validated_data.get('user_action_id'),
+    )
+    if job is None:
+        logger.info(
+            f'Scoring limit reached: chat_type={chat_type}, map_id={map_instance.id}, user={map_instance.user_id}'
+        )
+        return _scoring_limit_response(chat_type)
+
+    status_url = reverse('scoring_job', kwargs={'job_id': job.id})
+    payload = {**get_job_payload(job), 'status_url': status_url}
+    if settings.ASYNC_VIEWS_ENABLED:
+        payload['events_url'] = reverse('scoring_job_events', kwargs={'job_id': job.id})
+    response = Response(payload, status=status.HTTP_202_ACCEPTED)
+    response['Location'] = status_url
+    return response
+
+
+# 載入 map 時一併取得 template（期限、文章）與 essay（評分次數），view 與 service 共用
+_require_chat_map = require_map_owner(select_related=('template', 'essay'))
+
+
+def _error_status(result):
+    """
+    service 處理失敗時的 HTTP 狀態：同一個對話已有請求在處理時回傳 409，
+    thread 鎖的連線都在使用中時回傳 503，其餘為 500
+    """
+    code = result.get('error', {}).get('code')
+    if code == THREAD_BUSY_ERROR:
+        return status.HTTP_409_CONFLICT
+    if code == THREAD_LOCK_SATURATED_ERROR:
+        return status.HTTP_503_SERVICE_UNAVAILABLE
+    return status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+def _attach_trace_to_user_action(request, user_action_id, trace_id):
+    """AI 成功回應後，將 Langfuse trace_id 寫入 user action"""
+    try:
+        action = UserAction.objects.get(id=user_action_id, user=request.user)
+        action.metadata = action.metadata or {}
+        action.metadata['langfuse_trace_id'] = trace_id
+        action.save()
+    except UserAction.DoesNotExist:
+        logger.warning(f'UserAction {user_action_id} not found for user {request.user.id}')
+    except Exception as e:
+        logger.warning(f'Failed to update user action with trace_id: {e}')
+
+
+def _parse_history_params(request):
+    """
+    解析歷史查詢參數：limit（最新幾個回合）、before（分頁 cursor）與 If-None-Match
+
+    Returns:
+        tuple: (params, error_response)，解析成功時 error_response 為 None
+    """
+    params = {'etag': None}
+    for name in ('limit', 'before'):
+        value = request.query_params.get(name)
+        if value is None:
+            params[name] = None
+            continue
+        try:
+            params[name] = int(value)
+        except ValueError:
+            params[name] = -1
+        if params[name] < 1:
+            return None, Response(
+                {'success': False, 'messages': [], 'error': f'Invalid {name}'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        params['etag'] = if_none_match.removeprefix('W/').strip('"')
+
+    return params, None
+
+
+def _history_response(result):
+    """組成歷史回應，帶上以 checkpoint id 為版本的 ETag"""
+    if not result['success']:
+        return Response(
+            {
+                'success': False,
+                'messages': [],
+                'error': result.get('error', {}),
+            },
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+    if result.get('not_modified'):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(
+            {
+                'success': True,
+                'messages': result['messages'],
+                'next_cursor': result.get('next_cursor'),
+            }
+        )
+
+    if result.get('etag'):
+        response['ETag'] = f'"{result["etag"]}"'
+    # 每次都需向後端確認版本，但版本未變時只回傳 304
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# 連點或前端重試時，相同 user_action_id 的訊息只執行一次（也可由 Idempotency-Key header 指定）
+_chat_idempotent = idempotent(
+    'chat', fields=('map_id', 'message', 'user_action_id'), required='user_action_id'
+)
+
+
 @api_view(['POST'])
-@require_map_owner
+@_require_chat_map
+@_chat_idempotent
 def chat(request, chat_type):
     """
     統一的聊天訊息處理 endpoint
@@ -32,70 +275,33 @@ def chat(request, chat_type):
             {'success': False, 'error': 'Invalid request data'}, status=status.HTTP_400_BAD_REQUEST
         )
 
+    quota = None
     try:
         message = serializer.validated_data['message']
         map_id = serializer.validated_data['map_id']
         essay_plain_text = serializer.validated_data.get('essay_plain_text', '')
+        map_instance = request.map_instance
 
-        # 取得 map 並檢查期限
-        try:
-            map_instance = Map.objects.get(id=map_id, user=request.user)
-            if not map_instance.template or not check_template_deadline(map_instance.template):
-                logger.warning(
-                    f'Template expired, cannot use chat: map_id={map_id}, user={request.user.id}'
-                )
-                return Response(
-                    {'success': False, 'error': 'This task has expired and chat is not available'},
-                    status=status.HTTP_403_FORBIDDEN,
-                )
-        except Map.DoesNotExist:
-            logger.error(f'Map not found: map_id={map_id}, user={request.user.id}')
-            return Response(
-                {'success': False, 'error': 'Map not found'},
-                status=status.HTTP_404_NOT_FOUND,
-            )
-
-        # 評分次數檢查
+        # 檢查期限與評分次數（評分請求預扣一次）
         is_scoring = message == '[scoring]'
-        scoring_remaining = None
-
-        if is_scoring:
-            scoring_limit_reached = False
-            if chat_type == 'mindmap':
-                if map_instance.scoring_remaining <= 0:
-                    scoring_limit_reached = True
-                    scoring_remaining = 0
-            elif chat_type == 'essay':
-                try:
-                    essay = Essay.objects.get(map=map_instance)
-                    if essay.scoring_remaining <= 0:
-                        scoring_limit_reached = True
-                        scoring_remaining = 0
-                except Essay.DoesNotExist:
-                    logger.error(f'Essay not found for map: map_id={map_id}')
-                    return Response(
-                        {'success': False, 'error': 'Essay not found'},
-                        status=status.HTTP_404_NOT_FOUND,
-                    )
-
-            if scoring_limit_reached:
-                logger.info(
-                    f'Scoring limit reached: chat_type={chat_type}, map_id={map_id}, user={request.user.id}'
-                )
-                return Response(
-                    {
-                        'success': True,
-                        'message': 'Scoring limit reached.',
-                        'message_type': f'{"cer_scoring" if chat_type == "mindmap" else "essay_scoring"}',
-                        'scoring_remaining': 0,
-                    }
-                )
+
+        # 非同步評分：建立工作後立即回傳 202，由評分 worker 執行
+        if is_scoring and settings.SCORING_JOBS_ENABLED:
+            return _submit_scoring_job(chat_type, map_instance, serializer.validated_data)
+
+        quota, error_response = _check_chat_request(chat_type, map_instance, is_scoring)
+        if error_response is not None:
+            return error_response
+        _release_db_connection()
 
         # 根據 chat_type 選擇對應的 service
         if chat_type == 'mindmap':
             service = get_langgraph_service()
             result = service.process_user_message(
-                user_input=message, map_id=map_id, user_id=str(request.user.id)
+                user_input=message,
+                map_id=map_id,
+                user_id=str(request.user.id),
+                map_instance=map_instance,
             )
         elif chat_type == 'essay':
             service = get_essay_langgraph_service()
@@ -104,6 +310,7 @@ def chat(request, chat_type):
                 map_id=map_id,
                 user_id=str(request.user.id),
                 essay_plain_text=essay_plain_text,
+                map_instance=map_instance,
             )
         else:
             return Response(
@@ -111,6 +318,9 @@ def chat(request, chat_type):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        # 評分成功時確認預扣的次數，失敗時退回
+        scoring_remaining = _finish_scoring(quota, result)
+
         # 檢查處理結果
         if not result['success']:
             # 返回錯誤資訊
@@ -120,36 +330,13 @@ def chat(request, chat_type):
                     'message': result['message'],  # 使用者友善訊息
                     'error': result.get('error', {}),  # 詳細錯誤資訊（開發者用）
                 },
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                status=_error_status(result),
             )
 
-        # 評分成功後扣減次數
-        if is_scoring and result['success']:
-            now = timezone.now()
-            if chat_type == 'mindmap':
-                map_instance.scoring_remaining = max(0, map_instance.scoring_remaining - 1)
-                map_instance.scoring_updated_at = now
-                map_instance.save(update_fields=['scoring_remaining', 'scoring_updated_at'])
-                scoring_remaining = map_instance.scoring_remaining
-            elif chat_type == 'essay':
-                essay = Essay.objects.get(map=map_instance)
-                essay.scoring_remaining = max(0, essay.scoring_remaining - 1)
-                essay.scoring_updated_at = now
-                essay.save(update_fields=['scoring_remaining', 'scoring_updated_at'])
-                scoring_remaining = essay.scoring_remaining
-
         # AI 成功回應後，更新 user action
         user_action_id = serializer.validated_data.get('user_action_id')
         if user_action_id and 'trace_id' in result:
-            try:
-                action = UserAction.objects.get(id=user_action_id, user=request.user)
-                action.metadata = action.metadata or {}
-                action.metadata['langfuse_trace_id'] = result['trace_id']
-                action.save()
-            except UserAction.DoesNotExist:
-                logger.warning(f'UserAction {user_action_id} not found for user {request.user.id}')
-            except Exception as e:
-                logger.warning(f'Failed to update user action with trace_id: {e}')
+            _attach_trace_to_user_action(request, user_action_id, result['trace_id'])
 
         response_data = {
             'success': True,
@@ -161,11 +348,110 @@ def chat(request, chat_type):
 
         return Response(response_data)
 
+    except Exception as e:
+        logger.exception(e)
+        if quota is not None:
+            quota.release()
+        return Response(
+            {'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@api_view(['POST'])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+@_require_chat_map
+@_chat_idempotent
+def chat_stream(request, chat_type):
+    """
+    串流版聊天 endpoint（Server-Sent Events）
+    request body 與 chat 相同，回應事件：
+        - token: {"delta": "..."} 回應 agent 逐步產生的文字（CER 支援 agent 只推送 final_response）
+        - done: 與 chat 相同格式的最終結果，前端應以其中的 message 作為最終顯示內容
+    啟用非同步評分（SCORING_JOBS_ENABLED）時，評分請求與 chat 相同建立工作並回傳 202
+    （以 text/event-stream 接收時為單一 accepted 事件），由前端輪詢 status_url
+    與 chat 相同去重：相同請求串流進行中時等待其完成，之後回傳最終結果（單一 done 事件）
+    """
+    serializer = ChatMessageSerializer(data=request.data)
+
+    if not serializer.is_valid():
+        return Response(
+            {'success': False, 'error': 'Invalid request data'}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    message = serializer.validated_data['message']
+    map_id = serializer.validated_data['map_id']
+    essay_plain_text = serializer.validated_data.get('essay_plain_text', '')
+    user_action_id = serializer.validated_data.get('user_action_id')
+
+    map_instance = request.map_instance
+
+    is_scoring = message == '[scoring]'
+    try:
+        # 非同步評分：與 chat 相同建立工作後立即回傳 202，不在請求中執行評分
+        if is_scoring and settings.SCORING_JOBS_ENABLED:
+            return _submit_scoring_job(chat_type, map_instance, serializer.validated_data)
+        quota, error_response = _check_chat_request(chat_type, map_instance, is_scoring)
     except Exception as e:
         logger.exception(e)
         return Response(
             {'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+    if error_response is not None:
+        return error_response
+
+    if chat_type == 'mindmap':
+        events = get_langgraph_service().stream_user_message(
+            user_input=message,
+            map_id=map_id,
+            user_id=str(request.user.id),
+            map_instance=map_instance,
+        )
+    elif chat_type == 'essay':
+        events = get_essay_langgraph_service().stream_user_message(
+            user_input=message,
+            map_id=map_id,
+            user_id=str(request.user.id),
+            essay_plain_text=essay_plain_text,
+            map_instance=map_instance,
+        )
+    else:
+        return Response(
+            {'success': False, 'error': f'Unknown chat type: {chat_type}'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    def event_stream():
+        try:
+            for event in events:
+                if event['event'] == 'done':
+                    result = event['data']
+                    result.pop('classification', None)
+                    try:
+                        scoring_remaining = _finish_scoring(quota, result)
+                        if scoring_remaining is not None:
+                            result['scoring_remaining'] = scoring_remaining
+                        if result['success'] and user_action_id and result.get('trace_id'):
+                            _attach_trace_to_user_action(
+                                request, user_action_id, result['trace_id']
+                            )
+                    except Exception:
+                        logger.exception(f'Failed to finalize streamed chat: map_id={map_id}')
+                    result.pop('scoring_cached', None)
+                    result.pop('trace_id', None)
+                    # 相同請求的重試（連點、前端重送）直接回傳最終結果
+                    set_stream_result(response, result)
+                yield format_sse_event(event['event'], event['data'])
+        finally:
+            # 串流中斷（例如使用者關閉頁面）時退回預扣的評分次數
+            if quota is not None:
+                quota.release()
+
+    _release_db_connection()
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # 關閉反向代理（nginx）的緩衝，讓 token 即時送達瀏覽器
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @api_view(['GET'])
@@ -174,6 +460,11 @@ def get_chat_history(request, chat_type, map_id):
     """
     統一的聊天歷史獲取 endpoint
     根據 chat_type 路由到不同的 LangGraph service
+
+    Query Params:
+        - limit: 只回傳最新的幾個回合（選填，未指定時回傳全部）
+        - before: 分頁 cursor，使用上一頁回應的 next_cursor 取得更早的回合
+    回應帶有 ETag（最新 checkpoint id），If-None-Match 相同時回傳 304
     """
     try:
         # 根據 chat_type 選擇對應的 service
@@ -187,19 +478,317 @@ def get_chat_history(request, chat_type, map_id):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        result = service.get_conversation_history(map_id)
+        params, error_response = _parse_history_params(request)
+        if error_response is not None:
+            return error_response
+
+        result = service.get_conversation_history(map_id, **params)
+
+        return _history_response(result)
+
+    except Exception as e:
+        logger.exception(e)
+        return Response(
+            {'success': False, 'messages': [], 'error': str(e)},
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+
+
+# 訂閱評分工作時，狀態未改變期間定期送出 SSE 註解，避免反向代理視為閒置連線
+_SSE_KEEPALIVE = ': keep-alive\n\n'
+_SSE_KEEPALIVE_SECONDS = 15
+
+
+def _get_scoring_job(request, job_id):
+    """
+    取得使用者自己的評分工作
+
+    Returns:
+        tuple: (job, error_response)，未登入回傳 401，不存在或不屬於該使用者回傳 404
+    """
+    if not request.user or not request.user.is_authenticated:
+        return None, Response(
+            {'success': False, 'error': 'Authentication required'},
+            status=status.HTTP_401_UNAUTHORIZED,
+        )
+    job = get_user_job(job_id, request.user)
+    if job is None:
+        return None, Response(
+            {'success': False, 'error': 'Scoring job not found'},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+    return job, None
+
+
+class _JobSubscription:
+    """評分工作的訂閱：狀態改變時送出事件，完成或超過 SCORING_JOB_SUBSCRIBE_SECONDS 時結束"""
+
+    def __init__(self):
+        self.deadline = time.monotonic() + settings.SCORING_JOB_SUBSCRIBE_SECONDS
+        self.last_status = None
+        self.last_sent = time.monotonic()
+        self.done = False
+
+    def update(self, job):
+        """依最新的工作狀態回傳要送出的內容（沒有內容時為 None）"""
+        now = time.monotonic()
+        if job is None:
+            self.done = True
+            return format_sse_event('error', {'success': False, 'error': 'Scoring job not found'})
+        if job.status != self.last_status:
+            self.last_status = job.status
+            self.last_sent = now
+            self.done = is_finished(job)
+            return format_sse_event('done' if self.done else 'status', get_job_payload(job))
+        self.done = now >= self.deadline
+        if now - self.last_sent >= _SSE_KEEPALIVE_SECONDS:
+            self.last_sent = now
+            return _SSE_KEEPALIVE
+        return None
+
+
+def _poll_user_job(job_id, user):
+    """訂閱期間查詢工作狀態，查詢後立即歸還 Django 連線（訂閱最長維持 SCORING_JOB_SUBSCRIBE_SECONDS）"""
+    job = get_user_job(job_id, user)
+    close_old_connections()
+    return job
+
+
+def _job_events_response(event_stream):
+    response = StreamingHttpResponse(event_stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@api_view(['GET'])
+def get_scoring_job(request, job_id):
+    """
+    評分工作的狀態（輪詢）
+    status 為 pending / running / succeeded / failed，
+    succeeded 時回應包含與 chat 相同的 message、message_type 與 scoring_remaining
+    """
+    try:
+        job, error_response = _get_scoring_job(request, job_id)
+        if error_response is not None:
+            return error_response
+        return Response(get_job_payload(job))
+
+    except Exception as e:
+        logger.exception(e)
+        return Response(
+            {'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+# ---------------------------------------------------------------------------
+# Async views（SERVER_MODE=asgi 時由 urls.py 使用）
+# LLM 呼叫與 checkpoint 讀寫改為 await，等待期間不佔用 worker thread
+# ---------------------------------------------------------------------------
+
+
+async def _aget_chat_service(chat_type):
+    """取得 chat_type 對應的 service（首次建立會連線資料庫，需在 thread 中執行）"""
+    if chat_type == 'mindmap':
+        return await sync_to_async(get_langgraph_service)()
+    if chat_type == 'essay':
+        return await sync_to_async(get_essay_langgraph_service)()
+    return None
+
+
+@async_api_view(['POST'])
+@_require_chat_map
+@_chat_idempotent
+async def chat_async(request, chat_type):
+    """chat 的 async 版本，request / response 格式相同"""
+    serializer = ChatMessageSerializer(data=request.data)
+
+    if not serializer.is_valid():
+        return Response(
+            {'success': False, 'error': 'Invalid request data'}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    quota = None
+    try:
+        message = serializer.validated_data['message']
+        map_id = serializer.validated_data['map_id']
+        essay_plain_text = serializer.validated_data.get('essay_plain_text', '')
+        map_instance = request.map_instance
+
+        is_scoring = message == '[scoring]'
+
+        if is_scoring and settings.SCORING_JOBS_ENABLED:
+            return await sync_to_async(_submit_scoring_job)(
+                chat_type, map_instance, serializer.validated_data
+            )
+
+        quota, error_response = await sync_to_async(_check_chat_request)(
+            chat_type, map_instance, is_scoring
+        )
+        if error_response is not None:
+            return error_response
+        await sync_to_async(_release_db_connection)()
+
+        service = await _aget_chat_service(chat_type)
+        if service is None:
+            return Response(
+                {'success': False, 'error': f'Unknown chat type: {chat_type}'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        kwargs = {
+            'user_input': message,
+            'map_id': map_id,
+            'user_id': str(request.user.id),
+            'map_instance': map_instance,
+        }
+        if chat_type == 'essay':
+            kwargs['essay_plain_text'] = essay_plain_text
+        result = await service.aprocess_user_message(**kwargs)
+
+        scoring_remaining = await sync_to_async(_finish_scoring)(quota, result)
 
         if not result['success']:
             return Response(
                 {
                     'success': False,
-                    'messages': [],
+                    'message': result['message'],
                     'error': result.get('error', {}),
                 },
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                status=_error_status(result),
+            )
+
+        user_action_id = serializer.validated_data.get('user_action_id')
+        if user_action_id and 'trace_id' in result:
+            await sync_to_async(_attach_trace_to_user_action)(
+                request, user_action_id, result['trace_id']
+            )
+
+        response_data = {
+            'success': True,
+            'message': result['message'],
+            'message_type': result.get('message_type'),
+        }
+        if scoring_remaining is not None:
+            response_data['scoring_remaining'] = scoring_remaining
+
+        return Response(response_data)
+
+    except Exception as e:
+        logger.exception(e)
+        if quota is not None:
+            await sync_to_async(quota.release)()
+        return Response(
+            {'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@async_api_view(['POST'])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+@_require_chat_map
+@_chat_idempotent
+async def chat_stream_async(request, chat_type):
+    """chat_stream 的 async 版本，事件格式相同"""
+    serializer = ChatMessageSerializer(data=request.data)
+
+    if not serializer.is_valid():
+        return Response(
+            {'success': False, 'error': 'Invalid request data'}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    message = serializer.validated_data['message']
+    map_id = serializer.validated_data['map_id']
+    essay_plain_text = serializer.validated_data.get('essay_plain_text', '')
+    user_action_id = serializer.validated_data.get('user_action_id')
+
+    map_instance = request.map_instance
+
+    is_scoring = message == '[scoring]'
+    quota = None
+    try:
+        if is_scoring and settings.SCORING_JOBS_ENABLED:
+            return await sync_to_async(_submit_scoring_job)(
+                chat_type, map_instance, serializer.validated_data
+            )
+        quota, error_response = await sync_to_async(_check_chat_request)(
+            chat_type, map_instance, is_scoring
+        )
+        service = await _aget_chat_service(chat_type)
+    except Exception as e:
+        logger.exception(e)
+        if quota is not None:
+            await sync_to_async(quota.release)()
+        return Response(
+            {'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+    if error_response is not None:
+        return error_response
+    if service is None:
+        return Response(
+            {'success': False, 'error': f'Unknown chat type: {chat_type}'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    kwargs = {
+        'user_input': message,
+        'map_id': map_id,
+        'user_id': str(request.user.id),
+        'map_instance': map_instance,
+    }
+    if chat_type == 'essay':
+        kwargs['essay_plain_text'] = essay_plain_text
+
+    async def event_stream():
+        try:
+            async for event in service.astream_user_message(**kwargs):
+                if event['event'] == 'done':
+                    result = event['data']
+                    result.pop('classification', None)
+                    try:
+                        scoring_remaining = await sync_to_async(_finish_scoring)(quota, result)
+                        if scoring_remaining is not None:
+                            result['scoring_remaining'] = scoring_remaining
+                        if result['success'] and user_action_id and result.get('trace_id'):
+                            await sync_to_async(_attach_trace_to_user_action)(
+                                request, user_action_id, result['trace_id']
+                            )
+                    except Exception:
+                        logger.exception(f'Failed to finalize streamed chat: map_id={map_id}')
+                    result.pop('scoring_cached', None)
+                    result.pop('trace_id', None)
+                    # 相同請求的重試（連點、前端重送）直接回傳最終結果
+                    set_stream_result(response, result)
+                yield format_sse_event(event['event'], event['data'])
+        finally:
+            if quota is not None:
+                await sync_to_async(quota.release)()
+
+    await sync_to_async(_release_db_connection)()
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@async_api_view(['GET'])
+@require_map_owner
+async def get_chat_history_async(request, chat_type, map_id):
+    """get_chat_history 的 async 版本"""
+    try:
+        service = await _aget_chat_service(chat_type)
+        if service is None:
+            return Response(
+                {'success': False, 'error': f'Unknown chat type: {chat_type}'},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        return Response({'success': True, 'messages': result['messages']})
+        params, error_response = _parse_history_params(request)
+        if error_response is not None:
+            return error_response
+
+        result = await service.aget_conversation_history(map_id, **params)
+
+        return _history_response(result)
 
     except Exception as e:
         logger.exception(e)
@@ -207,3 +796,49 @@ def get_chat_history(request, chat_type, map_id):
             {'success': False, 'messages': [], 'error': str(e)},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR,
         )
+
+
+@async_api_view(['GET'])
+async def get_scoring_job_async(request, job_id):
+    """get_scoring_job 的 async 版本"""
+    try:
+        job, error_response = await sync_to_async(_get_scoring_job)(request, job_id)
+        if error_response is not None:
+            return error_response
+        return Response(get_job_payload(job))
+
+    except Exception as e:
+        logger.exception(e)
+        return Response(
+            {'success': False, 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+
+@async_api_view(['GET'])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+async def scoring_job_events_async(request, job_id):
+    """
+    訂閱評分工作的狀態（Server-Sent Events，僅 ASGI 模式；WSGI 模式改以 get_scoring_job 輪詢），
+    回應事件：
+        - status: 工作狀態（pending / running）改變
+        - done: 工作完成，內容與 get_scoring_job 相同
+    連線最長維持 SCORING_JOB_SUBSCRIBE_SECONDS，工作未完成時結束串流，由前端重新訂閱
+    （EventSource 會自動重新連線）；等待期間不佔用 worker thread 與 Django 連線
+    """
+    job, error_response = await sync_to_async(_get_scoring_job)(request, job_id)
+    if error_response is not None:
+        return error_response
+
+    async def event_stream():
+        subscription = _JobSubscription()
+        current = job
+        while True:
+            chunk = subscription.update(current)
+            if chunk:
+                yield chunk
+            if subscription.done:
+                return
+            await asyncio.sleep(settings.SCORING_JOB_POLL_SECONDS)
+            current = await sync_to_async(_poll_user_job)(job.pk, request.user)
+
+    return _job_events_response(event_stream())
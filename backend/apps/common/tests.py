@@ -0,0 +1,643 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+from google.api_core.exceptions import InvalidArgument, ResourceExhausted, ServiceUnavailable
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.prompts import PromptTemplate
+
+from apps.common.utils import llm_governor
+from apps.common.utils.context_cache import InMemoryContextCacheBackend, context_cache_registry
+from apps.common.utils.llm_governor import (
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    InMemoryTokenBucketBackend,
+    PostgresTokenBucketBackend,
+    RateLimitedError,
+    llm_priority,
+    rate_governor,
+)
+from apps.common.utils.llm_resilience import (
+    CircuitOpenError,
+    call_with_resilience,
+    resilience_registry,
+)
+from apps.common.utils.llm_routing import (
+    FALLBACK_CIRCUIT_OPEN,
+    FALLBACK_RATE_LIMITED,
+    FALLBACK_SERVER_ERROR,
+    FALLBACK_THROTTLED,
+    FALLBACK_TIMEOUT,
+    RoutedChatModel,
+    get_fallback_reason,
+    get_routing_metadata,
+)
+from apps.common.utils.prompt_cache import PromptAssemblyCache
+from apps.common.utils.stream_parser import JsonFieldStreamParser
+from apps.common.utils.structured_output import (
+    StructuredOutput,
+    SupportResponse,
+    get_structured_output,
+    structured_output_stats,
+)
+from apps.common.utils.tracing import STATUS_OK, STATUS_UNAVAILABLE, Tracer
+from apps.common.utils.warmup import (
+    WARMUP_DISABLED,
+    WARMUP_FAILED,
+    WARMUP_PENDING,
+    WARMUP_READY,
+    WarmUp,
+)
+
+
+def feed_in_chunks(parser, text, size):
+    return ''.join(parser.feed(text[i : i + size]) for i in range(0, len(text), size))
+
+
+class TestJsonFieldStreamParser:
+    @pytest.mark.parametrize('chunk_size', [1, 2, 5, 64])
+    def test_extracts_final_response_across_chunk_boundaries(self, chunk_size):
+        """測試任意切割的 chunk 都能正確解碼 final_response"""
+        payload = {
+            'reasoning': '學生詢問 evidence 的定義',
+            'final_response': 'Evidence 是 "事實" \\ 資料\n第二行 😀',
+            'response_strategy': 'scaffolding',
+        }
+        text = '```json\n' + json.dumps(payload) + '\n```'
+
+        parser = JsonFieldStreamParser('final_response')
+        output = feed_in_chunks(parser, text, chunk_size)
+
+        assert output == payload['final_response']
+        assert parser.done is True
+
+    def test_ignores_field_name_inside_other_values(self):
+        """測試其他欄位內容或巢狀物件中出現相同欄位名稱時不會誤判"""
+        text = json.dumps(
+            {
+                'reasoning': 'should not output "final_response": "wrong"',
+                'detail': {'final_response': 'nested'},
+                'final_response': 'correct',
+            },
+            ensure_ascii=False,
+        )
+
+        parser = JsonFieldStreamParser('final_response')
+
+        assert parser.feed(text) == 'correct'
+
+    def test_no_output_without_target_field(self):
+        """測試回應不是 JSON 或沒有目標欄位時不輸出任何內容"""
+        parser = JsonFieldStreamParser('final_response')
+
+        assert parser.feed('plain text answer') == ''
+        assert parser.feed('{"reasoning": "x"}') == ''
+        assert parser.done is False
+
+
+class FailingChatModel(GenericFakeChatModel):
+    error: Exception
+
+    def _generate(self, *args, **kwargs):
+        raise self.error
+
+
+class TestLLMRouting:
+    @pytest.fixture
+    def routed(self, monkeypatch):
+        monkeypatch.setenv('GOOGLE_API_KEY', 'test')
+        return RoutedChatModel('feedback')
+
+    @pytest.mark.parametrize(
+        'error, reason',
+        [
+            (ResourceExhausted('quota'), FALLBACK_RATE_LIMITED),
+            (ServiceUnavailable('down'), FALLBACK_SERVER_ERROR),
+            (TimeoutError(), FALLBACK_TIMEOUT),
+            (InvalidArgument('bad request'), None),
+            (ValueError('parse error'), None),
+        ],
+    )
+    def test_fallback_reason(self, error, reason):
+        """測試只有逾時、429 與 5xx 會觸發降級"""
+        assert get_fallback_reason(error) == reason
+
+    def test_fallback_reason_follows_wrapped_error(self):
+        """測試被包裝的 429 錯誤也能判斷"""
+        try:
+            try:
+                raise ResourceExhausted('quota')
+            except ResourceExhausted as e:
+                raise RuntimeError('wrapped') from e
+        except RuntimeError as wrapped:
+            assert get_fallback_reason(wrapped) == FALLBACK_RATE_LIMITED
+
+    def test_primary_response_is_annotated(self, routed):
+        """測試主要模型成功時記錄 route 與模型"""
+        routed.primary = GenericFakeChatModel(messages=iter([AIMessage(content='ok')]))
+
+        response = routed.invoke([HumanMessage(content='hi')])
+
+        assert get_routing_metadata(response) == {
+            'llm_route': 'feedback',
+            'llm_model': routed.model,
+            'llm_fallback_reason': None,
+        }
+
+    def test_falls_back_on_rate_limit(self, routed):
+        """測試主要模型回傳 429 時改用 fallback 模型"""
+        routed.primary = FailingChatModel(messages=iter([]), error=ResourceExhausted('quota'))
+        routed.fallback = GenericFakeChatModel(messages=iter([AIMessage(content='fallback')]))
+
+        response = routed.invoke([HumanMessage(content='hi')])
+
+        assert response.content == 'fallback'
+        assert get_routing_metadata(response)['llm_model'] == routed.fallback_model
+        assert get_routing_metadata(response)['llm_fallback_reason'] == FALLBACK_RATE_LIMITED
+
+    def test_does_not_fall_back_on_invalid_request(self, routed):
+        """測試非暫時性錯誤直接拋出，不改用 fallback 模型"""
+        routed.primary = FailingChatModel(messages=iter([]), error=InvalidArgument('bad'))
+
+        with pytest.raises(InvalidArgument):
+            routed.invoke([HumanMessage(content='hi')])
+
+
+class TestLLMResilience:
+    @pytest.fixture(autouse=True)
+    def resilience(self, settings):
+        settings.LLM_RETRY_MAX_ATTEMPTS = 3
+        settings.LLM_RETRY_BASE_DELAY = 0
+        settings.LLM_CIRCUIT_FAILURE_THRESHOLD = 2
+        settings.LLM_CIRCUIT_OPEN_SECONDS = 30
+        resilience_registry.reset()
+        yield
+        resilience_registry.reset()
+
+    @staticmethod
+    def flaky(errors, result='ok'):
+        """依序拋出 errors 中的錯誤，之後回傳 result"""
+        errors = list(errors)
+
+        def call():
+            if errors:
+                raise errors.pop(0)
+            return result
+
+        return call
+
+    def test_retries_transient_error(self):
+        """測試暫時性錯誤重試後成功，並記錄為 retried"""
+        call = self.flaky([ServiceUnavailable('down')])
+
+        assert call_with_resilience('m', call, lambda e: True) == 'ok'
+        assert resilience_registry.snapshot()['m']['outcomes'] == {'retried': 1}
+        assert resilience_registry.snapshot()['m']['state'] == 'closed'
+
+    def test_does_not_retry_non_transient_error(self):
+        """測試非暫時性錯誤不重試，也不計入熔斷"""
+        call = self.flaky([InvalidArgument('bad')])
+
+        with pytest.raises(InvalidArgument):
+            call_with_resilience('m', call, lambda e: False)
+        assert resilience_registry.snapshot()['m']['consecutive_failures'] == 0
+
+    def test_circuit_opens_and_short_circuits(self):
+        """測試連續失敗達門檻後熔斷，之後的呼叫直接失敗"""
+        call = self.flaky([ServiceUnavailable('down')] * 10)
+
+        with pytest.raises(ServiceUnavailable):
+            call_with_resilience('m', call, lambda e: True)
+        with pytest.raises(CircuitOpenError):
+            call_with_resilience('m', call, lambda e: True)
+
+        snapshot = resilience_registry.snapshot()['m']
+        assert snapshot['state'] == 'open'
+        assert snapshot['outcomes'] == {'failed': 1, 'short_circuited': 1}
+
+    def test_half_open_trial_closes_circuit(self, settings):
+        """測試開啟期間結束後，試探請求成功即關閉熔斷器"""
+        settings.LLM_CIRCUIT_OPEN_SECONDS = 0
+        for _ in range(2):
+            with pytest.raises(ServiceUnavailable):
+                call_with_resilience(
+                    'm', self.flaky([ServiceUnavailable('down')]), lambda e: True, retry=False
+                )
+        assert resilience_registry.snapshot()['m']['state'] == 'open'
+
+        assert call_with_resilience('m', self.flaky([]), lambda e: True, retry=False) == 'ok'
+        assert resilience_registry.snapshot()['m']['state'] == 'closed'
+
+    def test_routes_to_fallback_while_circuit_open(self, monkeypatch):
+        """測試主要模型熔斷期間直接改用 fallback 模型"""
+        monkeypatch.setenv('GOOGLE_API_KEY', 'test')
+        routed = RoutedChatModel('feedback')
+        routed.primary = FailingChatModel(messages=iter([]), error=ServiceUnavailable('down'))
+        routed.fallback = GenericFakeChatModel(
+            messages=iter([AIMessage(content='a'), AIMessage(content='b'), AIMessage(content='c')])
+        )
+
+        for _ in range(3):
+            response = routed.invoke([HumanMessage(content='hi')])
+
+        assert response.content == 'c'
+        assert get_routing_metadata(response)['llm_fallback_reason'] == FALLBACK_CIRCUIT_OPEN
+        # 有 fallback 的主要模型不重試，兩次失敗後熔斷
+        assert resilience_registry.snapshot()[routed.model]['outcomes'] == {'failed': 2}
+
+
+class FakeBucketCursor:
+    """chatbot_llm_rate_bucket 的替代品：只記錄各模型剩餘的請求數"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params):
+        model = params['model']
+        if sql.startswith('INSERT'):
+            self.rowcount = 0 if model in self.rows else 1
+            self.rows.setdefault(model, params['rpm'])
+        elif self.rows.get(model, 0) >= 1:
+            self.rows[model] -= 1
+            self.rowcount = 1
+        else:
+            self.rowcount = 0
+
+
+class TestRateGovernor:
+    @pytest.fixture(autouse=True)
+    def governor(self, settings):
+        settings.LLM_GOVERNOR_ENABLED = True
+        settings.LLM_RATE_LIMITS = {'m': {'rpm': 10, 'tpm': 1000}}
+        settings.LLM_PRIORITY_CLASSES = {
+            'interactive': {'reserve': 0.0, 'max_wait': 0},
+            'batch': {'reserve': 0.4, 'max_wait': 0},
+        }
+        rate_governor.reset(InMemoryTokenBucketBackend())
+        yield
+        rate_governor.reset()
+
+    def test_lower_priority_leaves_reserve(self):
+        """測試額度低於保留比例時較低等級被拒絕，較高等級仍可取得"""
+        for _ in range(6):
+            rate_governor.acquire('m', PRIORITY_BATCH, 10)
+
+        with pytest.raises(RateLimitedError):
+            rate_governor.acquire('m', PRIORITY_BATCH, 10)
+        rate_governor.acquire('m', PRIORITY_INTERACTIVE, 10)
+
+        snapshot = rate_governor.snapshot()
+        assert snapshot['batch']['admitted'] == 6
+        assert snapshot['batch']['throttled'] == 1
+        assert snapshot['interactive']['admitted'] == 1
+
+    def test_settle_refunds_overestimate(self):
+        """測試依實際用量退回多扣的 token"""
+        rate_governor.acquire('m', PRIORITY_INTERACTIVE, 900)
+        with pytest.raises(RateLimitedError):
+            rate_governor.acquire('m', PRIORITY_INTERACTIVE, 900)
+
+        response = AIMessage(
+            content='ok',
+            usage_metadata={'input_tokens': 50, 'output_tokens': 50, 'total_tokens': 100},
+        )
+        rate_governor.settle('m', 900, response)
+
+        rate_governor.acquire('m', PRIORITY_INTERACTIVE, 800)
+
+    def test_postgres_bucket_recreated_after_delete(self, monkeypatch):
+        """測試 bucket 資料列被刪除（清空或還原資料表）後重新建立，不會一直視為額度不足"""
+        rows = {}
+        monkeypatch.setattr(
+            llm_governor, 'connection', SimpleNamespace(cursor=lambda: FakeBucketCursor(rows))
+        )
+        backend = PostgresTokenBucketBackend()
+        limits = {'rpm': 2, 'tpm': 1000}
+
+        assert backend.try_take('m', limits, 0.0, 10)
+        rows.clear()
+        assert backend.try_take('m', limits, 0.0, 10)
+        assert backend.try_take('m', limits, 0.0, 10)
+        assert not backend.try_take('m', limits, 0.0, 10)
+
+    def test_unlimited_model_is_not_governed(self):
+        """測試未設定上限的模型不管控"""
+        for _ in range(20):
+            rate_governor.acquire('other', PRIORITY_BATCH, 10**6)
+
+        assert rate_governor.snapshot()['batch']['admitted'] == 0
+
+    def test_routes_to_fallback_when_throttled(self, settings, monkeypatch):
+        """測試主要模型額度不足時改用 fallback 模型，llm_priority 可覆寫優先等級"""
+        monkeypatch.setenv('GOOGLE_API_KEY', 'test')
+        routed = RoutedChatModel('feedback')
+        settings.LLM_RATE_LIMITS = {routed.model: {'rpm': 10, 'tpm': 10**6}}
+        routed.primary = GenericFakeChatModel(messages=iter([AIMessage(content='primary')] * 6))
+        routed.fallback = GenericFakeChatModel(messages=iter([AIMessage(content='fallback')]))
+
+        with llm_priority(PRIORITY_BATCH):
+            for _ in range(6):
+                routed.invoke([HumanMessage(content='hi')])
+            response = routed.invoke([HumanMessage(content='hi')])
+
+        assert response.content == 'fallback'
+        assert get_routing_metadata(response)['llm_fallback_reason'] == FALLBACK_THROTTLED
+
+
+class SlowLangfuse:
+    def auth_check(self):
+        time.sleep(0.2)
+        return True
+
+
+class TestTracing:
+    @pytest.fixture
+    def tracer(self, settings):
+        settings.TRACING_ENABLED = True
+        settings.TRACING_SAMPLE_RATES = {'cer_scoring': 1.0, 'mindmap_chat': 0.0}
+        settings.TRACING_HEALTH_CHECK_SECONDS = 60
+        tracer = Tracer()
+        tracer._client = SlowLangfuse()
+        return tracer
+
+    def test_sampled_out_route_is_noop(self, tracer):
+        """測試未取樣的 route 不建立 span，也不掛 callback"""
+        with tracer.trace('t', 'mindmap_chat', 's', 'u', 'hi') as trace_span:
+            trace_span.update_trace(output='ok')
+
+        assert trace_span.callbacks == []
+        assert trace_span.trace_id is None
+        assert tracer.snapshot()['routes'] == {'mindmap_chat': {'sampled_out': 1}}
+
+    def test_unavailable_langfuse_is_noop(self, tracer):
+        """測試 Langfuse 無法連線時，一律記錄的 route 也不建立 span"""
+        tracer._status = STATUS_UNAVAILABLE
+        tracer._checked_at = time.monotonic()
+
+        with tracer.trace('t', 'cer_scoring', 's', 'u', 'hi') as trace_span:
+            pass
+
+        assert trace_span.trace_id is None
+        assert tracer.snapshot()['routes'] == {'cer_scoring': {'unavailable': 1}}
+
+    def test_status_check_does_not_block(self, tracer):
+        """測試連線狀態在背景檢查，不等待網路"""
+        start = time.monotonic()
+        status = tracer.get_status()
+
+        assert time.monotonic() - start < 0.1
+        assert status == 'unknown'
+        for _ in range(50):
+            if tracer.get_status() == STATUS_OK:
+                break
+            time.sleep(0.05)
+        assert tracer.get_status() == STATUS_OK
+
+
+class RecordingChatModel(GenericFakeChatModel):
+    calls: list = []
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls.append((messages, kwargs))
+        return super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+
+class TestPromptCache:
+    PROMPT = PromptTemplate.from_template('你是助教。\n文章：{article_content}')
+
+    def test_same_template_reuses_system_message(self):
+        """測試相同 template 重複使用組裝好的 system prompt"""
+        cache = PromptAssemblyCache()
+
+        first = cache.render('feedback', self.PROMPT, '文章內容', '1:2026-01-01T00:00:00')
+        second = cache.render('feedback', self.PROMPT, '文章內容', '1:2026-01-01T00:00:00')
+
+        assert first is second
+        assert first.content == '你是助教。\n文章：文章內容'
+
+    def test_template_update_changes_prompt_id(self):
+        """測試 template 更新或不同 agent 時產生不同的 system prompt"""
+        cache = PromptAssemblyCache()
+
+        original = cache.render('feedback', self.PROMPT, '舊文章', '1:2026-01-01T00:00:00')
+        updated = cache.render('feedback', self.PROMPT, '新文章', '1:2026-02-01T00:00:00')
+        other_agent = cache.render('cer_scoring', self.PROMPT, '舊文章', '1:2026-01-01T00:00:00')
+
+        assert updated.content.endswith('新文章')
+        assert len({original.id, updated.id, other_agent.id}) == 3
+
+    def test_without_template_key_is_not_cached(self):
+        """測試沒有 template 時不使用快取，也不產生 prompt id"""
+        message = PromptAssemblyCache().render('feedback', self.PROMPT, '文章', None)
+
+        assert message.id is None
+
+    @pytest.fixture
+    def context_cache(self, settings):
+        settings.PROMPT_CONTEXT_CACHE_ENABLED = True
+        settings.PROMPT_CONTEXT_CACHE_MIN_CHARS = 0
+        backend = InMemoryContextCacheBackend()
+        context_cache_registry.reset(backend)
+        yield backend
+        context_cache_registry.reset()
+
+    def test_provider_cache_replaces_system_prompt(self, context_cache, monkeypatch):
+        """測試啟用 context cache 時只建立一次快取，之後以 cached_content 取代 system prompt"""
+        monkeypatch.setenv('GOOGLE_API_KEY', 'test')
+        routed = RoutedChatModel('feedback')
+        routed.primary = RecordingChatModel(
+            messages=iter([AIMessage(content='a'), AIMessage(content='b')]), calls=[]
+        )
+        system_message = PromptAssemblyCache().render(
+            'feedback', self.PROMPT, '文章', '1:2026-01-01T00:00:00'
+        )
+
+        for query in ('第一題', '第二題'):
+            routed.invoke([system_message, HumanMessage(content=query)])
+
+        assert context_cache.created == [(routed.model, system_message.content)]
+        for messages, kwargs in routed.primary.calls:
+            assert kwargs['cached_content'] == 'cachedContents/local-1'
+            assert not any(isinstance(message, SystemMessage) for message in messages)
+
+    def test_uncached_prompt_is_sent_in_full(self, context_cache, monkeypatch):
+        """測試沒有 prompt id 的 system prompt 照常送出"""
+        monkeypatch.setenv('GOOGLE_API_KEY', 'test')
+        routed = RoutedChatModel('feedback')
+        routed.primary = RecordingChatModel(messages=iter([AIMessage(content='a')]), calls=[])
+
+        routed.invoke([SystemMessage(content='prompt'), HumanMessage(content='hi')])
+
+        messages, kwargs = routed.primary.calls[0]
+        assert context_cache.created == []
+        assert 'cached_content' not in kwargs
+        assert isinstance(messages[0], SystemMessage)
+
+    def test_rejected_cache_is_recreated(self, context_cache, monkeypatch):
+        """測試 provider 拒絕 cached content 時丟棄記錄，下次呼叫重新建立；暫時性錯誤則保留"""
+        monkeypatch.setenv('GOOGLE_API_KEY', 'test')
+        routed = RoutedChatModel('feedback')
+        routed.fallback = None
+        system_message = PromptAssemblyCache().render(
+            'feedback', self.PROMPT, '文章', '1:2026-01-01T00:00:00'
+        )
+        messages = [system_message, HumanMessage(content='hi')]
+
+        routed.primary = FailingChatModel(messages=iter([]), error=ServiceUnavailable('down'))
+        with pytest.raises(ServiceUnavailable):
+            routed._invoke_primary(messages, None)
+        assert len(context_cache.created) == 1
+
+        routed.primary = FailingChatModel(messages=iter([]), error=InvalidArgument('not found'))
+        with pytest.raises(InvalidArgument):
+            routed._invoke_primary(messages, None)
+
+        routed.primary = RecordingChatModel(messages=iter([AIMessage(content='a')]), calls=[])
+        routed.invoke(messages)
+
+        assert len(context_cache.created) == 2
+        assert routed.primary.calls[0][1]['cached_content'] == 'cachedContents/local-2'
+
+
+class TestStructuredOutput:
+    VALID = json.dumps(
+        {
+            'reasoning': 'r',
+            'response_strategy': 's',
+            'strategy_detail': 'd',
+            'final_response': '答案',
+        },
+        ensure_ascii=False,
+    )
+
+    @pytest.fixture
+    def routed(self, monkeypatch):
+        monkeypatch.setenv('GOOGLE_API_KEY', 'test')
+        return RoutedChatModel('feedback')
+
+    def test_parse_and_repair(self):
+        """測試合法 JSON 直接解析，被 Markdown 包裹的 JSON 經修復後解析，缺欄位時失敗"""
+        output = StructuredOutput('test', SupportResponse)
+
+        assert output.parse(self.VALID) == (json.loads(self.VALID), False)
+        assert output.parse(f'```json\n{self.VALID}\n```') == (json.loads(self.VALID), True)
+        assert output.parse('{"reasoning": "x"}') == (None, False)
+
+    def test_response_schema_keeps_field_order(self):
+        """測試 response_schema 依 schema 順序輸出欄位（reasoning 在 final_response 之前）"""
+        schema = StructuredOutput('test', SupportResponse).response_schema
+
+        assert schema['propertyOrdering'] == [
+            'reasoning',
+            'response_strategy',
+            'strategy_detail',
+            'final_response',
+        ]
+        assert schema['required'] == schema['propertyOrdering']
+
+    def test_provider_json_mode_kwargs(self, routed, settings):
+        """測試呼叫模型時傳入 provider JSON 模式的參數，結果寫入 response_metadata"""
+        settings.STRUCTURED_OUTPUT_PROVIDER_MODE = True
+        routed.primary = RecordingChatModel(
+            messages=iter([AIMessage(content=self.VALID)]), calls=[]
+        )
+        output = StructuredOutput('test_kwargs', SupportResponse)
+
+        response = output.invoke(routed, [HumanMessage(content='hi')])
+
+        _, kwargs = routed.primary.calls[0]
+        assert kwargs['response_mime_type'] == 'application/json'
+        assert kwargs['response_schema'] == output.response_schema
+        assert get_structured_output(response)['final_response'] == '答案'
+        assert structured_output_stats.snapshot()['test_kwargs']['parsed'] == 1
+
+    def test_retries_malformed_output(self, routed, settings):
+        """測試無法解析時重新呼叫模型並記錄重試次數"""
+        settings.STRUCTURED_OUTPUT_MAX_RETRIES = 1
+        routed.primary = GenericFakeChatModel(
+            messages=iter([AIMessage(content='not json'), AIMessage(content=self.VALID)])
+        )
+
+        response = StructuredOutput('test_retry', SupportResponse).invoke(
+            routed, [HumanMessage(content='hi')]
+        )
+
+        assert get_structured_output(response)['final_response'] == '答案'
+        assert structured_output_stats.snapshot()['test_retry'] == {
+            'parsed': 1,
+            'repaired': 0,
+            'retried': 1,
+            'failed': 0,
+        }
+
+    def test_no_retry_for_streamed_output(self, routed, settings):
+        """測試串流輸出的 agent 不重試，解析失敗時結果為 None"""
+        settings.STRUCTURED_OUTPUT_MAX_RETRIES = 1
+        routed.primary = GenericFakeChatModel(messages=iter([AIMessage(content='not json')]))
+
+        response = StructuredOutput('test_stream', SupportResponse, retry=False).invoke(
+            routed, [HumanMessage(content='hi')]
+        )
+
+        assert get_structured_output(response) is None
+        assert structured_output_stats.snapshot()['test_stream']['failed'] == 1
+
+
+def failing_warmup_step():
+    raise ConnectionError('database unavailable')
+
+
+class TestWarmUp:
+    """Worker warm-up 狀態與 readiness"""
+
+    def test_not_ready_until_steps_complete(self, settings):
+        """測試 warm-up 完成前不可接收請求，完成後記錄各服務的建立時間"""
+        settings.WARMUP_ENABLED = True
+        settings.WARMUP_STEPS = ['builtins.dict']
+        warm_up = WarmUp()
+
+        assert warm_up.status == WARMUP_PENDING
+        assert not warm_up.is_ready()
+
+        warm_up.run()
+
+        assert warm_up.is_ready()
+        assert 'dict' in warm_up.snapshot()['durations']
+
+    def test_failure_can_be_retried(self, settings):
+        """測試失敗時回報錯誤，之後可重新執行"""
+        settings.WARMUP_ENABLED = True
+        settings.WARMUP_STEPS = ['apps.common.tests.failing_warmup_step']
+        warm_up = WarmUp()
+
+        warm_up.run()
+
+        assert warm_up.status == WARMUP_FAILED
+        assert 'database unavailable' in warm_up.snapshot()['error']
+
+        settings.WARMUP_STEPS = ['builtins.dict']
+        assert warm_up.start()
+        deadline = time.monotonic() + 5
+        while warm_up.status != WARMUP_READY and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert warm_up.status == WARMUP_READY
+        assert not warm_up.start()
+
+    def test_disabled_is_always_ready(self, settings):
+        """測試未啟用 warm-up 時不影響 readiness"""
+        settings.WARMUP_ENABLED = False
+        warm_up = WarmUp()
+
+        assert not warm_up.start()
+        assert warm_up.status == WARMUP_DISABLED
+        assert warm_up.is_ready()
@@ -0,0 +1,169 @@
+"""
+Provider 端 context cache（Gemini cached content）
+
+同一份 template 的 system prompt（含完整文章）在每次對話都會重新送出並計費。
+啟用 PROMPT_CONTEXT_CACHE_ENABLED 後，RoutedChatModel 會將 prompt_cache 產生的 system prompt
+建立為 provider 端的 cached content，之後的呼叫只送出 cached content 名稱與對話訊息。
+
+- 快取名稱記錄在 process 內，過期前（預留 _EXPIRY_MARGIN_SECONDS）重複使用
+- 內容太短（低於 provider 最低 token 數）或建立失敗時，一段時間內不再嘗試，直接送出完整 prompt
+- 使用 cached content 的呼叫發生非暫時性錯誤（例如 provider 已刪除該快取）時丟棄記錄，下次重新建立
+- 後端由 PROMPT_CONTEXT_CACHE_BACKEND 指定，測試或本機開發可改用 InMemoryContextCacheBackend
+"""
+
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from langchain_core.messages import BaseMessage, SystemMessage
+
+from .prompt_cache import PROMPT_ID_PREFIX
+
+logger = logging.getLogger(__name__)
+
+# 快取到期前多久停止使用，避免呼叫途中過期
+_EXPIRY_MARGIN_SECONDS = 60
+
+# 建立失敗後多久內不再嘗試
+_FAILURE_BACKOFF_SECONDS = 600
+
+
+class ContextCacheBackend(ABC):
+    """provider context cache 後端"""
+
+    @abstractmethod
+    def create(self, model: str, system_instruction: str, ttl_seconds: int) -> str:
+        """
+        建立 cached content
+
+        Returns:
+            str: cached content 名稱（呼叫模型時作為 cached_content 參數）
+        """
+
+
+class GeminiContextCacheBackend(ContextCacheBackend):
+    """Gemini API 的 cached content"""
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from google import genai
+
+                    # 與 ChatGoogleGenerativeAI 相同，由環境變數 GOOGLE_API_KEY 取得金鑰
+                    self._client = genai.Client()
+        return self._client
+
+    def create(self, model: str, system_instruction: str, ttl_seconds: int) -> str:
+        from google.genai import types
+
+        cache = self._get_client().caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                ttl=f'{ttl_seconds}s',
+            ),
+        )
+        return cache.name
+
+
+class InMemoryContextCacheBackend(ContextCacheBackend):
+    """本機替代後端：不呼叫 provider，只記錄建立的內容（測試與本機開發用）"""
+
+    def __init__(self):
+        self.created: List[Tuple[str, str]] = []
+        self._lock = threading.Lock()
+
+    def create(self, model: str, system_instruction: str, ttl_seconds: int) -> str:
+        with self._lock:
+            self.created.append((model, system_instruction))
+            return f'cachedContents/local-{len(self.created)}'
+
+
+class ContextCacheRegistry:
+    """已建立的 cached content（per process），key 為 (模型, system prompt id)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._backend: Optional[ContextCacheBackend] = None
+        self._entries: Dict[Tuple[str, str], Tuple[Optional[str], float]] = {}
+
+    @property
+    def backend(self) -> ContextCacheBackend:
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = import_string(settings.PROMPT_CONTEXT_CACHE_BACKEND)()
+        return self._backend
+
+    def reset(self, backend: Optional[ContextCacheBackend] = None):
+        """清除已記錄的快取並更換後端（None 表示下次使用時依設定重新建立）"""
+        with self._lock:
+            self._backend = backend
+            self._entries.clear()
+
+    @staticmethod
+    def _is_cacheable(message: BaseMessage) -> bool:
+        # 只快取 prompt_cache 組裝的 system prompt（有穩定 id），且長度達到 provider 最低要求
+        return (
+            isinstance(message, SystemMessage)
+            and isinstance(message.id, str)
+            and message.id.startswith(PROMPT_ID_PREFIX)
+            and isinstance(message.content, str)
+            and len(message.content) >= settings.PROMPT_CONTEXT_CACHE_MIN_CHARS
+        )
+
+    def get_cache_name(self, model: str, messages: List[BaseMessage]) -> Optional[str]:
+        """
+        取得 messages 開頭 system prompt 的 cached content 名稱，必要時建立
+
+        Returns:
+            str | None: 無法使用快取時回傳 None（呼叫端應送出完整訊息）
+        """
+        if not settings.PROMPT_CONTEXT_CACHE_ENABLED or not messages:
+            return None
+
+        system_message = messages[0]
+        if not self._is_cacheable(system_message):
+            return None
+
+        key = (model, system_message.id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        ttl_seconds = settings.PROMPT_CONTEXT_CACHE_TTL_SECONDS
+        try:
+            name = self.backend.create(model, system_message.content, ttl_seconds)
+        except Exception as e:
+            logger.warning(f'Context cache creation failed for {model}: {str(e)[:100]}')
+            with self._lock:
+                self._entries[key] = (None, now + _FAILURE_BACKOFF_SECONDS)
+            return None
+
+        logger.info(f'Context cache created: {model} {system_message.id} -> {name}')
+        with self._lock:
+            self._entries[key] = (name, now + ttl_seconds - _EXPIRY_MARGIN_SECONDS)
+        return name
+
+    def discard(self, model: str, messages: List[BaseMessage], name: str):
+        """丟棄 provider 拒絕的 cached content 名稱（已被其他呼叫重新建立時保留新的記錄）"""
+        key = (model, messages[0].id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == name:
+                del self._entries[key]
+        logger.warning(f'Context cache discarded: {model} {key[1]} -> {name}')
+
+
+context_cache_registry = ContextCacheRegistry()
@@ -0,0 +1,327 @@
+"""
+LLM 呼叫的速率管控（跨 worker 的 token bucket）
+
+多個 gunicorn worker 與批次工作各自呼叫 Gemini，同時大量評分時會耗盡專案配額（429）。
+RoutedChatModel 呼叫模型前向 rate_governor 取得額度：
+- 每個模型兩個 token bucket：每分鐘請求數（rpm）與每分鐘 token 數（tpm），上限定義在 settings.LLM_RATE_LIMITS
+- bucket 存在 PostgreSQL（chatbot_llm_rate_bucket），以單一條件 UPDATE 補充並扣除額度，所有 worker 共用
+- token 數在呼叫前以訊息長度估計，回應後依 usage_metadata 的實際用量修正
+- 優先等級：interactive > scoring > feedback > batch（見 LLM_PRIORITY_CLASSES），
+  較低等級只能使用 bucket 中保留比例（reserve）以上的額度，剩餘額度留給較高等級
+- 額度不足時等待，超過該等級的 max_wait 後拋出 RateLimitedError（有 fallback 模型時改用 fallback）
+未設定上限的模型不管控；無法連線資料庫時不管控，照常呼叫。
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+from langchain_core.messages import BaseMessage
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_SCORING = 'scoring'
+PRIORITY_FEEDBACK = 'feedback'
+PRIORITY_BATCH = 'batch'
+
+# 等待額度時重新嘗試的間隔（秒）
+_POLL_INTERVAL_SECONDS = 0.25
+
+# 估計 token 數時每個 token 的字元數（中英混合的粗略估計）
+_CHARS_PER_TOKEN = 3
+
+# 未設定 max_output_tokens 的 route 預估的輸出 token 數
+_DEFAULT_OUTPUT_TOKENS = 2048
+
+# 批次工作以 llm_priority 覆寫 route 的優先等級
+_priority_override: ContextVar[Optional[str]] = ContextVar('llm_priority', default=None)
+
+
+class RateLimitedError(Exception):
+    """等待額度逾時，呼叫未送出"""
+
+    def __init__(self, model: str, priority: str):
+        super().__init__(f'LLM rate limit reached for {model} ({priority})')
+        self.model = model
+        self.priority = priority
+
+
+@contextmanager
+def llm_priority(priority: str):
+    """
+    覆寫區塊內所有 LLM 呼叫的優先等級
+
+    使用方式（批次 / 離線工作）：
+        with llm_priority(PRIORITY_BATCH):
+            ...
+    """
+    if priority not in settings.LLM_PRIORITY_CLASSES:
+        raise ValueError(f'Unknown LLM priority: {priority}')
+    token = _priority_override.set(priority)
+    try:
+        yield
+    finally:
+        _priority_override.reset(token)
+
+
+def get_priority(route_priority: str) -> str:
+    """取得本次呼叫的優先等級（llm_priority 覆寫優先）"""
+    return _priority_override.get() or route_priority
+
+
+def estimate_tokens(messages: List[BaseMessage], max_output_tokens: Optional[int]) -> int:
+    """估計一次呼叫的 token 數（輸入長度 + 輸出上限）"""
+    chars = sum(len(message.content) for message in messages if isinstance(message.content, str))
+    return chars // _CHARS_PER_TOKEN + (max_output_tokens or _DEFAULT_OUTPUT_TOKENS)
+
+
+def get_usage_tokens(response) -> Optional[int]:
+    """取得回應的實際 token 用量，provider 未回報時回傳 None"""
+    usage = getattr(response, 'usage_metadata', None) or {}
+    return usage.get('total_tokens')
+
+
+class TokenBucketBackend(ABC):
+    """token bucket 的儲存（補充與扣除需為原子操作）"""
+
+    @abstractmethod
+    def try_take(self, model: str, limits: Dict[str, int], reserve: float, tokens: int) -> bool:
+        """
+        補充後扣除 1 個請求與 tokens 個 token
+
+        扣除後兩個 bucket 都需保留 reserve 比例的額度，否則不扣除並回傳 False
+        """
+
+    @abstractmethod
+    def adjust(self, model: str, limits: Dict[str, int], tokens: int):
+        """修正 token bucket（正數退回、負數追加扣除）"""
+
+
+class PostgresTokenBucketBackend(TokenBucketBackend):
+    """PostgreSQL 上的 bucket（chatbot_llm_rate_bucket），所有 worker 共用"""
+
+    # 依上次更新後經過的時間補充（不超過上限）
+    _REFILL = (
+        'LEAST({limit}, {column} + {limit} * '
+        'EXTRACT(EPOCH FROM statement_timestamp() - updated_at) / 60)'
+    )
+    _REQUESTS = _REFILL.format(limit='%(rpm)s', column='requests')
+    _TOKENS = _REFILL.format(limit='%(tpm)s', column='tokens')
+
+    _INSERT_SQL = (
+        'INSERT INTO chatbot_llm_rate_bucket (model, requests, tokens, updated_at) '
+        'VALUES (%(model)s, %(rpm)s, %(tpm)s, statement_timestamp()) '
+        'ON CONFLICT (model) DO NOTHING'
+    )
+    _TAKE_SQL = (
+        f'UPDATE chatbot_llm_rate_bucket SET '
+        f'requests = {_REQUESTS} - 1, tokens = {_TOKENS} - %(cost)s, '
+        f'updated_at = statement_timestamp() '
+        f'WHERE model = %(model)s '
+        f'AND {_REQUESTS} - 1 >= %(rpm)s * %(reserve)s '
+        f'AND {_TOKENS} - %(cost)s >= %(tpm)s * %(reserve)s'
+    )
+    _ADJUST_SQL = (
+        'UPDATE chatbot_llm_rate_bucket SET tokens = LEAST(%(tpm)s, tokens + %(delta)s) '
+        'WHERE model = %(model)s'
+    )
+
+    def try_take(self, model: str, limits: Dict[str, int], reserve: float, tokens: int) -> bool:
+        params = {
+            'model': model,
+            'rpm': limits['rpm'],
+            'tpm': limits['tpm'],
+            'reserve': reserve,
+            'cost': tokens,
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(self._TAKE_SQL, params)
+            if cursor.rowcount == 1:
+                return True
+            # 額度不足，或 bucket 尚未建立（首次使用、資料表被清空或還原）：建立後再試一次
+            cursor.execute(self._INSERT_SQL, params)
+            if cursor.rowcount == 0:
+                return False
+            cursor.execute(self._TAKE_SQL, params)
+            return cursor.rowcount == 1
+
+    def adjust(self, model: str, limits: Dict[str, int], tokens: int):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self._ADJUST_SQL, {'model': model, 'tpm': limits['tpm'], 'delta': tokens}
+            )
+
+
+class InMemoryTokenBucketBackend(TokenBucketBackend):
+    """單一 process 的替代後端（測試與本機開發用）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Dict[str, float]] = {}
+
+    def _refill(self, model: str, limits: Dict[str, int]) -> Dict[str, float]:
+        now = time.monotonic()
+        bucket = self._buckets.setdefault(
+            model, {'requests': limits['rpm'], 'tokens': limits['tpm'], 'updated_at': now}
+        )
+        elapsed = now - bucket['updated_at']
+        bucket['requests'] = min(limits['rpm'], bucket['requests'] + limits['rpm'] * elapsed / 60)
+        bucket['tokens'] = min(limits['tpm'], bucket['tokens'] + limits['tpm'] * elapsed / 60)
+        bucket['updated_at'] = now
+        return bucket
+
+    def try_take(self, model: str, limits: Dict[str, int], reserve: float, tokens: int) -> bool:
+        with self._lock:
+            bucket = self._refill(model, limits)
+            if (
+                bucket['requests'] - 1 < limits['rpm'] * reserve
+                or bucket['tokens'] - tokens < limits['tpm'] * reserve
+            ):
+                return False
+            bucket['requests'] -= 1
+            bucket['tokens'] -= tokens
+            return True
+
+    def adjust(self, model: str, limits: Dict[str, int], tokens: int):
+        with self._lock:
+            bucket = self._refill(model, limits)
+            bucket['tokens'] = min(limits['tpm'], bucket['tokens'] + tokens)
+
+
+class RateGovernor:
+    """依優先等級分配各模型的呼叫額度，並統計等待與拒絕次數（統計為 per process）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._backend: Optional[TokenBucketBackend] = None
+        self._counts: Dict[str, Counter] = {}
+        self._wait_ms: Dict[str, float] = {}
+
+    @property
+    def backend(self) -> TokenBucketBackend:
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = import_string(settings.LLM_GOVERNOR_BACKEND)()
+        return self._backend
+
+    def reset(self, backend: Optional[TokenBucketBackend] = None):
+        """清除統計並更換後端（None 表示下次使用時依設定重新建立）"""
+        with self._lock:
+            self._backend = backend
+            self._counts.clear()
+            self._wait_ms.clear()
+
+    def _get_limits(self, model: str) -> Optional[Dict[str, int]]:
+        if not settings.LLM_GOVERNOR_ENABLED:
+            return None
+        return settings.LLM_RATE_LIMITS.get(model)
+
+    def _record(self, priority: str, outcome: str, waited: float = 0.0):
+        with self._lock:
+            self._counts.setdefault(priority, Counter())[outcome] += 1
+            self._wait_ms[priority] = self._wait_ms.get(priority, 0.0) + waited * 1000
+
+    def _try_take(
+        self, model: str, limits: Dict[str, int], priority: str, tokens: int
+    ) -> Optional[bool]:
+        """嘗試取得額度，後端異常時回傳 None（不管控）"""
+        reserve = settings.LLM_PRIORITY_CLASSES[priority]['reserve']
+        # 單次估計超過可用額度時以可用額度計算，避免永遠無法取得
+        tokens = min(tokens, int(limits['tpm'] * (1 - reserve)))
+        try:
+            return self.backend.try_take(model, limits, reserve, tokens)
+        except Exception as e:
+            logger.warning(f'LLM governor unavailable, continuing without limit: {str(e)[:100]}')
+            return None
+
+    def acquire(self, model: str, priority: str, tokens: int):
+        """
+        取得一次呼叫的額度（額度不足時等待）
+
+        Raises:
+            RateLimitedError: 超過該優先等級的 max_wait 仍無額度
+        """
+        limits = self._get_limits(model)
+        if limits is None:
+            return
+
+        start = time.monotonic()
+        deadline = start + settings.LLM_PRIORITY_CLASSES[priority]['max_wait']
+        while True:
+            if self._try_take(model, limits, priority, tokens) is not False:
+                waited = time.monotonic() - start
+                self._record(priority, 'waited' if waited > 0.01 else 'admitted', waited)
+                return
+            if time.monotonic() + _POLL_INTERVAL_SECONDS > deadline:
+                self._record(priority, 'throttled', time.monotonic() - start)
+                logger.warning(f'LLM call throttled: {model} ({priority})')
+                raise RateLimitedError(model, priority)
+            time.sleep(_POLL_INTERVAL_SECONDS)
+
+    async def aacquire(self, model: str, priority: str, tokens: int):
+        """acquire 的 async 版本（等待時不佔用 event loop）"""
+        limits = self._get_limits(model)
+        if limits is None:
+            return
+
+        try_take = sync_to_async(self._try_take)
+        start = time.monotonic()
+        deadline = start + settings.LLM_PRIORITY_CLASSES[priority]['max_wait']
+        while True:
+            if await try_take(model, limits, priority, tokens) is not False:
+                waited = time.monotonic() - start
+                self._record(priority, 'waited' if waited > 0.01 else 'admitted', waited)
+                return
+            if time.monotonic() + _POLL_INTERVAL_SECONDS > deadline:
+                self._record(priority, 'throttled', time.monotonic() - start)
+                logger.warning(f'LLM call throttled (async): {model} ({priority})')
+                raise RateLimitedError(model, priority)
+            await asyncio.sleep(_POLL_INTERVAL_SECONDS)
+
+    def settle(self, model: str, estimated: int, response):
+        """依實際 token 用量修正預估的扣除量"""
+        limits = self._get_limits(model)
+        actual = get_usage_tokens(response)
+        if limits is None or actual is None or actual == estimated:
+            return
+        try:
+            self.backend.adjust(model, limits, estimated - actual)
+        except Exception as e:
+            logger.warning(f'LLM governor adjust failed: {str(e)[:100]}')
+
+    async def asettle(self, model: str, estimated: int, response):
+        """settle 的 async 版本"""
+        if self._get_limits(model) is not None:
+            await sync_to_async(self.settle)(model, estimated, response)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                priority: {
+                    'admitted': self._counts.get(priority, Counter())['admitted'],
+                    'waited': self._counts.get(priority, Counter())['waited'],
+                    'throttled': self._counts.get(priority, Counter())['throttled'],
+                    'total_wait_ms': round(self._wait_ms.get(priority, 0.0), 1),
+                }
+                for priority in settings.LLM_PRIORITY_CLASSES
+            }
+
+
+rate_governor = RateGovernor()
+
+
+def get_rate_governor_metrics() -> Dict[str, Any]:
+    """取得目前 process 各優先等級的取得 / 等待 / 拒絕次數與累計等待時間"""
+    return rate_governor.snapshot()
@@ -0,0 +1,283 @@
+"""
+LLM 呼叫的重試與熔斷（per process）
+
+RoutedChatModel 以此模組包裝每一次模型呼叫：
+- 暫時性錯誤（逾時、429、5xx）以指數退避加隨機抖動重試，所有嘗試共用 LLM_RETRY_BUDGET_SECONDS 的時間預算
+- 每個模型一個熔斷器：連續 LLM_CIRCUIT_FAILURE_THRESHOLD 次暫時性錯誤後開啟，
+  LLM_CIRCUIT_OPEN_SECONDS 內直接失敗（CircuitOpenError），不再佔用 worker 等待故障中的 provider；
+  之後放行一個試探請求（half-open），成功則關閉，失敗則重新開啟
+- 依模型與結果（success / retried / failed / short_circuited）統計，見 get_resilience_metrics
+參數錯誤等非暫時性錯誤不重試，也不計入熔斷。
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# 熔斷器狀態
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+# 統計的呼叫結果
+OUTCOME_SUCCESS = 'success'
+OUTCOME_RETRIED = 'retried'
+OUTCOME_FAILED = 'failed'
+OUTCOME_SHORT_CIRCUITED = 'short_circuited'
+
+
+class CircuitOpenError(Exception):
+    """模型的熔斷器開啟中，呼叫未送出"""
+
+    def __init__(self, model: str):
+        super().__init__(f'Circuit open for LLM model: {model}')
+        self.model = model
+
+
+class CircuitBreaker:
+    """單一模型的熔斷器"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """是否允許送出呼叫（開啟期間拒絕；到期後只放行一個試探請求）"""
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            if self.state == CIRCUIT_OPEN and time.monotonic() >= self.opened_until:
+                self.state = CIRCUIT_HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == CIRCUIT_HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == CIRCUIT_OPEN and time.monotonic() < self.opened_until
+
+    def release_trial(self):
+        """試探請求被取消（未得到結果）時，允許下一個請求重新試探"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CIRCUIT_CLOSED:
+                logger.info(f'LLM circuit closed: {self.model}')
+            self.state = CIRCUIT_CLOSED
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (
+                self.state == CIRCUIT_HALF_OPEN
+                or self.failures >= settings.LLM_CIRCUIT_FAILURE_THRESHOLD
+            ):
+                if self.state != CIRCUIT_OPEN:
+                    logger.warning(
+                        f'LLM circuit opened: {self.model} after {self.failures} failures'
+                    )
+                self.state = CIRCUIT_OPEN
+                self.opened_until = time.monotonic() + settings.LLM_CIRCUIT_OPEN_SECONDS
+                self._trial_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'open_remaining': round(max(self.opened_until - time.monotonic(), 0), 1)
+                if self.state == CIRCUIT_OPEN
+                else 0,
+            }
+
+
+class ResilienceRegistry:
+    """各模型的熔斷器與呼叫統計"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._counts: Dict[str, Counter] = {}
+
+    def get_breaker(self, model: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(model)
+            if breaker is None:
+                breaker = self._breakers[model] = CircuitBreaker(model)
+            return breaker
+
+    def record(self, model: str, outcome: str):
+        with self._lock:
+            self._counts.setdefault(model, Counter())[outcome] += 1
+
+    def is_open(self, model: str) -> bool:
+        """熔斷器是否開啟中（供呼叫前判斷是否直接改用 fallback 模型）"""
+        return self.get_breaker(model).is_open()
+
+    def reset(self):
+        with self._lock:
+            self._breakers.clear()
+            self._counts.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            models = set(self._breakers) | set(self._counts)
+            breakers = dict(self._breakers)
+            counts = {model: dict(counter) for model, counter in self._counts.items()}
+        return {
+            model: {
+                **(breakers[model].snapshot() if model in breakers else {}),
+                'outcomes': counts.get(model, {}),
+            }
+            for model in sorted(models)
+        }
+
+
+resilience_registry = ResilienceRegistry()
+
+
+def get_resilience_metrics() -> Dict[str, Dict[str, Any]]:
+    """取得目前 process 各模型的熔斷狀態與呼叫結果統計"""
+    return resilience_registry.snapshot()
+
+
+def get_backoff_delay(attempt: int) -> float:
+    """第 attempt 次重試前的等待秒數（指數退避 + full jitter）"""
+    ceiling = min(settings.LLM_RETRY_MAX_DELAY, settings.LLM_RETRY_BASE_DELAY * (2**attempt))
+    return random.uniform(0, ceiling)
+
+
+class _RetryPolicy:
+    """單次呼叫（含重試）的狀態"""
+
+    def __init__(self, model: str, retry: bool, is_transient: Callable[[BaseException], bool]):
+        self.model = model
+        self.breaker = resilience_registry.get_breaker(model)
+        self.max_attempts = max(1, settings.LLM_RETRY_MAX_ATTEMPTS) if retry else 1
+        self.is_transient = is_transient
+        self.deadline = time.monotonic() + settings.LLM_RETRY_BUDGET_SECONDS
+        self.attempt = 0
+
+    def before_attempt(self):
+        if not self.breaker.allow():
+            resilience_registry.record(self.model, OUTCOME_SHORT_CIRCUITED)
+            raise CircuitOpenError(self.model)
+        self.attempt += 1
+
+    def on_success(self):
+        self.breaker.record_success()
+        resilience_registry.record(
+            self.model, OUTCOME_RETRIED if self.attempt > 1 else OUTCOME_SUCCESS
+        )
+
+    def on_error(self, error: BaseException) -> Optional[float]:
+        """
+        處理失敗的嘗試
+
+        Returns:
+            float | None: 重試前的等待秒數；不重試時回傳 None（呼叫端重新拋出錯誤）
+        """
+        if not self.is_transient(error):
+            # 非暫時性錯誤（例如參數錯誤）代表 provider 正常運作
+            self.breaker.record_success()
+            resilience_registry.record(self.model, OUTCOME_FAILED)
+            return None
+
+        self.breaker.record_failure()
+        delay = get_backoff_delay(self.attempt - 1)
+        # 重試途中熔斷器開啟時停止重試，拋出原本的錯誤
+        if (
+            self.attempt >= self.max_attempts
+            or time.monotonic() + delay >= self.deadline
+            or self.breaker.is_open()
+        ):
+            resilience_registry.record(self.model, OUTCOME_FAILED)
+            return None
+
+        logger.info(
+            f'LLM call to {self.model} failed ({type(error).__name__}), '
+            f'retrying in {delay:.2f}s (attempt {self.attempt + 1}/{self.max_attempts})'
+        )
+        return delay
+
+
+def call_with_resilience(
+    model: str,
+    call: Callable[[], T],
+    is_transient: Callable[[BaseException], bool],
+    retry: bool = True,
+) -> T:
+    """
+    以重試與熔斷呼叫模型
+
+    Args:
+        model: 模型名稱（熔斷與統計的單位）
+        call: 實際的模型呼叫
+        is_transient: 判斷錯誤是否為暫時性（可重試、計入熔斷）
+        retry: 是否重試（有 fallback 模型的主要模型不重試，直接降級以控制延遲）
+
+    Raises:
+        CircuitOpenError: 熔斷器開啟中
+    """
+    policy = _RetryPolicy(model, retry, is_transient)
+    while True:
+        policy.before_attempt()
+        try:
+            result = call()
+        except Exception as e:
+            delay = policy.on_error(e)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        except BaseException:
+            policy.breaker.release_trial()
+            raise
+        policy.on_success()
+        return result
+
+
+async def acall_with_resilience(
+    model: str,
+    call: Callable[[], Awaitable[T]],
+    is_transient: Callable[[BaseException], bool],
+    retry: bool = True,
+) -> T:
+    """call_with_resilience 的 async 版本（退避期間不佔用 event loop）"""
+    policy = _RetryPolicy(model, retry, is_transient)
+    while True:
+        policy.before_attempt()
+        try:
+            result = await call()
+        except Exception as e:
+            delay = policy.on_error(e)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            # 例如推測執行未命中時取消的呼叫
+            policy.breaker.release_trial()
+            raise
+        policy.on_success()
+        return result
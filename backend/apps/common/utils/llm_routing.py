@@ -0,0 +1,330 @@
+"""
+LLM 模型路由（分級與降級）
+
+每個 route（classifier、各 agent）的模型、溫度、延遲預算、輸出上限定義在 settings.LLM_ROUTES：
+- 路由類的輕量工作使用 flash 等級模型
+- 主要模型逾時（超過 latency_budget）、回傳 429 或 5xx 時，自動改用較快的 fallback 模型
+- 主要模型最近的 p95 延遲超過預算、或熔斷器開啟時，暫時直接使用 fallback 模型
+- 每次模型呼叫經過 llm_resilience 的重試（指數退避）與熔斷；有 fallback 的主要模型不重試
+- 呼叫前向 llm_governor 取得額度（依 route 的 priority 分級），主要模型等待逾時時改用 fallback 模型
+每次呼叫的路由結果會寫入 response.response_metadata['llm_routing']，由 agent 帶入 trace metadata。
+啟用 provider context cache 時，主要模型的 system prompt 以 cached content 送出（見 context_cache）。
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from google.api_core.exceptions import DeadlineExceeded, GoogleAPICallError
+from langchain_core.messages import BaseMessage
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+from .context_cache import context_cache_registry
+from .llm_governor import (
+    PRIORITY_INTERACTIVE,
+    RateLimitedError,
+    estimate_tokens,
+    get_priority,
+    rate_governor,
+)
+from .llm_resilience import (
+    CircuitOpenError,
+    acall_with_resilience,
+    call_with_resilience,
+    resilience_registry,
+)
+
+logger = logging.getLogger(__name__)
+
+ROUTING_METADATA_KEY = 'llm_routing'
+
+# 降級原因
+FALLBACK_TIMEOUT = 'timeout'
+FALLBACK_RATE_LIMITED = 'rate_limited'
+FALLBACK_SERVER_ERROR = 'server_error'
+FALLBACK_DEGRADED = 'p95_over_budget'
+FALLBACK_CIRCUIT_OPEN = 'circuit_open'
+FALLBACK_THROTTLED = 'throttled'
+
+# 計算 p95 的視窗大小與最少樣本數
+_LATENCY_WINDOW = 50
+_MIN_SAMPLES = 20
+
+
+class LatencyTracker:
+    """各模型最近的延遲紀錄（per process），p95 超過預算時標記為降級"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = {}
+        self._degraded_until: Dict[str, float] = {}
+
+    def record(self, model: str, seconds: float, budget: Optional[float]):
+        with self._lock:
+            samples = self._samples.setdefault(model, deque(maxlen=_LATENCY_WINDOW))
+            samples.append(seconds)
+            if budget is None or len(samples) < _MIN_SAMPLES:
+                return
+
+            p95 = sorted(samples)[int(len(samples) * 0.95) - 1]
+            if p95 > budget:
+                self._degraded_until[model] = time.monotonic() + settings.LLM_DEGRADED_SECONDS
+                # 降級期間不再呼叫此模型，清空樣本，恢復後重新累積
+                samples.clear()
+                logger.warning(f'LLM model degraded: {model} p95={p95:.1f}s > budget={budget}s')
+
+    def is_degraded(self, model: str) -> bool:
+        with self._lock:
+            return self._degraded_until.get(model, 0) > time.monotonic()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                model: {
+                    'samples': len(samples),
+                    'p95': sorted(samples)[max(int(len(samples) * 0.95) - 1, 0)]
+                    if samples
+                    else None,
+                    'degraded': self._degraded_until.get(model, 0) > now,
+                }
+                for model, samples in self._samples.items()
+            }
+
+
+latency_tracker = LatencyTracker()
+
+
+def get_route_config(route: str) -> Dict[str, Any]:
+    """取得 route 設定（未設定的欄位使用預設值）"""
+    if route not in settings.LLM_ROUTES:
+        raise ValueError(f'Unknown LLM route: {route}')
+
+    return {
+        'fallback_model': None,
+        'temperature': 0.7,
+        'latency_budget': None,
+        'max_output_tokens': None,
+        'thinking_budget': None,
+        'priority': PRIORITY_INTERACTIVE,
+        **settings.LLM_ROUTES[route],
+    }
+
+
+def get_fallback_reason(error: BaseException) -> Optional[str]:
+    """判斷錯誤是否應改用 fallback 模型，回傳原因；不需降級（例如參數錯誤）時回傳 None"""
+    while error is not None:
+        if isinstance(error, CircuitOpenError):
+            return FALLBACK_CIRCUIT_OPEN
+        if isinstance(error, (TimeoutError, asyncio.TimeoutError, DeadlineExceeded)):
+            return FALLBACK_TIMEOUT
+        if isinstance(error, GoogleAPICallError):
+            if error.code == 429:
+                return FALLBACK_RATE_LIMITED
+            if error.code is not None and error.code >= 500:
+                return FALLBACK_SERVER_ERROR
+            return None
+        error = error.__cause__
+    return None
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """暫時性錯誤（逾時、429、5xx）：可重試，並計入熔斷"""
+    return get_fallback_reason(error) in (
+        FALLBACK_TIMEOUT,
+        FALLBACK_RATE_LIMITED,
+        FALLBACK_SERVER_ERROR,
+    )
+
+
+def get_routing_metadata(response, prefix: str = 'llm') -> Dict[str, Any]:
+    """從 LLM 回應取得路由結果（供 trace metadata 使用），沒有路由資訊時回傳空 dict"""
+    routing = getattr(response, 'response_metadata', {}).get(ROUTING_METADATA_KEY)
+    if not routing:
+        return {}
+    return {f'{prefix}_{key}': value for key, value in routing.items()}
+
+
+class RoutedChatModel:
+    """依 route 設定建立模型並處理降級，提供與 ChatGoogleGenerativeAI 相同的 invoke / ainvoke"""
+
+    def __init__(self, route: str):
+        config = get_route_config(route)
+
+        self.route = route
+        self.model = config['model']
+        self.latency_budget = config['latency_budget']
+        self.max_output_tokens = config['max_output_tokens']
+        self.priority = config['priority']
+
+        fallback_model = config['fallback_model'] if settings.LLM_FALLBACK_ENABLED else None
+        self.fallback_model = fallback_model
+
+        # 有 fallback 時主要模型不重試，直接降級以控制延遲
+        self.retry_primary = fallback_model is None
+        self.primary = self._build_model(self.model, config)
+        self.fallback = self._build_model(fallback_model, config) if fallback_model else None
+
+    @staticmethod
+    def _build_model(model: str, config: Dict[str, Any]):
+        # 重試由 llm_resilience 處理（共用時間預算與熔斷），模型本身只呼叫一次
+        kwargs = {'model': model, 'temperature': config['temperature'], 'max_retries': 1}
+        if config['latency_budget'] is not None:
+            kwargs['timeout'] = config['latency_budget']
+        if config['max_output_tokens'] is not None:
+            kwargs['max_output_tokens'] = config['max_output_tokens']
+        if config['thinking_budget'] is not None:
+            kwargs['thinking_budget'] = config['thinking_budget']
+        return ChatGoogleGenerativeAI(**kwargs)
+
+    def invoke(self, messages: List[BaseMessage], config: Optional[dict] = None, **kwargs):
+        """
+        呼叫模型（主要模型失敗時改用 fallback 模型）
+
+        Args:
+            messages: 送給模型的訊息
+            config: LangChain config（callbacks、run_name）
+            **kwargs: 傳給模型的呼叫參數（例如結構化輸出的 response_mime_type / response_schema）
+        """
+        priority = get_priority(self.priority)
+        estimated = estimate_tokens(messages, self.max_output_tokens)
+        reason = self._degraded_reason()
+        if reason is None:
+            try:
+                rate_governor.acquire(self.model, priority, estimated)
+            except RateLimitedError as e:
+                reason = self._handle_throttled(e)
+        if reason is None:
+            start = time.monotonic()
+            try:
+                response = call_with_resilience(
+                    self.model,
+                    lambda: self._invoke_primary(messages, config, **kwargs),
+                    is_transient_error,
+                    retry=self.retry_primary,
+                )
+            except Exception as e:
+                reason = self._handle_primary_error(e, start)
+            else:
+                latency_tracker.record(self.model, time.monotonic() - start, self.latency_budget)
+                rate_governor.settle(self.model, estimated, response)
+                return self._annotate(response, self.model, None)
+
+        logger.warning(f'LLM route {self.route} falling back to {self.fallback_model}: {reason}')
+        rate_governor.acquire(self.fallback_model, priority, estimated)
+        response = call_with_resilience(
+            self.fallback_model,
+            lambda: self.fallback.invoke(messages, config=config, **kwargs),
+            is_transient_error,
+        )
+        rate_governor.settle(self.fallback_model, estimated, response)
+        return self._annotate(response, self.fallback_model, reason)
+
+    async def ainvoke(self, messages: List[BaseMessage], config: Optional[dict] = None, **kwargs):
+        """invoke 的 async 版本"""
+        priority = get_priority(self.priority)
+        estimated = estimate_tokens(messages, self.max_output_tokens)
+        reason = self._degraded_reason()
+        if reason is None:
+            try:
+                await rate_governor.aacquire(self.model, priority, estimated)
+            except RateLimitedError as e:
+                reason = self._handle_throttled(e)
+        if reason is None:
+            start = time.monotonic()
+            try:
+                response = await acall_with_resilience(
+                    self.model,
+                    lambda: self._ainvoke_primary(messages, config, **kwargs),
+                    is_transient_error,
+                    retry=self.retry_primary,
+                )
+            except Exception as e:
+                reason = self._handle_primary_error(e, start)
+            else:
+                latency_tracker.record(self.model, time.monotonic() - start, self.latency_budget)
+                await rate_governor.asettle(self.model, estimated, response)
+                return self._annotate(response, self.model, None)
+
+        logger.warning(f'LLM route {self.route} falling back to {self.fallback_model}: {reason}')
+        await rate_governor.aacquire(self.fallback_model, priority, estimated)
+        response = await acall_with_resilience(
+            self.fallback_model,
+            lambda: self.fallback.ainvoke(messages, config=config, **kwargs),
+            is_transient_error,
+        )
+        await rate_governor.asettle(self.fallback_model, estimated, response)
+        return self._annotate(response, self.fallback_model, reason)
+
+    def _invoke_primary(self, messages: List[BaseMessage], config: Optional[dict], **kwargs):
+        # cached content 只對應主要模型；fallback 模型一律送出完整訊息
+        cache_name = context_cache_registry.get_cache_name(self.model, messages)
+        if cache_name is None:
+            return self.primary.invoke(messages, config=config, **kwargs)
+        try:
+            return self.primary.invoke(
+                messages[1:], config=config, cached_content=cache_name, **kwargs
+            )
+        except Exception as e:
+            self._discard_rejected_cache(e, messages, cache_name)
+            raise
+
+    async def _ainvoke_primary(self, messages: List[BaseMessage], config: Optional[dict], **kwargs):
+        cache_name = None
+        if settings.PROMPT_CONTEXT_CACHE_ENABLED:
+            # 第一次建立 cached content 是同步的 API 呼叫，移到 thread 執行
+            cache_name = await asyncio.to_thread(
+                context_cache_registry.get_cache_name, self.model, messages
+            )
+        if cache_name is None:
+            return await self.primary.ainvoke(messages, config=config, **kwargs)
+        try:
+            return await self.primary.ainvoke(
+                messages[1:], config=config, cached_content=cache_name, **kwargs
+            )
+        except Exception as e:
+            self._discard_rejected_cache(e, messages, cache_name)
+            raise
+
+    def _discard_rejected_cache(
+        self, error: Exception, messages: List[BaseMessage], cache_name: str
+    ):
+        # 非暫時性錯誤可能是 cached content 已失效（過期、被刪除），丟棄後下次重新建立
+        if not is_transient_error(error):
+            context_cache_registry.discard(self.model, messages, cache_name)
+
+    def _degraded_reason(self) -> Optional[str]:
+        if self.fallback is None:
+            return None
+        if resilience_registry.is_open(self.model):
+            return FALLBACK_CIRCUIT_OPEN
+        if latency_tracker.is_degraded(self.model):
+            return FALLBACK_DEGRADED
+        return None
+
+    def _handle_throttled(self, error: RateLimitedError) -> str:
+        """主要模型額度不足：有 fallback 時改用 fallback，否則重新拋出錯誤"""
+        if self.fallback is None:
+            raise error
+        return FALLBACK_THROTTLED
+
+    def _handle_primary_error(self, error: Exception, start: float) -> str:
+        """主要模型失敗：可降級時回傳原因，否則重新拋出錯誤"""
+        reason = get_fallback_reason(error)
+        if reason == FALLBACK_TIMEOUT:
+            latency_tracker.record(self.model, time.monotonic() - start, self.latency_budget)
+        if reason is None or self.fallback is None:
+            raise error
+        return reason
+
+    def _annotate(self, response, model: str, fallback_reason: Optional[str]):
+        response.response_metadata[ROUTING_METADATA_KEY] = {
+            'route': self.route,
+            'model': model,
+            'fallback_reason': fallback_reason,
+        }
+        return response
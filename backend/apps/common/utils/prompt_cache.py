@@ -0,0 +1,105 @@
+"""
+System prompt 組裝快取
+
+agent 的 system prompt 由 prompt 模板與 template 的文章內容組成，同一個 MindMapTemplate 的
+所有學生使用完全相同的 system prompt。此模組以 (agent, prompt 版本, template id, template 更新時間)
+為 key，將組裝好的 SystemMessage 保留在記憶體中，避免每次呼叫都重新 format 長篇文章。
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import PromptTemplate
+
+logger = logging.getLogger(__name__)
+
+# SystemMessage.id 的前綴，provider context cache 以此作為 system prompt 的識別
+PROMPT_ID_PREFIX = 'prompt-'
+
+_CACHE_MAX_SIZE = 256
+
+
+def get_prompt_version(prompt_template: PromptTemplate) -> str:
+    """prompt 模板的版本（內容雜湊），修改 prompt 後依版本產生的快取不再使用"""
+    return hashlib.sha256(prompt_template.template.encode('utf-8')).hexdigest()[:16]
+
+
+def make_template_key(template) -> Optional[str]:
+    """
+    MindMapTemplate 的快取識別（id 與更新時間），文章修改後 updated_at 改變，key 隨之改變
+
+    Returns:
+        str | None: 沒有 template 時回傳 None
+    """
+    if template is None:
+        return None
+    return f'{template.id}:{template.updated_at.isoformat()}'
+
+
+class PromptAssemblyCache:
+    """組裝好的 system prompt 快取（per process）"""
+
+    def __init__(self, max_size: int = _CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _get_version(self, prompt_template: PromptTemplate) -> str:
+        # prompt 模板為模組層級常數，版本只需計算一次
+        version = self._versions.get(id(prompt_template))
+        if version is None:
+            version = get_prompt_version(prompt_template)
+            self._versions[id(prompt_template)] = version
+        return version
+
+    def render(
+        self,
+        agent: str,
+        prompt_template: PromptTemplate,
+        article_content: str,
+        template_key: Optional[str],
+    ) -> SystemMessage:
+        """
+        取得 agent 的 system prompt
+
+        Args:
+            agent: agent 名稱
+            prompt_template: prompt 模板（需包含 article_content 變數）
+            article_content: 文章內容
+            template_key: make_template_key 的結果，None 表示不使用快取（例如沒有 template）
+
+        Returns:
+            SystemMessage: 組裝好的 system prompt；使用快取時 id 為穩定的 prompt 識別
+        """
+        if template_key is None:
+            return SystemMessage(content=prompt_template.format(article_content=article_content))
+
+        key = (agent, self._get_version(prompt_template), template_key)
+        with self._lock:
+            message = self._cache.get(key)
+            if message is not None:
+                self._cache.move_to_end(key)
+                return message
+
+        prompt_id = hashlib.sha256('\0'.join(key).encode('utf-8')).hexdigest()[:32]
+        message = SystemMessage(
+            content=prompt_template.format(article_content=article_content),
+            id=f'{PROMPT_ID_PREFIX}{prompt_id}',
+        )
+        logger.debug(f'System prompt assembled: agent={agent}, template={template_key}')
+
+        with self._lock:
+            self._cache[key] = message
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+        return message
+
+
+prompt_assembly_cache = PromptAssemblyCache()
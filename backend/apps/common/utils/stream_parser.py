@@ -0,0 +1,198 @@
+"""
+串流解析工具模組
+
+提供 LLM 串流輸出的增量解析器，讓 SSE endpoint 只推送使用者應該看到的文字。
+"""
+
+_SIMPLE_ESCAPES = {
+    '"': '"',
+    '\\': '\\',
+    '/': '/',
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+}
+
+
+def get_chunk_text(chunk) -> str:
+    """
+    取得 message chunk 中的文字內容
+
+    Gemini 部分模型的 content 會是 list（包含多個 part），需合併其中的文字部分。
+
+    Args:
+        chunk: AIMessageChunk 或具有 content 屬性的物件
+
+    Returns:
+        str: chunk 的文字內容
+    """
+    content = getattr(chunk, 'content', '')
+    if isinstance(content, str):
+        return content
+
+    texts = []
+    for part in content or []:
+        if isinstance(part, str):
+            texts.append(part)
+        elif isinstance(part, dict) and part.get('type') == 'text':
+            texts.append(part.get('text', ''))
+    return ''.join(texts)
+
+
+class RawTextStreamParser:
+    """直接輸出原始文字的串流解析器（用於非 JSON 格式的回應）"""
+
+    done = False
+
+    def feed(self, chunk: str) -> str:
+        return chunk
+
+
+class JsonFieldStreamParser:
+    """
+    增量 JSON 欄位解析器
+
+    從 LLM 逐步產生的 JSON 文字中，只提取最外層物件指定欄位的字串值。
+    可處理 Markdown 代碼塊包裹、跳脫字元與任意位置切斷的 chunk。
+
+    使用方式：
+        parser = JsonFieldStreamParser('final_response')
+        for chunk in chunks:
+            text = parser.feed(chunk)
+    """
+
+    def __init__(self, field: str):
+        """
+        Args:
+            field: 要串流輸出的欄位名稱（例如 final_response）
+        """
+        self.field = field
+        self.done = False
+
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._unicode_buffer = None
+        self._pending_high_surrogate = None
+        self._expecting_key = False
+        self._string_is_key = False
+        self._string_buffer = []
+        self._last_key = None
+        self._capturing = False
+
+    def feed(self, chunk: str) -> str:
+        """
+        餵入新的 chunk
+
+        Args:
+            chunk: LLM 新產生的文字片段
+
+        Returns:
+            str: 目標欄位新增的已解碼文字（可能為空字串）
+        """
+        if self.done or not chunk:
+            return ''
+
+        output = []
+        for char in chunk:
+            if self._in_string:
+                decoded = self._consume_string_char(char)
+                if decoded is None:
+                    continue
+                if self._capturing:
+                    output.append(decoded)
+                elif self._string_is_key:
+                    self._string_buffer.append(decoded)
+                if self.done:
+                    break
+                continue
+
+            if char == '"':
+                self._start_string()
+            elif char in '{[':
+                self._depth += 1
+                self._expecting_key = char == '{' and self._depth == 1
+            elif char in '}]':
+                self._depth = max(0, self._depth - 1)
+            elif char == ',' and self._depth == 1:
+                self._expecting_key = True
+            elif char == ':' and self._depth == 1:
+                self._expecting_key = False
+
+        return ''.join(output)
+
+    def _start_string(self):
+        """遇到字串起始引號時，判斷此字串是 key 還是目標欄位的 value"""
+        self._in_string = True
+        self._string_is_key = self._depth == 1 and self._expecting_key
+        self._string_buffer = []
+        self._capturing = (
+            self._depth == 1 and not self._expecting_key and self._last_key == self.field
+        )
+
+    def _end_string(self):
+        """字串結束：記錄 key 或結束擷取"""
+        self._in_string = False
+        if self._capturing:
+            self._capturing = False
+            self.done = True
+        elif self._string_is_key:
+            self._last_key = ''.join(self._string_buffer)
+            self._expecting_key = False
+
+    def _consume_string_char(self, char: str):
+        """
+        處理字串內的字元
+
+        Returns:
+            str | None: 解碼後的字元，None 表示尚未產生可輸出的字元
+        """
+        if self._unicode_buffer is not None:
+            self._unicode_buffer += char
+            if len(self._unicode_buffer) < 4:
+                return None
+            try:
+                code_point = int(self._unicode_buffer, 16)
+            except ValueError:
+                code_point = 0xFFFD
+            self._unicode_buffer = None
+            return self._decode_code_point(code_point)
+
+        if self._escape:
+            self._escape = False
+            if char == 'u':
+                self._unicode_buffer = ''
+                return None
+            return self._flush_surrogate() + _SIMPLE_ESCAPES.get(char, char)
+
+        if char == '\\':
+            self._escape = True
+            return None
+
+        if char == '"':
+            pending = self._flush_surrogate()
+            self._end_string()
+            return pending or None
+
+        return self._flush_surrogate() + char
+
+    def _decode_code_point(self, code_point: int) -> str:
+        """處理 \\uXXXX，包含跨 chunk 的 UTF-16 surrogate pair"""
+        if 0xD800 <= code_point <= 0xDBFF:
+            pending = self._flush_surrogate()
+            self._pending_high_surrogate = code_point
+            return pending or None
+        if 0xDC00 <= code_point <= 0xDFFF and self._pending_high_surrogate is not None:
+            high = self._pending_high_surrogate
+            self._pending_high_surrogate = None
+            return chr(0x10000 + ((high - 0xD800) << 10) + (code_point - 0xDC00))
+        return self._flush_surrogate() + chr(code_point)
+
+    def _flush_surrogate(self) -> str:
+        """輸出未配對的 high surrogate（以替代字元表示）"""
+        if self._pending_high_surrogate is None:
+            return ''
+        self._pending_high_surrogate = None
+        return '�'
@@ -0,0 +1,207 @@
+"""
+結構化輸出（Structured Output）
+
+回傳 JSON 的 agent 以 pydantic schema 定義輸出格式：
+- 呼叫模型時開啟 provider 的 JSON 模式（response_mime_type / response_schema），模型直接輸出符合 schema 的 JSON
+- 每次回應只解析一次，結果寫入 response.response_metadata['structured_output']，
+  process_response 與 extract_metadata 透過 get_structured_output 共用
+- 解析失敗時先修復（去除 Markdown 包裹等），仍失敗則重新呼叫模型（最多 STRUCTURED_OUTPUT_MAX_RETRIES 次；
+  串流輸出的 agent 已將內容送給使用者，不重試）
+- 全部失敗時 structured_output 為 None，agent 沿用原本的原始內容 fallback
+解析結果（直接成功 / 修復 / 重試 / 失敗）依 agent 統計，見 get_structured_output_metrics。
+"""
+
+import json
+import logging
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Type
+
+from django.conf import settings
+from langchain_core.messages import BaseMessage
+from langchain_core.utils.json_schema import dereference_refs
+from pydantic import BaseModel, ValidationError
+
+from .json_parser import parse_llm_json_response
+from .stream_parser import get_chunk_text
+
+logger = logging.getLogger(__name__)
+
+STRUCTURED_OUTPUT_KEY = 'structured_output'
+
+# 統計的解析結果
+OUTCOME_PARSED = 'parsed'
+OUTCOME_REPAIRED = 'repaired'
+OUTCOME_RETRIED = 'retried'
+OUTCOME_FAILED = 'failed'
+
+
+class StructuredOutputStats:
+    """各 agent 的解析結果統計（per process）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, Counter] = {}
+
+    def record(self, name: str, outcome: str):
+        with self._lock:
+            self._counts.setdefault(name, Counter())[outcome] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {
+                name: {
+                    outcome: counter.get(outcome, 0)
+                    for outcome in (
+                        OUTCOME_PARSED,
+                        OUTCOME_REPAIRED,
+                        OUTCOME_RETRIED,
+                        OUTCOME_FAILED,
+                    )
+                }
+                for name, counter in self._counts.items()
+            }
+
+
+structured_output_stats = StructuredOutputStats()
+
+
+def get_structured_output_metrics() -> Dict[str, Dict[str, int]]:
+    """取得目前 process 的結構化輸出解析統計"""
+    return structured_output_stats.snapshot()
+
+
+def _to_response_schema(schema: Any) -> Any:
+    """
+    將 pydantic 的 JSON schema 轉為 provider 的 response_schema
+
+    展開 $ref 並加上 propertyOrdering（Gemini 預設依字母順序輸出欄位，
+    需維持 prompt 要求的順序，例如先輸出 reasoning 再輸出 final_response）；
+    有預設值的欄位驗證時可省略，但仍要求模型輸出
+    """
+    if isinstance(schema, list):
+        return [_to_response_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+
+    converted = {key: _to_response_schema(value) for key, value in schema.items() if key != '$defs'}
+    if isinstance(schema.get('properties'), dict):
+        converted['propertyOrdering'] = list(schema['properties'])
+        converted['required'] = list(schema['properties'])
+    return converted
+
+
+class StructuredOutput:
+    """agent 的輸出 schema"""
+
+    def __init__(self, name: str, schema: Type[BaseModel], retry: bool = True):
+        """
+        Args:
+            name: 統計用的 agent 名稱
+            schema: 輸出格式（pydantic model）
+            retry: 解析失敗時是否重新呼叫模型（串流輸出的 agent 設為 False）
+        """
+        self.name = name
+        self.schema = schema
+        self.retry = retry
+        self.response_schema = _to_response_schema(dereference_refs(schema.model_json_schema()))
+
+    def get_invoke_kwargs(self) -> Dict[str, Any]:
+        """呼叫模型時開啟 provider JSON 模式的參數"""
+        if not settings.STRUCTURED_OUTPUT_PROVIDER_MODE:
+            return {}
+        return {'response_mime_type': 'application/json', 'response_schema': self.response_schema}
+
+    def parse(self, text: str) -> tuple[Optional[dict], bool]:
+        """
+        解析並驗證模型輸出
+
+        Returns:
+            tuple: (解析結果, 是否經過修復)；無法解析時為 (None, False)
+        """
+        try:
+            return self.schema.model_validate_json(text).model_dump(), False
+        except ValidationError:
+            pass
+
+        # 修復：取出被 Markdown 或其他文字包裹的 JSON
+        try:
+            return self.schema.model_validate(parse_llm_json_response(text)).model_dump(), True
+        except (json.JSONDecodeError, ValidationError) as e:
+            logger.warning(f'{self.name}: structured output invalid: {str(e)[:200]}')
+            return None, False
+
+    def _handle(self, response) -> Optional[dict]:
+        """解析回應並記錄結果，回傳解析結果（失敗時為 None）"""
+        parsed, repaired = self.parse(get_chunk_text(response))
+        if parsed is not None:
+            structured_output_stats.record(
+                self.name, OUTCOME_REPAIRED if repaired else OUTCOME_PARSED
+            )
+        return parsed
+
+    def _get_max_retries(self) -> int:
+        return settings.STRUCTURED_OUTPUT_MAX_RETRIES if self.retry else 0
+
+    def _annotate(self, response, parsed: Optional[dict]):
+        if parsed is None:
+            structured_output_stats.record(self.name, OUTCOME_FAILED)
+        response.response_metadata[STRUCTURED_OUTPUT_KEY] = parsed
+        return response
+
+    def invoke(self, llm, messages: List[BaseMessage], config: Optional[dict] = None):
+        """
+        呼叫模型並解析結構化輸出
+
+        Args:
+            llm: RoutedChatModel
+            messages: 送給模型的訊息
+            config: LangChain config（callbacks、run_name）
+
+        Returns:
+            模型回應（response_metadata['structured_output'] 為解析結果或 None）
+        """
+        kwargs = self.get_invoke_kwargs()
+        response = llm.invoke(messages, config=config, **kwargs)
+        parsed = self._handle(response)
+
+        for attempt in range(self._get_max_retries()):
+            if parsed is not None:
+                break
+            structured_output_stats.record(self.name, OUTCOME_RETRIED)
+            logger.info(f'{self.name}: retrying malformed structured output ({attempt + 1})')
+            response = llm.invoke(messages, config=config, **kwargs)
+            parsed = self._handle(response)
+
+        return self._annotate(response, parsed)
+
+    async def ainvoke(self, llm, messages: List[BaseMessage], config: Optional[dict] = None):
+        """invoke 的 async 版本"""
+        kwargs = self.get_invoke_kwargs()
+        response = await llm.ainvoke(messages, config=config, **kwargs)
+        parsed = self._handle(response)
+
+        for attempt in range(self._get_max_retries()):
+            if parsed is not None:
+                break
+            structured_output_stats.record(self.name, OUTCOME_RETRIED)
+            logger.info(f'{self.name}: retrying malformed structured output ({attempt + 1})')
+            response = await llm.ainvoke(messages, config=config, **kwargs)
+            parsed = self._handle(response)
+
+        return self._annotate(response, parsed)
+
+
+def get_structured_output(response) -> Optional[dict]:
+    """取得回應的結構化輸出，未使用結構化輸出或解析失敗時回傳 None"""
+    return getattr(response, 'response_metadata', {}).get(STRUCTURED_OUTPUT_KEY)
+
+
+class SupportResponse(BaseModel):
+    """對話型 agent（CER 認知支援、essay 支援、節點回饋）共用的輸出格式"""
+
+    # 只記錄在 metadata，缺少時不影響回應
+    reasoning: str = ''
+    response_strategy: str = ''
+    strategy_detail: str = ''
+    final_response: str
@@ -0,0 +1,174 @@
+"""
+Langfuse tracing（背景批次送出、依 route 取樣）
+
+各 service 以 tracer.trace 建立每個請求的 trace，取代直接使用 Langfuse client：
+- 整個 process 共用一個 Langfuse client；span 放入有上限的背景佇列（TRACING_MAX_QUEUE_SIZE），
+  每 TRACING_FLUSH_AT 筆或 TRACING_FLUSH_INTERVAL 秒批次送出，佇列已滿時丟棄，不阻塞請求
+- 依 route 取樣（TRACING_SAMPLE_RATES），例如評分一律記錄、一般對話只記錄一部分；
+  未取樣的請求不建立 span 也不掛 CallbackHandler，不佔用請求的 CPU
+- Langfuse 的連線狀態由背景執行緒定期檢查（TRACING_HEALTH_CHECK_SECONDS），
+  無法連線時 trace 為 no-op，請求與 health probe 都不等待 Langfuse
+未記錄的 trace 的 trace_id 為 None。
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from langfuse import Langfuse, propagate_attributes
+from langfuse.langchain import CallbackHandler
+
+logger = logging.getLogger(__name__)
+
+# Langfuse 連線狀態
+STATUS_UNKNOWN = 'unknown'
+STATUS_OK = 'ok'
+STATUS_UNAVAILABLE = 'unavailable'
+
+
+class Trace:
+    """一個請求的 trace；未記錄時所有操作皆為 no-op"""
+
+    def __init__(self, span=None):
+        self.span = span
+        # CallbackHandler 會自動繼承目前的 span
+        self.callbacks: List[Any] = [CallbackHandler()] if span is not None else []
+
+    @property
+    def trace_id(self) -> Optional[str]:
+        return self.span.trace_id if self.span is not None else None
+
+    def update_trace(self, **kwargs):
+        """更新 trace 的 input / output / metadata"""
+        if self.span is not None:
+            self.span.update_trace(**kwargs)
+
+
+class Tracer:
+    """Langfuse client、取樣與連線狀態（per process）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client: Optional[Langfuse] = None
+        self._status = STATUS_UNKNOWN
+        self._checked_at = 0.0
+        self._checking = False
+        self._counts: Counter = Counter()
+
+    @property
+    def client(self) -> Langfuse:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    # OpenTelemetry 的 BatchSpanProcessor 由環境變數設定佇列上限
+                    os.environ.setdefault(
+                        'OTEL_BSP_MAX_QUEUE_SIZE', str(settings.TRACING_MAX_QUEUE_SIZE)
+                    )
+                    self._client = Langfuse(
+                        flush_at=settings.TRACING_FLUSH_AT,
+                        flush_interval=settings.TRACING_FLUSH_INTERVAL,
+                        timeout=settings.TRACING_EXPORT_TIMEOUT,
+                    )
+        return self._client
+
+    def should_sample(self, route: str) -> bool:
+        rate = settings.TRACING_SAMPLE_RATES.get(route, settings.TRACING_DEFAULT_SAMPLE_RATE)
+        return rate >= 1 or random.random() < rate
+
+    def _check(self):
+        """檢查 Langfuse 連線（背景執行緒）"""
+        try:
+            status = STATUS_OK if self.client.auth_check() else STATUS_UNAVAILABLE
+        except Exception as e:
+            logger.debug(f'Langfuse auth check failed: {str(e)[:100]}')
+            status = STATUS_UNAVAILABLE
+
+        with self._lock:
+            if status != self._status:
+                log = logger.info if status == STATUS_OK else logger.warning
+                log(f'Langfuse tracing status changed: {self._status} -> {status}')
+            self._status = status
+            self._checked_at = time.monotonic()
+            self._checking = False
+
+    def get_status(self) -> str:
+        """
+        取得 Langfuse 連線狀態（不等待網路）
+
+        狀態過期時在背景重新檢查，本次回傳上一次的結果
+        """
+        with self._lock:
+            stale = time.monotonic() - self._checked_at >= settings.TRACING_HEALTH_CHECK_SECONDS
+            if stale and not self._checking:
+                self._checking = True
+                threading.Thread(target=self._check, name='langfuse-check', daemon=True).start()
+            return self._status
+
+    def is_available(self) -> bool:
+        # 尚未完成第一次檢查時先記錄，無法送出的 span 只會留在背景佇列
+        return self.get_status() != STATUS_UNAVAILABLE
+
+    @contextmanager
+    def trace(
+        self,
+        name: str,
+        route: str,
+        session_id: Optional[str],
+        user_id: Optional[str],
+        input: Any,
+        metadata: Optional[Dict[str, Any]] = None,
+        force: bool = False,
+    ):
+        """
+        建立請求的 trace 並設定 session / user
+
+        使用方式：
+            with tracer.trace('mindmap_interaction', route, session_id, user_id, input) as trace_span:
+                result = graph.process_message(..., callbacks=trace_span.callbacks)
+                trace_span.update_trace(output=..., metadata=...)
+
+        Args:
+            name: trace 名稱
+            route: 取樣用的 route（見 TRACING_SAMPLE_RATES）
+            force: 不取樣，一律記錄（例如 health check）
+        """
+        if not settings.TRACING_ENABLED:
+            outcome = 'disabled'
+        elif not (force or self.should_sample(route)):
+            outcome = 'sampled_out'
+        elif not self.is_available():
+            outcome = 'unavailable'
+        else:
+            outcome = 'traced'
+        with self._lock:
+            self._counts[(route, outcome)] += 1
+
+        if outcome != 'traced':
+            yield Trace()
+            return
+
+        with self.client.start_as_current_observation(name=name, as_type='span') as span:
+            with propagate_attributes(session_id=session_id, user_id=user_id):
+                span.update_trace(input=input, metadata=metadata)
+                yield Trace(span)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            routes: Dict[str, Dict[str, int]] = {}
+            for (route, outcome), count in self._counts.items():
+                routes.setdefault(route, {})[outcome] = count
+            return {'status': self._status, 'routes': routes}
+
+
+tracer = Tracer()
+
+
+def get_tracing_metrics() -> Dict[str, Any]:
+    """取得 Langfuse 連線狀態與目前 process 各 route 的記錄 / 取樣略過次數"""
+    return tracer.snapshot()
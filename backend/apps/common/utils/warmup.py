@@ -0,0 +1,118 @@
+"""
+Worker 啟動時的預載與 warm-up
+
+LangGraph 服務在第一次使用時才建立（連線池、graph 編譯、Gemini client），
+沒有 warm-up 時，每個 worker 的第一個請求要等待這些初始化。分為兩個階段：
+- preload：在 gunicorn master（preload_app）載入 URLconf，import views、graph、langchain 等模組，
+  fork 後各 worker 以 copy-on-write 共用；此階段不建立連線、執行緒或 client，fork 後才安全
+- warm-up：每個 worker 啟動後在背景執行緒依序建立 WARMUP_STEPS 的服務，
+  完成前 readiness probe 回報 not-ready；失敗時由下一次 readiness probe 重新執行
+ASGI 模式的 async 連線池綁定 event loop，仍在第一個請求時建立。
+"""
+
+import gc
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# warm-up 狀態
+WARMUP_DISABLED = 'disabled'
+WARMUP_PENDING = 'pending'
+WARMUP_RUNNING = 'running'
+WARMUP_READY = 'ready'
+WARMUP_FAILED = 'failed'
+
+
+def preload():
+    """
+    在 fork 前載入模組（gunicorn master 呼叫）
+
+    只 import 模組，不建立連線或執行緒；gc.freeze 將已載入的物件移出 GC 追蹤，
+    避免 worker 的 GC 寫入這些物件造成 copy-on-write 複製
+    """
+    from django.urls import get_resolver
+
+    start = time.monotonic()
+    get_resolver().url_patterns
+    gc.freeze()
+    logger.info(f'Application modules preloaded in {time.monotonic() - start:.2f}s')
+
+
+class WarmUp:
+    """目前 process 的 warm-up 狀態"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status = WARMUP_PENDING
+        self._error: Optional[str] = None
+        self._durations: Dict[str, float] = {}
+
+    def start(self) -> bool:
+        """
+        在背景執行緒開始 warm-up
+
+        Returns:
+            bool: 是否開始執行（已在執行或已完成時回傳 False）
+        """
+        if not settings.WARMUP_ENABLED:
+            return False
+        with self._lock:
+            if self._status in (WARMUP_RUNNING, WARMUP_READY):
+                return False
+            self._status = WARMUP_RUNNING
+            self._error = None
+        threading.Thread(target=self.run, name='warmup', daemon=True).start()
+        return True
+
+    def run(self):
+        """依序建立 WARMUP_STEPS 的服務（已建立的服務直接回傳單例，不會重複建立）"""
+        start = time.monotonic()
+        try:
+            for path in settings.WARMUP_STEPS:
+                step_start = time.monotonic()
+                import_string(path)()
+                with self._lock:
+                    self._durations[path.rsplit('.', 1)[-1]] = round(
+                        time.monotonic() - step_start, 2
+                    )
+        except Exception as e:
+            logger.exception('Worker warm-up failed')
+            with self._lock:
+                self._status = WARMUP_FAILED
+                self._error = f'{type(e).__name__}: {str(e)[:200]}'
+            return
+
+        with self._lock:
+            self._status = WARMUP_READY
+        logger.info(f'Worker warm-up completed in {time.monotonic() - start:.2f}s')
+
+    def is_ready(self) -> bool:
+        """是否可接收請求（未啟用 warm-up 時一律為 True）"""
+        return not settings.WARMUP_ENABLED or self.status == WARMUP_READY
+
+    @property
+    def status(self) -> str:
+        if not settings.WARMUP_ENABLED:
+            return WARMUP_DISABLED
+        with self._lock:
+            return self._status
+
+    def reset(self):
+        with self._lock:
+            self._status = WARMUP_PENDING
+            self._error = None
+            self._durations.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        status = self.status
+        with self._lock:
+            return {'status': status, 'error': self._error, 'durations': dict(self._durations)}
+
+
+warmup = WarmUp()
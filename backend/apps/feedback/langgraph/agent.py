@@ -3,13 +3,18 @@ Feedback Agent - 處理節點編輯回饋的 LLM Agent
 """
 
 import logging
-from typing import Any, List, Tuple
+from typing import Any, List, Optional, Tuple
 
-from langchain_core.messages import BaseMessage, SystemMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.messages import BaseMessage
 
-from apps.common.utils.json_parser import parse_llm_json_response
+from apps.common.utils.llm_routing import RoutedChatModel, get_routing_metadata
 from apps.common.utils.message_filter import filter_messages
+from apps.common.utils.prompt_cache import prompt_assembly_cache
+from apps.common.utils.structured_output import (
+    StructuredOutput,
+    SupportResponse,
+    get_structured_output,
+)
 
 from .prompts import FEEDBACK_PROMPT
 
@@ -19,17 +24,16 @@ logger = logging.getLogger(__name__)
 class FeedbackAgent:
     """節點編輯回饋 Agent"""
 
+    output_schema = StructuredOutput('feedback', SupportResponse)
+
     def __init__(self):
         """初始化 Feedback Agent"""
-        self.llm = ChatGoogleGenerativeAI(
-            model='gemini-3-flash-preview',
-            temperature=0.5,
-        )
+        self.llm = RoutedChatModel('feedback')
         self.prompt_template = FEEDBACK_PROMPT
 
     def process_response(self, response) -> str:
         """
-        處理回應：解析 JSON 並提取 final_response
+        處理回應：取出已解析 JSON 的 final_response
 
         Args:
             response: LLM 的回應
@@ -37,19 +41,15 @@ class FeedbackAgent:
         Returns:
             str: final_response 的內容，或完整回應（如果解析失敗）
         """
-        try:
-            result = parse_llm_json_response(response.content)
-            if 'final_response' not in result:
-                logger.warning('Response missing final_response field, using raw content')
-                return response.content
-            return result['final_response']
-        except Exception as e:
-            logger.warning(f'Failed to parse response: {str(e)[:100]}, using raw content')
+        result = get_structured_output(response)
+        if result is None:
+            logger.warning('Invalid structured response, using raw content')
             return response.content
+        return result['final_response']
 
     def extract_metadata(self, response) -> dict:
         """
-        提取 metadata：從 JSON 回應中提取 reasoning, response_strategy, strategy_detail
+        提取 metadata：從已解析的 JSON 回應中提取 reasoning, response_strategy, strategy_detail
 
         Args:
             response: LLM 的回應
@@ -57,22 +57,37 @@ class FeedbackAgent:
         Returns:
             dict: metadata 包含 reasoning, response_strategy, strategy_detail
         """
-        try:
-            result = parse_llm_json_response(response.content)
-            return {
-                'reasoning': result.get('reasoning', ''),
-                'response_strategy': result.get('response_strategy', ''),
-                'strategy_detail': result.get('strategy_detail', ''),
-            }
-        except Exception as e:
-            logger.warning(f'Failed to extract metadata: {str(e)[:100]}')
+        result = get_structured_output(response)
+        if result is None:
             return {}
+        return {
+            'reasoning': result['reasoning'],
+            'response_strategy': result['response_strategy'],
+            'strategy_detail': result['strategy_detail'],
+        }
+
+    def prepare_messages(
+        self,
+        messages: List[BaseMessage],
+        article_content: str = '',
+        template_key: Optional[str] = None,
+    ) -> list:
+        """組成送給 LLM 的訊息：System Prompt + 過濾後的訊息"""
+        filtered_messages = filter_messages(
+            messages, context_fields_to_keep=['mind_map_data', 'metadata']
+        )
+        system_message = prompt_assembly_cache.render(
+            'feedback', self.prompt_template, article_content, template_key
+        )
+
+        return [system_message] + filtered_messages
 
     def process(
         self,
         messages: List[BaseMessage],
         article_content: str = '',
         callbacks: List[Any] = None,
+        template_key: Optional[str] = None,
     ) -> Tuple[str, dict]:
         """
         處理 feedback 生成
@@ -81,23 +96,47 @@ class FeedbackAgent:
             messages: 訊息列表 (包含學生操作的 HumanMessage)
             article_content: 文章內容
             callbacks: LangChain callbacks
+            template_key: template 的快取識別（None 時不使用 system prompt 快取）
 
         Returns:
             Tuple[str, dict]: (LLM 生成的回饋, metadata)
         """
-        filtered_messages = filter_messages(
-            messages, context_fields_to_keep=['mind_map_data', 'metadata']
-        )
-        system_message_content = self.prompt_template.format(article_content=article_content)
+        final_messages = self.prepare_messages(messages, article_content, template_key)
+
+        try:
+            response = self.output_schema.invoke(
+                self.llm,
+                final_messages,
+                config={'callbacks': callbacks, 'run_name': 'FeedbackAgent'},
+            )
+            final_response = self.process_response(response)
+            metadata = self.extract_metadata(response)
+            metadata.update(get_routing_metadata(response))
+            return final_response, metadata
+
+        except Exception as e:
+            logger.exception('Feedback agent failed')
+            return 'Sorry, I am unable to provide feedback at this time.', {}
 
-        final_messages = [SystemMessage(content=system_message_content)] + filtered_messages
+    async def aprocess(
+        self,
+        messages: List[BaseMessage],
+        article_content: str = '',
+        callbacks: List[Any] = None,
+        template_key: Optional[str] = None,
+    ) -> Tuple[str, dict]:
+        """process 的 async 版本（ASGI 模式使用）"""
+        final_messages = self.prepare_messages(messages, article_content, template_key)
 
         try:
-            response = self.llm.invoke(
-                final_messages, config={'callbacks': callbacks, 'run_name': 'FeedbackAgent'}
+            response = await self.output_schema.ainvoke(
+                self.llm,
+                final_messages,
+                config={'callbacks': callbacks, 'run_name': 'FeedbackAgent'},
             )
             final_response = self.process_response(response)
             metadata = self.extract_metadata(response)
+            metadata.update(get_routing_metadata(response))
             return final_response, metadata
 
         except Exception as e:
@@ -4,10 +4,10 @@ Feedback Graph - 簡化版 LangGraph 流程
 
 import json
 import operator
-from typing import Annotated, Any, Dict, List, TypedDict
+from typing import Annotated, Any, Dict, List, Optional, TypedDict
 
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
-from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from langgraph.graph import END, START, StateGraph
 
 from .agent import FeedbackAgent
@@ -17,6 +17,7 @@ from .agent import FeedbackAgent
 class FeedbackState(TypedDict):
     messages: Annotated[List[BaseMessage], operator.add]
     article_content: str  # 新增此欄位
+    template_key: Optional[str]
 
 
 class FeedbackGraph:
@@ -34,6 +35,21 @@ class FeedbackGraph:
             state['messages'],
             callbacks=callbacks,
             article_content=article_content,
+            template_key=state.get('template_key'),
+        )
+
+        return {'messages': [AIMessage(content=response, additional_kwargs={'metadata': metadata})]}
+
+    async def _afeedback_node(self, state: FeedbackState, config: RunnableConfig) -> dict:
+        """Node: 生成 feedback（async 版本）"""
+        callbacks = config.get('callbacks', [])
+        article_content = state.get('article_content', '')
+
+        response, metadata = await self.agent.aprocess(
+            state['messages'],
+            callbacks=callbacks,
+            article_content=article_content,
+            template_key=state.get('template_key'),
         )
 
         return {'messages': [AIMessage(content=response, additional_kwargs={'metadata': metadata})]}
@@ -43,7 +59,9 @@ class FeedbackGraph:
         workflow = StateGraph(FeedbackState)
 
         # 加入節點
-        workflow.add_node('feedback', self._feedback_node)
+        workflow.add_node(
+            'feedback', RunnableLambda(self._feedback_node, afunc=self._afeedback_node)
+        )
 
         # 設定流程：START -> feedback -> END
         workflow.add_edge(START, 'feedback')
@@ -59,6 +77,7 @@ class FeedbackGraph:
         article_content: str = '',
         thread_id: str = '',
         callbacks: List[Any] = None,
+        template_key: Optional[str] = None,
     ) -> Dict:
         """
         處理訊息並生成 feedback
@@ -70,6 +89,7 @@ class FeedbackGraph:
             article_content: 文章內容
             thread_id: 保留是為了 API 兼容性，但不再用於記憶管理
             callbacks: LangChain callbacks
+            template_key: template 的快取識別（system prompt 組裝快取使用）
 
         Returns:
             dict: 包含處理結果的狀態
@@ -77,9 +97,42 @@ class FeedbackGraph:
         config = {
             'callbacks': callbacks,
         }
+        inputs = self._build_inputs(
+            user_input, mind_map_data, metadata, article_content, template_key
+        )
+
+        return self.graph.invoke(inputs, config=config)
 
-        # 與 chatbot 相同的方式組成 inputs
-        inputs = {
+    async def aprocess_message(
+        self,
+        user_input: str,
+        mind_map_data: Dict,
+        metadata: List[Dict],
+        article_content: str = '',
+        thread_id: str = '',
+        callbacks: List[Any] = None,
+        template_key: Optional[str] = None,
+    ) -> Dict:
+        """process_message 的 async 版本（ASGI 模式使用）"""
+        config = {
+            'callbacks': callbacks,
+        }
+        inputs = self._build_inputs(
+            user_input, mind_map_data, metadata, article_content, template_key
+        )
+
+        return await self.graph.ainvoke(inputs, config=config)
+
+    def _build_inputs(
+        self,
+        user_input: str,
+        mind_map_data: Dict,
+        metadata: List[Dict],
+        article_content: str,
+        template_key: Optional[str] = None,
+    ) -> Dict:
+        """與 chatbot 相同的方式組成 inputs"""
+        return {
             'messages': [
                 HumanMessage(
                     content=json.dumps(
@@ -92,6 +145,5 @@ class FeedbackGraph:
                 )
             ],
             'article_content': article_content,
+            'template_key': template_key,
         }
-
-        return self.graph.invoke(inputs, config=config)
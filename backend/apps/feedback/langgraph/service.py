@@ -3,11 +3,14 @@ Feedback Service - 整合 LangGraph 的服務層
 """
 
 import logging
+import threading
+from typing import Optional
 
-from langfuse import Langfuse, propagate_attributes
-from langfuse.langchain import CallbackHandler
+from asgiref.sync import sync_to_async
 
 from apps.common.utils.map_data_utils import simplify_map_data
+from apps.common.utils.prompt_cache import make_template_key
+from apps.common.utils.tracing import tracer
 from apps.map.models import Map
 
 from ..models import NodeFeedback
@@ -22,7 +25,6 @@ class FeedbackService:
     def __init__(self):
         """初始化 Feedback Service"""
         self.graph = FeedbackGraph()
-        self.langfuse = Langfuse()
 
     def generate_feedback(
         self,
@@ -53,104 +55,209 @@ class FeedbackService:
         logger.debug(f'Metadata: {metadata}')
 
         try:
-            # 1. 從資料庫取得 Map 和相關的 Template
-            try:
-                map_instance = Map.objects.select_related('template').get(id=map_id)
-                logger.debug(
-                    f'Map loaded for feedback: nodes={len(map_instance.nodes)}, edges={len(map_instance.edges)}, template_id={map_instance.template_id}'
-                )
-            except Map.DoesNotExist:
-                logger.error(f'Map not found in generate_feedback: map_id={map_id}')
-                raise Exception(f'Map with id {map_id} does not exist')
-
-            # 2. 簡化 map 資料（與 chatbot 相同處理）
-            simplified_map = simplify_map_data(
-                {'nodes': map_instance.nodes, 'edges': map_instance.edges}
-            )
-            logger.debug(f'Simplified map data: {len(str(simplified_map))} chars')
+            # 1~4. 取得 Map、簡化後的 map 資料與文章內容
+            (
+                map_instance,
+                simplified_map,
+                article_content,
+                template_key,
+            ) = self._load_feedback_context(map_id)
 
-            # 3. 直接使用前端傳來的操作描述（作為 query）
+            # 直接使用前端傳來的操作描述（作為 query）
             query = operation_details
             logger.debug(f'Operation details: {query[:100]}...')
 
-            # 4. 取得文章內容
-            article_content = ''
-            if map_instance.template:
-                article_content = map_instance.template.article_content
-                logger.debug(f'Article content: {article_content[:100]}...')
-
             # 5. 設定 thread_id 和 session_id
             thread_id = f'feedback-{map_id}'
             session_id = thread_id
 
-            # 6. 使用 Langfuse Context Manager 建立 Trace 並設定 Session ID 和 User ID
-            with self.langfuse.start_as_current_observation(
-                name='feedback_generation',
-                as_type='span',
+            # 6. 建立 Trace（依取樣比例）並設定 Session ID 和 User ID
+            with tracer.trace(
+                'feedback_generation',
+                'feedback',
+                session_id=session_id,
+                user_id=user_id,
+                input=query,
             ) as trace_span:
-                # 設定 Trace 層級屬性 (Session ID 和 User ID) 並向下傳遞
-                with propagate_attributes(session_id=session_id, user_id=user_id):
-                    # 更新 Trace Input
-                    trace_span.update_trace(input=query)
-
-                    # 初始化 CallbackHandler (會自動繼承當前 Context)
-                    langfuse_handler = CallbackHandler()
-
-                    # 7. 調用 graph
-                    result = self.graph.process_message(
-                        user_input=query,
-                        mind_map_data=simplified_map,
-                        metadata=metadata,
-                        article_content=article_content,
-                        thread_id=thread_id,
-                        callbacks=[langfuse_handler],
-                    )
-
-                    # 8. 取得最後的回應和 metadata
-                    if result.get('messages'):
-                        last_message = result['messages'][-1]
-                        feedback_response = last_message.content.strip()
-                        agent_metadata = last_message.additional_kwargs.get('metadata', {})
-                    else:
-                        feedback_response = '無法生成回饋'
-                        agent_metadata = {}
-
-                    # 更新 Trace Output 和 Metadata
-                    trace_span.update_trace(
-                        output=feedback_response,
-                        metadata=agent_metadata,
-                    )
-
-                    # 9. 儲存到資料庫（合併 metadata）
-                    NodeFeedback.objects.create(
-                        user_id=user_id,
-                        map=map_instance,
-                        alert_title=alert_title,
-                        operation_details=operation_details,
-                        feedback=feedback_response,
-                        metadata={
-                            'operations': metadata,
-                            **agent_metadata,  # 加入 reasoning, response_strategy, strategy_detail
-                        },
-                    )
-
-                    logger.info(
-                        f'Feedback saved: map_id={map_id}, feedback_id={NodeFeedback.objects.latest("id").id}'
-                    )
-                    return feedback_response, trace_span.trace_id
+                # 7. 調用 graph
+                result = self.graph.process_message(
+                    user_input=query,
+                    mind_map_data=simplified_map,
+                    metadata=metadata,
+                    article_content=article_content,
+                    thread_id=thread_id,
+                    callbacks=trace_span.callbacks,
+                    template_key=template_key,
+                )
+
+                # 8. 取得最後的回應和 metadata
+                feedback_response, agent_metadata = self._extract_feedback(result)
+
+                # 更新 Trace Output 和 Metadata
+                trace_span.update_trace(
+                    output=feedback_response,
+                    metadata=agent_metadata,
+                )
+
+                # 9. 儲存到資料庫（合併 metadata）
+                self._save_feedback(
+                    user_id,
+                    map_instance,
+                    alert_title,
+                    operation_details,
+                    feedback_response,
+                    metadata,
+                    agent_metadata,
+                )
+                return feedback_response, trace_span.trace_id
 
         except Exception as e:
             logger.exception(f'Failed to generate feedback: map_id={map_id}')
             return 'Sorry, I am unable to provide feedback at this time.', None
 
+    async def agenerate_feedback(
+        self,
+        map_id: int,
+        metadata: list,
+        alert_title: str,
+        operation_details: str,
+        user_id: str,
+    ) -> tuple[str, str | None]:
+        """generate_feedback 的 async 版本（ASGI 模式使用）"""
+        logger.info(f'Generating feedback (async): map_id={map_id}, user_id={user_id}')
+
+        try:
+            (
+                map_instance,
+                simplified_map,
+                article_content,
+                template_key,
+            ) = await sync_to_async(self._load_feedback_context)(map_id)
+
+            query = operation_details
+            session_id = f'feedback-{map_id}'
+
+            with tracer.trace(
+                'feedback_generation',
+                'feedback',
+                session_id=session_id,
+                user_id=user_id,
+                input=query,
+            ) as trace_span:
+                result = await self.graph.aprocess_message(
+                    user_input=query,
+                    mind_map_data=simplified_map,
+                    metadata=metadata,
+                    article_content=article_content,
+                    thread_id=session_id,
+                    callbacks=trace_span.callbacks,
+                    template_key=template_key,
+                )
+
+                feedback_response, agent_metadata = self._extract_feedback(result)
+                trace_span.update_trace(output=feedback_response, metadata=agent_metadata)
+
+                await sync_to_async(self._save_feedback)(
+                    user_id,
+                    map_instance,
+                    alert_title,
+                    operation_details,
+                    feedback_response,
+                    metadata,
+                    agent_metadata,
+                )
+                return feedback_response, trace_span.trace_id
+
+        except Exception:
+            logger.exception(f'Failed to generate feedback (async): map_id={map_id}')
+            return 'Sorry, I am unable to provide feedback at this time.', None
+
+    def _load_feedback_context(self, map_id: int) -> tuple[Map, dict, str, Optional[str]]:
+        """
+        從資料庫取得 Map、簡化後的 map 資料、文章內容與 template 快取識別
+
+        Raises:
+            Exception: 當 Map 不存在時拋出
+        """
+        # 1. 從資料庫取得 Map 和相關的 Template
+        try:
+            map_instance = Map.objects.select_related('template').get(id=map_id)
+            logger.debug(
+                f'Map loaded for feedback: nodes={len(map_instance.nodes)}, edges={len(map_instance.edges)}, template_id={map_instance.template_id}'
+            )
+        except Map.DoesNotExist:
+            logger.error(f'Map not found in generate_feedback: map_id={map_id}')
+            raise Exception(f'Map with id {map_id} does not exist')
+
+        # 2. 簡化 map 資料（與 chatbot 相同處理）
+        simplified_map = simplify_map_data(
+            {'nodes': map_instance.nodes, 'edges': map_instance.edges}
+        )
+        logger.debug(f'Simplified map data: {len(str(simplified_map))} chars')
+
+        # 3. 取得文章內容
+        article_content = ''
+        if map_instance.template:
+            article_content = map_instance.template.article_content
+            logger.debug(f'Article content: {article_content[:100]}...')
+
+        return (
+            map_instance,
+            simplified_map,
+            article_content,
+            make_template_key(map_instance.template),
+        )
+
+    def _extract_feedback(self, result: dict) -> tuple[str, dict]:
+        """從 graph 結果取得最後的回應和 metadata"""
+        if result.get('messages'):
+            last_message = result['messages'][-1]
+            feedback_response = last_message.content.strip()
+            agent_metadata = last_message.additional_kwargs.get('metadata', {})
+        else:
+            feedback_response = '無法生成回饋'
+            agent_metadata = {}
+
+        return feedback_response, agent_metadata
+
+    def _save_feedback(
+        self,
+        user_id: str,
+        map_instance: Map,
+        alert_title: str,
+        operation_details: str,
+        feedback_response: str,
+        metadata: list,
+        agent_metadata: dict,
+    ) -> NodeFeedback:
+        """儲存 feedback 到資料庫（合併 metadata）"""
+        feedback = NodeFeedback.objects.create(
+            user_id=user_id,
+            map=map_instance,
+            alert_title=alert_title,
+            operation_details=operation_details,
+            feedback=feedback_response,
+            metadata={
+                'operations': metadata,
+                **agent_metadata,  # 加入 reasoning, response_strategy, strategy_detail
+            },
+        )
+
+        logger.info(f'Feedback saved: map_id={map_instance.id}, feedback_id={feedback.id}')
+        return feedback
+
 
 # Singleton instance
 _feedback_service = None
+_feedback_service_lock = threading.Lock()
 
 
 def get_feedback_service() -> FeedbackService:
     """取得 FeedbackService 實例（單例模式）"""
     global _feedback_service
     if _feedback_service is None:
-        _feedback_service = FeedbackService()
+        # 同時到達的請求（或 warm-up）只建立一次
+        with _feedback_service_lock:
+            if _feedback_service is None:
+                _feedback_service = FeedbackService()
     return _feedback_service
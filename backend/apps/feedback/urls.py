@@ -1,7 +1,13 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
+# ASGI 模式（uvicorn）使用 async view
+create_feedback = (
+    views.create_feedback_async if settings.ASYNC_VIEWS_ENABLED else views.create_feedback
+)
+
 urlpatterns = [
-    path('create/', views.create_feedback, name='create_feedback'),
+    path('create/', create_feedback, name='create_feedback'),
 ]
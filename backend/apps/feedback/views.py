@@ -1,9 +1,12 @@
 import logging
 
+from adrf.decorators import api_view as async_api_view
+from asgiref.sync import sync_to_async
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
+from apps.chatbot.idempotency import idempotent
 from apps.map.models import Map
 from apps.map.permissions import require_map_owner
 
@@ -13,9 +16,15 @@ from .serializers import CreateFeedbackSerializer, NodeFeedbackSerializer
 
 logger = logging.getLogger(__name__)
 
+# 同一次送出的重試（連點或前端重試）只生成一次回饋：以 Idempotency-Key header 或 user_action_id 識別，
+# 兩者皆無時不去重（學生刻意重複相同的操作時仍會產生新的回饋）
+FEEDBACK_KEY_FIELDS = ('map_id', 'metadata', 'alert_title', 'operation_details', 'user_action_id')
+_feedback_idempotent = idempotent('feedback', fields=FEEDBACK_KEY_FIELDS, required='user_action_id')
+
 
 @api_view(['POST'])
 @require_map_owner
+@_feedback_idempotent
 def create_feedback(request):
     """
     建立 Node 編輯的 feedback 並同步呼叫 LLM 生成回饋
@@ -87,3 +96,64 @@ def create_feedback(request):
             },
             status=status.HTTP_500_INTERNAL_SERVER_ERROR,
         )
+
+
+def _get_latest_feedback(map_id, user):
+    """查詢剛才儲存的 feedback record"""
+    feedback_record = NodeFeedback.objects.filter(map_id=map_id, user=user).latest('created_at')
+    return NodeFeedbackSerializer(feedback_record).data
+
+
+@async_api_view(['POST'])
+@require_map_owner
+@_feedback_idempotent
+async def create_feedback_async(request):
+    """create_feedback 的 async 版本（SERVER_MODE=asgi 時使用），request / response 格式相同"""
+    serializer = CreateFeedbackSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(
+            {'success': False, 'error': 'Invalid request data', 'details': serializer.errors},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    map_id = serializer.validated_data['map_id']
+    metadata = serializer.validated_data['metadata']
+    alert_title = serializer.validated_data['alert_title']
+    operation_details = serializer.validated_data['operation_details']
+
+    if not await Map.objects.filter(id=map_id).aexists():
+        return Response(
+            {'success': False, 'error': f'Map with id {map_id} not found'},
+            status=status.HTTP_404_NOT_FOUND,
+        )
+
+    try:
+        feedback_service = await sync_to_async(get_feedback_service)()
+        user_id = str(request.user.id)
+        feedback_text, trace_id = await feedback_service.agenerate_feedback(
+            map_id, metadata, alert_title, operation_details, user_id
+        )
+
+        feedback_data = await sync_to_async(_get_latest_feedback)(map_id, request.user)
+
+        return Response(
+            {
+                'success': True,
+                'data': {
+                    'feedback': feedback_text,
+                    'langfuse_trace_id': trace_id,
+                    **feedback_data,
+                },
+            }
+        )
+
+    except Exception as e:
+        logger.exception(e)
+        return Response(
+            {
+                'success': False,
+                'error': '生成回饋失敗，請稍後再試',
+                'details': str(e),
+            },
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
@@ -1,15 +1,26 @@
 import logging
 
+from django.conf import settings
 from django.db import OperationalError, connections
 from langchain_core.messages import HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langfuse import Langfuse
-from langfuse.langchain import CallbackHandler
 from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet
 
+from apps.chatbot.langgraph.checkpointer import get_pool_metrics
+from apps.chatbot.langgraph.speculation import get_speculation_metrics
+from apps.chatbot.langgraph.state_cache import get_state_cache_metrics
+from apps.chatbot.langgraph.thread_lock import get_thread_lock_metrics
+from apps.chatbot.scoring_jobs import get_scoring_job_metrics
+from apps.common.utils.llm_governor import get_rate_governor_metrics
+from apps.common.utils.llm_resilience import get_resilience_metrics
+from apps.common.utils.llm_routing import latency_tracker
+from apps.common.utils.structured_output import get_structured_output_metrics
+from apps.common.utils.tracing import STATUS_UNAVAILABLE, get_tracing_metrics, tracer
+from apps.common.utils.warmup import WARMUP_FAILED, WARMUP_PENDING, warmup
+
 logger = logging.getLogger('default')
 
 
@@ -36,22 +47,82 @@ class HealthViewSet(ViewSet):
             overall_status = False
         checks['database'] = db_status
 
-        # Check Langfuse
-        langfuse_status = 'ok'
-        try:
-            langfuse = Langfuse()
-            langfuse.auth_check()
-        except Exception as e:
-            logger.error(f'Langfuse connection error: {e}')
-            langfuse_status = 'error'
-            overall_status = False
+        # Check Langfuse（背景檢查的結果，不等待網路；無法連線時 tracing 為 no-op，不影響 ready）
+        langfuse_status = tracer.get_status()
+        if langfuse_status == STATUS_UNAVAILABLE:
+            logger.warning('Langfuse unavailable, tracing disabled')
         checks['langfuse'] = langfuse_status
 
+        # Check worker warm-up（LangGraph 服務建立完成前不接收流量；未開始或失敗時在背景重新執行）
+        if warmup.status in (WARMUP_PENDING, WARMUP_FAILED):
+            warmup.start()
+        checks['warmup'] = warmup.status
+        if not warmup.is_ready():
+            overall_status = False
+
         if overall_status:
             return Response({'status': 'ok', 'dependencies': checks}, status=200)
         else:
             return Response({'status': 'error', 'dependencies': checks}, status=503)
 
+    @action(detail=False, methods=['get'], url_path='db-pool')
+    def db_pool(self, request):
+        # 連線池等待時間與飽和度（僅反映處理此請求的 worker process）
+        return Response({'status': 'ok', 'pools': get_pool_metrics()}, status=200)
+
+    @action(detail=False, methods=['get'])
+    def speculation(self, request):
+        # 推測執行命中率（僅反映處理此請求的 worker process）
+        return Response({'status': 'ok', 'graphs': get_speculation_metrics()}, status=200)
+
+    @action(detail=False, methods=['get'], url_path='thread-locks')
+    def thread_locks(self, request):
+        # 對話 thread 鎖的持有數、排隊深度與拒絕 / 逾時次數（僅反映處理此請求的 worker process）
+        return Response({'status': 'ok', 'locks': get_thread_lock_metrics()}, status=200)
+
+    @action(detail=False, methods=['get'], url_path='state-cache')
+    def state_cache(self, request):
+        # thread state 快取的命中率與大小（僅反映處理此請求的 worker process）
+        return Response({'status': 'ok', 'cache': get_state_cache_metrics()}, status=200)
+
+    @action(detail=False, methods=['get'], url_path='scoring-jobs')
+    def scoring_jobs(self, request):
+        # 非同步評分工作的佇列狀態（所有 worker 共用，查詢資料庫）
+        try:
+            return Response({'status': 'ok', 'jobs': get_scoring_job_metrics()}, status=200)
+        except OperationalError as e:
+            logger.error(f'Scoring job metrics failed: {e}')
+            return Response({'status': 'error', 'error': str(e)}, status=503)
+
+    @action(detail=False, methods=['get'], url_path='llm-routing')
+    def llm_routing(self, request):
+        # 各模型最近的 p95 延遲、降級與熔斷狀態，及各優先等級的等待 / 拒絕次數
+        # （僅反映處理此請求的 worker process）
+        return Response(
+            {
+                'status': 'ok',
+                'models': latency_tracker.snapshot(),
+                'circuits': get_resilience_metrics(),
+                'rate_governor': get_rate_governor_metrics(),
+            },
+            status=200,
+        )
+
+    @action(detail=False, methods=['get'], url_path='structured-output')
+    def structured_output(self, request):
+        # 各 agent 結構化輸出的解析結果統計（僅反映處理此請求的 worker process）
+        return Response({'status': 'ok', 'agents': get_structured_output_metrics()}, status=200)
+
+    @action(detail=False, methods=['get'])
+    def tracing(self, request):
+        # Langfuse 連線狀態與各 route 的記錄 / 取樣略過次數（僅反映處理此請求的 worker process）
+        return Response({'status': 'ok', 'tracing': get_tracing_metrics()}, status=200)
+
+    @action(detail=False, methods=['get'], url_path='warmup')
+    def warmup_status(self, request):
+        # worker warm-up 的狀態與各服務的建立時間（僅反映處理此請求的 worker process）
+        return Response({'status': 'ok', 'warmup': warmup.snapshot()}, status=200)
+
     @action(detail=False, methods=['get'])
     def llm(self, request):
         # Check LLM
@@ -60,17 +131,20 @@ class HealthViewSet(ViewSet):
         llm_response = None
 
         try:
-            langfuse = Langfuse()
-            llm = ChatGoogleGenerativeAI(model='gemini-3-flash-preview', temperature=0)
+            llm = ChatGoogleGenerativeAI(model=settings.LLM_FLASH_MODEL, temperature=0)
 
-            with langfuse.start_as_current_observation(
-                name='health_check', as_type='trace', metadata={'type': 'health'}
+            message = HumanMessage(content='Health Check. Reply with only "OK".')
+            with tracer.trace(
+                'health_check',
+                'health',
+                session_id=None,
+                user_id=None,
+                input=message.content,
+                metadata={'type': 'health'},
+                force=True,
             ) as trace:
-                langfuse_handler = CallbackHandler()
-                message = HumanMessage(content='Health Check. Reply with only "OK".')
-                trace.update(input='Health Check. Reply with only "OK".')
-                llm_response = llm.invoke([message], config={'callbacks': [langfuse_handler]})
-                trace.update(output=llm_response.content)
+                llm_response = llm.invoke([message], config={'callbacks': trace.callbacks})
+                trace.update_trace(output=llm_response.content)
                 trace_id = trace.trace_id
 
             if not trace_id:
@@ -1,5 +1,6 @@
 import logging
 from functools import wraps
+from inspect import iscoroutinefunction
 
 from rest_framework import status
 from rest_framework.response import Response
@@ -9,7 +10,7 @@ from .models import Map
 logger = logging.getLogger(__name__)
 
 
-def require_map_owner(view_func):
+def require_map_owner(view_func=None, *, select_related=None):
     """
     權限檢查 decorator：確保當前使用者擁有指定的 map
 
@@ -20,51 +21,116 @@ def require_map_owner(view_func):
             # 如果執行到這裡，表示 request.user 確實擁有這個 map
             ...
 
+    view 需要 map 本身時，指定 select_related，檢查時一併載入 map 與關聯資料（同一次查詢），
+    放在 request.map_instance，view 與 service 不需再查詢：
+        @require_map_owner(select_related=('template', 'essay'))
+        def my_view(request, map_id=None):
+            map_instance = request.map_instance
+
     行為：
         - 從 URL 參數（map_id）或 request.data['map_id'] 中取得 map ID
-        - 驗證 Map.objects.filter(id=map_id, user=request.user).exists()
+        - 驗證 Map.objects.filter(id=map_id, user=request.user).exists()（指定 select_related 時改為載入 map）
         - 如果 map 不存在或不屬於當前使用者，回傳 404 Not Found
+        - 支援 async view（ASGI 模式），會改用 async ORM 查詢
         - 回傳 404 而非 403，避免洩漏 map 是否存在的資訊
     """
 
+    if view_func is None:
+        return lambda func: require_map_owner(func, select_related=select_related)
+
+    def get_queryset(request, map_id):
+        queryset = Map.objects.filter(id=map_id, user=request.user)
+        if select_related is not None:
+            queryset = queryset.select_related(*select_related)
+        return queryset
+
+    if iscoroutinefunction(view_func):
+        # async view（ASGI 模式）：使用 async ORM 查詢
+        @wraps(view_func)
+        async def async_wrapper(request, *args, **kwargs):
+            map_id, error_response = _get_map_id(request, kwargs)
+            if error_response is not None:
+                return error_response
+
+            try:
+                if select_related is None:
+                    owned = await get_queryset(request, map_id).aexists()
+                else:
+                    request.map_instance = await get_queryset(request, map_id).afirst()
+                    owned = request.map_instance is not None
+                if not owned:
+                    return _map_not_found()
+            except Exception as e:
+                return _ownership_check_failed(map_id, e)
+
+            return await view_func(request, *args, **kwargs)
+
+        return async_wrapper
+
     @wraps(view_func)
     def wrapper(request, *args, **kwargs):
-        # 0. 確認使用者已登入
-        if not request.user or not request.user.is_authenticated:
-            return Response(
-                {'success': False, 'error': 'Authentication required'},
-                status=status.HTTP_401_UNAUTHORIZED,
-            )
-
-        # 1. 嘗試從 URL 參數取得 map_id
-        map_id = kwargs.get('map_id')
-
-        # 2. 如果 URL 沒有，從 request.data 取得（適用於 POST）
-        if map_id is None and hasattr(request, 'data'):
-            map_id = request.data.get('map_id')
-
-        # 3. 如果都沒有，回傳錯誤
-        if map_id is None:
-            return Response(
-                {'success': False, 'error': 'map_id is required'},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+        # 0~3. 確認使用者已登入並取得 map_id
+        map_id, error_response = _get_map_id(request, kwargs)
+        if error_response is not None:
+            return error_response
 
         # 4. 檢查 map 是否存在且屬於當前使用者
         try:
-            if not Map.objects.filter(id=map_id, user=request.user).exists():
+            if select_related is None:
+                owned = get_queryset(request, map_id).exists()
+            else:
+                request.map_instance = get_queryset(request, map_id).first()
+                owned = request.map_instance is not None
+            if not owned:
                 # 回傳 404 而非 403，避免洩漏資源存在性
-                return Response(
-                    {'success': False, 'error': 'Map not found'}, status=status.HTTP_404_NOT_FOUND
-                )
+                return _map_not_found()
         except Exception as e:
-            logger.exception(f'Map ownership check failed: map_id={map_id}')
-            return Response(
-                {'success': False, 'error': str(e)},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            )
+            return _ownership_check_failed(map_id, e)
 
         # 5. 權限檢查通過，執行原本的 view
         return view_func(request, *args, **kwargs)
 
     return wrapper
+
+
+def _get_map_id(request, kwargs):
+    """
+    確認使用者已登入，並從 URL 參數或 request.data 取得 map_id
+
+    Returns:
+        tuple: (map_id, error_response)，成功時 error_response 為 None
+    """
+    # 0. 確認使用者已登入
+    if not request.user or not request.user.is_authenticated:
+        return None, Response(
+            {'success': False, 'error': 'Authentication required'},
+            status=status.HTTP_401_UNAUTHORIZED,
+        )
+
+    # 1. 嘗試從 URL 參數取得 map_id
+    map_id = kwargs.get('map_id')
+
+    # 2. 如果 URL 沒有，從 request.data 取得（適用於 POST）
+    if map_id is None and hasattr(request, 'data'):
+        map_id = request.data.get('map_id')
+
+    # 3. 如果都沒有，回傳錯誤
+    if map_id is None:
+        return None, Response(
+            {'success': False, 'error': 'map_id is required'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    return map_id, None
+
+
+def _map_not_found():
+    return Response({'success': False, 'error': 'Map not found'}, status=status.HTTP_404_NOT_FOUND)
+
+
+def _ownership_check_failed(map_id, error):
+    logger.exception(f'Map ownership check failed: map_id={map_id}')
+    return Response(
+        {'success': False, 'error': str(error)},
+        status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+    )
@@ -0,0 +1,109 @@
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.chatbot.langgraph.checkpoint_retention import (
+    get_threads_with_checkpoints,
+    iter_thread_batches,
+    prune_threads,
+)
+from apps.chatbot.langgraph.history_store import archive_projected_thread
+from apps.map.models import Map
+
+
+class Command(BaseCommand):
+    help = (
+        '清理 LangGraph checkpoint：每個 thread 保留最新的 checkpoint 與最近幾個歷史 checkpoint，'
+        '刪除不再被參照的 writes / blobs，並封存 template 已結束的 thread（可在線上資料庫分批執行）'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep',
+            type=int,
+            default=settings.CHECKPOINT_RETENTION_KEEP,
+            help='最新的 checkpoint 之外保留的歷史 checkpoint 數'
+            f'（預設: {settings.CHECKPOINT_RETENTION_KEEP}）',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help='每批處理的 thread 數（預設: 200）',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.1,
+            help='每批之間暫停的秒數，降低對線上請求的影響（預設: 0.1）',
+        )
+        parser.add_argument(
+            '--archive-after-days',
+            type=int,
+            default=settings.CHECKPOINT_ARCHIVE_AFTER_DAYS,
+            help='封存 template 結束超過此天數的 thread'
+            f'（預設: {settings.CHECKPOINT_ARCHIVE_AFTER_DAYS}）',
+        )
+        parser.add_argument(
+            '--no-archive',
+            action='store_true',
+            help='不封存 thread，只清理較舊的 checkpoint',
+        )
+
+    def handle(self, *args, **options):
+        if not options['no_archive']:
+            self.archive(options['archive_after_days'], options['batch_size'], options['sleep'])
+        self.prune(options['keep'], options['batch_size'], options['sleep'])
+
+    def prune(self, keep, batch_size, sleep):
+        totals = Counter()
+        for thread_ids in iter_thread_batches(batch_size):
+            totals.update(prune_threads(thread_ids, keep))
+            totals['threads'] += len(thread_ids)
+            time.sleep(sleep)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'已清理 {totals["threads"]} 個 thread：刪除 checkpoints={totals["checkpoints"]}, '
+                f'writes={totals["writes"]}, blobs={totals["blobs"]}'
+            )
+        )
+
+    def archive(self, days, batch_size, sleep):
+        """封存 template 已結束的 thread：在 thread 鎖內確保對話歷史投影為最新，再刪除所有 checkpoint"""
+        # 在函式內 import：建立 service 會連線資料庫並編譯 graph，只在需要封存時建立
+        from apps.chatbot.langgraph.essay.service import get_essay_langgraph_service
+        from apps.chatbot.langgraph.mindmap.service import get_langgraph_service
+
+        services = {'mindmap': get_langgraph_service, 'essay': get_essay_langgraph_service}
+        cutoff = timezone.now() - timedelta(days=days)
+        maps = Map.objects.filter(template__end_date__lt=cutoff).order_by('id')
+
+        archived = skipped = 0
+        last_id = 0
+        while True:
+            map_ids = list(maps.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+            if not map_ids:
+                break
+            last_id = map_ids[-1]
+
+            candidates = [f'{prefix}-{map_id}' for map_id in map_ids for prefix in services]
+            for thread_id in get_threads_with_checkpoints(candidates):
+                prefix, map_id = thread_id.rsplit('-', 1)
+                service = services[prefix]()
+                # 讀取歷史時會在投影過期時從 checkpoint 重建
+                if not archive_projected_thread(
+                    thread_id,
+                    lambda: service.get_conversation_history(int(map_id))['success'],
+                ):
+                    self.stderr.write(f'略過 {thread_id}：對話進行中或對話歷史投影未更新')
+                    skipped += 1
+                    continue
+                archived += 1
+            time.sleep(sleep)
+
+        self.stdout.write(self.style.SUCCESS(f'已封存 {archived} 個 thread（略過 {skipped} 個）'))
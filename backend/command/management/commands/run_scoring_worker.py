@@ -0,0 +1,75 @@
+import logging
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from apps.chatbot.scoring_jobs import claim_scoring_job, run_scoring_job
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        '執行非同步評分工作（SCORING_JOBS_ENABLED）：多個 thread 各自領取工作並執行評分，'
+        '收到 SIGTERM / SIGINT 時完成執行中的工作後結束'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=settings.SCORING_WORKER_THREADS,
+            help=f'同時執行的評分數（預設: {settings.SCORING_WORKER_THREADS}）',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='沒有工作時查詢的間隔秒數（預設: 1）',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='處理完目前可執行的工作後結束',
+        )
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: stop.set())
+
+        threads = max(1, options['threads'])
+        self.stdout.write(f'評分 worker 啟動：threads={threads}')
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='scoring') as executor:
+            futures = [
+                executor.submit(self.work, stop, options['poll_interval'], options['once'])
+                for _ in range(threads)
+            ]
+            processed = sum(future.result() for future in futures)
+
+        self.stdout.write(self.style.SUCCESS(f'評分 worker 結束：已處理 {processed} 個工作'))
+
+    def work(self, stop, poll_interval, once):
+        """領取並執行工作直到收到停止訊號（once 時沒有工作即結束），回傳處理的工作數"""
+        processed = 0
+        while not stop.is_set():
+            try:
+                job = claim_scoring_job()
+                if job is None:
+                    if once:
+                        break
+                    stop.wait(poll_interval)
+                    continue
+                run_scoring_job(job)
+                processed += 1
+            except Exception:
+                logger.exception('Scoring worker failed to process job')
+                stop.wait(poll_interval)
+            finally:
+                # 連線歸還連線池（資料庫重啟後取得新的連線）
+                close_old_connections()
+        return processed
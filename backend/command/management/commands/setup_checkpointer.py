@@ -0,0 +1,12 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.chatbot.langgraph.checkpointer import setup_checkpoint_tables
+
+
+class Command(BaseCommand):
+    help = '建立 / 更新 LangGraph checkpoint 資料表（部署時執行一次，worker 啟動時不再執行）'
+
+    def handle(self, *args, **options):
+        setup_checkpoint_tables(settings.DATABASE_URL)
+        self.stdout.write(self.style.SUCCESS('Checkpoint tables are up to date'))
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_asgi_application()
+
+# uvicorn 的每個 worker 各自載入此模組，在背景建立 LangGraph 服務（見 apps.common.utils.warmup）
+from apps.common.utils.warmup import warmup  # noqa: E402
+
+warmup.start()
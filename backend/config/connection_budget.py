@@ -0,0 +1,32 @@
+"""
+每個 process 的資料庫連線預算分配（settings 與連線預算檢查共用）
+"""
+
+
+def split_connection_budget(
+    connections_per_process: int,
+    web_threads: int,
+    async_views: bool,
+    thread_lock_enabled: bool,
+) -> dict:
+    """
+    將每個 process 的連線預算分給 thread 鎖、LangGraph checkpointer 與 Django 連線池
+
+    - thread 鎖：每個進行中的對話持有一條連線直到回應完成。WSGI 模式同時進行的對話不超過
+      web_threads，連線池固定為 web_threads 條，連線不足時不會把無關的 thread 誤報為忙碌；
+      ASGI 模式同時進行的對話沒有上限，取預算約三分之一（用完時回報鎖後端飽和）
+    - 其餘連線約一半給 checkpointer，剩下給 Django（皆不超過 web_threads）
+
+    Returns:
+        dict: {'thread_lock': ..., 'checkpoint': ..., 'django': ...} 各連線池的上限
+    """
+    thread_lock = 0
+    if thread_lock_enabled:
+        thread_lock = max(1, connections_per_process // 3) if async_views else web_threads
+    pooled = max(2, connections_per_process - thread_lock)
+    checkpoint = max(1, min(web_threads, pooled // 2))
+    return {
+        'thread_lock': thread_lock,
+        'checkpoint': checkpoint,
+        'django': max(1, min(web_threads, pooled - checkpoint)),
+    }
@@ -0,0 +1,22 @@
+"""
+gunicorn 設定（WSGI 模式，見 entrypoint.sh）
+
+workers / threads / bind 由 entrypoint.sh 的參數指定。
+master 先載入 application 與各模組（preload_app），fork 後由 worker 共用；
+連線池、graph 與 Gemini client 不可跨 fork 共用，在每個 worker 啟動後於背景建立（warm-up）。
+"""
+
+preload_app = True
+
+
+def when_ready(server):
+    # master 已載入 application，尚未 fork worker
+    from apps.common.utils.warmup import preload
+
+    preload()
+
+
+def post_worker_init(worker):
+    from apps.common.utils.warmup import warmup
+
+    warmup.start()
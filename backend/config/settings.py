@@ -10,14 +10,18 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import json
 import logging
 import os
 import sys
 from datetime import timedelta
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
 from dotenv import load_dotenv
 
+from config.connection_budget import split_connection_budget
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -42,6 +46,8 @@ CSRF_TRUSTED_ORIGINS = os.getenv('CSRF_TRUSTED_ORIGINS').split(',')
 
 CORS_ALLOWED_ORIGINS = os.getenv('CORS_ALLOWED_ORIGINS').split(',')
 
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
+
 
 # Application definition
 INSTALLED_APPS = [
@@ -52,6 +58,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'corsheaders',
+    'adrf',
     # apps
     'command',
     'apps.health',
@@ -102,6 +109,11 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'config.wsgi.application'
+ASGI_APPLICATION = 'config.asgi.application'
+
+# 執行模式：wsgi（gunicorn gthread，同步 views）或 asgi（uvicorn，chat / feedback 使用 async views）
+SERVER_MODE = os.getenv('SERVER_MODE', 'wsgi').lower()
+ASYNC_VIEWS_ENABLED = SERVER_MODE == 'asgi'
 
 
 # Database
@@ -117,6 +129,44 @@ DATABASES = {
     }
 }
 
+# Database connection budget
+# 所有 worker 的連線總數不可超過 PostgreSQL max_connections（docker-compose.prod.yaml 設定為 200）
+# 每個 process 的預算 = (max_connections - 保留連線) / worker 數，
+# 先分給 thread 鎖的專用連線池（每個持有中的鎖一條連線，WSGI 模式為 WEB_THREADS 條），
+# 其餘分給 Django 與 LangGraph checkpointer（見 config/connection_budget.py）。
+# Django 與 checkpoint 連線池小於 WEB_THREADS：chat 在呼叫 LLM 前歸還 Django 連線，
+# 兩者都只在短查詢期間佔用連線
+DB_MAX_CONNECTIONS = int(os.getenv('DB_MAX_CONNECTIONS', '200'))
+DB_RESERVED_CONNECTIONS = int(
+    os.getenv('DB_RESERVED_CONNECTIONS', '20')
+)  # migrate、admin、批次腳本
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', '4' if ASYNC_VIEWS_ENABLED else '12'))
+WEB_THREADS = int(os.getenv('WEB_THREADS', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+# 非同步評分工作：啟用時另有一個評分 worker process（manage.py run_scoring_worker）
+SCORING_JOBS_ENABLED = os.getenv('SCORING_JOBS_ENABLED', 'false').lower() == 'true'
+DB_PROCESSES = WEB_WORKERS + int(SCORING_JOBS_ENABLED)
+
+DB_CONNECTIONS_PER_PROCESS = max(
+    2, (DB_MAX_CONNECTIONS - DB_RESERVED_CONNECTIONS) // max(1, DB_PROCESSES)
+)
+# LangGraph thread 互斥鎖（PostgreSQL advisory lock），對話進行中持有一條鎖專用連線
+THREAD_LOCK_ENABLED = os.getenv('THREAD_LOCK_ENABLED', 'true').lower() == 'true'
+_POOL_SIZES = split_connection_budget(
+    DB_CONNECTIONS_PER_PROCESS, WEB_THREADS, ASYNC_VIEWS_ENABLED, THREAD_LOCK_ENABLED
+)
+THREAD_LOCK_POOL_MAX_SIZE = _POOL_SIZES['thread_lock']
+CHECKPOINT_POOL_MAX_SIZE = _POOL_SIZES['checkpoint']
+DJANGO_DB_POOL_MAX_SIZE = _POOL_SIZES['django']
+
+DATABASES['default']['OPTIONS'] = {
+    'pool': {
+        'min_size': 1,
+        'max_size': DJANGO_DB_POOL_MAX_SIZE,
+        'timeout': DB_POOL_TIMEOUT,
+    }
+}
+
 DATABASE_URL = f'postgresql://{os.getenv("DB_USER")}:{os.getenv("DB_PASSWORD")}@{os.getenv("DB_HOST")}:{os.getenv("DB_PORT")}/{os.getenv("DB_NAME")}'
 
 # User model
@@ -273,6 +323,262 @@ LOGGING = {
 }
 
 
+# LLM model routing
+LLM_PRO_MODEL = os.getenv('LLM_PRO_MODEL', 'gemini-2.5-pro')
+LLM_SCORING_MODEL = os.getenv('LLM_SCORING_MODEL', 'gemini-3-pro-preview')
+LLM_FLASH_MODEL = os.getenv('LLM_FLASH_MODEL', 'gemini-3-flash-preview')
+LLM_LITE_MODEL = os.getenv('LLM_LITE_MODEL', 'gemini-2.5-flash-lite')
+# 主要模型逾時 / 429 / 5xx 時改用 fallback 模型
+LLM_FALLBACK_ENABLED = os.getenv('LLM_FALLBACK_ENABLED', 'true').lower() == 'true'
+# 主要模型 p95 延遲超過預算時，直接使用 fallback 模型的秒數
+LLM_DEGRADED_SECONDS = int(os.getenv('LLM_DEGRADED_SECONDS', '60'))
+# 暫時性錯誤（逾時 / 429 / 5xx）的重試：指數退避加隨機抖動，所有嘗試共用時間預算
+LLM_RETRY_MAX_ATTEMPTS = int(os.getenv('LLM_RETRY_MAX_ATTEMPTS', '3'))
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', '0.5'))
+LLM_RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', '8'))
+LLM_RETRY_BUDGET_SECONDS = float(os.getenv('LLM_RETRY_BUDGET_SECONDS', '30'))
+# 熔斷：同一模型連續失敗達門檻後，一段時間內直接失敗（有 fallback 時改用 fallback 模型）
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('LLM_CIRCUIT_FAILURE_THRESHOLD', '5'))
+LLM_CIRCUIT_OPEN_SECONDS = int(os.getenv('LLM_CIRCUIT_OPEN_SECONDS', '30'))
+# 速率管控：各模型每分鐘請求數（rpm）與 token 數（tpm）的上限，由所有 worker 共用（未列出的模型不管控）
+LLM_GOVERNOR_ENABLED = os.getenv('LLM_GOVERNOR_ENABLED', 'true').lower() == 'true'
+LLM_GOVERNOR_BACKEND = os.getenv(
+    'LLM_GOVERNOR_BACKEND', 'apps.common.utils.llm_governor.PostgresTokenBucketBackend'
+)
+LLM_RATE_LIMITS = {
+    LLM_PRO_MODEL: {'rpm': 150, 'tpm': 2_000_000},
+    LLM_SCORING_MODEL: {'rpm': 50, 'tpm': 1_000_000},
+    LLM_FLASH_MODEL: {'rpm': 1000, 'tpm': 1_000_000},
+    LLM_LITE_MODEL: {'rpm': 4000, 'tpm': 4_000_000},
+}
+# 以 JSON 覆寫部分模型，例如 {"gemini-2.5-pro": {"rpm": 300, "tpm": 4000000}}
+LLM_RATE_LIMITS.update(json.loads(os.getenv('LLM_RATE_LIMIT_OVERRIDES', '{}')))
+# 優先等級（由高到低）：reserve 為此等級不可使用、保留給較高等級的額度比例，
+# max_wait 為等待額度的最長秒數（逾時改用 fallback 模型或回傳錯誤）
+LLM_PRIORITY_CLASSES = {
+    'interactive': {'reserve': 0.0, 'max_wait': 5},
+    'scoring': {'reserve': 0.1, 'max_wait': 60},
+    'feedback': {'reserve': 0.2, 'max_wait': 20},
+    'batch': {'reserve': 0.4, 'max_wait': 10},
+}
+# latency_budget：p95 延遲預算（秒），同時作為單次請求的逾時
+# priority：速率管控的優先等級，未設定時為 interactive
+# max_output_tokens 包含 thinking tokens；None 表示使用模型預設值
+LLM_ROUTES = {
+    'mindmap_classifier': {
+        'model': LLM_FLASH_MODEL,
+        'fallback_model': LLM_LITE_MODEL,
+        'temperature': 0.3,
+        'latency_budget': 10,
+        'max_output_tokens': 2048,
+        'thinking_budget': 512,
+    },
+    'essay_classifier': {
+        'model': LLM_FLASH_MODEL,
+        'fallback_model': LLM_LITE_MODEL,
+        'temperature': 0.3,
+        'latency_budget': 10,
+        'max_output_tokens': 2048,
+        'thinking_budget': 512,
+    },
+    'operator_support': {
+        'model': LLM_PRO_MODEL,
+        'fallback_model': LLM_FLASH_MODEL,
+        'temperature': 0.3,
+        'latency_budget': 45,
+        'max_output_tokens': 8192,
+        'thinking_budget': 2048,
+    },
+    'cer_cognitive_support': {
+        'model': LLM_PRO_MODEL,
+        'fallback_model': LLM_FLASH_MODEL,
+        'temperature': 0.5,
+        'latency_budget': 45,
+        'max_output_tokens': 8192,
+        'thinking_budget': 2048,
+    },
+    'essay_support': {
+        'model': LLM_PRO_MODEL,
+        'fallback_model': LLM_FLASH_MODEL,
+        'temperature': 0.5,
+        'latency_budget': 45,
+        'max_output_tokens': 8192,
+        'thinking_budget': 2048,
+    },
+    'cer_scoring': {
+        'model': LLM_SCORING_MODEL,
+        'fallback_model': LLM_PRO_MODEL,
+        'temperature': 0.5,
+        'latency_budget': 120,
+        'priority': 'scoring',
+    },
+    'essay_scoring': {
+        'model': LLM_SCORING_MODEL,
+        'fallback_model': LLM_PRO_MODEL,
+        'temperature': 0.5,
+        'latency_budget': 120,
+        'priority': 'scoring',
+    },
+    'feedback': {
+        'model': LLM_FLASH_MODEL,
+        'fallback_model': LLM_LITE_MODEL,
+        'temperature': 0.5,
+        'latency_budget': 30,
+        'max_output_tokens': 4096,
+        'thinking_budget': 1024,
+        'priority': 'feedback',
+    },
+    'conversation_summary': {
+        'model': LLM_FLASH_MODEL,
+        'fallback_model': LLM_LITE_MODEL,
+        'temperature': 0.2,
+        'latency_budget': 20,
+        'max_output_tokens': 2048,
+        'thinking_budget': 512,
+        # 摘要失敗不影響回應，額度不足時最先讓出
+        'priority': 'batch',
+    },
+}
+# 以 JSON 覆寫部分設定，例如 {"cer_scoring": {"latency_budget": 180}}
+for _route, _overrides in json.loads(os.getenv('LLM_ROUTE_OVERRIDES', '{}')).items():
+    LLM_ROUTES.setdefault(_route, {}).update(_overrides)
+
+# 結構化輸出：回傳 JSON 的 agent 開啟 provider JSON 模式（response_schema）
+STRUCTURED_OUTPUT_PROVIDER_MODE = (
+    os.getenv('STRUCTURED_OUTPUT_PROVIDER_MODE', 'true').lower() == 'true'
+)
+# 輸出無法解析（修復後仍失敗）時重新呼叫模型的次數（串流輸出的 agent 不重試）
+STRUCTURED_OUTPUT_MAX_RETRIES = int(os.getenv('STRUCTURED_OUTPUT_MAX_RETRIES', '1'))
+
+
+# Chatbot（classifier 快取、推測執行、評分快取、prompt 快取、對話記憶、請求去重、thread 鎖）
+# classifier 結果快取
+CLASSIFIER_CACHE_ENABLED = os.getenv('CLASSIFIER_CACHE_ENABLED', 'true').lower() == 'true'
+CLASSIFIER_CACHE_TTL_SECONDS = int(os.getenv('CLASSIFIER_CACHE_TTL_SECONDS', '86400'))
+# key 納入最近幾輪對話（同一句話在不同上下文可能是不同意圖）
+CLASSIFIER_CACHE_HISTORY_TURNS = int(os.getenv('CLASSIFIER_CACHE_HISTORY_TURNS', '2'))
+
+# 推測執行：classifier 與預測的 agent 同時執行（未命中時會多一次 LLM 呼叫，預設關閉）
+SPECULATIVE_EXECUTION_ENABLED = (
+    os.getenv('SPECULATIVE_EXECUTION_ENABLED', 'false').lower() == 'true'
+)
+
+# 評分結果快取：相同內容重複評分時直接回傳先前的結果
+SCORING_CACHE_ENABLED = os.getenv('SCORING_CACHE_ENABLED', 'true').lower() == 'true'
+# 命中快取時是否扣減評分次數
+SCORING_CACHE_HIT_CONSUMES_QUOTA = (
+    os.getenv('SCORING_CACHE_HIT_CONSUMES_QUOTA', 'false').lower() == 'true'
+)
+
+# provider 端 context cache：同一份 template 的 system prompt 建立為 Gemini cached content
+# 快取名稱記錄在各 process 內，建立與儲存會另外計費，預設關閉
+PROMPT_CONTEXT_CACHE_ENABLED = os.getenv('PROMPT_CONTEXT_CACHE_ENABLED', 'false').lower() == 'true'
+PROMPT_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv('PROMPT_CONTEXT_CACHE_TTL_SECONDS', '3600'))
+# 低於此長度的 prompt 不建立快取（provider 有最低 token 數限制）
+PROMPT_CONTEXT_CACHE_MIN_CHARS = int(os.getenv('PROMPT_CONTEXT_CACHE_MIN_CHARS', '4000'))
+PROMPT_CONTEXT_CACHE_BACKEND = os.getenv(
+    'PROMPT_CONTEXT_CACHE_BACKEND', 'apps.common.utils.context_cache.GeminiContextCacheBackend'
+)
+
+# 對話摘要記憶：保留最近幾輪完整訊息，更早的訊息累積一定輪數後併入摘要
+CONVERSATION_MEMORY_ENABLED = os.getenv('CONVERSATION_MEMORY_ENABLED', 'true').lower() == 'true'
+CONVERSATION_MEMORY_WINDOW_TURNS = max(int(os.getenv('CONVERSATION_MEMORY_WINDOW_TURNS', '6')), 1)
+CONVERSATION_MEMORY_BATCH_TURNS = max(int(os.getenv('CONVERSATION_MEMORY_BATCH_TURNS', '4')), 1)
+
+# 心智圖差異編碼：歷史訊息只送出相對前一輪的變更，差異超過完整心智圖的此比例時送出完整心智圖
+MAP_DELTA_ENABLED = os.getenv('MAP_DELTA_ENABLED', 'true').lower() == 'true'
+MAP_DELTA_MAX_RATIO = float(os.getenv('MAP_DELTA_MAX_RATIO', '0.5'))
+
+# POST 去重（chat、feedback）：相同請求執行中時等待其結果，完成的回應保留一段時間供重試直接回傳
+IDEMPOTENCY_ENABLED = os.getenv('IDEMPOTENCY_ENABLED', 'true').lower() == 'true'
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', '600'))
+# 重複的請求最多等待多久，逾時回傳 409
+IDEMPOTENCY_WAIT_SECONDS = int(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '120'))
+# 執行中的紀錄超過此時間視為中斷（worker 異常結束），之後的請求可重新執行
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', '600'))
+
+# 同一個 thread 已有請求在處理時：queue 等待（最多 THREAD_LOCK_TIMEOUT_SECONDS），reject 直接回傳 409
+# （THREAD_LOCK_ENABLED 定義於 Database connection budget）
+THREAD_LOCK_POLICY = os.getenv('THREAD_LOCK_POLICY', 'queue').lower()
+THREAD_LOCK_TIMEOUT_SECONDS = float(os.getenv('THREAD_LOCK_TIMEOUT_SECONDS', '60'))
+THREAD_LOCK_BACKEND = os.getenv(
+    'THREAD_LOCK_BACKEND', 'apps.chatbot.langgraph.thread_lock.PostgresAdvisoryLockBackend'
+)
+
+# 非同步評分工作：[scoring] 請求建立工作後立即回傳 202，由評分 worker 執行後寫回對話
+# （SCORING_JOBS_ENABLED 定義於 Database connection budget）
+# worker process 同時執行的評分數（不超過連線池大小）
+SCORING_WORKER_THREADS = max(
+    1, min(int(os.getenv('SCORING_WORKER_THREADS', '4')), DJANGO_DB_POOL_MAX_SIZE)
+)
+# 執行中的工作超過此秒數未完成視為 worker 中斷，由其他 worker 重新領取
+SCORING_JOB_LEASE_SECONDS = int(os.getenv('SCORING_JOB_LEASE_SECONDS', '300'))
+# 失敗時的嘗試次數上限與重試間隔（秒，依嘗試次數遞增）
+SCORING_JOB_MAX_ATTEMPTS = int(os.getenv('SCORING_JOB_MAX_ATTEMPTS', '3'))
+SCORING_JOB_RETRY_DELAY_SECONDS = float(os.getenv('SCORING_JOB_RETRY_DELAY_SECONDS', '5'))
+# 訂閱工作狀態（SSE）時查詢資料庫的間隔與單次連線的最長時間（低於 cloudflared 的 100 秒逾時）
+SCORING_JOB_POLL_SECONDS = float(os.getenv('SCORING_JOB_POLL_SECONDS', '1'))
+SCORING_JOB_SUBSCRIBE_SECONDS = int(os.getenv('SCORING_JOB_SUBSCRIBE_SECONDS', '90'))
+
+
+# Langfuse tracing：span 放入背景佇列批次送出，依 route 取樣，無法連線時不記錄
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'true').lower() == 'true'
+# 每個 route 記錄的比例（0~1），未列出的 route 使用 TRACING_DEFAULT_SAMPLE_RATE
+TRACING_SAMPLE_RATES = {
+    'cer_scoring': 1.0,
+    'essay_scoring': 1.0,
+    'mindmap_chat': float(os.getenv('TRACING_CHAT_SAMPLE_RATE', '0.25')),
+    'essay_chat': float(os.getenv('TRACING_CHAT_SAMPLE_RATE', '0.25')),
+    'feedback': float(os.getenv('TRACING_FEEDBACK_SAMPLE_RATE', '0.25')),
+}
+TRACING_DEFAULT_SAMPLE_RATE = float(os.getenv('TRACING_DEFAULT_SAMPLE_RATE', '1.0'))
+# 背景佇列上限（超過時丟棄 span）、批次大小與送出間隔（秒）
+TRACING_MAX_QUEUE_SIZE = int(os.getenv('TRACING_MAX_QUEUE_SIZE', '2048'))
+TRACING_FLUSH_AT = int(os.getenv('TRACING_FLUSH_AT', '256'))
+TRACING_FLUSH_INTERVAL = float(os.getenv('TRACING_FLUSH_INTERVAL', '5'))
+TRACING_EXPORT_TIMEOUT = int(os.getenv('TRACING_EXPORT_TIMEOUT', '10'))
+# 背景檢查 Langfuse 連線狀態的間隔（秒）
+TRACING_HEALTH_CHECK_SECONDS = int(os.getenv('TRACING_HEALTH_CHECK_SECONDS', '60'))
+
+
+# Worker warm-up：worker 啟動後在背景建立 LangGraph 服務（連線池、graph、Gemini client），
+# 完成前 readiness probe 回報 not-ready
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'true').lower() == 'true'
+# 依序建立的服務（回傳單例的函式）
+WARMUP_STEPS = [
+    'apps.chatbot.langgraph.mindmap.service.get_langgraph_service',
+    'apps.chatbot.langgraph.essay.service.get_essay_langgraph_service',
+    'apps.feedback.langgraph.service.get_feedback_service',
+]
+# 建立 checkpointer 時是否執行 checkpoint 資料表的 migration（setup）
+# 正式環境於部署時以 manage.py setup_checkpointer 執行一次（entrypoint.sh），各 worker 不再執行
+CHECKPOINT_SETUP_ON_START = os.getenv('CHECKPOINT_SETUP_ON_START', 'true').lower() == 'true'
+
+
+# LangGraph checkpoint 差異儲存：append-only 的 channel 只寫入新增的訊息（見 delta_saver）
+# 關閉時仍可讀取已寫入的差異
+CHECKPOINT_DELTA_ENABLED = os.getenv('CHECKPOINT_DELTA_ENABLED', 'true').lower() == 'true'
+CHECKPOINT_DELTA_CHANNELS = ['messages']
+# 差異累積超過此訊息數時寫入新的完整列表
+CHECKPOINT_DELTA_CONSOLIDATE_MESSAGES = int(
+    os.getenv('CHECKPOINT_DELTA_CONSOLIDATE_MESSAGES', '20')
+)
+
+# 最近使用的 thread state 快取（per process），讀取前以 checkpoint id 確認未被其他 worker 更新
+THREAD_STATE_CACHE_ENABLED = os.getenv('THREAD_STATE_CACHE_ENABLED', 'true').lower() == 'true'
+THREAD_STATE_CACHE_MAX_THREADS = int(os.getenv('THREAD_STATE_CACHE_MAX_THREADS', '256'))
+# 所有快取的 state 合計的訊息數上限（限制記憶體用量）
+THREAD_STATE_CACHE_MAX_MESSAGES = int(os.getenv('THREAD_STATE_CACHE_MAX_MESSAGES', '20000'))
+
+# LangGraph checkpoint 保留（manage.py prune_checkpoints）
+# 每個 thread 除最新的 checkpoint 外，再保留的歷史 checkpoint 數
+CHECKPOINT_RETENTION_KEEP = int(os.getenv('CHECKPOINT_RETENTION_KEEP', '2'))
+# 每輪對話完成後即清理該 thread 較舊的 checkpoint（預設只由排程執行的指令清理）
+CHECKPOINT_PRUNE_ON_TURN = os.getenv('CHECKPOINT_PRUNE_ON_TURN', 'false').lower() == 'true'
+# template 結束（end_date）超過此天數的 thread 封存：刪除 checkpoint，只保留對話歷史投影
+CHECKPOINT_ARCHIVE_AFTER_DAYS = int(os.getenv('CHECKPOINT_ARCHIVE_AFTER_DAYS', '14'))
+
+
 # Profiling
 ENABLE_PROFILING = os.getenv('ENABLE_PROFILING', 'false').lower() == 'true'
 
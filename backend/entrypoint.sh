@@ -6,16 +6,33 @@ if [ ! -d "logs" ]; then
     chmod -R 777 logs
 fi
 
-# migrate
+# 指定指令時直接執行（例如評分 worker；migrate 與 collectstatic 由 backend 容器執行）
+if [ "$#" -gt 0 ]; then
+    exec "$@"
+fi
+
+# migrate（同時執行資料庫連線預算檢查）
 python manage.py migrate --noinput
 
+# LangGraph checkpoint 資料表（部署時執行一次，worker 啟動時不再執行）
+python manage.py setup_checkpointer
+export CHECKPOINT_SETUP_ON_START=false
+
 # collectstatic
 python manage.py collectstatic --noinput
 
 # run
-gunicorn --access-logfile - \
-    --workers 12 \
-    --threads 10 \
-    --bind 0.0.0.0:8000 \
-    --worker-class gthread \
-    config.wsgi:application
+if [ "${SERVER_MODE:-wsgi}" = "asgi" ]; then
+    uvicorn config.asgi:application \
+        --workers ${WEB_WORKERS:-4} \
+        --host 0.0.0.0 \
+        --port 8000
+else
+    gunicorn --config config/gunicorn.conf.py \
+        --access-logfile - \
+        --workers ${WEB_WORKERS:-12} \
+        --threads ${WEB_THREADS:-10} \
+        --bind 0.0.0.0:8000 \
+        --worker-class gthread \
+        config.wsgi:application
+fi